@@ -18,6 +18,7 @@ class Client(c.Module):
             key : str = None,
             save_history: bool = True,
             history_path : str = 'history',
+            unix_socket: bool = True,
             loop: 'asyncio.EventLoop' = None, 
             debug: bool = False,
             serializer= 'serializer',
@@ -26,6 +27,7 @@ class Client(c.Module):
             **kwargs
         ):
         self.loop = c.get_event_loop() if loop == None else loop
+        self.unix_socket = unix_socket
 
         self.set_client(address = address, network=network)
         self.serializer = c.module(serializer)()
@@ -147,6 +149,21 @@ class Client(c.Module):
         return result
 
 
+    async def send_socket_request(self, path:str, fn:str, request: dict, timeout:int=10, verbose=False):
+        c.print(f"🔌 Call {path}/{fn} 🔌  (🔑{self.key.ss58_address})", color='green', verbose=verbose)
+        result = await c.module('socket').async_call(path, {'fn': fn, 'input': request}, timeout=timeout)
+        if isinstance(result, list):
+            # the items of a stream
+            return [self.process_socket_result(item) for item in result]
+        return self.process_socket_result(result)
+
+    def process_socket_result(self, result):
+        if type(result) in [str, dict]:
+            result = self.serializer.deserialize(result)
+        if isinstance(result, dict) and 'data' in result:
+            result = result['data']
+        return result
+
     def process_output(self, result):
         ## handles 
         if isinstance(result, str):
@@ -193,7 +210,17 @@ class Client(c.Module):
         kwargs =kwargs or {}
         kwargs.update(extra_kwargs)
         request = self.prepare_request(args=args, kwargs=kwargs, params=params, message_type=message_type)
-        result = await self.send_request(url=url, request=request, headers=headers, timeout=timeout, verbose=verbose)
+        socket_path = self.socket_path if address in [None, self.address] else None
+        if socket_path != None:
+            try:
+                result = await self.send_socket_request(socket_path, fn=fn or self.default_fn, request=request, timeout=timeout, verbose=verbose)
+            except (ConnectionError, FileNotFoundError, asyncio.IncompleteReadError) as e:
+                # the server stopped serving the socket (or closed it mid response), so use http from now on
+                c.print(f'Socket {socket_path} failed ({e}), using http', color='yellow', verbose=verbose)
+                self.socket_path = None
+                result = await self.send_request(url=url, request=request, headers=headers, timeout=timeout, verbose=verbose)
+        else:
+            result = await self.send_request(url=url, request=request, headers=headers, timeout=timeout, verbose=verbose)
         if self.save_history:
             input = self.serializer.deserialize(request)
             path =  self.history_path+ '/' + self.key.ss58_address + '/' + self.address+ '/'+  str(input['timestamp'])
@@ -233,7 +260,9 @@ class Client(c.Module):
             address = address.split('://')[-1]
         address = address.replace(c.ip(), '0.0.0.0')
         self.address = address
-        return {'address': self.address}
+        # servers on this host are called over their unix socket when they serve one
+        self.socket_path = c.module('namespace').get_socket(address) if self.unix_socket else None
+        return {'address': self.address, 'socket_path': self.socket_path}
 
     @classmethod
     def history(cls, key=None, history_path='history'):
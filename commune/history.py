@@ -1,51 +1,499 @@
 import commune as c
 import os
+import json
+import bisect
+import fcntl
+import atexit
+import threading
+import numpy as np
+from typing import *
 
 class History(c.Module):
-    def __init__(self, folder_path='history'):
-        self.folder_path = self.resolve_path(folder_path)
+    """
+    An append-only store of timestamped items.
+
+    The items are json lines in segment files that each cover one period (an hour by default),
+    named {start}-{seconds}.jsonl, each next to an index of (timestamp, offset, length) records.
+    The segments are sorted by start and do not overlap, so a time range is found by bisecting
+    the segments and then the index of each segment, and the last n items are read from the end
+    of the newest segments, without listing or opening a file per item.
+    A batch of items is one locked write per segment.
+    """
+    index_dtype = np.dtype([('timestamp', '<f8'), ('offset', '<i8'), ('length', '<u4')])
+    segment_ext = '.jsonl'
+    index_ext = '.idx'
+
+    def __init__(self,
+                 folder_path:str = 'history',
+                 partition:int = 3600,
+                 batch_size:int = 1,
+                 flush_interval:float = 1.0,
+                 max_age:float = None,
+                 max_bytes:int = None):
+        """
+        partition: the seconds covered by a new segment
+        batch_size: the items buffered by add before they are written (at most flush_interval seconds)
+        max_age, max_bytes: segments that are older, or beyond the total size, are removed when a segment is started
+        """
+        self.partition = partition
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()
+        self.buffer = []
+        self.last_flush = c.time()
+        self.index_cache = {}
+        os.makedirs(self.resolve_path(folder_path), exist_ok=True)
+        self.set_folder_path(folder_path)
+        if batch_size > 1:
+            atexit.register(self.flush)
 
     def set_folder_path(self, path):
         self.folder_path = self.resolve_path(path) # set the folder path to the resolved path
         assert os.path.isdir(self.folder_path), f"History path {self.folder_path} does not exist" # check if the path exists
-        c.print(f"History path: {self.folder_path}", color='green') # print the path
-        
+        self.segments = [] # the sorted (start, seconds) of the segments
+        self.segments_mtime = None
+        self.refresh_segments()
+
+    """
+    ################ SEGMENTS ############################
+    """
+
+    def segment_name(self, segment:Tuple[float, float]) -> str:
+        return f'{int(segment[0])}-{int(segment[1])}'
+
+    def segment_path(self, segment:Tuple[float, float], ext:str = segment_ext) -> str:
+        return f'{self.folder_path}/{self.segment_name(segment)}{ext}'
+
+    def get_file_timestamp(self, file) -> int:
+        """
+        The start of the segment file (or the timestamp of a legacy item file).
+        """
+        return int(file.split('/')[-1].split('.')[0].split('-')[0])
+
+    def refresh_segments(self) -> List[Tuple[float, float]]:
+        """
+        Lists the segments again only when the folder changed (a segment was created or removed).
+        """
+        mtime = os.stat(self.folder_path).st_mtime_ns
+        if mtime == self.segments_mtime:
+            return self.segments
+        segments = []
+        legacy = []
+        for entry in os.scandir(self.folder_path):
+            name = entry.name
+            if name.endswith(self.segment_ext):
+                start, seconds = name[:-len(self.segment_ext)].split('-')
+                segments.append((int(start), int(seconds)))
+            elif self.is_legacy(name):
+                legacy.append(entry.path)
+            elif entry.is_dir():
+                # the old layout also kept items in a folder per address, history/<server>/<address>/<timestamp>.json
+                for root, dirs, files in os.walk(entry.path):
+                    legacy += [os.path.join(root, f) for f in files if self.is_legacy(f)]
+        self.segments = sorted(segments)
+        self.segments_mtime = mtime
+        if len(legacy) > 0:
+            self.migrate(legacy)
+        return self.segments
+
+    def is_legacy(self, name:str) -> bool:
+        # an item file is named by its timestamp, with .json when it was put with a relative path
+        if name.endswith('.json'):
+            name = name[:-len('.json')]
+        return name.replace('.', '', 1).isdigit()
+
+    def segment_for(self, timestamp:float) -> Tuple[float, float]:
+        """
+        The segment an item with the timestamp is appended to: the one that covers it, or a new one.
+        """
+        i = bisect.bisect_right(self.segments, (timestamp, float('inf'))) - 1
+        if i >= 0 and self.segments[i][0] + self.segments[i][1] > timestamp:
+            return self.segments[i]
+        start = int(timestamp // self.partition * self.partition)
+        if i >= 0:
+            start = max(start, self.segments[i][0] + self.segments[i][1])
+        seconds = self.partition
+        if i + 1 < len(self.segments):
+            # a new segment ends where a later (compacted) one starts, so segments never overlap
+            seconds = min(seconds, self.segments[i + 1][0] - start)
+        return (start, seconds)
+
+    def overlapping_segments(self, start:float = None, end:float = None) -> List[Tuple[float, float]]:
+        segments = self.segments
+        lo = 0
+        if start != None:
+            ends = [s + n for s, n in segments]
+            lo = bisect.bisect_right(ends, start)
+        hi = len(segments) if end == None else bisect.bisect_left(segments, (end,))
+        return segments[lo:hi]
+
+    """
+    ################ WRITE ############################
+    """
+
     def add(self, item:dict, path=None):
+        """
+        Appends the item (at its timestamp, set to now if missing).
+        """
         if 'timestamp' not in item:
             item['timestamp'] = c.timestamp()
-        path = path or (self.folder_path + '/' + str(item['timestamp']))
-        return self.put(path, item)
-    
+        with self.lock:
+            self.buffer.append(item)
+            if len(self.buffer) >= self.batch_size or c.time() - self.last_flush > self.flush_interval:
+                self.flush()
+        return {'success': True, 'msg': 'added item', 'timestamp': item['timestamp']}
+
+    def flush(self) -> int:
+        with self.lock:
+            items, self.buffer = self.buffer, []
+            self.last_flush = c.time()
+            if len(items) > 0:
+                self.add_many(items)
+        return len(items)
+
+    def add_many(self, items:List[dict]) -> dict:
+        """
+        Appends the items with one write of the data and one of the index per segment.
+        """
+        with self.lock:
+            self.refresh_segments()
+            groups = {}
+            for item in items:
+                if 'timestamp' not in item:
+                    item['timestamp'] = c.timestamp()
+                groups.setdefault(self.segment_for(item['timestamp']), []).append(item)
+            new_segment = False
+            for segment, group in groups.items():
+                lines = [(json.dumps(item, default=str) + '\n').encode() for item in group]
+                index = np.zeros(len(lines), dtype=self.index_dtype)
+                index['timestamp'] = [item['timestamp'] for item in group]
+                index['length'] = [len(line) for line in lines]
+                with open(self.segment_path(segment), 'ab') as f:
+                    # other processes appending to the segment wait, so the offsets are right
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                    try:
+                        offset = f.seek(0, 2)
+                        index['offset'] = offset + np.cumsum(index['length']) - index['length']
+                        f.write(b''.join(lines))
+                        f.flush()
+                        # the index is written after the data, so it never points past it
+                        with open(self.segment_path(segment, self.index_ext), 'ab') as index_file:
+                            index_file.write(index.tobytes())
+                    finally:
+                        fcntl.flock(f, fcntl.LOCK_UN)
+                if segment not in self.segments:
+                    bisect.insort(self.segments, segment)
+                    new_segment = True
+            if new_segment:
+                self.segments_mtime = os.stat(self.folder_path).st_mtime_ns
+                if self.max_age != None or self.max_bytes != None:
+                    self.prune(max_age=self.max_age, max_bytes=self.max_bytes)
+        return {'success': True, 'msg': f'added {len(items)} items', 'segments': len(groups)}
+
+    """
+    ################ READ ############################
+    """
+
+    def load_index(self, segment:Tuple[float, float]) -> np.ndarray:
+        """
+        The index of the segment sorted by timestamp, reading only the records added since the last load.
+        """
+        path = self.segment_path(segment, self.index_ext)
+        size, index = self.index_cache.get(path, (0, np.zeros(0, dtype=self.index_dtype)))
+        new_size = os.path.getsize(path)
+        new_size -= new_size % self.index_dtype.itemsize # a record that is being written
+        if new_size < size:
+            size, index = 0, np.zeros(0, dtype=self.index_dtype)
+        if new_size > size:
+            with open(path, 'rb') as f:
+                f.seek(size)
+                new = np.frombuffer(f.read(new_size - size), dtype=self.index_dtype)
+            index = np.concatenate([index, new])
+            if len(index) > len(new) and new['timestamp'][0] < index['timestamp'][-len(new) - 1] or np.any(np.diff(new['timestamp']) < 0):
+                # items added with older timestamps than the ones before them
+                index = index[np.argsort(index['timestamp'], kind='stable')]
+            self.index_cache[path] = (new_size, index)
+        return index
+
+    def read_items(self, segment:Tuple[float, float], index:np.ndarray, search:str = None) -> List[dict]:
+        if len(index) == 0:
+            return []
+        start = int(index['offset'].min())
+        end = int((index['offset'] + index['length']).max())
+        with open(self.segment_path(segment), 'rb') as f:
+            data = os.pread(f.fileno(), end - start, start)
+        items = []
+        search = search.encode() if search != None else None
+        for offset, length in zip(index['offset'].tolist(), index['length'].tolist()):
+            line = data[offset - start: offset - start + length]
+            if search == None or search in line:
+                items.append(json.loads(line))
+        return items
+
+    def range(self,
+              start:float = None,
+              end:float = None,
+              n:int = None,
+              reverse:bool = False,
+              search:str = None) -> List[dict]:
+        """
+        The items with start <= timestamp < end, oldest first (newest first if reverse), at most n.
+        search keeps the items whose json contains it.
+        """
+        with self.lock:
+            self.flush()
+            self.refresh_segments()
+            segments = self.overlapping_segments(start, end)
+            items = []
+            for segment in (reversed(segments) if reverse else segments):
+                index = self.load_index(segment)
+                ts = index['timestamp']
+                lo = 0 if start == None else int(np.searchsorted(ts, start, side='left'))
+                hi = len(ts) if end == None else int(np.searchsorted(ts, end, side='left'))
+                index = index[lo:hi]
+                if reverse:
+                    index = index[::-1]
+                if search == None:
+                    if n != None:
+                        index = index[:n - len(items)]
+                    items += self.read_items(segment, index)
+                else:
+                    # the matches are not known before reading, so read in blocks until there are n
+                    block = 1024
+                    for i in range(0, len(index), block):
+                        items += self.read_items(segment, index[i:i + block], search=search)
+                        if n != None and len(items) >= n:
+                            break
+                if n != None and len(items) >= n:
+                    break
+            return items[:n] if n != None else items
+
+    def count(self, start:float = None, end:float = None) -> int:
+        with self.lock:
+            self.flush()
+            self.refresh_segments()
+            count = 0
+            for segment in self.overlapping_segments(start, end):
+                ts = self.load_index(segment)['timestamp']
+                lo = 0 if start == None else np.searchsorted(ts, start, side='left')
+                hi = len(ts) if end == None else np.searchsorted(ts, end, side='left')
+                count += int(hi - lo)
+            return count
+
     def paths(self, key=None, max_age=None):
-        files = []
-        current_timestamp = c.timestamp()
-        for file in c.ls(self.folder_path):
-            timestamp = self.get_file_timestamp(file)
-            if max_age and current_timestamp - timestamp > max_age:
-                continue
-            files.append(file)
-        return files
-    
-    def get_file_timestamp(self, file):
-        return int(file.split('/')[-1].split('.')[0])
+        """
+        The segment files, with the ones that ended more than max_age seconds ago left out.
+        """
+        self.refresh_segments()
+        start = c.timestamp() - max_age if max_age else None
+        return [self.segment_path(s) for s in self.overlapping_segments(start)]
 
     def history_paths(self, search=None, n=1000, reverse=False):
-        paths =  self.ls(self.folder_path)
+        paths = [self.segment_path(s) for s in self.refresh_segments()]
         sorted_paths = sorted(paths, reverse=reverse)
         if search:
-            sorted_paths = [p for p in sorted_paths if search in p] 
+            sorted_paths = [p for p in sorted_paths if search in p]
         return sorted_paths[:n]
-    
-    def history(self, search=None, n=100, reverse=True, idx=None):
-        history_paths = self.history_paths(n=n, reverse=reverse, search=search)
-        history = [c.get(s) for s in history_paths]
+
+    def history(self, search=None, n=100, reverse=True, idx=None, max_age=None):
+        start = c.timestamp() - max_age if max_age else None
+        history = self.range(start=start, n=n, reverse=reverse, search=search)
         if idx:
             return history[idx]
         return history
-    
+
     def last_n(self, n=1):
         return self.history(n=n)
-    
 
+    """
+    ################ RETENTION ############################
+    """
+
+    def rm_segment(self, segment:Tuple[float, float]):
+        for ext in [self.segment_ext, self.index_ext]:
+            path = self.segment_path(segment, ext)
+            self.index_cache.pop(path, None)
+            if os.path.exists(path):
+                os.remove(path)
+        if segment in self.segments:
+            self.segments.remove(segment)
+
+    def prune(self, max_age:float = None, max_bytes:int = None) -> dict:
+        """
+        Removes the segments that ended more than max_age seconds ago, then the oldest segments
+        until the rest take at most max_bytes.
+        """
+        with self.lock:
+            self.refresh_segments()
+            removed = []
+            if max_age != None:
+                cutoff = c.timestamp() - max_age
+                removed += [s for s in self.segments if s[0] + s[1] <= cutoff]
+            if max_bytes != None:
+                sizes = [os.path.getsize(self.segment_path(s)) + os.path.getsize(self.segment_path(s, self.index_ext)) for s in self.segments]
+                total = sum(sizes)
+                for segment, size in zip(self.segments, sizes):
+                    # the newest segment is kept, it is being written
+                    if total <= max_bytes or segment == self.segments[-1]:
+                        break
+                    removed.append(segment)
+                    total -= size
+            removed = sorted(set(removed))
+            for segment in removed:
+                self.rm_segment(segment)
+        return {'success': True, 'msg': f'removed {len(removed)} segments', 'removed': [self.segment_name(s) for s in removed]}
+
+    def compact(self, seconds:int = 86400, older_than:float = None) -> dict:
+        """
+        Merges the segments of each finished period of seconds (a day by default) that ended more
+        than older_than seconds ago into one segment, with the items sorted by timestamp.
+        """
+        older_than = seconds if older_than == None else older_than
+        with self.lock:
+            self.flush()
+            self.refresh_segments()
+            cutoff = c.timestamp() - older_than
+            groups = {}
+            for segment in self.segments:
+                bucket = segment[0] // seconds * seconds
+                if segment[0] + segment[1] <= bucket + seconds and bucket + seconds <= cutoff:
+                    groups.setdefault(bucket, []).append(segment)
+            compacted = []
+            for bucket, segments in groups.items():
+                if len(segments) == 1 and segments[0][1] == seconds:
+                    continue
+                items = []
+                for segment in segments:
+                    index = self.load_index(segment)
+                    items += list(zip(index['timestamp'].tolist(), self.read_items(segment, index)))
+                items.sort(key=lambda x: x[0])
+                target = (bucket, seconds)
+                lines = [(json.dumps(item, default=str) + '\n').encode() for _, item in items]
+                index = np.zeros(len(lines), dtype=self.index_dtype)
+                index['timestamp'] = [t for t, _ in items]
+                index['length'] = [len(line) for line in lines]
+                index['offset'] = np.cumsum(index['length']) - index['length']
+                # the merged segment replaces the others atomically
+                for ext, data in [(self.segment_ext, b''.join(lines)), (self.index_ext, index.tobytes())]:
+                    tmp_path = self.segment_path(target, ext) + '.tmp'
+                    with open(tmp_path, 'wb') as f:
+                        f.write(data)
+                    os.replace(tmp_path, self.segment_path(target, ext))
+                for segment in segments:
+                    if segment != target:
+                        self.rm_segment(segment)
+                self.index_cache.pop(self.segment_path(target, self.index_ext), None)
+                if target not in self.segments:
+                    bisect.insort(self.segments, target)
+                compacted.append(self.segment_name(target))
+            self.segments_mtime = None
+        return {'success': True, 'msg': f'compacted {len(compacted)} periods', 'compacted': compacted}
+
+    def migrate(self, paths:List[str]) -> dict:
+        """
+        Moves the items of the old one file per item layout into segments.
+        """
+        items = []
+        for path in paths:
+            try:
+                with open(path) as f:
+                    item = json.load(f)
+                if isinstance(item, dict) and 'data' in item and 'encrypted' in item:
+                    # the wrapper c.put writes around the item
+                    item = item['data']
+                items.append(item)
+            except Exception as e:
+                c.print(f'could not migrate {path}: {e}', color='red')
+        items = [item for item in items if isinstance(item, dict)]
+        for item in items:
+            item.setdefault('timestamp', c.timestamp())
+        self.add_many(items)
+        for path in paths:
+            os.remove(path)
+        for path in paths:
+            # the address folders of the old layout go once they are empty
+            directory = os.path.dirname(path)
+            while directory != self.folder_path and directory.startswith(self.folder_path) and os.path.isdir(directory) and len(os.listdir(directory)) == 0:
+                os.rmdir(directory)
+                directory = os.path.dirname(directory)
+        c.print(f'migrated {len(items)} items to segments in {self.folder_path}', color='green')
+        return {'success': True, 'msg': f'migrated {len(items)} items'}
+
+    """
+    ################ TESTS ############################
+    """
+
+    @classmethod
+    def test(cls, path:str = 'test_history'):
+        cls.rm(path)
+        self = cls(path, partition=100)
+        t0 = 1_000_000
+        items = [{'timestamp': t0 + i, 'i': i, 'fn': 'even' if i % 2 == 0 else 'odd'} for i in range(1000)]
+        self.add_many(items[:500])
+        for item in items[500:]:
+            self.add(item)
+        assert len(self.segments) == 10, self.segments
+        assert [x['i'] for x in self.last_n(3)] == [999, 998, 997]
+        assert [x['i'] for x in self.range(t0 + 150, t0 + 250)] == list(range(150, 250))
+        assert [x['i'] for x in self.range(t0 + 150, t0 + 250, n=5, reverse=True)] == [249, 248, 247, 246, 245]
+        assert [x['i'] for x in self.range(search='"odd"', n=3)] == [1, 3, 5]
+        assert self.count(t0 + 10, t0 + 990) == 980
+        # an item older than the ones before it
+        self.add({'timestamp': t0 + 150.5, 'i': -1})
+        assert [x['i'] for x in self.range(t0 + 150, t0 + 152)] == [150, -1, 151]
+        # another store on the same folder sees the items
+        assert cls(path).count() == 1001
+        self.compact(seconds=500, older_than=0)
+        assert self.segments == [(t0, 500), (t0 + 500, 500)], self.segments
+        assert [x['i'] for x in self.range(t0 + 150, t0 + 152)] == [150, -1, 151]
+        assert self.count() == 1001
+        self.add({'timestamp': t0 + 2000, 'i': 2000})
+        self.prune(max_age=c.timestamp() - t0 - 1500)
+        assert self.count() == 1 and self.last_n(1)[0]['i'] == 2000
+        # the items of the old layout are moved into segments
+        c.put(self.folder_path + '/123.json', {'timestamp': 123, 'i': 123})
+        assert os.path.exists(self.folder_path + '/123.json')
+        assert cls(path).range(end=124)[0]['i'] == 123
+        assert not os.path.exists(self.folder_path + '/123.json')
+        # and so are those of the folder per address layout, at any depth, which the server put with
+        # an absolute path and so without .json
+        c.put(self.folder_path + '/5GrwvaEF/0.0.0.0:8000/124.25', {'timestamp': 124.25, 'i': 124})
+        c.put(self.folder_path + '/5GrwvaEF/0.0.0.0:8001/125.json', {'timestamp': 125, 'i': 125})
+        c.put(self.folder_path + '/0.0.0.0:8000/126', {'timestamp': 126, 'i': 126})
+        assert os.path.exists(self.folder_path + '/0.0.0.0:8000/126')
+        store = cls(path)
+        assert [x['i'] for x in store.range(end=127)] == [123, 124, 125, 126]
+        assert not os.path.exists(self.folder_path + '/5GrwvaEF') and not os.path.exists(self.folder_path + '/0.0.0.0:8000')
+        cls.rm(path)
+        return {'success': True, 'msg': 'history test passed'}
 
-    
+    @classmethod
+    def test_benchmark(cls, path:str = 'test_history_benchmark', n:int = 10_000_000, batch_size:int = 10_000, span:float = 30 * 86400):
+        """
+        Writes n items over span seconds in batches, then times range queries and last_n.
+        """
+        cls.rm(path)
+        self = cls(path)
+        t0 = c.timestamp() - span
+        step = span / n
+        stats = {'n': n}
+        t = c.time()
+        for i in range(0, n, batch_size):
+            self.add_many([{'timestamp': t0 + j * step, 'fn': 'forward', 'latency': 0.01, 'i': j} for j in range(i, min(i + batch_size, n))])
+        stats['write_per_second'] = n / (c.time() - t)
+        self = cls(path)
+        t = c.time()
+        last = self.last_n(100)
+        stats['last_100_seconds'] = c.time() - t
+        assert last[0]['i'] == n - 1
+        t = c.time()
+        hour = self.range(start=t0 + span / 2, end=t0 + span / 2 + 3600)
+        stats['range_hour_seconds'] = c.time() - t
+        stats['range_hour_items'] = len(hour)
+        t = c.time()
+        stats['count'] = self.count()
+        stats['count_seconds'] = c.time() - t
+        cls.rm(path)
+        return stats
@@ -1,5 +1,9 @@
+import os
+import io
+import hmac
 import base64
 import hashlib
+import struct
 from Crypto import Random
 from Crypto.Cipher import AES
 from copy import deepcopy
@@ -7,25 +11,297 @@ import json
 import sys
 import inspect
 import time
+from typing import *
+import numpy as np
 import commune as c
 class AESKey(c.Module):
+    """
+    Encrypts with AES-256-GCM in authenticated chunks, so that data of any size is encrypted and
+    decrypted in constant memory.
 
-    def __init__(self, key:str = 'dummy' ): 
+    A stream is a header (magic, version, kind, chunk size, a random salt and the metadata needed to
+    rebuild the value, e.g. the dtype and shape of an array) followed by records of
+    [4 byte length][ciphertext][16 byte tag]. Every stream gets its own key from the salt, chunk i
+    uses the nonce (i, last) and every chunk authenticates the header, so chunks can not be
+    reordered, truncated, dropped or moved between streams.
+
+    bytes, arrays and tensors are encrypted from their buffers without conversion, other values go
+    through python2str as before. decrypt still reads the old AES-CBC strings.
+    """
+    magic = b'CAES'
+    version = 1
+    tag_size = 16
+    salt_size = 16
+    chunk_size = 2**20
+
+    def __init__(self, key:str = 'dummy', chunk_size:int = 2**20):
         self.bs = AES.block_size
         self.key_phrase = hashlib.sha256(key.encode()).digest()
+        self.chunk_size = chunk_size
 
-    def encrypt(self, data, return_string = True):
-        data = self.python2str(data)
-        data = self._pad(data)
-        iv = Random.new().read(AES.block_size)
-        cipher = AES.new(self.key_phrase, AES.MODE_CBC, iv)
-        encrypted_bytes = base64.b64encode(iv + cipher.encrypt(data.encode()))
-        encrypted_data =  encrypted_bytes.decode() if return_string else encrypted_bytes
+    """
+    ################ STREAMING ############################
+    """
+
+    @staticmethod
+    def is_raw(data) -> bool:
+        return isinstance(data, (bytes, bytearray, memoryview, np.ndarray)) or 'torch.Tensor' in str(type(data))
+
+    def to_buffer(self, data) -> Tuple[str, dict, memoryview]:
+        """
+        The kind of the value, the metadata to rebuild it and its bytes, without copying raw buffers.
+        """
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            return 'bytes', {}, memoryview(data).cast('B')
+        if 'torch.Tensor' in str(type(data)):
+            array = data.detach().cpu().numpy()
+            return 'tensor', {'dtype': array.dtype.str, 'shape': list(array.shape)}, memoryview(np.ascontiguousarray(array)).cast('B')
+        if isinstance(data, np.ndarray):
+            assert data.dtype != object, 'object arrays can not be encrypted as raw buffers'
+            return 'ndarray', {'dtype': data.dtype.str, 'shape': list(data.shape)}, memoryview(np.ascontiguousarray(data)).cast('B')
+        if isinstance(data, str):
+            return 'str', {}, memoryview(data.encode('utf-8'))
+        return 'python', {}, memoryview(self.python2str(data).encode('utf-8'))
+
+    def from_buffer(self, kind:str, meta:dict, buffer:Union[bytes, bytearray]) -> Any:
+        if kind == 'bytes':
+            return bytes(buffer)
+        if kind in ['ndarray', 'tensor']:
+            array = np.frombuffer(buffer, dtype=np.dtype(meta['dtype'])).reshape(meta['shape'])
+            if kind == 'tensor':
+                import torch
+                return torch.from_numpy(array)
+            return array
+        text = bytes(buffer).decode('utf-8')
+        return text if kind == 'str' else self.str2python(text)
+
+    def header(self, kind:str = 'bytes', meta:dict = None, chunk_size:int = None, salt:bytes = None) -> bytes:
+        meta = json.dumps({'kind': kind, **(meta or {})}).encode()
+        salt = salt or Random.new().read(self.salt_size)
+        return self.magic + struct.pack('<BII', self.version, chunk_size or self.chunk_size, len(meta)) + salt + meta
+
+    def parse_header(self, read:Callable) -> Tuple[dict, bytes]:
+        """
+        The metadata (with kind and chunk_size) and the raw header, from a read(n) function.
+        """
+        prefix = bytes(read(len(self.magic) + 9 + self.salt_size))
+        assert prefix[:len(self.magic)] == self.magic, 'not an encrypted stream'
+        version, chunk_size, meta_size = struct.unpack('<BII', prefix[len(self.magic):len(self.magic) + 9])
+        assert version == self.version, f'unsupported stream version {version}'
+        meta_bytes = bytes(read(meta_size))
+        meta = json.loads(meta_bytes)
+        meta['chunk_size'] = chunk_size
+        meta['salt'] = prefix[-self.salt_size:]
+        return meta, prefix + meta_bytes
+
+    def stream_key(self, salt:bytes) -> bytes:
+        return hmac.new(self.key_phrase, b'stream' + salt, hashlib.sha256).digest()
+
+    @staticmethod
+    def nonce(i:int, last:bool) -> bytes:
+        return struct.pack('>QI', i, int(last))
+
+    def encrypt_chunk(self, key:bytes, header:bytes, i:int, last:bool, chunk:memoryview, output:memoryview = None) -> Tuple[bytes, bytes]:
+        cipher = AES.new(key, AES.MODE_GCM, nonce=self.nonce(i, last), mac_len=self.tag_size)
+        cipher.update(header)
+        ciphertext = cipher.encrypt(chunk, output=output)
+        return ciphertext, cipher.digest()
+
+    def decrypt_chunk(self, key:bytes, header:bytes, i:int, last:bool, chunk:memoryview, tag:bytes, output:memoryview = None) -> bytes:
+        cipher = AES.new(key, AES.MODE_GCM, nonce=self.nonce(i, last), mac_len=self.tag_size)
+        cipher.update(header)
+        plaintext = cipher.decrypt(chunk, output=output)
+        try:
+            cipher.verify(tag)
+        except ValueError:
+            raise ValueError(f'chunk {i} failed authentication (wrong key or tampered data)')
+        return plaintext
+
+    def encrypt_chunks(self, chunks:Iterable, kind:str = 'bytes', meta:dict = None, chunk_size:int = None) -> Iterator[bytes]:
+        """
+        Encrypts an iterable of byte strings of any sizes, and yields the header and then one record per
+        chunk_size bytes. Only about one chunk is held at a time.
+        """
+        chunk_size = chunk_size or self.chunk_size
+        header = self.header(kind=kind, meta=meta, chunk_size=chunk_size)
+        key = self.stream_key(header[len(self.magic) + 9:len(self.magic) + 9 + self.salt_size])
+        yield header
+        pending = bytearray()
+        i = 0
+        for piece in chunks:
+            pending += piece
+            start = 0
+            # one chunk is held back, since the last chunk is marked in its nonce
+            while len(pending) - start > chunk_size:
+                with memoryview(pending) as view:
+                    ciphertext, tag = self.encrypt_chunk(key, header, i, False, view[start:start + chunk_size])
+                yield struct.pack('<I', len(ciphertext)) + ciphertext + tag
+                start += chunk_size
+                i += 1
+            del pending[:start]
+        with memoryview(pending) as view:
+            ciphertext, tag = self.encrypt_chunk(key, header, i, True, view)
+        yield struct.pack('<I', len(ciphertext)) + ciphertext + tag
+
+    def decrypt_chunks(self, stream:Union[io.IOBase, Iterable[bytes]], meta:dict = None) -> Iterator[bytes]:
+        """
+        Decrypts a stream from a file object or an iterable of byte strings, and yields the plaintext
+        chunk by chunk. Every chunk is authenticated before it is yielded, and a stream that stops
+        before its last chunk raises. Pass a dict as meta to receive the header metadata.
+        """
+        read = stream.read if hasattr(stream, 'read') else self.reader(stream)
+        header_meta, header = self.parse_header(read)
+        if meta != None:
+            meta.update(header_meta)
+        key = self.stream_key(header_meta['salt'])
+        i = 0
+        record = read(4)
+        while True:
+            assert len(record) == 4, 'the stream was truncated'
+            size = struct.unpack('<I', record)[0]
+            body = read(size + self.tag_size)
+            assert len(body) == size + self.tag_size, 'the stream was truncated'
+            record = read(4)
+            last = len(record) == 0
+            view = memoryview(body)
+            yield self.decrypt_chunk(key, header, i, last, view[:size], view[size:])
+            if last:
+                return
+            i += 1
+
+    @staticmethod
+    def reader(chunks:Iterable[bytes]) -> Callable:
+        """
+        A read(n) function over an iterable of byte strings.
+        """
+        chunks = iter(chunks)
+        buffer = bytearray()
+        def read(n:int) -> bytes:
+            while len(buffer) < n:
+                piece = next(chunks, None)
+                if piece == None:
+                    break
+                buffer.extend(piece)
+            data = bytes(buffer[:n])
+            del buffer[:n]
+            return data
+        return read
+
+    def encrypt_bytes(self, data, chunk_size:int = None) -> bytearray:
+        """
+        Encrypts a value into one stream, writing the ciphertext straight into a preallocated buffer.
+        """
+        chunk_size = chunk_size or self.chunk_size
+        kind, meta, buffer = self.to_buffer(data)
+        header = self.header(kind=kind, meta=meta, chunk_size=chunk_size)
+        key = self.stream_key(header[len(self.magic) + 9:len(self.magic) + 9 + self.salt_size])
+        num_chunks = max(-(-len(buffer) // chunk_size), 1)
+        out = bytearray(len(header) + num_chunks * (4 + self.tag_size) + len(buffer))
+        view = memoryview(out)
+        view[:len(header)] = header
+        position = len(header)
+        for i in range(num_chunks):
+            chunk = buffer[i * chunk_size:(i + 1) * chunk_size]
+            struct.pack_into('<I', out, position, len(chunk))
+            position += 4
+            _, tag = self.encrypt_chunk(key, header, i, i == num_chunks - 1, chunk, output=view[position:position + len(chunk)])
+            position += len(chunk)
+            view[position:position + self.tag_size] = tag
+            position += self.tag_size
+        return out
 
-        return encrypted_data
+    def decrypt_bytes(self, data:Union[bytes, bytearray, memoryview]) -> Any:
+        """
+        Decrypts a stream held in memory into a preallocated buffer, and rebuilds the value.
+        """
+        view = memoryview(data).cast('B')
+        position = 0
+        def read(n):
+            nonlocal position
+            position += n
+            return view[position - n:position]
+        meta, header = self.parse_header(read)
+        header = bytes(header)
+        key = self.stream_key(meta['salt'])
+        # the plaintext is the stream without the header and the length and tag of every record
+        num_chunks = max(-(-(len(view) - len(header)) // (meta['chunk_size'] + 4 + self.tag_size)), 1)
+        out = bytearray(len(view) - len(header) - num_chunks * (4 + self.tag_size))
+        out_view = memoryview(out)
+        offset = 0
+        for i in range(num_chunks):
+            size = struct.unpack('<I', read(4))[0]
+            body = read(size + self.tag_size)
+            assert len(body) == size + self.tag_size, 'the stream was truncated'
+            self.decrypt_chunk(key, header, i, i == num_chunks - 1, body[:size], body[size:], output=out_view[offset:offset + size])
+            offset += size
+        assert position == len(view), 'unexpected data after the last chunk'
+        return self.from_buffer(meta['kind'], meta, out)
+
+    def encrypt_path(self, src:str, dst:str, chunk_size:int = None) -> dict:
+        """
+        Encrypts the file src into dst in constant memory (dst is replaced atomically).
+        """
+        chunk_size = chunk_size or self.chunk_size
+        with open(src, 'rb') as f:
+            chunks = iter(lambda: f.read(chunk_size), b'')
+            return self.write_stream(self.encrypt_chunks(chunks, chunk_size=chunk_size), dst)
+
+    def decrypt_path(self, src:str, dst:str) -> dict:
+        """
+        Decrypts the stream in src into the file dst in constant memory.
+        """
+        with open(src, 'rb') as f:
+            return self.write_stream(self.decrypt_chunks(f), dst)
+
+    @staticmethod
+    def write_stream(chunks:Iterable[bytes], path:str) -> dict:
+        tmp_path = path + '.tmp'
+        size = 0
+        with open(tmp_path, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                size += len(chunk)
+        os.replace(tmp_path, path)
+        return {'success': True, 'path': path, 'size': size}
+
+    def encrypt_to_path(self, data, path:str, chunk_size:int = None) -> dict:
+        """
+        Encrypts a value (or an iterable of byte strings) into the file path, chunk by chunk.
+        """
+        if self.is_raw(data) or isinstance(data, str) or not hasattr(data, '__iter__'):
+            kind, meta, buffer = self.to_buffer(data)
+            chunk_size = chunk_size or self.chunk_size
+            chunks = (buffer[i:i + chunk_size] for i in range(0, len(buffer), chunk_size))
+        else:
+            kind, meta, chunks = 'bytes', {}, data
+        return self.write_stream(self.encrypt_chunks(chunks, kind=kind, meta=meta, chunk_size=chunk_size), path)
+
+    def decrypt_from_path(self, path:str) -> Any:
+        """
+        Reads back a value written by encrypt_to_path.
+        """
+        with open(path, 'rb') as f:
+            return self.decrypt_bytes(f.read())
+
+    """
+    ################ VALUES ############################
+    """
+
+    def encrypt(self, data, return_string = True):
+        encrypted_bytes = self.encrypt_bytes(data)
+        if not return_string:
+            return encrypted_bytes
+        return base64.b64encode(encrypted_bytes).decode()
 
     def decrypt(self, enc):
-        enc = base64.b64decode(enc)
+        if isinstance(enc, str):
+            enc = base64.b64decode(enc)
+        if bytes(enc[:len(self.magic)]) == self.magic:
+            return self.decrypt_bytes(enc)
+        return self.decrypt_cbc(enc)
+
+    def decrypt_cbc(self, enc:bytes):
+        """ Decrypts the strings of the previous AES-CBC format. """
         iv = enc[:AES.block_size]
         cipher = AES.new(self.key_phrase, AES.MODE_CBC, iv)
         decrypted_data =  self._unpad(cipher.decrypt(enc[AES.block_size:])).decode('utf-8')
@@ -48,7 +324,7 @@ class AESKey(c.Module):
             [1,2,3,5],
             {'fam': 1, 'bro': 'fam', 'chris': {'sup': [1,'dawg']}},
             1,
-            'fam', 
+            'fam',
         ]
         import time
         for test_object in test_objects:
@@ -56,7 +332,7 @@ class AESKey(c.Module):
             encrypted = self.encrypt(test_object)
             decrypted = self.decrypt(encrypted)
             assert decrypted == test_object, f'FAILED: {test_encrypt_decrypt} {test_object} FAILED'
-            
+
             size_bytes = sys.getsizeof(test_object)
             seconds =  time.time() - start_time
             rate = size_bytes / seconds
@@ -64,7 +340,7 @@ class AESKey(c.Module):
         print('PASSED test_encrypt_decrypt')
 
         return True
-    
+
     @classmethod
     def test_encrypt_decrypt_throughput(cls, key='dummy'):
         import streamlit as st
@@ -72,13 +348,13 @@ class AESKey(c.Module):
         test_object = [1,2,3,5]*1000000
         start_time = time.time()
         encrypted = self.encrypt(test_object)
-        seconds =  time.time() - start_time        
+        seconds =  time.time() - start_time
         size_bytes = sys.getsizeof(test_object)
         encrypt_rate = size_bytes / seconds
 
         start_time = time.time()
         decrypted = self.decrypt(encrypted)
-        seconds =  time.time() - start_time        
+        seconds =  time.time() - start_time
         size_bytes = sys.getsizeof(test_object)
         decrypt_rate = size_bytes / seconds
 
@@ -88,7 +364,77 @@ class AESKey(c.Module):
         print('PASSED test_encrypt_decrypt')
 
         return True
-    
+
+    @classmethod
+    def test_stream(cls, key='dummy'):
+        self = cls(key=key, chunk_size=1000)
+        data = os.urandom(10**4 + 7)
+        array = np.arange(12, dtype=np.float32).reshape(3, 4)
+        for value in [data, b'', 'fam', {'fam': [1, 2]}]:
+            assert self.decrypt(self.encrypt(value)) == value
+        assert np.array_equal(self.decrypt(self.encrypt(array)), array)
+        stream = list(self.encrypt_chunks([data[:3], data[3:5000], data[5000:]]))
+        assert b''.join(self.decrypt_chunks(stream)) == data
+        assert self.decrypt_bytes(b''.join(stream)) == data
+        # a tampered, truncated or reordered stream does not decrypt
+        encrypted = bytearray(self.encrypt_bytes(data))
+        attacks = {'tampered': encrypted[:100] + bytes([encrypted[100] ^ 1]) + encrypted[101:],
+                   'truncated': encrypted[:len(stream[0]) + len(stream[1])],
+                   'reordered': stream[0] + stream[2] + stream[1] + b''.join(stream[3:])}
+        attacks['wrong key'] = encrypted
+        for name, attack in attacks.items():
+            other = cls(key='other') if name == 'wrong key' else self
+            try:
+                b''.join(other.decrypt_chunks([bytes(attack)]))
+            except (ValueError, AssertionError):
+                continue
+            raise Exception(f'the {name} stream decrypted')
+        return {'success': True, 'msg': 'stream test passed'}
+
+    @classmethod
+    def test_stream_throughput(cls, key='dummy', size_mb:int = 256, chunk_size:int = 2**20, max_memory_mb:int = 64):
+        """
+        MB/s of value and file encryption, and the peak memory of encrypting and decrypting a
+        size_mb file, which has to stay under max_memory_mb.
+        """
+        import tracemalloc
+        self = cls(key=key, chunk_size=chunk_size)
+        data = np.random.default_rng(0).integers(0, 255, size=64 * 2**20, dtype=np.uint8)
+        t0 = time.time()
+        encrypted = self.encrypt_bytes(data)
+        encrypt_rate = data.nbytes / 2**20 / (time.time() - t0)
+        t0 = time.time()
+        decrypted = self.decrypt_bytes(encrypted)
+        decrypt_rate = data.nbytes / 2**20 / (time.time() - t0)
+        assert np.array_equal(decrypted, data)
+        del encrypted, decrypted
+
+        src = self.resolve_path('stream_test.bin')
+        with open(src, 'wb') as f:
+            for _ in range(size_mb):
+                f.write(os.urandom(2**20))
+        tracemalloc.start()
+        t0 = time.time()
+        self.encrypt_path(src, src + '.enc')
+        self.decrypt_path(src + '.enc', src + '.dec')
+        file_rate = 2 * size_mb / (time.time() - t0)
+        peak_mb = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+        assert peak_mb < max_memory_mb, f'streaming used {peak_mb:.1f}MB for a {size_mb}MB file'
+        with open(src, 'rb') as a, open(src + '.dec', 'rb') as b:
+            while True:
+                x, y = a.read(2**24), b.read(2**24)
+                assert x == y, 'the decrypted file differs'
+                if len(x) == 0:
+                    break
+        for path in [src, src + '.enc', src + '.dec']:
+            os.remove(path)
+        return {'success': True,
+                'encrypt_mb_per_second': encrypt_rate,
+                'decrypt_mb_per_second': decrypt_rate,
+                'file_mb_per_second': file_rate,
+                'peak_memory_mb': peak_mb}
+
     @classmethod
     def test(cls):
         import streamlit as st
@@ -103,7 +449,7 @@ class AESKey(c.Module):
         import streamlit as st
         with st.expander('Tests'):
             cls.test()
-        
+
 
 if __name__ =='__main__':
     AESKey.streamlit()
@@ -3,7 +3,7 @@ import inspect
 import concurrent
 import threading
 from copy import deepcopy
-from typing import Optional, Union, Dict, List, Any, Tuple, Callable
+from typing import Optional, Union, Dict, List, Any, Tuple, Callable, Iterator
 from munch import Munch
 from rich.console import Console
 import json
@@ -534,14 +534,22 @@ class c:
         Puts a value in the config
         '''
         encrypt = encrypt or password != None
-        
-        if encrypt or password != None:
+        stream = encrypt and c.module('key.aes').is_raw(v)
+
+        if stream:
+            # raw buffers (bytes, arrays, tensors) are encrypted chunk by chunk into a file next to the json
+            path = cls.resolve_path(k, extension='enc')
+            c.get_key().resolve_aes_key(password).encrypt_to_path(v, path)
+            v = {'path': path}
+        elif encrypt or password != None:
             v = c.encrypt(v, password=password)
 
         if not c.jsonable(v):
             v = c.serialize(v)    
         
         data = {'data': v, 'encrypted': encrypt, 'timestamp': c.timestamp()}            
+        if stream:
+            data['stream'] = True
         
         # default json 
         getattr(cls,f'put_{mode}')(k, data)
@@ -580,7 +588,10 @@ class c:
 
         if password != None:
             assert data['encrypted'] , f'{k} is not encrypted'
-            data['data'] = c.decrypt(data['data'], password=password, key=key)
+            if data.get('stream', False):
+                data['data'] = c.get_key(key).resolve_aes_key(password).decrypt_from_path(data['data']['path'])
+            else:
+                data['data'] = c.decrypt(data['data'], password=password, key=key)
 
         data = data or default
         
@@ -898,6 +909,22 @@ class c:
         return c.module('os').cmd( *args, **kwargs)
     run_command = shell = cmd 
 
+    @classmethod
+    def cmds(cls, *args,**kwargs):
+        return c.module('os').cmds( *args, **kwargs)
+
+    @classmethod
+    def scheduler(cls):
+        return c.module('scheduler')
+    
+    @classmethod
+    def schedule(cls, fn:'callable', interval:float, **kwargs):
+        return c.module('scheduler').schedule(fn, interval, **kwargs)
+
+    @classmethod
+    async def async_cmd(cls, *args,**kwargs):
+        return await c.module('os').async_cmd( *args, **kwargs)
+
     @classmethod
     def import_module(cls, import_path:str) -> 'Object':
         from importlib import import_module
@@ -1967,16 +1994,15 @@ class c:
                  data:Dict, 
                  meta = None,
                  verbose: bool = False,
-
+                 wait: bool = True,
                  **kwargs) -> str:
         if meta != None:
             data = {'data':data, 'meta':meta}
         path = cls.resolve_path(path=path, extension='json')
-        # cls.lock_file(path)
         c.print(f'Putting json from {path}', color='green', verbose=verbose)
         if isinstance(data, dict):
             data = json.dumps(data)
-        c.put_text(path, data)
+        c.put_text(path, data, wait=wait)
         return path
     
     save_json = put_json
@@ -3168,7 +3194,7 @@ class c:
                 
     @classmethod
     def pm2_servers(cls, search=None,  verbose:bool = False) -> List[str]:
-        return  c.module('pm2').servers(verbose=verbose)
+        return  c.module('pm2').servers(search=search, verbose=verbose)
     pm2ls  = pm2_list = pm2_servers
     # commune.run_command('pm2 status').stdout.split('\n')[5].split('    │')[0].split('  │ ')[-1]commune.run_command('pm2 status').stdout.split('\n')[5].split('    │')[0].split('  │ ')[-1] 
     
@@ -5140,7 +5166,12 @@ class c:
         return file_contents
 
     @classmethod
-    def put_text(cls, path:str, text:str, key=None, bits_per_character=8) -> None:
+    def put_text(cls, path:str, text:str, key=None, bits_per_character=8, wait:bool = True) -> None:
+        '''
+        Writes the text through the group writer: atomically (a temporary file renamed over the path),
+        coalesced with the other writes to the path and fsynced with the writes of the same batch.
+        With wait=False it returns before the write is committed (see flush_writes).
+        '''
         # Get the absolute path of the file
         path = cls.resolve_path(path)
         if not isinstance(text, str):
@@ -5148,14 +5179,25 @@ class c:
         if key != None:
             text = c.get_key(key).encrypt(text)
         # Write the text to the file
-        with open(path, 'w') as file:
-            file.write(text)
+        cls.writer().write(path, text, wait=wait)
         # get size
         text_size = len(text)*bits_per_character
     
         return {'success': True, 'msg': f'Wrote text to {path}', 'size': text_size}
     
 
+    @classmethod
+    def writer(cls, **kwargs):
+        from commune.utils.writer import writer
+        return writer(**kwargs)
+
+    @classmethod
+    def flush_writes(cls, timeout:float = None) -> dict:
+        """
+        Waits until every put_text/put_json of this process before it is committed.
+        """
+        return cls.writer().flush(timeout=timeout)
+
     def rm_lines(self, path:str, start_line:int, end_line:int) -> None:
         # Get the absolute path of the file
         text = c.get_text(path)
@@ -5240,6 +5282,14 @@ class c:
         # Get the absolute path of the file
         path = cls.resolve_path(path)
 
+        if start_byte == 0 and end_byte == 0:
+            # lines of the whole file are read without reading the whole file
+            from commune.utils.file import tail_text, read_lines
+            if tail != None and tail > 0:
+                return tail_text(path, tail)
+            elif tail == None and (start_line != None or end_line != None):
+                return read_lines(path, start_line, end_line or None)
+
         # Read the contents of the file
         with open(path, 'rb') as file:
 
@@ -5289,6 +5339,174 @@ class c:
     
     load_text = get_text
 
+    @classmethod
+    def follow_text(cls, 
+                    path: str, 
+                    tail:int = 0,
+                    poll_interval:float = 0.25,
+                    timeout:float = None,
+                    max_lines:int = None) -> Iterator[str]:
+        """
+        Yields the last tail lines of the file and then its new lines as they are written (like tail -F).
+        Served functions that return it stream the lines as events.
+        """
+        from commune.utils.file import follow_lines
+        path = cls.resolve_path(path)
+        return follow_lines(path, tail=tail, poll_interval=poll_interval, timeout=timeout, max_lines=max_lines)
+
+    follow = follow_text
+
+    def test_text_lines(self, path:str = 'test_text_lines.log', n:int = 5000):
+        path = self.resolve_path(path)
+        lines = [f'line {i} ' + 'x' * (i % 97) for i in range(n)]
+        for text in ['\n'.join(lines), '\n'.join(lines) + '\n']:
+            self.put_text(path, text)
+            split = text.split('\n')
+            for tail in [1, 2, 10, 3000, n + 10]:
+                assert self.get_text(path, tail=tail) == '\n'.join(split[-tail:]), f'tail={tail}'
+            for start, end in [(0, 10), (1023, 1025), (2048, None), (-10, None), (-20, -5), (10, -10), (None, 5), (4000, 100)]:
+                assert self.get_text(path, start_line=start, end_line=end) == '\n'.join(split[start:end]), f'lines {start}:{end}'
+            # the line index follows appends
+            with open(path, 'a') as f:
+                f.write('appended\n')
+            assert self.get_text(path, start_line=-2) == 'appended\n'
+        # follow yields the tail and then the appended lines
+        followed = self.follow_text(path, tail=1, poll_interval=0.01, timeout=2, max_lines=3)
+        assert next(followed) == 'appended'
+        with open(path, 'a') as f:
+            f.write('new 1\nnew ')
+        assert next(followed) == 'new 1'
+        with open(path, 'a') as f:
+            f.write('2\n')
+        assert next(followed) == 'new 2'
+        os.remove(path)
+        return {'success': True, 'msg': 'test_text_lines passed'}
+
+    def test_text_tail_benchmark(self, path:str = 'test_text_tail_benchmark.log', size_gb:float = 5.0, tail:int = 100) -> dict:
+        """
+        Compares reading lines of a size_gb log through the whole file and through the tail and line index.
+        """
+        path = self.resolve_path(path)
+        line = b'2024-01-01 00:00:00 INFO commune.server request served in 0.0012s ' + b'x' * 40 + b'\n'
+        block = line * (2**24 // len(line))
+        with open(path, 'wb') as f:
+            for _ in range(int(size_gb * 2**30 // len(block))):
+                f.write(block)
+        num_lines = os.path.getsize(path) // len(line)
+        stats = {'size_gb': os.path.getsize(path) / 2**30, 'lines': num_lines}
+        t0 = c.time()
+        fast_tail = self.get_text(path, tail=tail)
+        stats['tail_seconds'] = c.time() - t0
+        t0 = c.time()
+        self.get_text(path, start_line=num_lines // 2, end_line=num_lines // 2 + tail)
+        stats['index_build_seconds'] = c.time() - t0
+        t0 = c.time()
+        self.get_text(path, start_line=num_lines // 3, end_line=num_lines // 3 + tail)
+        stats['line_range_seconds'] = c.time() - t0
+        if size_gb <= 1:
+            # the old path holds the whole decoded file in memory
+            t0 = c.time()
+            with open(path) as f:
+                full_tail = '\n'.join(f.read().split('\n')[-tail:])
+            stats['full_read_tail_seconds'] = c.time() - t0
+            assert full_tail == fast_tail
+        os.remove(path)
+        return stats
+
+    def test_atomic_writes(self, path:str = 'test_atomic_writes', files:int = 8, crashes:int = 20, size:int = 2**16) -> dict:
+        """
+        Kills a process that rewrites files as fast as it can, crashes times, through the group writer and in place.
+        After every crash each file must hold a whole version, at least the last one the process saw flush_writes commit.
+        """
+        import time, signal, random, shutil
+        from commune.utils.writer import clean_tmp
+        stats = {}
+        for mode in ['atomic', 'in_place']:
+            directory = self.resolve_path(f'{path}/{mode}')
+            shutil.rmtree(directory, ignore_errors=True)
+            os.makedirs(directory)
+            paths = [os.path.join(directory, f'{i}.json') for i in range(files)]
+            stats[mode] = {'crashes': crashes, 'torn': 0, 'lost': 0}
+            for crash in range(crashes):
+                r, w = os.pipe()
+                pid = os.fork()
+                if pid == 0:
+                    os.close(r)
+                    try:
+                        version = 0
+                        while True:
+                            version += 1
+                            text = json.dumps({'version': version, 'data': 'x' * size})
+                            for p in paths:
+                                if mode == 'atomic':
+                                    self.put_text(p, text, wait=False)
+                                else:
+                                    with open(p, 'w') as f:
+                                        f.write(text)
+                            if mode == 'atomic' and version % 10 == 0:
+                                self.flush_writes()
+                            if mode == 'in_place' or version % 10 == 0:
+                                os.write(w, version.to_bytes(8, 'little'))
+                    finally:
+                        os._exit(1)
+                os.close(w)
+                time.sleep(random.uniform(0.01, 0.1))
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+                reported = b''
+                while True:
+                    chunk = os.read(r, 2**16)
+                    if len(chunk) == 0:
+                        break
+                    reported += chunk
+                os.close(r)
+                committed = int.from_bytes(reported[-8:], 'little') if len(reported) >= 8 else 0
+                for p in paths:
+                    try:
+                        with open(p) as f:
+                            version = json.load(f)['version']
+                    except Exception:
+                        stats[mode]['torn'] += 1
+                        continue
+                    if version < committed:
+                        stats[mode]['lost'] += 1
+            clean_tmp(directory, max_age=0)
+            assert len(os.listdir(directory)) == files, os.listdir(directory)
+            shutil.rmtree(directory)
+        assert stats['atomic']['torn'] == 0 and stats['atomic']['lost'] == 0, stats
+        return {'success': True, 'msg': 'test_atomic_writes passed', 'stats': stats}
+
+    def test_write_benchmark(self, path:str = 'test_write_benchmark', writes:int = 4000, files:int = 100, threads:int = 32, size:int = 1024) -> dict:
+        """
+        Writes per second from threads writing random files, in place (the old put_text), through one
+        atomic fsynced write each, and through the group writer.
+        """
+        import random, shutil
+        from concurrent.futures import ThreadPoolExecutor
+        from commune.utils.writer import atomic_write, GroupWriter
+        directory = self.resolve_path(path)
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+        paths = [os.path.join(directory, f'{i}.json') for i in range(files)]
+        text = json.dumps({'data': 'x' * size})
+        def in_place(p):
+            with open(p, 'w') as f:
+                f.write(text)
+        group_writer = GroupWriter()
+        writers = {'in_place': in_place,
+                   'atomic_fsync': lambda p: atomic_write(p, text),
+                   'group_commit': lambda p: group_writer.write(p, text)}
+        stats = {}
+        for name, write in writers.items():
+            targets = [random.choice(paths) for _ in range(writes)]
+            t0 = c.time()
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                list(executor.map(write, targets))
+            stats[f'{name}_writes_per_second'] = writes / (c.time() - t0)
+        stats['group_commit'] = dict(group_writer.stats)
+        shutil.rmtree(directory)
+        return stats
+
 
     @classmethod
     def free_gpu_memory(cls, 
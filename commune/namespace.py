@@ -1,4 +1,5 @@
 import commune as c
+import os
 from typing import *
 
 # THIS IS WHAT THE INTERNET IS, A BUNCH OF NAMESPACES, AND A BUNCH OF SERVERS, AND A BUNCH OF MODULES.
@@ -133,7 +134,42 @@ class Namespace(c.Module):
     
     @classmethod
     def networks(cls) -> dict:
-        return [p.split('/')[-1].split('.')[0] for p in cls.ls()]
+        return [n for n in [p.split('/')[-1].split('.')[0] for p in cls.ls()] if n != cls.sockets_path]
+
+    # the unix sockets of the servers on this host, by port
+    sockets_path = 'sockets'
+
+    @classmethod
+    def is_local_address(cls, address:str) -> bool:
+        ip = address.split('://')[-1].split('/')[0].split(':')[0]
+        return ip in [c.default_ip, '127.0.0.1', 'localhost'] or ip == c.ip()
+
+    @classmethod
+    def register_socket(cls, address:str, path:str) -> dict:
+        sockets = cls.get(cls.sockets_path, {})
+        sockets[address.split(':')[-1]] = path
+        cls.put(cls.sockets_path, sockets)
+        return {'success': True, 'msg': f'Socket {path} registered to {address}.'}
+
+    @classmethod
+    def deregister_socket(cls, address:str) -> dict:
+        sockets = cls.get(cls.sockets_path, {})
+        path = sockets.pop(address.split(':')[-1], None)
+        cls.put(cls.sockets_path, sockets)
+        return {'success': path != None, 'msg': f'Socket {path} deregistered from {address}.'}
+
+    @classmethod
+    def get_socket(cls, address:str) -> Optional[str]:
+        """
+        The unix socket of the server at address, if it is on this host and serves one.
+        """
+        if address == None or not cls.is_local_address(address):
+            return None
+        port = address.split('://')[-1].split('/')[0].split(':')[-1]
+        path = cls.get(cls.sockets_path, {}).get(port)
+        if path != None and os.path.exists(path):
+            return path
+        return None
     
     @classmethod
     def namespace_exists(cls, network:str) -> bool:
@@ -188,6 +188,93 @@ class OsModule(c.Module):
     def add_rsa_key(self, b=2048, t='rsa'):
         return c.cmd(f"ssh-keygen -b {b} -t {t}")
     
+    @staticmethod
+    def resolve_command(command:Union[str, list], 
+                        *args, 
+                        sudo:bool = False, 
+                        password:bool = None, 
+                        bash:bool = False) -> List[str]:
+        import shlex
+        if password != None:
+            sudo = True
+        if isinstance(command, str):
+            command = ' '.join([command] + [str(a) for a in args])
+        else:
+            # a list is taken as the argv as is, so its arguments can contain spaces
+            command = list(command) + [str(a) for a in args]
+        if bash:
+            # the shell parses the command, so operators like && and | keep working
+            command = ['bash', '-c', command if isinstance(command, str) else shlex.join(command)]
+        elif isinstance(command, str):
+            command = shlex.split(command)
+        if sudo:
+            command = ['sudo'] + command
+        return command
+
+    @staticmethod
+    def stop_process(process:'subprocess.Popen', timeout:float = 2):
+        """
+        Interrupts the process if it is still running, and kills it if it does not exit within timeout.
+        """
+        import signal
+        import subprocess
+        if process.poll() == None:
+            process.send_signal(signal.SIGINT)
+            try:
+                process.wait(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+        if process.stdout != None:
+            process.stdout.close()
+        return process.returncode
+
+    @staticmethod
+    def print_lines(buffer:str, text:str, color:str = 'white') -> str:
+        """
+        Prints the complete lines of buffer + text and returns the trailing partial line.
+        """
+        lines = (buffer + text).split('\n')
+        for line in lines[:-1]:
+            c.print(line, color=color)
+        return lines[-1]
+
+    @classmethod
+    def stream_output(cls, 
+                      process:'subprocess.Popen', 
+                      timeout:float = None, 
+                      chunk_size:int = 65536):
+        """
+        Yields the decoded output of the process in chunks of up to chunk_size bytes as soon as they are available.
+        The process is stopped when the output ends, the timeout passes or the generator is closed.
+        """
+        import codecs
+        import selectors
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        deadline = None if timeout == None else c.time() + timeout
+        fd = process.stdout.fileno()
+        selector = selectors.DefaultSelector()
+        selector.register(fd, selectors.EVENT_READ)
+        try:
+            while True:
+                remaining = None if deadline == None else deadline - c.time()
+                if remaining != None and remaining <= 0:
+                    raise TimeoutError(f'Command {process.args} timed out after {timeout}s')
+                if len(selector.select(timeout=remaining)) == 0:
+                    continue
+                data = os.read(fd, chunk_size)
+                if len(data) == 0:
+                    break
+                text = decoder.decode(data)
+                if len(text) > 0:
+                    yield text
+            text = decoder.decode(b'', final=True)
+            if len(text) > 0:
+                yield text
+        finally:
+            selector.close()
+            cls.stop_process(process)
+
     @classmethod
     def cmd(cls, 
                     command:Union[str, list],
@@ -201,37 +288,18 @@ class OsModule(c.Module):
                     generator: bool =  False,
                     color : str = 'white',
                     cwd : str = None,
+                    timeout : float = None,
+                    chunk_size : int = 65536,
                     **kwargs) -> 'subprocess.Popen':
         
         '''
         Runs  a command in the shell.
-        
+        The output is read in chunks, so large outputs take linear time.
+        If timeout (seconds) passes before the output ends, the process is stopped and a TimeoutError is raised.
         '''
         import subprocess
-        import shlex
-        
-        if len(args) > 0:
-            command = ' '.join([command] + list(args))
 
-        
-        def kill_process(process):
-            import signal
-            process.stdout.close()
-            process.send_signal(signal.SIGINT)
-            process.wait()
-            # sys.exit(0)
-            
-        if password != None:
-            sudo = True
-            
-        if sudo:
-            command = f'sudo {command}'
-            
-            
-        if bash:
-            command = f'bash -c "{command}"'
-
-        process = subprocess.Popen(shlex.split(command),
+        process = subprocess.Popen(cls.resolve_command(command, *args, sudo=sudo, password=password, bash=bash),
                                     stdout=subprocess.PIPE, 
                                     stderr=subprocess.STDOUT,
                                     cwd = cwd,
@@ -240,40 +308,140 @@ class OsModule(c.Module):
         if return_process:
             return process
 
-        def stream_output(process):
-            pipe = process.stdout
-            for ch in iter(lambda: pipe.read(1), b""):
-                # if the the terminal is stuck and needs to enter
-                process.poll() 
+        output = cls.stream_output(process, timeout=timeout, chunk_size=chunk_size)
 
+        if generator:
+            return output
 
-                try:
-                    yield ch.decode()
-                except Exception as e:
-                    pass       
-            kill_process(process)
+        chunks = []
+        line = ''
+        for chunk in output:
+            chunks.append(chunk)
+            # only for verbose
+            if verbose:
+                line = cls.print_lines(line, chunk, color=color)
+        if verbose and len(line) > 0:
+            c.print(line, color=color)
+
+        return ''.join(chunks)
+
+    @classmethod
+    async def async_cmd(cls, 
+                    command:Union[str, list],
+                    *args,
+                    verbose:bool = False , 
+                    env:Dict[str, str] = {}, 
+                    sudo:bool = False,
+                    password: bool = None,
+                    bash : bool = False,
+                    color : str = 'white',
+                    cwd : str = None,
+                    timeout : float = None,
+                    chunk_size : int = 65536,
+                    **kwargs) -> str:
+        '''
+        Runs a command on the event loop, so many commands can run concurrently without a thread each.
+        The process is killed if the timeout passes or the task is cancelled.
+        '''
+        import asyncio
+        import codecs
+        process = await asyncio.create_subprocess_exec(*cls.resolve_command(command, *args, sudo=sudo, password=password, bash=bash),
+                                                        stdout=asyncio.subprocess.PIPE,
+                                                        stderr=asyncio.subprocess.STDOUT,
+                                                        cwd=cwd,
+                                                        env={**os.environ, **env}, **kwargs)
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        chunks = []
+        line = ''
+
+        async def read():
+            nonlocal line
+            while True:
+                data = await process.stdout.read(chunk_size)
+                if len(data) == 0:
+                    break
+                chunks.append(decoder.decode(data))
+                if verbose:
+                    line = cls.print_lines(line, chunks[-1], color=color)
+            chunks.append(decoder.decode(b'', final=True))
+            await process.wait()
 
+        try:
+            await asyncio.wait_for(read(), timeout=timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if process.returncode == None:
+                process.kill()
+                await process.wait()
+            if isinstance(e, asyncio.TimeoutError):
+                raise TimeoutError(f'Command {command} timed out after {timeout}s')
+            raise e
+        if verbose and len(line) > 0:
+            c.print(line, color=color)
+        return ''.join(chunks)
 
+    @classmethod
+    def cmds(cls, 
+             commands:List[Union[str, list]], 
+             max_concurrency:int = 64, 
+             timeout:float = None, 
+             return_exceptions:bool = True,
+             **kwargs) -> List[str]:
+        '''
+        Runs many commands concurrently on one event loop and returns their outputs in order.
+        At most max_concurrency processes run at the same time, and timeout applies to each command.
+        '''
+        import asyncio
 
-        if generator:
-            return stream_output(process)
+        async def run_all():
+            semaphore = asyncio.Semaphore(max_concurrency)
+            async def run(command):
+                async with semaphore:
+                    return await cls.async_cmd(command, timeout=timeout, **kwargs)
+            return await asyncio.gather(*[run(command) for command in commands], return_exceptions=return_exceptions)
 
-        else:
-            text = ''
-            new_line = ''
-            
-            for ch in stream_output(process):
-                
-                text += ch
-                # only for verbose
-                if verbose:
-                    new_line += ch
+        return c.gather(run_all(), timeout=None)
 
-                    if ch == '\n':
-                        c.print(new_line[:-1], color=color)
-                        new_line = ''
+    @classmethod
+    def test_cmd(cls):
+        assert cls.cmd('echo hey') == 'hey\n'
+        assert cls.cmd(['echo', 'hey', 'fam']) == 'hey fam\n'
+        assert cls.cmd('printf "%s" "é∑ok"') == 'é∑ok', 'multibyte characters were split'
+        assert ''.join(cls.cmd('seq 1 1000', generator=True)) == cls.cmd('seq 1 1000')
+        t0 = c.time()
+        try:
+            cls.cmd('sleep 10', timeout=0.5)
+            raise Exception('the command did not time out')
+        except TimeoutError:
+            pass
+        assert c.time() - t0 < 5, 'the timed out process was not stopped'
+        outputs = cls.cmds(['sleep 0.5 && echo done', 'sleep 10'], timeout=2, bash=True)
+        assert outputs[0] == 'done\n' and isinstance(outputs[1], TimeoutError), outputs
+        return {'success': True, 'msg': 'cmd test passed'}
 
-        return text
+    @classmethod
+    def test_cmd_throughput(cls, mb:int = 16, num_commands:int = 100, sleep:float = 0.5):
+        """
+        Output throughput of cmd on a multi MB output against subprocess.run, and the wall time
+        of num_commands concurrent sleeps through cmds.
+        """
+        import subprocess
+        import sys
+        command = [sys.executable, '-c', f'import sys; sys.stdout.write(("x" * 1023 + "\\n") * {mb} * 1024)']
+        stats = {}
+        t0 = c.time()
+        output = cls.cmd(command)
+        stats['cmd_mb_per_second'] = mb / (c.time() - t0)
+        assert len(output) == mb * 1024 * 1024, f'expected {mb}MB, got {len(output)} bytes'
+        t0 = c.time()
+        subprocess.run(command, stdout=subprocess.PIPE)
+        stats['subprocess_mb_per_second'] = mb / (c.time() - t0)
+
+        t0 = c.time()
+        outputs = cls.cmds([f'sleep {sleep}'] * num_commands, max_concurrency=num_commands)
+        stats['cmds_seconds'] = c.time() - t0
+        stats['sequential_seconds'] = num_commands * sleep
+        assert all(o == '' for o in outputs), outputs[:4]
+        return stats
 
 
     @staticmethod
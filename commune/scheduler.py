@@ -0,0 +1,233 @@
+import json
+import heapq
+import hashlib
+import random
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import *
+import commune as c
+
+
+class Scheduler(c.Module):
+    """
+    One scheduler per process for periodic jobs.
+
+    Jobs sit in a heap ordered by their next run. A single thread waits on a condition until
+    the earliest job is due (so an idle process does not wake up at all), then hands the job to a
+    small worker pool, so a slow job does not delay the others. A job never overlaps itself: its
+    next run is scheduled when the current one finishes, interval seconds later with +/- jitter,
+    or later with exponential backoff after a failure. Jobs are keyed by name, and scheduling a
+    name that already exists returns the existing job, so identical jobs started by several
+    modules in one process run once.
+    """
+    # the state is shared by every instance in the process
+    jobs = {}
+    heap = []
+    cond = threading.Condition()
+    thread = None
+    executor = None
+    running = False
+
+    def __init__(self, max_workers:int = 8):
+        self.set_config(kwargs=locals())
+        self.start(max_workers=max_workers)
+
+    @classmethod
+    def start(cls, max_workers:int = 8):
+        with cls.cond:
+            if cls.running:
+                return
+            cls.running = True
+            cls.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='scheduler')
+            cls.thread = threading.Thread(target=cls.run_loop, daemon=True, name='scheduler')
+            cls.thread.start()
+
+    @classmethod
+    def job_name(cls, fn:Callable, args:list = None, kwargs:dict = None) -> str:
+        name = getattr(fn, '__qualname__', str(fn))
+        if '<' in name:
+            # lambdas and local functions share their qualname
+            name = f'{name}#{id(fn)}'
+        owner = getattr(fn, '__self__', None)
+        if owner != None and not isinstance(owner, type):
+            # bound methods of different instances are different jobs
+            name = f'{name}@{id(owner)}'
+        if args or kwargs:
+            key = json.dumps([args or [], kwargs or {}], sort_keys=True, default=str)
+            name += '::' + hashlib.sha256(key.encode()).hexdigest()[:8]
+        return name
+
+    @classmethod
+    def schedule(cls,
+                 fn:Callable,
+                 interval:float,
+                 name:str = None,
+                 args:list = None,
+                 kwargs:dict = None,
+                 jitter:float = 0.1,
+                 backoff:float = 2.0,
+                 max_backoff:float = None,
+                 delay:float = 0) -> dict:
+        """
+        Runs fn(*args, **kwargs) every interval seconds, first after delay seconds.
+        jitter is the fraction of the interval the next run is randomly moved by.
+        After n consecutive failures the next run is interval * backoff**n seconds later (at most max_backoff).
+        """
+        name = name or cls.job_name(fn, args, kwargs)
+        with cls.cond:
+            if name in cls.jobs and not cls.jobs[name]['cancelled']:
+                return cls.info(name)
+            job = {'name': name,
+                   'fn': fn,
+                   'args': args or [],
+                   'kwargs': kwargs or {},
+                   'interval': interval,
+                   'jitter': jitter,
+                   'backoff': backoff,
+                   'max_backoff': max_backoff if max_backoff != None else max(interval * 10, 60),
+                   'next_run': c.time() + delay,
+                   'last_run': None,
+                   'last_duration': None,
+                   'last_error': None,
+                   'runs': 0,
+                   'failures': 0,
+                   'consecutive_failures': 0,
+                   'running': False,
+                   'cancelled': False}
+            cls.jobs[name] = job
+            heapq.heappush(cls.heap, (job['next_run'], name))
+            cls.cond.notify()
+        cls.start()
+        return cls.info(name)
+
+    @classmethod
+    def run_loop(cls):
+        while True:
+            with cls.cond:
+                # a stopped (or restarted) scheduler leaves this thread behind
+                if not cls.running or cls.thread is not threading.current_thread():
+                    return
+                now = c.time()
+                while len(cls.heap) > 0:
+                    next_run, name = cls.heap[0]
+                    job = cls.jobs.get(name)
+                    # entries of cancelled or rescheduled jobs are dropped lazily
+                    if job == None or job['cancelled'] or job['running'] or job['next_run'] != next_run:
+                        heapq.heappop(cls.heap)
+                        continue
+                    if next_run > now:
+                        break
+                    heapq.heappop(cls.heap)
+                    job['running'] = True
+                    cls.executor.submit(cls.run_job, job)
+                timeout = cls.heap[0][0] - now if len(cls.heap) > 0 else None
+                cls.cond.wait(timeout=timeout)
+
+    @classmethod
+    def run_job(cls, job:dict):
+        t0 = c.time()
+        error = None
+        try:
+            job['fn'](*job['args'], **job['kwargs'])
+        except Exception as e:
+            error = ''.join(traceback.format_exception_only(type(e), e)).strip()
+        with cls.cond:
+            job['running'] = False
+            job['runs'] += 1
+            job['last_run'] = t0
+            job['last_duration'] = c.time() - t0
+            if error == None:
+                job['consecutive_failures'] = 0
+                delay = job['interval'] * (1 + job['jitter'] * (2 * random.random() - 1))
+            else:
+                job['failures'] += 1
+                job['consecutive_failures'] += 1
+                job['last_error'] = error
+                c.print(f'job {job["name"]} failed ({job["consecutive_failures"]} in a row): {error}', color='red')
+                delay = min(job['interval'] * job['backoff'] ** job['consecutive_failures'], job['max_backoff'])
+            if not job['cancelled']:
+                job['next_run'] = c.time() + delay
+                heapq.heappush(cls.heap, (job['next_run'], job['name']))
+                cls.cond.notify()
+
+    @classmethod
+    def info(cls, name:str) -> dict:
+        job = cls.jobs[name]
+        return {k: v for k,v in job.items() if k not in ['fn', 'args', 'kwargs']}
+
+    @classmethod
+    def ls(cls, search:str = None) -> Dict[str, dict]:
+        """
+        Every job with its last run, duration, next run and failures.
+        """
+        with cls.cond:
+            return {name: cls.info(name) for name in cls.jobs if search == None or search in name}
+
+    @classmethod
+    def run_now(cls, name:str) -> dict:
+        with cls.cond:
+            job = cls.jobs[name]
+            if not job['running']:
+                job['next_run'] = c.time()
+                heapq.heappush(cls.heap, (job['next_run'], name))
+                cls.cond.notify()
+        return cls.info(name)
+
+    @classmethod
+    def cancel(cls, name:str) -> dict:
+        with cls.cond:
+            job = cls.jobs.pop(name, None)
+            if job != None:
+                job['cancelled'] = True
+            cls.cond.notify()
+        return {'success': job != None, 'msg': f'cancelled {name}' if job != None else f'no job {name}'}
+
+    @classmethod
+    def wait(cls, timeout:float = None) -> dict:
+        """
+        Blocks (without using the cpu) until the scheduler is stopped, for processes that only run jobs.
+        """
+        cls.start()
+        cls.thread.join(timeout=timeout)
+        return cls.ls()
+
+    @classmethod
+    def stop(cls) -> dict:
+        with cls.cond:
+            cls.running = False
+            for job in cls.jobs.values():
+                job['cancelled'] = True
+            cls.jobs.clear()
+            cls.heap.clear()
+            cls.cond.notify()
+        if cls.executor != None:
+            cls.executor.shutdown(wait=False)
+        return {'success': True, 'msg': 'stopped the scheduler'}
+
+    @classmethod
+    def test_scheduler(cls):
+        cls.stop()
+        calls = {'ok': 0, 'fail': 0}
+        def ok():
+            calls['ok'] += 1
+        def fail():
+            calls['fail'] += 1
+            raise Exception('failed')
+        job = cls.schedule(ok, interval=0.05, jitter=0)
+        # the same job scheduled again (e.g. by another module) is not duplicated
+        assert cls.schedule(ok, interval=0.05)['name'] == job['name'] and len(cls.ls()) == 1
+        cls.schedule(fail, interval=0.05, backoff=4, max_backoff=10)
+        c.sleep(0.5)
+        jobs = cls.ls()
+        assert 8 <= calls['ok'] <= 11, calls
+        # backoff: runs at 0, then 0.2s later, then 0.8s later
+        assert calls['fail'] == 2, calls
+        assert jobs[cls.job_name(fail)]['consecutive_failures'] == 2 and 'failed' in jobs[cls.job_name(fail)]['last_error']
+        assert jobs[job['name']]['next_run'] > c.time() - 0.01
+        cls.cancel(job['name'])
+        n = calls['ok']
+        c.sleep(0.2)
+        assert calls['ok'] == n, 'a cancelled job ran'
+        cls.stop()
+        return {'success': True, 'msg': 'scheduler test passed', 'jobs': jobs}
@@ -261,6 +261,23 @@ class Serializer(c.Module):
         output = save({'data':data})  
         return self.bytes2str(output)
 
+    def serialize_topk(self, data: 'TopK') -> 'DataBlock':
+        # one blob, so the int32 indices and fp16/bf16 probabilities keep their dtypes on the wire
+        from safetensors.torch import save
+        import torch
+        output = save({'probs': data.probs.detach().contiguous().cpu(),
+                       'indices': data.indices.detach().contiguous().cpu(),
+                       'vocab_size': torch.tensor(data.vocab_size or 0)})
+        return self.bytes2str(output)
+
+    def deserialize_topk(self, data: str) -> 'TopK':
+        from safetensors.torch import load
+        from commune.utils.tokenizer import TopK
+        if isinstance(data, str):
+            data = self.str2bytes(data)
+        data = load(data)
+        return TopK(probs=data['probs'], indices=data['indices'], vocab_size=int(data['vocab_size']) or None)
+
     def serialize_numpy(self, data: 'np.ndarray') -> 'np.ndarray':     
         data =  self.numpy2bytes(data)
         return self.bytes2str(data)
@@ -301,6 +318,8 @@ class Serializer(c.Module):
         This function utilizes Python's `type()` built-in function and string manipulation to parse and determine the data type. It simplifies type checking for specific common data types used in data science and machine learning applications.
         '''
         data_type = str(type(data)).split("'")[1]
+        if data_type.endswith('.TopK'):
+            return 'topk'
         if 'Munch' in data_type:
             data_type = 'munch'
         if 'Tensor' in data_type or 'torch' in data_type:
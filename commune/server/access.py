@@ -36,7 +36,7 @@ class Access(c.Module):
                       'role2rate': role2rate, 
                       'fn_info': {}}
 
-        c.thread(self.run_loop)
+        self.run_loop()
 
 
     def set_module(self, module: c.Module):
@@ -51,13 +51,8 @@ class Access(c.Module):
         return {'success': True, 'msg': f'set module to {module}'}
     
     def run_loop(self):
-        while True:
-            try:
-                r = self.sync_network()
-            except Exception as e:
-                r = c.detailed_error(e)
-            c.print(r)
-            c.sleep(self.config.sync_interval)
+        # failed syncs are retried with backoff by the scheduler
+        return c.schedule(self.sync_network, interval=self.config.sync_interval)
 
     def sync_network(self):
         state = self.get(self.state_path, {}, max_age=self.config.sync_interval)
@@ -1,4 +1,5 @@
 import commune as c
+import os
 import pandas as pd
 from typing import *
 from fastapi import FastAPI
@@ -24,6 +25,7 @@ class Server(c.Module):
         serializer: str = 'serializer',
         save_history:bool= True,
         history_path:str = None , 
+        unix_socket: bool = True,
         nest_asyncio = True,
         mnemonic = None,
         new_loop = True,
@@ -44,6 +46,7 @@ class Server(c.Module):
         self.verbose = verbose
         self.sse = sse
         self.save_history = save_history
+        self.unix_socket = unix_socket
         self.chunk_size = chunk_size
         self.timeout = timeout
         self.free = free
@@ -80,7 +83,7 @@ class Server(c.Module):
 
         return {'success': True, 'msg': f'Set module {module}', 'key': self.key.ss58_address}
 
-    def forward(self, fn:str, input:dict):
+    def forward(self, fn:str, input:dict, sse:bool = True):
         """
         fn (str): the function to call
         input (dict): the input to the function
@@ -91,6 +94,7 @@ class Server(c.Module):
                 address: the address of the caller
             hash: the hash of the request (optional)
             signature: the signature of the request
+        sse (bool): whether generators are returned as an event stream (http) or as a generator (unix socket)
    
         """
         user_info = None
@@ -166,7 +170,7 @@ class Server(c.Module):
         c.print(print_info, color=color)
         
 
-        result = self.process_result(result)
+        result = self.process_result(result, sse=sse)
     
         output = {
         'module': self.name,
@@ -211,24 +215,26 @@ class Server(c.Module):
             c.print(f' Served ( {self.name} --> {self.address} ) 🚀\033 ', color='purple')
             c.print(f'🔑 Key: {self.key} 🔑\033', color='yellow')
             c.register_server(name=self.name, address = self.address, network=self.network)
+            if self.unix_socket:
+                self.serve_socket()
             uvicorn.run(self.app, host='0.0.0.0', port=self.port, loop="asyncio")
         except Exception as e:
             c.print(e, color='red')
             c.deregister_server(self.name, network=self.network)
         finally:
             c.deregister_server(self.name, network=self.network)
+            self.stop_socket()
         
     @classmethod
     def history_paths(cls, server=None, history_path='history', n=100, key=None):
-        if server == None:
-            dirpath  = f'{history_path}'
-            paths =  cls.glob(dirpath)
-        else:
-            
-            dirpath  = f'{history_path}/{server}'
-            paths =  cls.ls(dirpath)
-        paths = sorted(paths, reverse=True)[:n]
-        return paths
+        return [p for store in cls.history_stores(server=server, history_path=history_path) for p in store.history_paths(reverse=True)][:n]
+
+    @classmethod
+    def history_stores(cls, server=None, history_path='history') -> List['History']:
+        dirpath = cls.resolve_path(history_path if server == None else f'{history_path}/{server}')
+        if server != None:
+            return [c.module('history')(dirpath)]
+        return [c.module('history')(p) for p in cls.ls(dirpath) if os.path.isdir(p)]
 
 
     def state_dict(self) -> Dict:
@@ -242,8 +248,11 @@ class Server(c.Module):
     
 
 
-    def process_result(self,  result):
-        if c.is_generator(result):
+    def process_result(self,  result, sse:bool = True):
+        if c.is_generator(result) and not sse:
+            # the socket sends every item as a frame
+            return (self.serializer.serialize({'data': item}) for item in result)
+        elif c.is_generator(result):
             from sse_starlette.sse import EventSourceResponse
             # for sse we want to wrap the generator in an eventsource response
             result = self.generator_wrapper(result)
@@ -275,13 +284,38 @@ class Server(c.Module):
 
 
 
+    # UNIX SOCKET
+    def serve_socket(self) -> dict:
+        """
+        Serves forward on a unix socket too, registered in the namespace by port, for clients on the same host.
+        Requests are signed and checked by forward exactly like the http ones.
+        """
+        socket_module = c.module('socket')
+        path = socket_module.socket_path(self.name)
+        self.socket_server = socket_module.serve(path, self.socket_forward)
+        c.module('namespace').register_socket(self.address, path)
+        c.print(f'🔌 Socket: {path} 🔌', color='yellow')
+        return {'success': True, 'path': path}
+
+    def socket_forward(self, request:dict):
+        return self.forward(fn=request['fn'], input=request['input'], sse=False)
+
+    def stop_socket(self) -> dict:
+        if getattr(self, 'socket_server', None) == None:
+            return {'success': False, 'msg': 'no socket'}
+        c.module('namespace').deregister_socket(self.address)
+        c.module('socket').stop(self.socket_server)
+        self.socket_server = None
+        return {'success': True, 'msg': 'stopped the socket'}
+
     # HISTORY 
     def add_history(self, item:dict):    
-        path = self.history_path + '/' + item['address'] + '/'+  str(item['timestamp']) 
-        self.put(path, item)
+        self.history_store.add(item)
 
     def set_history_path(self, history_path):
         self.history_path = self.resolve_path(history_path or f'history/{self.name}')
+        # the calls are appended to time partitioned segments instead of a file per call
+        self.history_store = c.module('history')(self.history_path)
         return {'history_path': self.history_path}
 
     @classmethod
@@ -296,11 +330,16 @@ class Server(c.Module):
                 history_path='history',
                 features=[ 'module', 'fn', 'seconds_ago', 'latency', 'address'], 
                 to_list=False,
+                server=None,
+                n=100,
+                max_age=None,
                 **kwargs
                 ):
-        key = c.get_key(key)
-        history_path = cls.history_paths(key=key, history_path=history_path)
-        df =  c.df([cls.get(path) for path in history_path])
+        history = []
+        for store in cls.history_stores(server=server, history_path=history_path):
+            history += store.history(n=n, max_age=max_age)
+        history = sorted(history, key=lambda x: x['timestamp'], reverse=True)[:n]
+        df =  c.df(history)
         now = c.timestamp()
         df['seconds_ago'] = df['timestamp'].apply(lambda x: now - x)
         df = df[features]
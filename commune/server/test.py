@@ -45,3 +45,17 @@ class Test(c.Module):
         c.kill(module_name)
         return {'success': True, 'msg': 'server test passed'}
 
+    @classmethod
+    def test_serving_socket(cls, module_name = 'module::test_socket'):
+        # the server and the client load the socket through the module resolver, not an import
+        assert c.module('socket').__name__ == 'Socket', c.module('socket')
+        c.serve(module_name)
+        c.wait_for_server(module_name)
+        client = c.connect(module_name, virtual=False)
+        assert client.socket_path != None, f"{module_name} serves no socket"
+        client.forward('put', args=["hey", 1])
+        assert client.forward('get', args=["hey"]) == 1
+        # a failed socket call falls back to http and clears the path, so the calls went over the socket
+        assert client.socket_path != None
+        c.kill(module_name)
+        return {'success': True, 'msg': 'server socket test passed'}
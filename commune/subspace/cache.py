@@ -0,0 +1,198 @@
+import os
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import *
+import commune as c
+
+
+class QueryCache(c.Module):
+    """
+    A chain state cache keyed by (storage item, params, block hash).
+
+    Values live in an in-memory LRU tier and a compact msgpack tier on disk laid out as
+    {network}/{block}-{block_hash}/{digest}.msgpack, where the digest is the hash of the
+    storage item and its params. msgpack keeps integer map keys as integers, so values
+    come back exactly as they were stored. Only the newest max_blocks blocks are kept.
+    """
+    lock = threading.Lock()
+
+    def __init__(self,
+                 path:str = 'query_cache',
+                 max_items:int = 4096,
+                 max_blocks:int = 32):
+        self.set_config(kwargs=locals())
+        self.dirpath = self.resolve_path(path)
+        self.memory = OrderedDict() # (network, block, digest) -> (timestamp, packed value)
+        self.latest = {} # (network, digest) -> (block, timestamp)
+        self.network2blocks = {} # network -> {block: block_hash}
+
+    @staticmethod
+    def pack(value:Any) -> bytes:
+        import msgpack
+        return msgpack.packb(value, use_bin_type=True)
+
+    @staticmethod
+    def unpack(data:bytes) -> Any:
+        import msgpack
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+    @staticmethod
+    def digest(name:str, params:list = None, module:str = 'SubspaceModule') -> str:
+        params = params or []
+        item_key = f'{module}.{name}::' + '-'.join([str(p) for p in params])
+        return hashlib.sha256(item_key.encode()).hexdigest()[:32]
+
+    def network_path(self, network:str) -> str:
+        return os.path.join(self.dirpath, network)
+
+    def block_path(self, network:str, block:int, block_hash:str) -> str:
+        return os.path.join(self.network_path(network), f'{block}-{block_hash}')
+
+    def blocks(self, network:str) -> Dict[int, str]:
+        """
+        The cached blocks of the network (block -> block_hash), listed from disk once.
+        """
+        if network not in self.network2blocks:
+            blocks = {}
+            path = self.network_path(network)
+            if os.path.isdir(path):
+                for name in os.listdir(path):
+                    block, block_hash = name.split('-', 1)
+                    blocks[int(block)] = block_hash
+            self.network2blocks[network] = blocks
+        return self.network2blocks[network]
+
+    def block_hash(self, network:str, block:int) -> Optional[str]:
+        return self.blocks(network).get(block)
+
+    def lookup(self,
+               network:str,
+               name:str,
+               params:list = None,
+               module:str = 'SubspaceModule',
+               block:int = None,
+               max_age:int = None,
+               default:Any = None) -> Any:
+        """
+        Returns the value at the block, or the newest cached value if block is None.
+        """
+        digest = self.digest(name, params, module)
+        if block == None:
+            block = self.latest_block(network, digest)
+            if block == None:
+                return default
+        key = (network, block, digest)
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry != None:
+                self.memory.move_to_end(key)
+        if entry == None:
+            block_hash = self.block_hash(network, block)
+            if block_hash == None:
+                return default
+            path = os.path.join(self.block_path(network, block, block_hash), digest + '.msgpack')
+            try:
+                with open(path, 'rb') as f:
+                    entry = (os.path.getmtime(path), f.read())
+            except FileNotFoundError:
+                return default
+            self.remember(key, entry)
+        timestamp, data = entry
+        if max_age != None and c.time() - timestamp > max_age:
+            return default
+        return self.unpack(data)
+
+    def latest_block(self, network:str, digest:str) -> Optional[int]:
+        latest = self.latest.get((network, digest))
+        if latest != None:
+            return latest[0]
+        # cold start, look for the newest block on disk that has the item
+        for block, block_hash in sorted(self.blocks(network).items(), reverse=True):
+            path = os.path.join(self.block_path(network, block, block_hash), digest + '.msgpack')
+            if os.path.exists(path):
+                self.latest[(network, digest)] = (block, os.path.getmtime(path))
+                return block
+        return None
+
+    def remember(self, key:tuple, entry:tuple):
+        with self.lock:
+            self.memory[key] = entry
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.config.max_items:
+                self.memory.popitem(last=False)
+
+    def store(self,
+              network:str,
+              name:str,
+              value:Any,
+              block:int,
+              block_hash:str,
+              params:list = None,
+              module:str = 'SubspaceModule') -> dict:
+        digest = self.digest(name, params, module)
+        data = self.pack(value)
+        timestamp = c.time()
+        path = self.block_path(network, block, block_hash)
+        os.makedirs(path, exist_ok=True)
+        filepath = os.path.join(path, digest + '.msgpack')
+        tmp_path = filepath + f'.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, filepath)
+
+        self.remember((network, block, digest), (timestamp, data))
+        blocks = self.blocks(network)
+        is_new_block = block not in blocks
+        blocks[block] = block_hash
+        latest = self.latest.get((network, digest))
+        if latest == None or latest[0] <= block:
+            self.latest[(network, digest)] = (block, timestamp)
+        if is_new_block:
+            self.evict(network)
+        return {'block': block, 'digest': digest, 'size': len(data)}
+
+    def evict(self, network:str, max_blocks:int = None) -> List[int]:
+        """
+        Removes every block older than the newest max_blocks blocks.
+        """
+        max_blocks = max_blocks or self.config.max_blocks
+        blocks = self.blocks(network)
+        evicted = sorted(blocks.keys(), reverse=True)[max_blocks:]
+        for block in evicted:
+            shutil.rmtree(self.block_path(network, block, blocks.pop(block)), ignore_errors=True)
+        if len(evicted) > 0:
+            evicted_set = set(evicted)
+            with self.lock:
+                for key in [k for k in self.memory if k[0] == network and k[1] in evicted_set]:
+                    self.memory.pop(key, None)
+            for key in [k for k,v in self.latest.items() if k[0] == network and v[0] in evicted_set]:
+                self.latest.pop(key, None)
+        return evicted
+
+    def clear(self, network:str = None):
+        path = self.network_path(network) if network != None else self.dirpath
+        shutil.rmtree(path, ignore_errors=True)
+        self.memory.clear()
+        self.latest.clear()
+        self.network2blocks.clear()
+        return {'success': True, 'msg': f'Cleared {path}'}
+
+    def test_query_cache(self, network:str = 'test', n:int = 4):
+        self = QueryCache(path='test_query_cache', max_blocks=n)
+        self.clear()
+        value = {0: {1: 'a', 2: 'b'}, 'key': [1, 2, 3]}
+        for block in range(n * 2):
+            self.store(network, 'StakeFrom', {**value, 'block': block}, block=block, block_hash=f'0x{block}', params=[0])
+        assert sorted(self.blocks(network)) == list(range(n, n * 2)), 'old blocks were not evicted'
+        assert self.lookup(network, 'StakeFrom', params=[0], block=0) == None
+        assert self.lookup(network, 'StakeFrom', params=[0], block=n)['block'] == n
+        latest = self.lookup(network, 'StakeFrom', params=[0])
+        assert latest == {**value, 'block': n * 2 - 1}, f'int keys were not preserved {latest}'
+        # a fresh cache reads the disk tier
+        cold = QueryCache(path='test_query_cache', max_blocks=n)
+        assert cold.lookup(network, 'StakeFrom', params=[0]) == latest
+        assert cold.lookup(network, 'StakeFrom', params=[1]) == None
+        self.clear()
+        return {'success': True, 'msg': 'query cache test passed'}
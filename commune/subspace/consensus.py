@@ -0,0 +1,277 @@
+from typing import *
+import numpy as np
+import commune as c
+
+
+class Consensus(c.Module):
+    """
+    An offline, vectorized simulator of subnet consensus.
+
+    One epoch takes a weight matrix W (n x n, W[i, j] is the weight voter i gives module j)
+    and a stake vector S, and computes trust, incentive, dividends and emission per uid:
+
+        incentive = S @ W                      (optionally W is clipped to the stake weighted
+                                                kappa quantile of each column, as in yuma)
+        trust     = S @ (W > 0)
+        bonds     = S[:, None] * W / column sum  (optionally an ema over epochs)
+        dividends = bonds @ incentive
+        emission  = founder share + incentive_ratio * incentive + (1 - incentive_ratio) * dividends
+
+    Params use the names of subnet_params/global_params (percent ratios like the chain).
+    """
+
+    def __init__(self,
+                 incentive_ratio:float = 50,
+                 trust_ratio:float = 0,
+                 founder_share:float = 0,
+                 founder_uid:int = 0,
+                 max_weight_age:int = None,
+                 min_weight_stake:float = 0,
+                 kappa:float = None,
+                 bonds_alpha:float = None,
+                 emission_per_epoch:float = 1.0):
+        self.set_config(kwargs=locals())
+
+    @classmethod
+    def from_params(cls, subnet_params:dict, global_params:dict = None, **kwargs) -> 'Consensus':
+        """
+        Builds a simulator from the dicts returned by Subspace.subnet_params and Subspace.global_params.
+        """
+        global_params = global_params or {}
+        params = dict(incentive_ratio=subnet_params.get('incentive_ratio', 50),
+                      trust_ratio=subnet_params.get('trust_ratio', 0),
+                      founder_share=subnet_params.get('founder_share', 0),
+                      max_weight_age=subnet_params.get('max_weight_age'),
+                      min_weight_stake=global_params.get('min_weight_stake', 0))
+        if 'unit_emission' in global_params and 'tempo' in subnet_params:
+            params['emission_per_epoch'] = global_params['unit_emission'] * subnet_params['tempo']
+        params.update(kwargs)
+        return cls(**params)
+
+    @staticmethod
+    def weight_matrix(weights:Dict[int, List[list]], n:int = None, dtype=np.float64) -> np.ndarray:
+        """
+        Converts the chain weights {uid: [[uid, weight], ...]} into a dense n x n matrix.
+        """
+        n = n or max([uid for uid in weights] + [uid for w in weights.values() for uid, _ in w] + [-1]) + 1
+        W = np.zeros((n, n), dtype=dtype)
+        rows = np.array([uid for uid, w in weights.items() for _ in w], dtype=np.int64)
+        cols = np.array([j for w in weights.values() for j, _ in w], dtype=np.int64)
+        values = np.array([v for w in weights.values() for _, v in w], dtype=dtype)
+        if len(rows) > 0:
+            mask = (rows < n) & (cols < n)
+            W[rows[mask], cols[mask]] = values[mask]
+        return W
+
+    @staticmethod
+    def stake_vector(stake_from:Dict[str, Union[dict, list]], keys:List[str], dtype=np.float64) -> np.ndarray:
+        """
+        The total stake of each key in uid order, from {key: {staker: amount}} or {key: [[staker, amount], ...]}.
+        """
+        def total(stakes):
+            stakes = stakes.values() if isinstance(stakes, dict) else [v for _, v in stakes]
+            return sum(stakes)
+        return np.array([total(stake_from.get(k, [])) for k in keys], dtype=dtype)
+
+    @staticmethod
+    def normalize(x:np.ndarray, axis:int = None) -> np.ndarray:
+        total = x.sum(axis=axis, keepdims=axis != None)
+        return np.divide(x, total, out=np.zeros_like(x, dtype=np.float64), where=total > 0)
+
+    @staticmethod
+    def weighted_quantile(W:np.ndarray, S:np.ndarray, q:float) -> np.ndarray:
+        """
+        The stake weighted q quantile of every column of W, computed for all columns at once.
+        Weight matrices are mostly zeros, so only the nonzero entries are sorted.
+        """
+        total = S.sum()
+        consensus = np.zeros(W.shape[1])
+        if total <= 0:
+            return consensus
+        # the stake of the voters that give a column zero weight sits at the bottom of its order
+        zero_stake = total - S @ (W > 0)
+        rows, cols = np.nonzero(W)
+        values = W[rows, cols]
+        if len(values) == 0:
+            return consensus
+        # one sort by column then value (a single key is much faster than lexsort)
+        order = np.argsort(cols * (values.max() + 1) + values, kind='stable')
+        cols, rows, values = cols[order], rows[order], values[order]
+        stake = S[rows]
+        cum_stake = np.cumsum(stake)
+        starts = np.searchsorted(cols, cols)
+        cum_stake = cum_stake - cum_stake[starts] + stake[starts] + zero_stake[cols]
+        reached = np.flatnonzero(cum_stake >= q * total)
+        reached_cols, first = np.unique(cols[reached], return_index=True)
+        consensus[reached_cols] = values[reached[first]]
+        consensus[zero_stake >= q * total] = 0
+        return consensus
+
+    def epoch(self,
+              W:np.ndarray,
+              S:np.ndarray,
+              last_update:np.ndarray = None,
+              block:int = None,
+              bonds:np.ndarray = None) -> Dict[str, np.ndarray]:
+        """
+        Runs one epoch and returns the trust, incentive, dividends, emission and bonds per uid.
+        """
+        config = self.config
+        n = W.shape[0]
+        S = np.asarray(S, dtype=np.float64)
+        W = np.array(W, dtype=np.float64)
+        np.fill_diagonal(W, 0)
+
+        # only voters with enough stake and fresh weights count
+        voter = S >= config.min_weight_stake
+        if config.max_weight_age != None and last_update is not None and block != None:
+            voter &= (block - np.asarray(last_update)) <= config.max_weight_age
+        W[~voter] = 0
+        S = self.normalize(np.where(voter, S, 0))
+        W = self.normalize(W, axis=1)
+
+        if config.kappa != None:
+            consensus = self.weighted_quantile(W, S, config.kappa)
+            W = np.minimum(W, consensus[None, :])
+
+        trust = S @ (W > 0)
+        incentive = self.normalize(S @ W)
+        if config.trust_ratio > 0:
+            trust_ratio = config.trust_ratio / 100
+            incentive = self.normalize((1 - trust_ratio) * incentive + trust_ratio * self.normalize(trust))
+
+        new_bonds = self.normalize(S[:, None] * W, axis=0)
+        if config.bonds_alpha != None and bonds is not None:
+            new_bonds = config.bonds_alpha * new_bonds + (1 - config.bonds_alpha) * bonds
+        dividends = self.normalize(new_bonds @ incentive)
+
+        total = config.emission_per_epoch
+        founder_emission = total * config.founder_share / 100
+        total = total - founder_emission
+        incentive_ratio = config.incentive_ratio / 100
+        emission = total * (incentive_ratio * incentive + (1 - incentive_ratio) * dividends)
+        if founder_emission > 0 and config.founder_uid < n:
+            emission[config.founder_uid] += founder_emission
+
+        return {'trust': trust,
+                'incentive': incentive,
+                'dividends': dividends,
+                'emission': emission,
+                'bonds': new_bonds}
+
+    def simulate(self,
+                 W:np.ndarray,
+                 S:np.ndarray,
+                 epochs:int = 100,
+                 strategy:Callable = None,
+                 compound:bool = True,
+                 last_update:np.ndarray = None,
+                 block:int = None,
+                 tempo:int = 100) -> Dict[str, np.ndarray]:
+        """
+        Runs many epochs and returns every output stacked as [epochs, n] arrays.
+        strategy(epoch, W, result) can return new weights between epochs (e.g. a vote strategy to backtest).
+        With compound, the emission of an epoch is added to the stake of the next one.
+        """
+        S = np.array(S, dtype=np.float64)
+        W = np.asarray(W)
+        history = {k: [] for k in ['trust', 'incentive', 'dividends', 'emission', 'stake']}
+        bonds = None
+        for epoch in range(epochs):
+            result = self.epoch(W, S, last_update=last_update, block=block, bonds=bonds)
+            bonds = result['bonds']
+            for k in ['trust', 'incentive', 'dividends', 'emission']:
+                history[k].append(result[k])
+            history['stake'].append(S.copy())
+            if compound:
+                S = S + result['emission']
+            if block != None:
+                block += tempo
+            if strategy != None:
+                new_W = strategy(epoch, W, result)
+                if new_W is not None:
+                    new_W = np.asarray(new_W)
+                    if last_update is not None and block != None:
+                        # the voters that changed their weights have fresh weights
+                        last_update = np.array(last_update)
+                        last_update[(new_W != W).any(axis=1)] = block
+                    W = new_W
+        return {k: np.stack(v) for k,v in history.items()}
+
+    @classmethod
+    def from_chain(cls, netuid:int = 0, network:str = 'main', update:bool = False, **kwargs) -> dict:
+        """
+        The simulator and its inputs (W, S, last_update, block, keys) from the live chain.
+        """
+        subspace = c.module('subspace')(network=network)
+        subnet_params = subspace.subnet_params(netuid=netuid, update=update)
+        global_params = subspace.global_params(update=update)
+        keys = subspace.query_map('Keys', netuid=netuid, update=update)
+        keys = [keys[uid] for uid in sorted(keys)]
+        stake_from = subspace.query_map('StakeFrom', netuid=netuid, update=update)
+        return {'consensus': cls.from_params(subnet_params, global_params, **kwargs),
+                'W': cls.weight_matrix(subspace.weights(netuid=netuid, update=update), n=len(keys)),
+                'S': cls.stake_vector(stake_from, keys),
+                'last_update': np.array(subspace.last_update(netuid=netuid, update=update)),
+                'block': subspace.block,
+                'keys': keys}
+
+    @classmethod
+    def from_state(cls, state:dict, weights:Dict[int, List[list]] = None, netuid:int = 0, **kwargs) -> dict:
+        """
+        The simulator and its inputs from an archived state (Subspace.state_dict or Subspace.state_at).
+        The state holds no weights, so they are passed separately (or start from zero).
+        """
+        modules = state['modules']
+        modules = list(modules.values()) if isinstance(modules, dict) else modules
+        keys = [m['key'] for m in modules]
+        subnets = state.get('subnets', {})
+        subnet_params = subnets.get(netuid, subnets) if isinstance(subnets, dict) else {}
+        return {'consensus': cls.from_params(subnet_params, state.get('global', {}), **kwargs),
+                'W': cls.weight_matrix(weights or {}, n=len(keys)),
+                'S': cls.stake_vector({m['key']: m['stake_from'] for m in modules}, keys),
+                'last_update': np.array([m.get('last_update', 0) for m in modules]),
+                'block': state.get('block'),
+                'keys': keys}
+
+    def test_consensus(self, n:int = 64):
+        self = Consensus(incentive_ratio=50, kappa=0.5, emission_per_epoch=100)
+        rng = np.random.default_rng(0)
+        S = np.ones(n)
+        W = np.tile(rng.random(n), (n, 1))
+        # a colluding minority with 10% of the stake puts all its weight on itself
+        cabal = np.arange(n // 10)
+        W[cabal] = 0
+        W[np.ix_(cabal, cabal)] = 1
+        result = self.epoch(W, S)
+        assert np.isclose(result['emission'].sum(), 100), result['emission'].sum()
+        assert np.isclose(result['incentive'].sum(), 1) and np.isclose(result['dividends'].sum(), 1)
+        unclipped = Consensus(incentive_ratio=50, emission_per_epoch=100).epoch(W, S)
+        assert result['incentive'][cabal].sum() < unclipped['incentive'][cabal].sum(), 'clipping did not cut the cabal'
+
+        # stale voters and voters without enough stake are ignored
+        last_update = np.zeros(n)
+        last_update[cabal] = 1000
+        stale = Consensus(max_weight_age=100, min_weight_stake=0).epoch(W, S, last_update=last_update, block=1050)
+        assert stale['trust'][~np.isin(np.arange(n), cabal)].sum() == 0
+
+        # no weights at all, or no voter left after filtering, gives a zero consensus
+        empty = Consensus(kappa=0.5).epoch(np.zeros((4, 4)), np.ones(4))
+        assert np.all(empty['incentive'] == 0) and np.all(empty['trust'] == 0)
+        filtered = Consensus(kappa=0.5, min_weight_stake=10).epoch(W, S)
+        assert np.all(filtered['incentive'] == 0)
+
+        history = self.simulate(W, S, epochs=10)
+        assert history['emission'].shape == (10, n)
+        assert np.isclose(history['stake'][-1].sum(), n + 900)
+        return {'success': True, 'msg': 'consensus test passed'}
+
+    def test_simulate_speed(self, n:int = 4096, epochs:int = 10):
+        self = Consensus(kappa=0.5, bonds_alpha=0.1)
+        rng = np.random.default_rng(0)
+        W = rng.random((n, n)) * (rng.random((n, n)) < 0.05)
+        S = rng.random(n)
+        t0 = c.time()
+        self.simulate(W, S, epochs=epochs)
+        seconds = c.time() - t0
+        return {'success': True, 'uids': n, 'epochs': epochs, 'seconds_per_epoch': seconds / epochs}
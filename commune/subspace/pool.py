@@ -0,0 +1,419 @@
+import json
+import queue
+import hashlib
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import *
+import commune as c
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    """
+    Answers json-rpc calls (and batches of them) with the methods of SubstratePool.serve_stub.
+    It is defined before SubstratePool, since a module resolves to the last class of its file.
+    """
+    def do_POST(self):
+        methods, stats = self.server.methods, self.server.stats
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        stats['requests'] += 1
+        batch = body if isinstance(body, list) else [body]
+        responses = []
+        for request in batch:
+            stats['calls'] += 1
+            fn = methods.get(request['method'])
+            if fn == None:
+                responses.append({'jsonrpc': '2.0', 'id': request['id'], 'error': {'code': -32601, 'message': 'Method not found'}})
+            else:
+                responses.append({'jsonrpc': '2.0', 'id': request['id'], 'result': fn(request.get('params', []))})
+        data = json.dumps(responses if isinstance(body, list) else responses[0]).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args, **kwargs):
+        pass
+
+
+class SubstratePool(c.Module):
+    """
+    A pool of persistent substrate connections per endpoint.
+
+    Every endpoint (url) gets up to num_connections SubstrateInterface objects that are
+    checked out by one thread at a time, health checked when they have been idle,
+    and reconnected with exponential backoff when they break. Many storage queries
+    (or raw json-rpc calls) can be pipelined into a single round trip.
+    """
+
+    # the pools are shared across instances so that every Subspace in the process reuses the same sockets
+    url2pool = {}
+    url2stats = {}
+    url2session = {}
+    lock = threading.Lock()
+    # the connections that get_substrate pins to each thread
+    thread_local = threading.local()
+
+    default_substrate_kwargs = dict(ss58_format=42,
+                                    type_registry_preset='substrate-node-template',
+                                    auto_discover=True,
+                                    auto_reconnect=True)
+
+    def __init__(self,
+                 num_connections:int = 4,
+                 health_interval:int = 30,
+                 backoff:float = 0.5,
+                 max_backoff:float = 16,
+                 trials:int = 4,
+                 timeout:int = 30,
+                 substrate_kwargs:dict = None):
+        self.set_config(kwargs=locals())
+        self.substrate_kwargs = {**self.default_substrate_kwargs, **(substrate_kwargs or {})}
+
+    def stats(self, url:str = None) -> dict:
+        if url != None:
+            return self.url2stats.get(url, {})
+        return dict(self.url2stats)
+
+    def update_stats(self, url:str, **increments):
+        with self.lock:
+            stats = self.url2stats.setdefault(url, {'connects': 0, 'reconnects': 0, 'failures': 0, 'checkouts': 0, 'batches': 0, 'calls': 0})
+            for k,v in increments.items():
+                stats[k] = stats.get(k, 0) + v
+        return stats
+
+    def pool_key(self, url:str, **kwargs) -> str:
+        """
+        Connections opened with other substrate kwargs (ss58_format, type_registry, ...) than the defaults get their own pool.
+        """
+        kwargs = {k: v for k, v in kwargs.items() if v != None and self.substrate_kwargs.get(k) != v}
+        if len(kwargs) == 0:
+            return url
+        return f'{url}#{hashlib.sha256(json.dumps(kwargs, sort_keys=True, default=str).encode()).hexdigest()[:16]}'
+
+    def get_pool(self, url:str, **kwargs) -> dict:
+        key = self.pool_key(url, **kwargs)
+        with self.lock:
+            if key not in self.url2pool:
+                self.url2pool[key] = {'url': url, 'kwargs': kwargs, 'idle': queue.LifoQueue(), 'size': 0, 'all': []}
+            return self.url2pool[key]
+
+    def backoff_time(self, trial:int) -> float:
+        return min(self.config.backoff * (2 ** trial), self.config.max_backoff)
+
+    def connect(self, url:str, trials:int = None, **kwargs) -> 'SubstrateInterface':
+        """
+        Opens a new connection to the url, retrying with exponential backoff.
+        """
+        from substrateinterface import SubstrateInterface
+        trials = trials or self.config.trials
+        kwargs = {**self.substrate_kwargs, **kwargs}
+        for trial in range(trials):
+            try:
+                substrate = SubstrateInterface(url=url, **kwargs)
+                self.update_stats(url, connects=1)
+                return substrate
+            except Exception as e:
+                self.update_stats(url, failures=1)
+                if trial == trials - 1:
+                    raise e
+                sleep_time = self.backoff_time(trial)
+                c.print(f'Failed to connect to {url} ({e}), retrying in {sleep_time}s', color='red')
+                c.sleep(sleep_time)
+
+    def is_healthy(self, substrate:'SubstrateInterface') -> bool:
+        try:
+            substrate.rpc_request('system_health', [])
+            return True
+        except Exception as e:
+            return False
+
+    def close_connection(self, substrate:'SubstrateInterface'):
+        try:
+            substrate.close()
+        except Exception as e:
+            pass
+
+    def checkout(self, url:str, timeout:int = None, **kwargs) -> dict:
+        pool = self.get_pool(url, **kwargs)
+        timeout = timeout or self.config.timeout
+        conn = None
+        with self.lock:
+            if pool['idle'].empty() and pool['size'] < self.config.num_connections:
+                # reserve the slot before connecting so that we dont overshoot the pool size
+                pool['size'] += 1
+                conn = {'substrate': None, 'last_check': 0, 'healthy': True}
+        if conn == None:
+            conn = pool['idle'].get(timeout=timeout)
+        if conn['substrate'] == None:
+            try:
+                conn['substrate'] = self.connect(url, **pool['kwargs'])
+            except Exception as e:
+                with self.lock:
+                    pool['size'] -= 1
+                raise e
+            conn['last_check'] = c.time()
+            with self.lock:
+                pool['all'].append(conn)
+        elif not conn['healthy'] or (c.time() - conn['last_check'] > self.config.health_interval):
+            if not conn['healthy'] or not self.is_healthy(conn['substrate']):
+                self.reconnect(url, conn, **pool['kwargs'])
+            conn['last_check'] = c.time()
+        self.update_stats(url, checkouts=1)
+        return conn
+
+    def checkin(self, url:str, conn:dict, **kwargs):
+        self.get_pool(url, **kwargs)['idle'].put(conn)
+
+    def reconnect(self, url:str, conn:dict, **kwargs):
+        self.close_connection(conn['substrate'])
+        conn['substrate'] = self.connect(url, **kwargs)
+        conn['healthy'] = True
+        self.update_stats(url, reconnects=1)
+        return conn
+
+    @contextmanager
+    def connection(self, url:str, timeout:int = None, **kwargs):
+        """
+        Checks out a connection for exclusive use by the calling thread.
+        If the body raises a connection error, the connection is marked as unhealthy
+        and is reconnected the next time it is checked out.
+        kwargs are the substrate kwargs of the connection (see pool_key).
+        """
+        conn = self.checkout(url, timeout=timeout, **kwargs)
+        try:
+            yield conn['substrate']
+        except (ConnectionError, BrokenPipeError, TimeoutError, OSError) as e:
+            conn['healthy'] = False
+            self.update_stats(url, failures=1)
+            raise e
+        except Exception as e:
+            if 'Connection' in type(e).__name__:
+                conn['healthy'] = False
+                self.update_stats(url, failures=1)
+            raise e
+        finally:
+            self.checkin(url, conn, **kwargs)
+
+    def get_substrate(self, url:str, **kwargs) -> 'SubstrateInterface':
+        """
+        Returns the connection of the calling thread, opened on its first call and never shared with other threads.
+        Use connection() for short uses, which share the pool instead of holding a connection per thread.
+        """
+        key = self.pool_key(url, **kwargs)
+        substrates = self.thread_local.__dict__.setdefault('substrates', {})
+        if key not in substrates:
+            substrates[key] = self.connect(url, **kwargs)
+        return substrates[key]
+
+    def get_session(self, url:str) -> 'requests.Session':
+        import requests
+        with self.lock:
+            if url not in self.url2session:
+                self.url2session[url] = requests.Session()
+            return self.url2session[url]
+
+    def rpc_batch(self, calls:List[Union[tuple, dict]], url:str, trials:int = None) -> List[Any]:
+        """
+        Sends many json-rpc calls in a single round trip and returns the results in order.
+        calls is a list of (method, params) tuples or {'method': .., 'params': ..} dicts.
+        """
+        trials = trials or self.config.trials
+        batch = []
+        for i, call in enumerate(calls):
+            if isinstance(call, dict):
+                method, params = call['method'], call.get('params', [])
+            else:
+                method, params = call
+            batch.append({'jsonrpc': '2.0', 'id': i, 'method': method, 'params': params})
+        if len(batch) == 0:
+            return []
+
+        for trial in range(trials):
+            try:
+                if url.startswith('ws'):
+                    with self.connection(url) as substrate:
+                        substrate.websocket.send(json.dumps(batch))
+                        responses = json.loads(substrate.websocket.recv())
+                else:
+                    session = self.get_session(url)
+                    responses = session.post(url, json=batch, timeout=self.config.timeout).json()
+                break
+            except Exception as e:
+                self.update_stats(url, failures=1)
+                if trial == trials - 1:
+                    raise e
+                c.sleep(self.backoff_time(trial))
+
+        self.update_stats(url, batches=1, calls=len(batch))
+        if isinstance(responses, dict):
+            responses = [responses]
+        id2response = {r['id']: r for r in responses}
+        results = []
+        for request in batch:
+            response = id2response.get(request['id'], {'error': 'missing response'})
+            results.append(response.get('result', response.get('error')))
+        return results
+
+    def query_batch(self,
+                    url:str,
+                    name:str,
+                    params_batch:List[list],
+                    module:str = 'SubspaceModule',
+                    block_hash:str = None,
+                    batch_size:int = 512) -> List[Any]:
+        """
+        Queries the same storage function for many params with one state_queryStorageAt
+        round trip per batch_size keys.
+        """
+        queries = [(module, name, p if isinstance(p, list) else [p]) for p in params_batch]
+        return self.query_multi(url=url, queries=queries, block_hash=block_hash, batch_size=batch_size)
+
+    def query_multi(self,
+                    url:str,
+                    queries:List[tuple],
+                    block_hash:str = None,
+                    batch_size:int = 512,
+                    values:bool = True) -> List[Any]:
+        """
+        Queries a list of (module, storage_function, params) in as few round trips as possible.
+        """
+        results = []
+        with self.connection(url) as substrate:
+            storage_keys = [substrate.create_storage_key(*q) for q in queries]
+            for keys in c.chunk(storage_keys, chunk_size=batch_size):
+                results += substrate.query_multi(keys, block_hash=block_hash)
+        self.update_stats(url, batches=1, calls=len(queries))
+        if values:
+            results = [getattr(v, 'value', v) for k, v in results]
+        return results
+
+    def close(self, url:str = None):
+        keys = [k for k, pool in self.url2pool.items() if url == None or pool['url'] == url]
+        urls = set([self.url2pool[k]['url'] for k in keys])
+        for key in keys:
+            pool = self.url2pool.pop(key, None)
+            if pool == None:
+                continue
+            for conn in pool['all']:
+                self.close_connection(conn['substrate'])
+        for url in urls:
+            session = self.url2session.pop(url, None)
+            if session != None:
+                session.close()
+        return {'success': True, 'msg': f'Closed {len(keys)} pools'}
+
+    @classmethod
+    def serve_stub(cls, port:int = None, methods:Dict[str, Callable] = None) -> dict:
+        """
+        Serves a local json-rpc stub over http for testing.
+        Each method maps to a function that takes the params and returns the result.
+        """
+        methods = methods or {}
+        methods = {'system_health': lambda params: {'peers': 0, 'isSyncing': False, 'shouldHavePeers': False},
+                   'echo': lambda params: params,
+                   **methods}
+        stats = {'requests': 0, 'calls': 0}
+        port = port or c.free_port()
+        server = ThreadingHTTPServer(('127.0.0.1', port), _StubHandler)
+        server.methods, server.stats = methods, stats
+        c.thread(server.serve_forever)
+        return {'server': server, 'url': f'http://127.0.0.1:{port}', 'port': port, 'stats': stats}
+
+    def test_rpc_batch(self, n:int = 100):
+        stub = self.serve_stub()
+        calls = [('echo', [i]) for i in range(n)]
+        results = self.rpc_batch(calls, url=stub['url'])
+        assert results == [[i] for i in range(n)], f'results out of order {results[:4]}'
+        assert stub['stats']['requests'] == 1, f'expected one round trip, got {stub["stats"]["requests"]}'
+        assert stub['stats']['calls'] == n
+        stub['server'].shutdown()
+        stub['server'].server_close()
+        return {'success': True, 'msg': f'{n} calls in one round trip'}
+
+    def test_reconnect(self):
+        stub = self.serve_stub()
+        url, port = stub['url'], stub['port']
+        assert self.rpc_batch([('system_health', [])], url=url)[0]['isSyncing'] == False
+        stub['server'].shutdown()
+        stub['server'].server_close()
+
+        def restart():
+            c.sleep(self.backoff_time(0))
+            restart.stub = self.serve_stub(port=port)
+        c.thread(restart)
+        # the first trial fails and the backoff gives the stub time to come back
+        results = self.rpc_batch([('echo', ['hey'])], url=url, trials=4)
+        assert results == [['hey']], results
+        assert self.stats(url)['failures'] >= 1
+        restart.stub['server'].shutdown()
+        restart.stub['server'].server_close()
+        return {'success': True, 'msg': 'reconnected with backoff', 'stats': self.stats(url)}
+
+    def test_rpc_batch_ws(self, n:int = 100):
+        url = 'ws://stub:9944'
+        self.connect = lambda url, **kwargs: StubSubstrate(url, **kwargs)
+        results = self.rpc_batch([('echo', [i]) for i in range(n)], url=url)
+        assert results == [[i] for i in range(n)], f'results out of order {results[:4]}'
+        with self.connection(url) as substrate:
+            assert substrate.websocket.requests == 1, f'expected one round trip, got {substrate.websocket.requests}'
+        self.close(url)
+        return {'success': True, 'msg': f'{n} calls in one websocket round trip'}
+
+    def test_get_substrate(self):
+        url = 'ws://stub:9944'
+        self.connect = lambda url, **kwargs: StubSubstrate(url, **kwargs)
+        substrate = self.get_substrate(url)
+        assert self.get_substrate(url) is substrate
+        # other threads get their own connection
+        others = []
+        threads = [threading.Thread(target=lambda: others.append(self.get_substrate(url))) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(set(map(id, others + [substrate]))) == 5
+        # other kwargs get other connections, opened with them
+        other = self.get_substrate(url, ss58_format=2)
+        assert other is not substrate and other.kwargs['ss58_format'] == 2
+        with self.connection(url, ss58_format=2) as pooled:
+            assert pooled.kwargs['ss58_format'] == 2
+        assert self.pool_key(url, ss58_format=42) == url != self.pool_key(url, ss58_format=2)
+        self.close(url)
+        return {'success': True, 'msg': 'get_substrate pins a connection per thread and kwargs'}
+
+
+class StubSubstrate:
+    """
+    An in-process stand-in for a SubstrateInterface with a websocket that answers json-rpc batches (in reverse order).
+    """
+    def __init__(self, url:str, **kwargs):
+        self.url = url
+        self.kwargs = kwargs
+        self.websocket = StubWebsocket()
+
+    def rpc_request(self, method:str, params:list):
+        return {'result': self.websocket.answer({'id': 0, 'method': method, 'params': params})['result']}
+
+    def close(self):
+        pass
+
+
+class StubWebsocket:
+    def __init__(self):
+        self.requests = 0
+        self.responses = []
+
+    def answer(self, request:dict) -> dict:
+        if request['method'] == 'system_health':
+            return {'jsonrpc': '2.0', 'id': request['id'], 'result': {'peers': 0, 'isSyncing': False}}
+        return {'jsonrpc': '2.0', 'id': request['id'], 'result': request['params']}
+
+    def send(self, data:str):
+        self.requests += 1
+        batch = json.loads(data)
+        self.responses.append(json.dumps([self.answer(r) for r in reversed(batch)]))
+
+    def recv(self) -> str:
+        return self.responses.pop(0)
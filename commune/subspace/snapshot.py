@@ -0,0 +1,363 @@
+import os
+import struct
+import bisect
+import threading
+from typing import *
+import commune as c
+
+
+class Snapshot(c.Module):
+    """
+    Incremental chain state snapshots.
+
+    Every snapshot is flattened into {path tuple: value} and appended to {network}.snapshots
+    as a msgpack record with three columns (keys, values, removed). Every base_interval
+    records a full base is written, the records in between only hold the keys that changed.
+    {network}.index holds one fixed size (block, offset, length, is_base) row per record,
+    so a block resolves to its record with a binary search and a single seek.
+
+    Every value that changed is also appended on its own to {network}.values, with a
+    (key id, block, offset, length, removed) row in {network}.columns and the key in {network}.keys,
+    so the history of one key (series) is read without decoding whole states.
+    """
+    index_format = '<QQQB'
+    index_row_size = struct.calcsize(index_format)
+    column_format = '<IQQIB'
+    column_row_size = struct.calcsize(column_format)
+    missing = object()
+
+    def __init__(self,
+                 network:str = 'main',
+                 path:str = 'snapshots',
+                 base_interval:int = 100):
+        self.set_config(kwargs=locals())
+        self.dirpath = self.resolve_path(path)
+        os.makedirs(self.dirpath, exist_ok=True)
+        self.data_path = os.path.join(self.dirpath, f'{network}.snapshots')
+        self.index_path = os.path.join(self.dirpath, f'{network}.index')
+        self.keys_path = os.path.join(self.dirpath, f'{network}.keys')
+        self.columns_path = os.path.join(self.dirpath, f'{network}.columns')
+        self.values_path = os.path.join(self.dirpath, f'{network}.values')
+        self.lock = threading.Lock()
+        self.head = None # (block, flat state) of the newest record, used to diff the next one
+        self.load_index()
+        self.load_columns()
+        if len(self.index_blocks) > 0 and not os.path.exists(self.keys_path):
+            self.build_columns()
+
+    def load_index(self):
+        self.index_blocks, self.index_offsets, self.index_lengths, self.base_positions = [], [], [], []
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, 'rb') as f:
+            data = f.read()
+        # ignore a torn trailing row
+        data = data[:len(data) - len(data) % self.index_row_size]
+        for block, offset, length, is_base in struct.iter_unpack(self.index_format, data):
+            self.add_index_row(block, offset, length, is_base)
+
+    def add_index_row(self, block:int, offset:int, length:int, is_base:bool):
+        if is_base:
+            self.base_positions.append(len(self.index_blocks))
+        self.index_blocks.append(block)
+        self.index_offsets.append(offset)
+        self.index_lengths.append(length)
+
+    def load_columns(self):
+        import msgpack
+        self.key_ids = {}
+        self.key_rows = {} # key id -> ([block], [offset], [length], [removed]), in block order
+        if os.path.exists(self.keys_path):
+            with open(self.keys_path, 'rb') as f:
+                # a torn trailing key is not yielded
+                for key in msgpack.Unpacker(f, raw=False, strict_map_key=False):
+                    self.key_ids[tuple(key)] = len(self.key_ids)
+        if not os.path.exists(self.columns_path):
+            return
+        with open(self.columns_path, 'rb') as f:
+            data = f.read()
+        data = data[:len(data) - len(data) % self.column_row_size]
+        latest_block = self.latest_block()
+        for key_id, block, offset, length, removed in struct.iter_unpack(self.column_format, data):
+            # rows written before a crash that left their record unindexed
+            if key_id >= len(self.key_ids) or latest_block == None or block > latest_block:
+                continue
+            self.add_column_row(key_id, block, offset, length, removed)
+
+    def add_column_row(self, key_id:int, block:int, offset:int, length:int, removed:bool):
+        rows = self.key_rows.setdefault(key_id, ([], [], [], []))
+        for column, v in zip(rows, [block, offset, length, bool(removed)]):
+            column.append(v)
+
+    def write_columns(self, block:int, changed:Dict[tuple, Any], removed:List[tuple]):
+        """
+        Appends the values that changed at block, and the keys that were removed, to the columns.
+        """
+        import msgpack
+        new_keys = [k for k in list(changed) + removed if k not in self.key_ids]
+        if len(new_keys) > 0:
+            with open(self.keys_path, 'ab') as f:
+                for k in new_keys:
+                    f.write(msgpack.packb(list(k), use_bin_type=True))
+                    self.key_ids[k] = len(self.key_ids)
+        values = [msgpack.packb(v, use_bin_type=True) for v in changed.values()]
+        with open(self.values_path, 'ab') as f:
+            offset = f.tell()
+            f.write(b''.join(values))
+            f.flush()
+            os.fsync(f.fileno())
+        rows = []
+        for k, value in zip(changed, values):
+            rows.append((self.key_ids[k], block, offset, len(value), False))
+            offset += len(value)
+        rows += [(self.key_ids[k], block, 0, 0, True) for k in removed]
+        with open(self.columns_path, 'ab') as f:
+            f.write(b''.join(struct.pack(self.column_format, *row) for row in rows))
+        for row in rows:
+            self.add_column_row(*row)
+
+    def build_columns(self):
+        """
+        Writes the columns of snapshots that were taken before there were columns.
+        """
+        state = {}
+        base_positions = set(self.base_positions)
+        with open(self.data_path, 'rb') as f:
+            for p in range(len(self.index_blocks)):
+                record = self.read_record(p, f=f)
+                flat = {} if p in base_positions else dict(state)
+                for k in record['removed']:
+                    flat.pop(k, None)
+                flat.update(zip(record['keys'], record['values']))
+                changed = {k: v for k, v in flat.items() if state.get(k, self.missing) != v}
+                self.write_columns(record['block'], changed, [k for k in state if k not in flat])
+                state = flat
+        return {'success': True, 'msg': f'Built the columns of {len(self.index_blocks)} snapshots', 'keys': len(self.key_ids)}
+
+    def blocks(self) -> List[int]:
+        return list(self.index_blocks)
+
+    def latest_block(self) -> Optional[int]:
+        return self.index_blocks[-1] if len(self.index_blocks) > 0 else None
+
+    @classmethod
+    def flatten(cls, x:dict, prefix:tuple = ()) -> Dict[tuple, Any]:
+        flat = {}
+        for k, v in x.items():
+            if isinstance(v, dict) and len(v) > 0:
+                flat.update(cls.flatten(v, prefix + (k,)))
+            else:
+                flat[prefix + (k,)] = v
+        return flat
+
+    @staticmethod
+    def unflatten(flat:Dict[tuple, Any]) -> dict:
+        x = {}
+        for path, v in flat.items():
+            d = x
+            for k in path[:-1]:
+                d = d.setdefault(k, {})
+            d[path[-1]] = v
+        return x
+
+    @staticmethod
+    def resolve_key(key:Union[str, tuple, list]) -> tuple:
+        """
+        'modules/0/5F..' -> ('modules', 0, '5F..')
+        """
+        if isinstance(key, str):
+            key = [int(k) if k.isdigit() else k for k in key.split('/')]
+        return tuple(key)
+
+    def read_record(self, position:int, f=None) -> dict:
+        import msgpack
+        close = f == None
+        f = f or open(self.data_path, 'rb')
+        try:
+            f.seek(self.index_offsets[position])
+            record = msgpack.unpackb(f.read(self.index_lengths[position]), raw=False, strict_map_key=False)
+        finally:
+            if close:
+                f.close()
+        record['keys'] = [tuple(k) for k in record['keys']]
+        record['removed'] = [tuple(k) for k in record['removed']]
+        return record
+
+    def write_record(self, record:dict, is_base:bool):
+        import msgpack
+        data = msgpack.packb(record, use_bin_type=True)
+        with open(self.data_path, 'ab') as f:
+            offset = f.tell()
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        # the index row is written after the data, so a crash never indexes a partial record
+        with open(self.index_path, 'ab') as f:
+            f.write(struct.pack(self.index_format, record['block'], offset, len(data), int(is_base)))
+        self.add_index_row(record['block'], offset, len(data), is_base)
+        return {'block': record['block'], 'offset': offset, 'size': len(data), 'base': is_base}
+
+    def add(self, state:dict, block:int, block_hash:str = None) -> dict:
+        """
+        Appends the state at block, as a base or as a delta against the previous snapshot.
+        """
+        with self.lock:
+            latest_block = self.latest_block()
+            assert latest_block == None or block > latest_block, f'block {block} is not newer than {latest_block}'
+            flat = self.flatten(state)
+            since_base = len(self.index_blocks) - self.base_positions[-1] if len(self.base_positions) > 0 else None
+            is_base = since_base == None or since_base >= self.config.base_interval
+            if latest_block != None and self.head == None:
+                self.head = (latest_block, self.state_at(latest_block, flat=True))
+            prev = self.head[1] if self.head != None else {}
+            changed = [k for k, v in flat.items() if prev.get(k, self.missing) != v]
+            removed = [k for k in prev if k not in flat]
+            # the columns only ever hold changes, bases included
+            self.write_columns(block, {k: flat[k] for k in changed}, removed)
+            if is_base:
+                keys, removed = list(flat.keys()), []
+            else:
+                keys = changed
+            record = {'block': block,
+                      'block_hash': block_hash,
+                      'timestamp': c.time(),
+                      'keys': keys,
+                      'values': [flat[k] for k in keys],
+                      'removed': removed}
+            response = self.write_record(record, is_base=is_base)
+            self.head = (block, flat)
+        response['changed'] = len(keys)
+        response['removed'] = len(removed)
+        return response
+
+    def base_position(self, position:int) -> int:
+        idx = bisect.bisect_right(self.base_positions, position) - 1
+        assert idx >= 0, f'no base snapshot before position {position}'
+        return self.base_positions[idx]
+
+    def position(self, block:int) -> int:
+        """
+        The position of the newest record at or before block.
+        """
+        position = bisect.bisect_right(self.index_blocks, block) - 1
+        assert position >= 0, f'no snapshot at or before block {block}'
+        return position
+
+    def snapshot_at(self, block:int = None) -> Optional[dict]:
+        """
+        The state of the newest snapshot at or before block, with the block and block_hash of that snapshot,
+        or None when there is none.
+        """
+        block = self.latest_block() if block == None else block
+        if block == None or len(self.index_blocks) == 0 or block < self.index_blocks[0]:
+            return None
+        position = self.position(block)
+        record = self.read_record(position)
+        return {'block': record['block'], 'block_hash': record.get('block_hash'), **self.state_at(record['block'])}
+
+    def state_at(self, block:int = None, flat:bool = False) -> dict:
+        """
+        Reconstructs the state at block (the newest snapshot if None) from its base and deltas.
+        """
+        block = self.latest_block() if block == None else block
+        assert block != None, 'there are no snapshots'
+        position = self.position(block)
+        state = {}
+        with open(self.data_path, 'rb') as f:
+            for p in range(self.base_position(position), position + 1):
+                record = self.read_record(p, f=f)
+                for k in record['removed']:
+                    state.pop(k, None)
+                state.update(zip(record['keys'], record['values']))
+        return state if flat else self.unflatten(state)
+
+    def series(self, key:Union[str, tuple], start_block:int = None, end_block:int = None, last_n:int = None) -> Dict[int, Any]:
+        """
+        The value of key at every snapshot between start_block and end_block,
+        e.g. series('balances/5F..', last_n=1000). Only the values of key that changed in the range are read.
+        """
+        import msgpack
+        key = self.resolve_key(key)
+        end_block = self.latest_block() if end_block == None else end_block
+        if last_n != None:
+            start_block = end_block - last_n
+        start_block = self.index_blocks[0] if start_block == None else max(start_block, self.index_blocks[0])
+        start = self.position(start_block)
+        end = self.position(end_block)
+        series = {}
+        key_id = self.key_ids.get(key)
+        if key_id == None:
+            return series
+        blocks, offsets, lengths, removed = self.key_rows[key_id]
+        # the last change at or before the first snapshot of the range
+        i = bisect.bisect_right(blocks, self.index_blocks[start]) - 1
+        values = {}
+        with open(self.values_path, 'rb') as f:
+            for p in range(start, end + 1):
+                block = self.index_blocks[p]
+                while i + 1 < len(blocks) and blocks[i + 1] <= block:
+                    i += 1
+                if i < 0 or removed[i]:
+                    continue
+                if i not in values:
+                    f.seek(offsets[i])
+                    values[i] = msgpack.unpackb(f.read(lengths[i]), raw=False, strict_map_key=False)
+                series[block] = values[i]
+        return series
+
+    def stats(self) -> dict:
+        return {'records': len(self.index_blocks),
+                'bases': len(self.base_positions),
+                'keys': len(self.key_ids),
+                'first_block': self.index_blocks[0] if len(self.index_blocks) > 0 else None,
+                'latest_block': self.latest_block(),
+                'size': os.path.getsize(self.data_path) if os.path.exists(self.data_path) else 0}
+
+    def clear(self):
+        for path in [self.data_path, self.index_path, self.keys_path, self.columns_path, self.values_path]:
+            if os.path.exists(path):
+                os.remove(path)
+        self.head = None
+        self.load_index()
+        self.load_columns()
+        return {'success': True, 'msg': f'Cleared {self.data_path}'}
+
+    def test_snapshot(self, n:int = 250, num_keys:int = 200):
+        import random
+        self = Snapshot(network='test', path='test_snapshots', base_interval=50)
+        self.clear()
+        state = {'balances': {f'key{i}': i for i in range(num_keys)}, 'subnets': {0: {'tempo': 100}}}
+        block2state = {}
+        for block in range(0, n * 2, 2):
+            # a few balances change every block, and one key comes and goes
+            for i in random.sample(range(num_keys), 3):
+                state['balances'][f'key{i}'] += 1
+            if block % 10 == 0:
+                state['balances'].pop('ephemeral', None)
+            else:
+                state['balances']['ephemeral'] = block
+            self.add(state, block=block)
+            block2state[block] = c.copy(state)
+
+        for block in random.sample(list(block2state.keys()), 10):
+            assert self.state_at(block) == block2state[block], f'state mismatch at block {block}'
+            # blocks between snapshots resolve to the previous snapshot
+            assert self.state_at(block + 1) == block2state[block]
+
+        series = self.series('balances/key0', last_n=100)
+        expected = {b: s['balances']['key0'] for b, s in block2state.items() if b >= self.latest_block() - 100}
+        assert series == expected, f'series mismatch {series} != {expected}'
+        ephemeral = {b: s['balances']['ephemeral'] for b, s in block2state.items() if 'ephemeral' in s['balances']}
+        assert self.series('balances/ephemeral') == ephemeral
+        assert self.snapshot_at(-1) == None
+        assert self.snapshot_at(5)['block'] == 4 and self.snapshot_at(5)['balances'] == block2state[4]['balances']
+        reloaded = Snapshot(network='test', path='test_snapshots')
+        assert reloaded.state_at() == state, 'the index did not reload from disk'
+        assert reloaded.series('balances/key0', last_n=100) == expected, 'the columns did not reload from disk'
+        # snapshots taken before there were columns get them on load
+        for path in [self.keys_path, self.columns_path, self.values_path]:
+            os.remove(path)
+        assert Snapshot(network='test', path='test_snapshots').series('balances/key0', last_n=100) == expected
+        stats = self.stats()
+        self.clear()
+        return {'success': True, 'msg': 'snapshot test passed', 'stats': stats}
@@ -123,7 +123,30 @@ class Subspace(c.Module):
         
         return url
     
-    url2substrate = {}
+    network2url = {}
+    def network_url(self, network:str = None, mode:str = 'ws', update:bool = False) -> str:
+        """
+        Resolves the url once per (network, mode) so that url=None keeps hitting the same pooled connections.
+        """
+        network = network or self.config.network
+        key = f'{network}::{mode}'
+        if update or key not in self.network2url:
+            self.network2url[key] = self.resolve_url(None, network=network, mode=mode)
+        return self.network2url[key]
+
+    def substrate_pool(self) -> 'SubstratePool':
+        if not hasattr(self, '_substrate_pool'):
+            self._substrate_pool = c.module('subspace.pool')(**self.config.get('pool', {}))
+        return self._substrate_pool
+
+    def connection(self, network:str = None, mode:str = 'ws', url:str = None):
+        """
+        Checks out a pooled connection for exclusive use by the calling thread.
+        with self.connection(network) as substrate: ...
+        """
+        url = url or self.network_url(network=network, mode=mode)
+        return self.substrate_pool().connection(url)
+
     def get_substrate(self, 
                 network:str = 'main',
                 url : str = None,
@@ -167,19 +190,15 @@ class Subspace(c.Module):
 
 
         network = network or self.config.network
+        pool = self.substrate_pool()
+        resolve = url == None
 
-        if cache:
-            if url in self.url2substrate:
-                return self.url2substrate[url]
-
-
-        while trials > 0:
+        for trial in range(trials):
             try:
-                url = self.resolve_url(url, mode=mode, network=network)
-
-                substrate= SubstrateInterface(url=url, 
-                            websocket=websocket, 
-                            ss58_format=ss58_format, 
+                if resolve:
+                    # try another node if the last one failed
+                    url = self.network_url(network=network, mode=mode, update=trial > 0)
+                substrate_kwargs = dict(ss58_format=ss58_format, 
                             type_registry=type_registry, 
                             type_registry_preset=type_registry_preset, 
                             cache_region=cache_region, 
@@ -187,14 +206,16 @@ class Subspace(c.Module):
                             ws_options=ws_options, 
                             auto_discover=auto_discover, 
                             auto_reconnect=auto_reconnect)
+                if cache and websocket == None:
+                    # a connection of the calling thread, see connection() to share the pool instead
+                    substrate = pool.get_substrate(url, **substrate_kwargs)
+                else:
+                    substrate = pool.connect(url, websocket=websocket, **substrate_kwargs)
                 break
             except Exception as e:
-                trials = trials - 1
-                if trials > 0:
+                if trial == trials - 1:
                     raise e
-        
-        if cache:
-            self.url2substrate[url] = substrate
+                c.print(f'Failed to connect to {url} ({e}), trial {trial+1}/{trials}', color='red')
 
         self.network = network
         self.url = url
@@ -387,7 +408,6 @@ class Subspace(c.Module):
         """
 
         network = self.resolve_network(network)
-        path = f'query/{network}/{module}.{name}'
     
         params = params or []
         if not isinstance(params, list):
@@ -395,35 +415,33 @@ class Subspace(c.Module):
         if netuid != None and netuid != 'all':
             params = [netuid] + params
             
-        # we want to cache based on the params if there are any
-        if len(params) > 0 :
-            path = path + f'::params::' + '-'.join([str(p) for p in params])
+        # the cache is keyed on the params and the block, so historical reads never return another block
+        cache = self.query_cache()
+        if not update:
+            value = cache.lookup(network, name, params=params, module=module, block=block, max_age=max_age)
+            if value != None:
+                return value
 
-        value = self.get(path, None, max_age=max_age, update=update)
-        if value != None:
-            return value
+        block, block_hash = self.resolve_block(block, network=network)
         
         while trials > 0:
             try:
-                substrate = self.get_substrate(network=network, mode=mode)
-                response =  substrate.query(
-                    module=module,
-                    storage_function = name,
-                    block_hash = None if block == None else substrate.get_block_hash(block), 
-                    params = params
-                )
+                with self.connection(network=network, mode=mode) as substrate:
+                    response =  substrate.query(
+                        module=module,
+                        storage_function = name,
+                        block_hash = block_hash, 
+                        params = params
+                    )
                 value =  response.value
                 break
             except Exception as e:
                 trials = trials - 1
                 if trials == 0:
                     raise e
-        
-
 
-        # if the value is a tuple then we want to convert it to a list
         if save:
-            self.put(path, value)
+            cache.store(network, name, value, params=params, module=module, block=block, block_hash=block_hash)
 
         return value
 
@@ -473,7 +491,6 @@ class Subspace(c.Module):
             module = 'System'
         network = self.resolve_network(network, new_connection=False, mode=mode)
 
-        path = f'query/{network}/{module}.{name}'
         # resolving the params
         params = params or []
 
@@ -482,78 +499,94 @@ class Subspace(c.Module):
             params = [netuid] + params
         if not isinstance(params, list):
             params = [params]
-        if len(params) > 0 :
-            path = path + f'::params::' + '-'.join([str(p) for p in params])
-        path = path+"::block::"
-        paths = self.glob(path + '*')
-        update = update or len(paths) == 0 or block != None
-        if not update:
-            last_path = sorted(paths, reverse=True)[0]
-            value = self.get(last_path, None , max_age=max_age)
-        else:
-            value = None
 
-        if value == None:
-            # block = block or self.block
-            path = path + f'{block}'
-            network = self.resolve_network(network)
-            # if the value is a tuple then we want to convert it to a list
-    
-            while trials > 0:
-                try:
+        cache = self.query_cache()
+        if not update or block != None:
+            value = cache.lookup(network, name, params=params, module=module, block=block, max_age=max_age)
+            if value != None:
+                return value
 
-                    substrate = self.get_substrate(network=network, mode=mode)
+        block, block_hash = self.resolve_block(block, network=network)
+        while trials > 0:
+            try:
+                with self.connection(network=network, mode=mode) as substrate:
                     qmap =  substrate.query_map(
                         module=module,
                         storage_function = name,
                         params = params,
                         page_size = page_size,
                         max_results = max_results,
-                        block_hash =substrate.get_block_hash(block)
+                        block_hash = block_hash
                     )
-                    break
-                except Exception as e:
-                    trials = trials - 1
-                    if trials == 0:
-                        raise e
-                
+                    # the query map pages lazily, so we pull the pages while we hold the connection
+                    qmap = list(qmap)
+                break
+            except Exception as e:
+                trials = trials - 1
+                if trials == 0:
+                    raise e
 
-            new_qmap = {} 
-            progress_bar = c.progress(qmap, desc=f'Querying {name} ma')
-            for (k,v) in qmap:
-                progress_bar.update(1)
-                if not isinstance(k, tuple):
-                    k = [k]
-                if type(k) in [tuple,list]:
-                    # this is a double map
-                    k = [_k.value for _k in k]
-                if hasattr(v, 'value'):
-                    v = v.value
-                    c.dict_put(new_qmap, k, v)
+        new_qmap = {} 
+        progress_bar = c.progress(qmap, desc=f'Querying {name} ma')
+        for (k,v) in qmap:
+            progress_bar.update(1)
+            if not isinstance(k, tuple):
+                k = [k]
+            if type(k) in [tuple,list]:
+                # this is a double map
+                k = [_k.value for _k in k]
+            if hasattr(v, 'value'):
+                v = v.value
+                c.dict_put(new_qmap, k, v)
+
+        # sort the integer keyed maps once on write, the cache keeps the integer keys as they are
+        new_qmap = self.sort_int_keys(new_qmap)
+        cache.store(network, name, new_qmap, params=params, module=module, block=block, block_hash=block_hash)
+
+        return new_qmap
 
-            self.put(path, new_qmap)
-        
-        else: 
-            new_qmap = value
-
-        def convert_dict_k_digit_to_int(d):
-            is_int_bool = False
-            for k,v in c.copy(d).items():
-                if c.is_int(k):
-                    is_int_bool = True
-                    d[int(k)] = d.pop(k)
-                    if isinstance(v, dict):
-                        d[int(k)] = convert_dict_k_digit_to_int(v)
-            if is_int_bool:
-                # sort the dictionary by key
-                d = dict(sorted(d.items()))
-            
+    @classmethod
+    def sort_int_keys(cls, d:dict) -> dict:
+        if not isinstance(d, dict):
             return d
-                    
-
-        new_map = convert_dict_k_digit_to_int(new_qmap)
-
-        return new_map
+        d = {k: cls.sort_int_keys(v) for k,v in d.items()}
+        if any([isinstance(k, int) for k in d]):
+            d = dict(sorted(d.items(), key=lambda kv: (not isinstance(kv[0], int), kv[0] if isinstance(kv[0], int) else str(kv[0]))))
+        return d
+
+    def query_cache(self) -> 'QueryCache':
+        if not hasattr(self, '_query_cache'):
+            self._query_cache = c.module('subspace.cache')(**self.config.get('query_cache', {}))
+        return self._query_cache
+
+    network2head = {}
+    def head(self, network:str = None, max_age:int = None) -> dict:
+        """
+        The number and hash of the newest block, refreshed at most once per block time.
+        """
+        network = network or self.config.network
+        max_age = self.block_time if max_age == None else max_age
+        head = self.network2head.get(network)
+        if head == None or c.time() - head['timestamp'] > max_age:
+            with self.connection(network=network) as substrate:
+                header = substrate.get_block()['header']
+            head = {'block': header['number'], 'block_hash': header['hash'], 'timestamp': c.time()}
+            self.network2head[network] = head
+        return head
+
+    def resolve_block(self, block:int = None, network:str = None) -> Tuple[int, str]:
+        """
+        Pins a block (the head if None) to its number and hash.
+        """
+        network = network or self.config.network
+        if block == None:
+            head = self.head(network=network)
+            return head['block'], head['block_hash']
+        block_hash = self.query_cache().block_hash(network, block)
+        if block_hash == None:
+            with self.connection(network=network) as substrate:
+                block_hash = substrate.get_block_hash(block)
+        return block, block_hash
     
     def runtime_spec_version(self, network:str = 'main'):
         # Get the runtime version
@@ -733,6 +766,7 @@ class Subspace(c.Module):
     
 
     def clear_query_history(self):
+        self.query_cache().clear()
         return self.rm('query')
 
 
@@ -975,25 +1009,11 @@ class Subspace(c.Module):
     def loop(self, intervals = {'light': 5, 'full': 600}, network=None, remote:bool=True):
         if remote:
             return self.remote_fn('loop', kwargs=dict(intervals=intervals, network=network, remote=False))
-        last_update = {k:0 for k in intervals.keys()}
-        staleness = {k:0 for k in intervals.keys()}
         c.get_event_loop()
-
-        while True:
-            block = self.block
-            timestamp = c.timestamp()
-            staleness = {k:timestamp - last_update[k] for k in intervals.keys()}
-            if staleness["full"] > intervals["full"]:
-                request = {
-                            'network': network, 
-                           'block': block
-                           }
-                try:
-                    self.sync(**request)
-                except Exception as e:
-                    c.print(e)
-                    continue
-                last_update['full'] = timestamp
+        # the scheduler sleeps until the next sync is due and backs off when a sync fails
+        scheduler = c.scheduler()
+        scheduler.schedule(self.sync, interval=intervals['full'], name=f'subspace.sync::{network}', kwargs={'network': network})
+        return scheduler.wait()
             
 
     def subnet_exists(self, subnet:str, network=None) -> bool:
@@ -1160,9 +1180,7 @@ class Subspace(c.Module):
         return ''.join([c.capitalize() for c in chunks])
 
 
-    def query_multi(self, params_batch , substrate=None, module='SubspaceModule', feature='SubnetNames', network='main'):
-        substrate = substrate or self.get_substrate(network=network)
-
+    def query_multi(self, params_batch , substrate=None, module='SubspaceModule', feature='SubnetNames', network='main', block_hash=None, mode='ws'):
         # check if the params_batch is a list of lists
         for i,p in enumerate(params_batch):
             if isinstance(p, dict):
@@ -1173,10 +1191,22 @@ class Subspace(c.Module):
             params_batch[i] = p
             
         assert isinstance(params_batch, list), f"params_batch should be a list of lists"
-        multi_query = [substrate.create_storage_key(*p) for p in params_batch]
-        results = substrate.query_multi(multi_query)
+        if substrate != None:
+            multi_query = [substrate.create_storage_key(*p) for p in params_batch]
+            return substrate.query_multi(multi_query, block_hash=block_hash)
+        # pipeline the storage keys through the pool in as few round trips as possible
+        url = self.network_url(network=network, mode=mode)
+        results = self.substrate_pool().query_multi(url=url, queries=params_batch, block_hash=block_hash, values=False)
         return results
 
+    def query_batch(self, name:str, params_batch:List[list], module:str='SubspaceModule', network:str='main', block=None, mode='ws'):
+        """
+        Queries the same storage function for many params in a single round trip.
+        """
+        block_hash = None if block == None else self.block_hash(block, network=network)
+        url = self.network_url(network=network, mode=mode)
+        return self.substrate_pool().query_batch(url=url, name=name, params_batch=params_batch, module=module, block_hash=block_hash)
+
     def blocks_until_vote(self, netuid=0, **kwargs):
         netuid = self.resolve_netuid(netuid)
         tempo = self.subnet_params(netuid=netuid, **kwargs)['tempo']
@@ -1730,9 +1760,12 @@ class Subspace(c.Module):
         netuid = self.resolve_netuid(netuid or subnet)
         network = self.resolve_network(network)
         state = {}
-        path = f'query/{network}/SubspaceModule.Modules:{netuid}'
-        modules = self.get(path, None, max_age=max_age)
+        cache = self.query_cache()
+        # derived results get their own namespace, apart from the raw 'Modules' storage map
+        modules = cache.lookup(network, '__modules__', params=[netuid], block=block, max_age=max_age)
         if modules == None:
+            # pin every feature to the same block so that the modules are one consistent snapshot
+            block, block_hash = self.resolve_block(block, network=network)
 
             progress = c.tqdm(total=len(features), desc=f'Querying {features}')
             future2key = {}
@@ -1777,7 +1810,7 @@ class Subspace(c.Module):
                         uid_key = uid2key[uid]
                         module[feature] = state[feature].get(uid_key, name2default.get(uid_key, None))
                 modules.append(module)
-            self.put(path, modules)
+            cache.store(network, '__modules__', modules, params=[netuid], block=block, block_hash=block_hash)
 
             
         if len(modules) > 0:
@@ -2316,6 +2349,12 @@ class Subspace(c.Module):
         if save:
             update = True
         if not update:
+            state_dict = self.snapshot(network=network).snapshot_at(block)
+            if state_dict != None:
+                # the modules are snapshotted by key, state_dict returns them as a list
+                if isinstance(state_dict.get('modules'), dict):
+                    state_dict['modules'] = list(state_dict['modules'].values())
+                return state_dict
             state_path = self.latest_archive_path() # get the latest archive path
             state_dict = c.get(state_path, None)
             if state_path != None:
@@ -2323,8 +2362,6 @@ class Subspace(c.Module):
 
         block = block or self.block
 
-        path = f'state_dict/{network}.block-{block}-time-{int(c.time())}'
-
         feature2params = {}
 
         feature2params['balances'] = [self.get_feature, dict(feature='balances', update=update, block=block, timeout=timeout)]
@@ -2363,16 +2400,45 @@ class Subspace(c.Module):
             feature2result = {}
 
         if save:
-            self.put(path, state_dict)
+            # only the keys that changed since the last snapshot are written
+            snapshot = self.snapshot(network=network)
+            state = {k:v for k,v in state_dict.items() if k not in ['block', 'block_hash']}
+            if isinstance(state.get('modules'), list):
+                state['modules'] = {m['key']: m for m in state['modules']}
+            response = snapshot.add(state, block=state_dict['block'], block_hash=state_dict['block_hash'])
             end_time = c.time()
             latency = end_time - start_time
             response = {"success": True,
-                        "msg": f'Saving state_dict to {path}', 
+                        "msg": f'Saved snapshot of block {block} to {snapshot.data_path}', 
                         'latency': latency, 
-                        'block': state_dict['block']}
+                        **response}
+            return response
 
-        
-        return response  # put it in storage
+        return state_dict
+
+    network2snapshot = {}
+    @classmethod
+    def snapshot(cls, network:str = network) -> 'Snapshot':
+        network = network or cls.network
+        if network not in cls.network2snapshot:
+            cls.network2snapshot[network] = c.module('subspace.snapshot')(network=network)
+        return cls.network2snapshot[network]
+
+    def state_at(self, block:int = None, network:str = network) -> dict:
+        """
+        The snapshotted chain state at block (the newest snapshot if None).
+        """
+        return self.snapshot(network=network).state_at(block)
+
+    def state_series(self, key:str, start_block:int = None, end_block:int = None, last_n:int = None, network:str = network) -> Dict[int, Any]:
+        """
+        The snapshotted value of key over a block range, e.g. state_series('balances/5F..', last_n=1000).
+        """
+        return self.snapshot(network=network).series(key, start_block=start_block, end_block=end_block, last_n=last_n)
+
+    @classmethod
+    def snapshot_blocks(cls, network:str = network) -> List[int]:
+        return cls.snapshot(network=network).blocks()
     
 
     def sync(self,*args, **kwargs):
@@ -2631,12 +2697,12 @@ class Subspace(c.Module):
         return response
 
 
-    def run_loop(self):
-        while True:
-            self.update_modules()
-            self.subnet_params(netuid='all')
-            self.stake_from(netuid='all')
-            self.keys(netuid='all')
+    def run_loop(self, interval:float = 60):
+        scheduler = c.scheduler()
+        scheduler.schedule(self.update_modules, interval=interval, name='subspace.update_modules')
+        for fn in [self.subnet_params, self.stake_from, self.keys]:
+            scheduler.schedule(fn, interval=interval, name=f'subspace.{fn.__name__}::{self.network}', kwargs={'netuid': 'all'})
+        return scheduler.wait()
 
 
 
@@ -3465,10 +3531,10 @@ class Subspace(c.Module):
             c.print(f'Getting balances for {len(keys)} keys')
 
             def batch_fn(batch_keys):
-                substrate = self.get_substrate(network=network)
                 batch_keys = [key2address.get(k, k) for k in batch_keys]
                 c.print(f'Getting balances for {len(batch_keys)} keys')
-                results = substrate.query_multi([ substrate.create_storage_key("System", "Account", [k]) for k in batch_keys])
+                with self.connection(network=network, mode='http') as substrate:
+                    results = substrate.query_multi([ substrate.create_storage_key("System", "Account", [k]) for k in batch_keys])
                 return  {k.params[0]: v['data']['free'].value for k, v in results}
             key2balance = {}
             progress = c.progress(num_batches)
@@ -3756,6 +3822,17 @@ class Subspace(c.Module):
         modules = self.get_modules(netuid=0)
         return modules 
 
+    def test_substrate_pool(self, n:int = 10):
+        # the pool is loaded through the module resolver, like every chain call loads it
+        pool = self.substrate_pool()
+        assert type(pool).__name__ == 'SubstratePool', pool
+        stub = pool.serve_stub()
+        results = pool.rpc_batch([('echo', [i]) for i in range(n)], url=stub['url'])
+        assert results == [[i] for i in range(n)], results
+        stub['server'].shutdown()
+        stub['server'].server_close()
+        return {'success': True, 'msg': 'substrate pool test passed'}
+
 
             
     
@@ -10,7 +10,7 @@ class Tree(c.Module):
     default_trees = [default_tree_path]
     def __init__(self, **kwargs):
         self.set_config(kwargs=locals())
-        c.thread(self.run_loop)
+        self.run_loop()
 
     
     @classmethod
@@ -104,14 +104,16 @@ class Tree(c.Module):
         return old_tree_hash != new_tree_hash
 
     def run_loop(self, *args, sleep_time=10, **kwargs):
-        while True:
-            c.print('Checking for tree changes')
-            if self.has_tree_changed():
-                c.print('Tree has changed, updating')
-                self.tree(update=True)
-            else:
-                c.print('Tree has not changed')
-            self.sleep(10)
+        # every tree in the process shares one job
+        return c.schedule(self.update_tree, interval=sleep_time, name='tree.update_tree', delay=sleep_time)
+
+    def update_tree(self):
+        c.print('Checking for tree changes')
+        if self.has_tree_changed():
+            c.print('Tree has changed, updating')
+            self.tree(update=True)
+        else:
+            c.print('Tree has not changed')
         
     @classmethod
     def add_tree(cls, tree_path:str, **kwargs):
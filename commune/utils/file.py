@@ -0,0 +1,221 @@
+import os
+import time
+import threading
+from typing import *
+import numpy as np
+
+"""
+Reading lines of large (log) files without reading the whole file.
+
+Lines are the pieces of text.split('\n'), so a file that ends with a newline has an empty last
+line, like Module.get_text has always returned them.
+
+- tail_text seeks backwards in blocks until it has seen enough newlines.
+- read_lines uses a sparse line index (the offset of every stride-th line). It is cached per path
+  and extended when the file grows, and rebuilt when the file is replaced or truncated.
+- follow_lines yields new lines as they are appended, and survives log rotation.
+"""
+
+BLOCK_SIZE = 2**16
+SCAN_SIZE = 2**24
+
+
+def newline_positions(block:bytes, offset:int = 0) -> np.ndarray:
+    return np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == 10) + offset
+
+
+def decode(data:bytes) -> str:
+    return data.decode('utf-8', errors='replace')
+
+
+def tail_bytes(path:str, n:int, block_size:int = BLOCK_SIZE, end:int = None) -> bytes:
+    """
+    The bytes after the n-th newline from the end of the file (the whole file if it has fewer).
+    end is the size of the file to consider, for files that are being appended to.
+    """
+    if n <= 0:
+        return b''
+    with open(path, 'rb') as f:
+        position = f.seek(0, 2) if end == None else end
+        blocks = []
+        found = 0
+        while position > 0:
+            size = min(block_size, position)
+            position -= size
+            f.seek(position)
+            block = f.read(size)
+            newlines = newline_positions(block)
+            if found + len(newlines) >= n:
+                cut = int(newlines[len(newlines) - (n - found)]) + 1
+                blocks.append(block[cut:])
+                break
+            found += len(newlines)
+            blocks.append(block)
+            # grow the blocks for files with long lines
+            block_size = min(block_size * 2, SCAN_SIZE)
+    return b''.join(reversed(blocks))
+
+
+def tail_text(path:str, n:int = 20, block_size:int = BLOCK_SIZE) -> str:
+    """
+    The last n lines of the file, in O(size of the lines) time and memory.
+    """
+    return decode(tail_bytes(path, n, block_size=block_size))
+
+
+class LineIndex:
+    """
+    The byte offset of every stride-th line of a file, built in one pass of numpy scans and
+    extended when the file grows.
+    """
+
+    def __init__(self, path:str, stride:int = 1024):
+        self.path = path
+        self.stride = stride
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.offsets = [np.zeros(1, dtype=np.int64)] # the line starts 0, stride, 2 * stride, ...
+        self.num_newlines = 0
+        self.size = 0
+        self.inode = None
+
+    def update(self) -> 'LineIndex':
+        """
+        Indexes the bytes appended since the last update (or everything if the file was replaced or truncated).
+        """
+        with self.lock:
+            stat = os.stat(self.path)
+            if stat.st_ino != self.inode or stat.st_size < self.size:
+                self.reset()
+                self.inode = stat.st_ino
+            if stat.st_size == self.size:
+                return self
+            with open(self.path, 'rb') as f:
+                f.seek(self.size)
+                while self.size < stat.st_size:
+                    block = f.read(min(SCAN_SIZE, stat.st_size - self.size))
+                    if len(block) == 0:
+                        break
+                    # line k starts after newline k - 1, so keep the newlines k - 1 with k % stride == 0
+                    line_starts = newline_positions(block, self.size) + 1
+                    first = (-(self.num_newlines + 1)) % self.stride
+                    self.offsets.append(line_starts[first::self.stride])
+                    self.num_newlines += len(line_starts)
+                    self.size += len(block)
+            self.offsets = [np.concatenate(self.offsets)]
+        return self
+
+    @property
+    def num_lines(self) -> int:
+        return self.num_newlines + 1
+
+    def line_start(self, line:int, f) -> int:
+        """
+        The byte offset where line starts, reading forward from the closest indexed line.
+        """
+        if line <= 0:
+            return 0
+        if line >= self.num_lines:
+            return self.size
+        offsets = self.offsets[0]
+        position = int(offsets[line // self.stride])
+        remaining = line % self.stride
+        while remaining > 0:
+            f.seek(position)
+            block = f.read(BLOCK_SIZE)
+            newlines = newline_positions(block, position)
+            if len(newlines) >= remaining:
+                return int(newlines[remaining - 1]) + 1
+            remaining -= len(newlines)
+            position += len(block)
+        return position
+
+    def read_lines(self, start:int = None, end:int = None) -> str:
+        """
+        '\\n'.join(text.split('\\n')[start:end]) of the file, with python slice semantics.
+        """
+        self.update()
+        start, end, _ = slice(start, end).indices(self.num_lines)
+        if end <= start:
+            return ''
+        with open(self.path, 'rb') as f:
+            begin = self.line_start(start, f)
+            # the text ends before the newline that ends line end - 1
+            stop = self.line_start(end, f) - 1 if end < self.num_lines else self.size
+            f.seek(begin)
+            return decode(f.read(max(stop - begin, 0)))
+
+
+line_indexes = {}
+
+def line_index(path:str, stride:int = 1024) -> LineIndex:
+    path = os.path.abspath(path)
+    if path not in line_indexes:
+        line_indexes[path] = LineIndex(path, stride=stride)
+    return line_indexes[path].update()
+
+
+def read_lines(path:str, start:int = None, end:int = None) -> str:
+    """
+    The lines [start:end] of the file through its cached line index.
+    """
+    if start != None and start < 0 and (end == None or end < 0):
+        # lines counted from the end only need the tail
+        lines = tail_text(path, -start).split('\n')
+        return '\n'.join(lines[:end])
+    return line_index(path).read_lines(start, end)
+
+
+def follow_lines(path:str,
+                 tail:int = 0,
+                 poll_interval:float = 0.25,
+                 timeout:float = None,
+                 max_lines:int = None) -> Iterator[str]:
+    """
+    Yields the last tail lines and then every line appended to the file, as it is completed.
+    The file is polled with os.stat, and reopened from its start when it is rotated (a new inode)
+    or truncated. Stops after timeout seconds without new lines, or after max_lines lines.
+    """
+    count = 0
+    f = None
+    inode = None
+    pending = b''
+    last_line = time.time()
+    try:
+        while True:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                stat = None
+            if stat != None and (stat.st_ino != inode or stat.st_size < f.tell()):
+                if f != None:
+                    f.close()
+                first_open = inode == None
+                f = open(path, 'rb')
+                inode = stat.st_ino
+                pending = b''
+                if first_open:
+                    end = f.seek(0, 2)
+                    if tail > 0:
+                        # the last tail lines before the trailing newline, or with the partial last line
+                        pending = tail_bytes(path, tail + 1, end=end)
+            data = f.read() if f != None else b''
+            if len(pending) > 0 or len(data) > 0:
+                data = pending + data
+                lines = data.split(b'\n')
+                pending = lines.pop()
+                for line in lines:
+                    yield decode(line)
+                    count += 1
+                    if max_lines != None and count >= max_lines:
+                        return
+                if len(lines) > 0:
+                    last_line = time.time()
+            if timeout != None and time.time() - last_line > timeout:
+                return
+            time.sleep(poll_interval)
+    finally:
+        if f != None:
+            f.close()
@@ -17,15 +17,85 @@
 # OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 # DEALINGS IN THE SOFTWARE.
 
+import os
+import json
+import hashlib
+import itertools
 import torch
 
-from typing import List, Dict, Tuple, Any, Union
+from typing import List, Dict, Tuple, Any, Union, NamedTuple
 from transformers import PreTrainedTokenizerBase
 
 EPSILON = 1e-40
+TRANSLATION_MAP_DIR = os.path.expanduser('~/.commune/tokenizer/translation_maps')
+translation_map_cache = {}  # (from fingerprint, to fingerprint) -> translation map, shared within the process
+
+
+def get_tokenizer_alignment_segments(offset_mapping: List[tuple], offset_mapping_std: List[tuple]) -> List[tuple]:
+    r"""
+    Cuts both tokenizations at the right edges they share, and returns the segments in which both sides have
+    more than one distinct right edge. Splits can only occur in these (many-to-many) segments, and the alignment
+    walk restarts at every shared edge, so only these segments have to be walked.
+        Args:
+            offset_mapping (:obj:`List[tuple]`, `required`):
+                Tokenizer offset mappings for a specific sequence [(left_0, right_0), (left_1, right_1), ...].
+            offset_mapping_std (:obj:`List[tuple]`, `required`):
+                Standard tokenizer offset mappings for a specific sequence [(left_0, right_0), (left_1, right_1), ...]
+
+        Returns:
+            segments (:obj:`List[tuple]`, `required`):
+                [(start, end, start_std, end_std), ...] Token index ranges of the many-to-many segments.
+    """
+    if len(offset_mapping) == 0 or len(offset_mapping_std) == 0:
+        return []
+    rights = torch.tensor([o[1] for o in offset_mapping], dtype=torch.long)
+    rights_std = torch.tensor([o[1] for o in offset_mapping_std], dtype=torch.long)
+    if (rights[1:] < rights[:-1]).any() or (rights_std[1:] < rights_std[:-1]).any():
+        # out of order offsets (e.g. special tokens in the middle), walk the whole sequence
+        return [(0, len(offset_mapping), 0, len(offset_mapping_std))]
+
+    shared = torch.unique(rights[torch.isin(rights, rights_std)])  # sorted shared right edges
+    ends = torch.searchsorted(rights, shared, right=True)  # segment ends, after right-aligned overlapping tokens
+    ends_std = torch.searchsorted(rights_std, shared, right=True)
+    # the tail after the last shared edge is a segment too
+    ends = torch.cat([ends, torch.tensor([len(rights)])])
+    ends_std = torch.cat([ends_std, torch.tensor([len(rights_std)])])
+    starts = torch.cat([torch.tensor([0]), ends[:-1]])
+    starts_std = torch.cat([torch.tensor([0]), ends_std[:-1]])
+
+    def distinct_edges(rights, starts, ends):
+        # overlapping tokens share a right edge, so count the last token of every run of equal edges
+        last_of_run = torch.cat([rights[1:] != rights[:-1], torch.tensor([True])]).long()
+        cum = torch.cat([torch.tensor([0]), torch.cumsum(last_of_run, dim=0)])
+        return cum[ends] - cum[starts]
+
+    many = (distinct_edges(rights, starts, ends) > 1) & (distinct_edges(rights_std, starts_std, ends_std) > 1)
+    return [tuple(x) for x in torch.stack([starts, ends, starts_std, ends_std], dim=1)[many].tolist()]
 
 
 def get_tokenizer_alignment_splits(offset_mapping: List[tuple], offset_mapping_std: List[tuple]) -> Dict[int, tuple]:
+    r"""
+    Calculates split depths necessary for tokens to align input offsets to standard offsets.
+    Only the many-to-many segments between shared right edges are walked (see get_tokenizer_alignment_segments).
+        Args:
+            offset_mapping (:obj:`List[tuple]`, `required`):
+                Tokenizer offset mappings for a specific sequence [(left_0, right_0), (left_1, right_1), ...].
+            offset_mapping_std (:obj:`List[tuple]`, `required`):
+                Standard tokenizer offset mappings for a specific sequence [(left_0, right_0), (left_1, right_1), ...]
+
+        Returns:
+            splits (:obj:`Dict[int, tuple]`, `required`):
+                For tokens that have to be split, {Token index: (split depth 1, split depth 2, ...), ...}.
+    """
+    splits = {}
+    for start, end, start_std, end_std in get_tokenizer_alignment_segments(offset_mapping, offset_mapping_std):
+        segment_splits = walk_tokenizer_alignment_splits(offset_mapping[start:end], offset_mapping_std[start_std:end_std])
+        for idx, depths in segment_splits.items():
+            splits[start + idx] = depths
+    return dict(sorted(splits.items()))
+
+
+def walk_tokenizer_alignment_splits(offset_mapping: List[tuple], offset_mapping_std: List[tuple]) -> Dict[int, tuple]:
     r"""
     Calculates split depths necessary for tokens to align input offsets to standard offsets.
     Only input offsets may be split, not standard offsets, to create one-to-one, one-to-many, or many-to-one
@@ -268,7 +338,7 @@ def get_tokenizer_depth_split_map(tokenizer: PreTrainedTokenizerBase,
     """
     split_map = []
 
-    phrases = tokenizer.batch_decode(range(tokenizer.vocab_len))  # list of variable len strings (one per token)
+    phrases = get_vocab_phrases(tokenizer)  # list of variable len strings (one per token)
 
     # first part of the phrase up to distance characters
     split_phrases = [[phrase[:depths[0]] for phrase in phrases]]
@@ -402,46 +472,221 @@ def align_tokenizer_sequences(probs: torch.FloatTensor, offset_mapping: List[tup
     return aligned_probs, aligned_offset_mapping, aligned_tokens
 
 
+def get_vocab_phrases(tokenizer: PreTrainedTokenizerBase) -> List[str]:
+    r"""
+    The decoded string of every token in the vocabulary, decoded once and kept on the tokenizer.
+        Args:
+            tokenizer (:obj:`PreTrainedTokenizerBase`, `required`):
+                Tokenizer.
+
+        Returns:
+            phrases (:obj:`List[str]`, `required`):
+                [vocab_len] Token strings.
+    """
+    set_vocab_len(tokenizer)
+    if getattr(tokenizer, 'vocab_phrases', None) is None or len(tokenizer.vocab_phrases) != tokenizer.vocab_len:
+        tokenizer.vocab_phrases = tokenizer.batch_decode(range(tokenizer.vocab_len))
+    return tokenizer.vocab_phrases
+
+
+def get_tokenizer_fingerprint(tokenizer: PreTrainedTokenizerBase) -> str:
+    r"""
+    A short hash of the tokenizer vocabulary, used to key translation maps in memory and on disk.
+        Args:
+            tokenizer (:obj:`PreTrainedTokenizerBase`, `required`):
+                Tokenizer.
+
+        Returns:
+            fingerprint (:obj:`str`, `required`):
+                Hex digest of the vocabulary.
+    """
+    if getattr(tokenizer, 'fingerprint', None) is None:
+        set_vocab_len(tokenizer)
+        vocab = sorted(tokenizer.get_vocab().items(), key=lambda x: x[1])
+        data = json.dumps([tokenizer.__class__.__name__, tokenizer.vocab_len, vocab]).encode()
+        tokenizer.fingerprint = hashlib.sha256(data).hexdigest()[:24]
+    return tokenizer.fingerprint
+
+
+def build_translation_map(from_tokenizer: PreTrainedTokenizerBase,
+                          to_tokenizer: PreTrainedTokenizerBase) -> Dict[str, Any]:
+    r"""
+    Map individual token phrases from a tokenizer to another tokenizer, as compact tensors.
+        Args:
+            from_tokenizer (:obj:`PreTrainedTokenizerBase`, `required`):
+                From tokenizer.
+            to_tokenizer (:obj:`PreTrainedTokenizerBase`, `required`):
+                To tokenizer.
+
+        Returns:
+            translation_map (:obj:`Dict[str, Any]`, `required`):
+                'to': [from_vocab_len, max_len] target token sequence of every source token, padded with -1,
+                'lens': [from_vocab_len] target sequence lengths,
+                'counts': [max_len, to_vocab_len] number of sequences crossing each target token at each depth.
+    """
+    set_vocab_len(from_tokenizer)
+    set_vocab_len(to_tokenizer)
+
+    phrases = get_vocab_phrases(from_tokenizer)  # tokens to strings
+    to_tokens = to_tokenizer(phrases)['input_ids']  # convert single token from-phrases to to-tokenization
+
+    lens = torch.tensor([len(t) for t in to_tokens], dtype=torch.long)
+    max_len = int(lens.max())
+    flat = torch.tensor(list(itertools.chain.from_iterable(to_tokens)), dtype=torch.long)
+    rows = torch.repeat_interleave(torch.arange(len(to_tokens)), lens)  # source token of every target token
+    offsets = torch.cumsum(lens, dim=0) - lens
+    depths = torch.arange(len(flat)) - offsets[rows]  # position of every target token in its sequence
+
+    to = torch.full((len(to_tokens), max_len), -1, dtype=torch.int32)
+    to[rows, depths] = flat.to(torch.int32)
+    # accumulate counts on tokens, to be used to divide probability mass over its channeled sequences
+    counts = torch.bincount(depths * to_tokenizer.vocab_len + flat, minlength=max_len * to_tokenizer.vocab_len)
+    counts = counts.view(max_len, to_tokenizer.vocab_len).to(torch.int32)
+
+    return {'to': to, 'lens': lens.to(torch.int32), 'counts': counts}
+
+
+def complete_translation_map(translation_map: Dict[str, Any]) -> Dict[str, Any]:
+    r"""
+    Adds the derived views of a compact translation map in place: the per length maps ('lengths'),
+    and the (source, depth, target) pairs sorted by depth ('pairs') used for vectorized one-to-many translation.
+    Maps that only have 'lengths' (the previous format) get the compact tensors instead.
+        Args:
+            translation_map (:obj:`Dict[str, Any]`, `required`):
+                Translation map.
+
+        Returns:
+            translation_map (:obj:`Dict[str, Any]`, `required`):
+                The completed translation map.
+    """
+    if 'to' not in translation_map:
+        max_len = max(translation_map['lengths'].keys())
+        vocab_len = max([int(m['from'].max()) + 1 for m in translation_map['lengths'].values()])
+        to = torch.full((vocab_len, max_len), -1, dtype=torch.int32)
+        lens = torch.zeros(vocab_len, dtype=torch.int32)
+        for l, m in translation_map['lengths'].items():
+            to[m['from'], :l] = m['to'].to(torch.int32)
+            lens[m['from']] = l
+        translation_map['to'] = to
+        translation_map['lens'] = lens
+
+    to, lens = translation_map['to'], translation_map['lens'].long()
+    if 'lengths' not in translation_map:
+        translation_map['lengths'] = {}
+        for l in torch.unique(lens).tolist():
+            from_idx = (lens == l).nonzero().flatten()
+            translation_map['lengths'][l] = {'from': from_idx, 'to': to[from_idx, :l].long()}
+
+    if 'pairs' not in translation_map:
+        sources, depths = (to >= 0).nonzero(as_tuple=True)
+        order = torch.argsort(depths, stable=True)
+        sources, depths = sources[order], depths[order]
+        translation_map['pairs'] = {'from': sources,
+                                    'depth': depths,
+                                    'to': to[sources, depths].long(),
+                                    # number of pairs shallower than each depth, so a depth limit is a prefix
+                                    'depth_ends': torch.bincount(depths, minlength=to.shape[1]).cumsum(0)}
+    return translation_map
+
+
+def save_translation_map(translation_map: Dict[str, Any], path: str) -> str:
+    r"""
+    Persists the compact tensors of a translation map.
+        Args:
+            translation_map (:obj:`Dict[str, Any]`, `required`):
+                Translation map.
+            path (:obj:`str`, `required`):
+                File path.
+
+        Returns:
+            path (:obj:`str`, `required`):
+                File path.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    torch.save({k: translation_map[k].contiguous() for k in ['to', 'lens', 'counts']}, tmp_path)
+    os.replace(tmp_path, path)
+    return path
+
+
 def get_translation_map(from_tokenizer: PreTrainedTokenizerBase,
-                        to_tokenizer: PreTrainedTokenizerBase) -> Dict[str, Any]:
+                        to_tokenizer: PreTrainedTokenizerBase,
+                        cache: bool = True,
+                        path: str = TRANSLATION_MAP_DIR) -> Dict[str, Any]:
     r"""
     Map individual token phrases from a tokenizer to another tokenizer.
+    Maps are computed once per tokenizer pair, and kept in memory and on disk under path.
         Args:
             from_tokenizer (:obj:`PreTrainedTokenizerBase`, `required`):
                 From tokenizer.
             to_tokenizer (:obj:`PreTrainedTokenizerBase`, `required`):
                 To tokenizer.
+            cache (:obj:`bool`, `optional`):
+                Reuse (and store) the map of the tokenizer pair.
+            path (:obj:`str`, `optional`):
+                Directory of the persisted maps, None to only cache in memory.
 
         Returns:
             translation_map (:obj:`Dict[str, Any]`, `required`):
                 Maps for each observed length, a source token to a token sequence of that length,
                 with source index to target indices.
     """
-    set_vocab_len(from_tokenizer)
-    set_vocab_len(to_tokenizer)
+    if not cache:
+        return complete_translation_map(build_translation_map(from_tokenizer, to_tokenizer))
+
+    key = (get_tokenizer_fingerprint(from_tokenizer), get_tokenizer_fingerprint(to_tokenizer))
+    if key not in translation_map_cache:
+        filepath = os.path.join(path, f'{key[0]}-{key[1]}.pt') if path is not None else None
+        if filepath is not None and os.path.exists(filepath):
+            # the cached maps are plain tensors, so nothing but tensors is unpickled
+            translation_map = torch.load(filepath, weights_only=True)
+        else:
+            translation_map = build_translation_map(from_tokenizer, to_tokenizer)
+            if filepath is not None:
+                save_translation_map(translation_map, filepath)
+        translation_map_cache[key] = complete_translation_map(translation_map)
+    return translation_map_cache[key]
 
-    translation_map = {'lengths': {}}
 
-    phrases = from_tokenizer.batch_decode(range(from_tokenizer.vocab_len))  # tokens to strings
+def translate_one_to_many_batch(probs_from: torch.FloatTensor, probs_to: torch.FloatTensor,
+                                src_idx: torch.LongTensor, dst_idx: torch.LongTensor, many_lens: torch.LongTensor,
+                                translation_map: Dict[str, Any], chunk_size: int = 64) -> None:
+    r"""
+    Translate many single token probability distributions from a source tokenization to sequences of
+    probability distributions over a target tokenization, with one scatter per chunk of mappings.
+        Args:
+            probs_from (:obj:`torch.FloatTensor`, `required`):
+                [n, vocab_size] Input probability distributions over a from-tokenizer vocabulary.
+            probs_to (:obj:`torch.FloatTensor`, `required`):
+                [m, vocab_size] Output probability distributions over a to-tokenizer vocabulary, written in-place.
+            src_idx (:obj:`torch.LongTensor`, `required`):
+                [mappings] Row of probs_from to translate for each mapping.
+            dst_idx (:obj:`torch.LongTensor`, `required`):
+                [mappings] First row of probs_to each mapping unrolls into.
+            many_lens (:obj:`torch.LongTensor`, `required`):
+                [mappings] Number of probs_to rows each mapping unrolls into.
+            translation_map (:obj:`Dict[str, Any]`, `required`):
+                Maps for each observed length, a source token to a token sequence of that length,
+                with source index to target indices.
+
+        Returns:
 
-    to_tokens = to_tokenizer(phrases)['input_ids']  # convert single token from-phrases to to-tokenization
-    to_tokens_lens = [len(p) for p in to_tokens]
-    unique_lens = set(to_tokens_lens)
-    max_len = max(unique_lens)
-    counts = torch.zeros((max_len, to_tokenizer.vocab_len), dtype=torch.long)
-
-    for l in unique_lens:  # each unique one-to-many mapping length
-        from_idx = [i for i, k in enumerate(to_tokens_lens) if k == l]  # find len l to-tokenizations
-        subset = [to_tokens[i] for i in from_idx]  # find len l to-tokenizations
-        from_idx = torch.tensor(from_idx, dtype=torch.long)  # [subset_size]
-        to_idx = torch.tensor(subset, dtype=torch.long)  # [subset_size, l]
-        translation_map['lengths'][l] = {'from': from_idx,
-                                         'to': to_idx}
-        # accumulate counts on tokens, to be used to divide probability mass over its channeled sequences
-        counts[:l, :].scatter_add_(1, to_idx.T, torch.ones((l, len(subset)), dtype=torch.long))
-
-    translation_map['counts'] = counts
-    return translation_map
+    """
+    pairs = complete_translation_map(translation_map)['pairs']
+    vocab_size = probs_to.shape[-1]
+    probs_to_flat = probs_to.view(-1)
+    max_depth = len(pairs['depth_ends'])
+
+    for chunk in range(0, len(src_idx), chunk_size):
+        src = src_idx[chunk:chunk + chunk_size]
+        dst = dst_idx[chunk:chunk + chunk_size]
+        # unrolling steps beyond the longest mapping length are not available
+        num_pairs = pairs['depth_ends'][many_lens[chunk:chunk + chunk_size].clamp(1, max_depth) - 1]
+        mapping = torch.repeat_interleave(torch.arange(len(src)), num_pairs)  # mapping of every (mapping, pair)
+        pair = torch.arange(len(mapping)) - (torch.cumsum(num_pairs, dim=0) - num_pairs)[mapping]
+        values = probs_from[src[mapping], pairs['from'][pair]]
+        index = (dst[mapping] + pairs['depth'][pair]) * vocab_size + pairs['to'][pair]
+        probs_to_flat.index_add_(0, index.to(probs_to.device), values.to(probs_to.dtype))  # add probs in-place
 
 
 def translate_one_to_many(probs_from: torch.FloatTensor, probs_to: torch.FloatTensor,
@@ -461,16 +706,61 @@ def translate_one_to_many(probs_from: torch.FloatTensor, probs_to: torch.FloatTe
         Returns:
 
     """
-    many_len = probs_to.shape[0]
+    if probs_to.shape[0] == 0:
+        return
+    translate_one_to_many_batch(probs_from[None, :], probs_to, torch.tensor([0]), torch.tensor([0]),
+                                torch.tensor([probs_to.shape[0]]), translation_map)
+
+
+def translate_many_to_one_batch(probs_from: torch.FloatTensor, probs_to: torch.FloatTensor,
+                                src_idx: torch.LongTensor, many_lens: torch.LongTensor, dst_idx: torch.LongTensor,
+                                translation_map: Dict[str, Any], chunk_size: int = 16) -> None:
+    r"""
+    Translate many sequences of token probability distributions from a source tokenization to
+    single token probability distributions over a target tokenization, with one gather per chunk of mappings.
+        Args:
+            probs_from (:obj:`torch.FloatTensor`, `required`):
+                [n, vocab_size] Input probability distributions over a from-tokenizer vocabulary.
+            probs_to (:obj:`torch.FloatTensor`, `required`):
+                [m, vocab_size] Output probability distributions over a to-tokenizer vocabulary, written in-place.
+            src_idx (:obj:`torch.LongTensor`, `required`):
+                [mappings] First row of probs_from of each mapping.
+            many_lens (:obj:`torch.LongTensor`, `required`):
+                [mappings] Number of probs_from rows of each mapping.
+            dst_idx (:obj:`torch.LongTensor`, `required`):
+                [mappings] Row of probs_to each mapping is written to.
+            translation_map (:obj:`Dict[str, Any]`, `required`):
+                Maps for each observed length, a source token to a token sequence of that length,
+                with source index to target indices.
+
+        Returns:
+
+    """
+    translation_map = complete_translation_map(translation_map)
+    to = translation_map['to'].long()  # [to_vocab_size, max_len] source token sequence of every target token
+    lens = translation_map['lens'].long()  # [to_vocab_size]
+    counts = translation_map['counts'].to(probs_from.dtype)  # [max_len, vocab_size]
+    max_len = to.shape[1]
+    depth = torch.arange(max_len)
+    index = to.T.clamp(min=0)  # [max_len, to_vocab_size]
+    covered = lens > 0
+
+    for chunk in range(0, len(src_idx), chunk_size):
+        src = src_idx[chunk:chunk + chunk_size]
+        many = many_lens[chunk:chunk + chunk_size]
+        # rows past the mapping length are masked below, the clamp only keeps their index in range
+        rows = (src[:, None] + depth[None, :]).clamp(max=probs_from.shape[0] - 1)  # [chunk, max_len]
+        # === Spread probability mass over realized sequences ===
+        probs = probs_from[rows] / counts[None, :, :]  # [chunk, max_len, vocab_size]
+        # === Reverse map target token to source sequences, gather avg. sequence prob ===
+        gathered = probs.gather(2, index[None, :, :].expand(len(src), -1, -1))  # [chunk, max_len, to_vocab_size]
+        # sequence beyond the mapping length has min probability 0
+        valid = (depth[None, :, None] < lens[None, None, :]) & (depth[None, :, None] < many[:, None, None])
+        gathered = torch.where(valid, gathered, torch.zeros_like(gathered))
+        values = gathered.sum(dim=1) / lens.clamp(min=1)[None, :]  # [chunk, to_vocab_size] in-place average approx.
+        dst = dst_idx[chunk:chunk + chunk_size]
+        probs_to[dst[:, None], covered.nonzero().flatten()[None, :]] = values[:, covered].to(probs_to.dtype)
 
-    # === Unroll single distribution into std sequence ===
-    for i in range(many_len):  # each unrolling step
-        for map_len in translation_map['lengths'].keys():  # each one-to-many mapping length available
-            if map_len < i + 1:
-                continue  # skip unrolling steps not available in a shorter mapping length
-            from_idx = translation_map['lengths'][map_len]['from']
-            to_idx = translation_map['lengths'][map_len]['to'].T  # [map_len, subset_size_std]
-            probs_to[i, :].scatter_add_(0, to_idx[i, :], probs_from[from_idx])  # add probs in-place
 
 def translate_many_to_one(probs_from: torch.FloatTensor, probs_to: torch.FloatTensor,
                           translation_map: Dict[str, Any]) -> None:
@@ -489,27 +779,110 @@ def translate_many_to_one(probs_from: torch.FloatTensor, probs_to: torch.FloatTe
             Returns:
 
         """
-    many_len = probs_from.shape[0]
-    probs_from_copy = probs_from.clone()  # will modify from-probabilities
+    translate_many_to_one_batch(probs_from, probs_to[None, :], torch.tensor([0]), torch.tensor([probs_from.shape[0]]),
+                                torch.tensor([0]), translation_map)
+
+
+def get_tokenizer_translation_jobs(probs: torch.FloatTensor, offset_mapping: List[tuple], offset_mapping_std: List[tuple],
+                                   tokenizer: PreTrainedTokenizerBase,
+                                   split_map_cache: Dict[tuple, List[Dict[str, torch.Tensor]]],
+                                   tokens: torch.LongTensor, tokens_std: torch.LongTensor,
+                                   std_sequence_len: int) -> Tuple[torch.FloatTensor, List[tuple], List[tuple]]:
+    r"""
+    Aligns a source sequence to the standard tokenization, and lists the one-to-many and many-to-one
+    mappings that translate it, so the mappings of a whole batch can be applied at once.
+        Args:
+            probs (:obj:`torch.FloatTensor`, `required`):
+                [sequence_len, vocab_size] Input probability distribution over a source tokenizer vocabulary.
+            offset_mapping (:obj:`List[tuple]`, `required`):
+                Tokenizer offset mappings for a specific sequence [(left_0, right_0), (left_1, right_1), ...].
+            offset_mapping_std (:obj:`List[tuple]`, `required`):
+                Standard tokenizer offset mappings for a specific sequence [(left_0, right_0), (left_1, right_1), ...]
+            tokenizer (:obj:`PreTrainedTokenizerBase`, `required`):
+                Source tokenizer.
+            split_map_cache (:obj:`Dict[tuple, List[Dict[str, torch.Tensor]]]`, `required`):
+                A dictionary of depths keying split_maps of mappings from original tokens to
+                target tokens at each depth of the split. Adds split_maps to cache for faster future recall.
+            tokens (:obj:`torch.LongTensor`, `required`):
+                [sequence_len] A sequence of tokens produced by the source tokenizer.
+            tokens_std (:obj:`torch.LongTensor`, `required`):
+                [std_sequence_len] A sequence of tokens produced by the standard tokenizer.
+            std_sequence_len (:obj:`int`, `required`):
+                Number of rows of the standard distribution the mappings write to.
+
+        Returns:
+            aligned_probs (:obj:`torch.FloatTensor`, `required`):
+                [new_sequence_len, vocab_size] Aligned probability distribution over a tokenizer vocabulary.
+            one_to_many (:obj:`List[tuple]`, `required`):
+                [(aligned row, first std row, std rows), ...]
+            many_to_one (:obj:`List[tuple]`, `required`):
+                [(first aligned row, aligned rows, std row), ...]
+    """
+    # === Align tokenized sequences via source token splitting ===
+    result = align_tokenizer_sequences(probs, offset_mapping, offset_mapping_std,
+                                       tokenizer, split_map_cache, tokens.cpu(), tokens_std.cpu())
+    aligned_probs, aligned_offset_mapping, aligned_tokens = result
 
-    # === Spread probability mass over realized sequences ===
-    counts = translation_map['counts']  # [max_len, vocab_size]
-    translation_max_len = counts.shape[0]  # maximum possible many-to-one length available in translation map
+    # === Get one-to-many / many-to-one mappings ===
+    mappings = get_tokenizer_sequence_mappings(aligned_offset_mapping, offset_mapping_std)
 
-    if many_len <= translation_max_len:
-        probs_from_copy /= counts[:many_len, :]  # divide probability mass by amount of paths crossing each token
-    else:  # limit probs_from token depth to max_len
-        probs_from_copy[:translation_max_len, :] /= counts
+    one_to_many, many_to_one = [], []
+    for (right_idx, right_idx_std, segment_count_base, segment_count_std_base,
+         segment_count_overlap, segment_count_std_overlap) in mappings[1:]:  # don't map start token
+
+        segment_count = segment_count_base + segment_count_overlap  # calculate effective segments length
+        segment_count_std = segment_count_std_base + segment_count_std_overlap  # calculate effective segments length
+
+        # === One-to-many / one-to-one mapping ===
+        if segment_count_base == 1:
+            start_idx_std = max(right_idx_std - segment_count_std, 0)  # calculate starting index
+            many_len = min(right_idx_std, std_sequence_len) - start_idx_std
+            if right_idx < aligned_probs.shape[0] and many_len > 0:
+                one_to_many.append((right_idx - 1, start_idx_std, many_len))
 
-    # === Reverse map std token to source sequences, gather avg. sequence prob ===
-    for map_len in translation_map['lengths'].keys():  # mutually exclusive over std tokens
-        from_idx = translation_map['lengths'][map_len]['from']  # [subset_size_std] one std token
-        to_idx = translation_map['lengths'][map_len]['to'].T  # [map_len, subset_size_std] many server token seq
-        if many_len < map_len:  # sequence beyond segment_count has min probability 0
-            to_idx = to_idx[:many_len, :]  # [segment_count, subset_size_std]
-        server_seq_tokens = probs_from_copy.gather(1, to_idx)  # [map_len, subset_size_std] gather sequences
-        probs_to[from_idx] = server_seq_tokens.sum(dim=0) / map_len  # [subset_size_std] in-place average approx.
+        # === Many-to-one mapping ===
+        elif segment_count_std_base == 1:  # many-to-one
+            start_idx = max(right_idx - segment_count, 0)  # calculate starting index
+            # truncated at the end of the sequence like the slice aligned_probs[start_idx:right_idx], so a
+            # mapping never reads the rows of the next sequence once the batch is concatenated
+            many_len = min(right_idx, aligned_probs.shape[0]) - start_idx
+            if right_idx_std - 1 < std_sequence_len:
+                many_to_one.append((start_idx, max(many_len, 0), right_idx_std - 1))
+
+        else:
+            print('Undefined mapping.')
+
+    return aligned_probs, one_to_many, many_to_one
+
+
+def apply_tokenizer_translation_jobs(aligned_probs: torch.FloatTensor, probs_std: torch.FloatTensor,
+                                     one_to_many: List[tuple], many_to_one: List[tuple],
+                                     to_translation_map: Dict[str, Any], from_translation_map: Dict[str, Any]) -> None:
+    r"""
+    Applies the mappings listed by get_tokenizer_translation_jobs with one vectorized translation per mapping kind.
+        Args:
+            aligned_probs (:obj:`torch.FloatTensor`, `required`):
+                [n, vocab_size] Aligned source probability distributions.
+            probs_std (:obj:`torch.FloatTensor`, `required`):
+                [m, std_vocab_size] Output probability distribution over a target tokenizer vocabulary, written in-place.
+            one_to_many (:obj:`List[tuple]`, `required`):
+                [(aligned row, first std row, std rows), ...]
+            many_to_one (:obj:`List[tuple]`, `required`):
+                [(first aligned row, aligned rows, std row), ...]
+            to_translation_map (:obj:`Dict[str, Any]`, `required`):
+                Maps from source tokens to target token sequences.
+            from_translation_map (:obj:`Dict[str, Any]`, `required`):
+                Maps from target tokens to source token sequences.
+
+        Returns:
 
+    """
+    if len(one_to_many) > 0:
+        src_idx, dst_idx, many_lens = torch.tensor(one_to_many, dtype=torch.long).T
+        translate_one_to_many_batch(aligned_probs, probs_std, src_idx, dst_idx, many_lens, to_translation_map)
+    if len(many_to_one) > 0:
+        src_idx, many_lens, dst_idx = torch.tensor(many_to_one, dtype=torch.long).T
+        translate_many_to_one_batch(aligned_probs, probs_std, src_idx, many_lens, dst_idx, from_translation_map)
 
 
 def translate_tokenizer_probs(probs: torch.FloatTensor, probs_std: torch.FloatTensor,
@@ -553,40 +926,11 @@ def translate_tokenizer_probs(probs: torch.FloatTensor, probs_std: torch.FloatTe
         Returns:
 
     """
-    # === Align tokenized sequences via source token splitting ===
-    result = align_tokenizer_sequences(probs, offset_mapping, offset_mapping_std,
-                                       tokenizer, split_map_cache, tokens.cpu(), tokens_std.cpu())
-    aligned_probs, aligned_offset_mapping, aligned_tokens = result
-
-    # === Get one-to-many / many-to-one mappings ===
-    mappings = get_tokenizer_sequence_mappings(aligned_offset_mapping, offset_mapping_std)
-
-    # === Perform probability mappings ===
-    for (right_idx, right_idx_std, segment_count_base, segment_count_std_base,
-         segment_count_overlap, segment_count_std_overlap) in mappings[1:]:  # don't map start token
-
-        segment_count = segment_count_base + segment_count_overlap  # calculate effective segments length
-        segment_count_std = segment_count_std_base + segment_count_std_overlap  # calculate effective segments length
-
-        # === One-to-many / one-to-one mapping ===
-        if segment_count_base == 1:
-            start_idx_std = right_idx_std - segment_count_std  # calculate starting index
-            if right_idx < aligned_probs.shape[0]:
-                
-                translate_one_to_many(aligned_probs[right_idx-1],
-                                    probs_std[start_idx_std:start_idx_std+segment_count_std],
-                                    to_translation_map)
-
-        # === Many-to-one mapping ===
-        elif segment_count_std_base == 1:  # many-to-one
-            start_idx = right_idx - segment_count  # calculate starting index
-
-            translate_many_to_one(aligned_probs[start_idx:right_idx],
-                                  probs_std[right_idx_std-1],
-                                  from_translation_map)
-
-        else:
-            print('Undefined mapping.')
+    aligned_probs, one_to_many, many_to_one = get_tokenizer_translation_jobs(probs, offset_mapping, offset_mapping_std,
+                                                                             tokenizer, split_map_cache,
+                                                                             tokens, tokens_std, probs_std.shape[0])
+    apply_tokenizer_translation_jobs(aligned_probs, probs_std, one_to_many, many_to_one,
+                                     to_translation_map, from_translation_map)
 
 
 def get_top_probs(probs: torch.FloatTensor, tokenizer: PreTrainedTokenizerBase, amount: int = 10) -> str:
@@ -686,14 +1030,26 @@ def translate_logits_to_probs_std(logits: torch.FloatTensor,
         probs = padded_probs
 
     # === Translate to probabilities over standard tokenizer ===
+    # the mappings of every sequence are collected first, and applied to the whole batch at once
     probs_std = torch.zeros(batch_size, std_sequence_len, std_vocab_size)
+    aligned_probs, one_to_many, many_to_one = [], [], []
+    num_aligned = 0
     for b in range(batch_size):
         probs_b = probs[b][-len(offset_mapping[b]):]  # remove left padding
         tokens_b = tokens[b][-len(offset_mapping[b]):]  # remove left padding
-        translate_tokenizer_probs(probs_b, probs_std[b], offset_mapping[b], offset_mapping_std[b],
-                                  tokenizer, std_tokenizer,
-                                  split_map_cache, to_translation_map, from_translation_map,
-                                  tokens_b, tokens_std[b])
+        aligned_probs_b, one_to_many_b, many_to_one_b = get_tokenizer_translation_jobs(probs_b, offset_mapping[b],
+                                                                                       offset_mapping_std[b],
+                                                                                       tokenizer, split_map_cache,
+                                                                                       tokens_b, tokens_std[b],
+                                                                                       std_sequence_len)
+        row_std = b * std_sequence_len
+        one_to_many += [(num_aligned + i, row_std + j, n) for i, j, n in one_to_many_b]
+        many_to_one += [(num_aligned + i, n, row_std + j) for i, n, j in many_to_one_b]
+        aligned_probs.append(aligned_probs_b)
+        num_aligned += aligned_probs_b.shape[0]
+
+    apply_tokenizer_translation_jobs(torch.cat(aligned_probs, dim=0), probs_std.view(-1, std_vocab_size),
+                                     one_to_many, many_to_one, to_translation_map, from_translation_map)
 
     # === Correct excess probability mass (haircut) ===
     probs_std_sum = probs_std.sum(dim=-1)  # [batch_size, std_sequence_len]
@@ -708,6 +1064,33 @@ def translate_logits_to_probs_std(logits: torch.FloatTensor,
     return probs_std  # [batch_size, std_sequence_len, std_vocab_size]
 
 
+def test_translate_batch(tokenizer: str = 'gpt2', std_tokenizer: str = 'facebook/opt-125m', batch_size: int = 4) -> Dict[str, Any]:
+    r"""
+    A batch translates to the same standard distributions as each of its sequences on its own.
+    """
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer)
+    std_tokenizer = AutoTokenizer.from_pretrained(std_tokenizer)
+    prep_tokenizer(tokenizer, std_tokenizer)
+    texts = [' unbelievably tokenized, naïve café words:\n\t1234567 tokens'] * batch_size
+    encoding = tokenizer(texts, return_offsets_mapping=True, return_tensors='pt')
+    encoding_std = std_tokenizer(texts, return_offsets_mapping=True, return_tensors='pt')
+    offset_mapping = [[tuple(o) for o in offsets.tolist()] for offsets in encoding['offset_mapping']]
+    offset_mapping_std = [[tuple(o) for o in offsets.tolist()] for offsets in encoding_std['offset_mapping']]
+    translation_maps = [get_translation_map(tokenizer, std_tokenizer), get_translation_map(std_tokenizer, tokenizer)]
+    # every sequence gets other logits, so a mapping that reads into the next sequence shows
+    logits = torch.randn(batch_size, encoding['input_ids'].shape[1], len(tokenizer))
+
+    def translate(b: slice) -> torch.FloatTensor:
+        return translate_logits_to_probs_std(logits[b], offset_mapping[b], offset_mapping_std[b], tokenizer, std_tokenizer,
+                                             {}, *translation_maps, encoding['input_ids'][b], encoding_std['input_ids'][b])
+
+    probs_std = translate(slice(0, batch_size))
+    for b in range(batch_size):
+        assert torch.allclose(probs_std[b], translate(slice(b, b + 1))[0], atol=1e-6), f'sequence {b} differs in the batch'
+    return {'success': True, 'msg': 'batched translation matches the translation of each sequence'}
+
+
 def topk_token_phrases(logits: torch.Tensor, tokenizer: PreTrainedTokenizerBase,
                        topk: int, ignore_index: int = -100) -> torch.Tensor:
     r"""
@@ -937,6 +1320,7 @@ def phrase_cross_entropy(target_phrases: Union[List[List[int]], torch.Tensor],
                   [...],
                   [prob_floor_b=1, ignore_index, ..., ignore_index]],
                  [...]]
+                A packed TopK from encode_topk is scored on its sparse form (see topk_phrase_cross_entropy).
             ignore_index (:obj:`int`, `optional`):
                 Padding value to use for unfilled token positions in a shorter token phrase.
             reduce (:obj:`bool`, `optional`):
@@ -953,6 +1337,10 @@ def phrase_cross_entropy(target_phrases: Union[List[List[int]], torch.Tensor],
                 Phrase cross entropy loss, either scalar if reduce or [batch_size].
     """
 
+    if isinstance(topk_tensor, TopK):
+        return topk_phrase_cross_entropy(target_phrases, topk_tensor, reduce=reduce, reduction=reduction,
+                                         vocab_size_min=vocab_size_min)
+
     batch_size, topk_p1, max_len = topk_tensor.shape  # [batch_size, (topk + 1), max_len]
     topk = topk_p1 - 1
 
@@ -1424,43 +1812,218 @@ def prep_tokenizer(tokenizer, std_tokenizer=None):
     return tokenizer
 
 
-def encode_topk( forward_response_tensor: torch.Tensor , topk:int=4096) -> torch.Tensor:
-   
-    """ Returns topk tokens/probabilities given unnormalized logits as input. """
+class TopK(NamedTuple):
+    r"""
+    Packed top-k encoding of token probability distributions, as returned by encode_topk.
+    The serializer sends it as one safetensors blob, with the indices as int32 (exact for any vocabulary)
+    and the probabilities as fp16/bf16.
+        Args:
+            probs (:obj:`torch.Tensor`, `required`):
+                [batch_size, sequence_len, topk] Top-k probabilities, sorted in descending order.
+            indices (:obj:`torch.Tensor`, `required`):
+                [batch_size, sequence_len, topk] Token ids of the top-k probabilities (int32).
+            vocab_size (:obj:`int`, `required`):
+                Size of the vocabulary the top-k was selected from.
+    """
+    probs: torch.Tensor
+    indices: torch.Tensor
+    vocab_size: int
 
-    #import ipdb; ipdb.set_trace()
+    @property
+    def nbytes(self) -> int:
+        return self.probs.numel() * self.probs.element_size() + self.indices.numel() * self.indices.element_size()
 
+
+def encode_topk(forward_response_tensor: torch.Tensor, topk: int = 4096,
+                dtype: torch.dtype = torch.float16, packed: bool = True) -> Union[TopK, torch.Tensor]:
+    r"""
+    Returns topk tokens/probabilities given unnormalized logits as input.
+        Args:
+            forward_response_tensor (:obj:`torch.Tensor`, `required`):
+                [batch_size, sequence_len, vocab_size] Unnormalized logit scores.
+            topk (:obj:`int`, `optional`):
+                Number of tokens to keep per position.
+            dtype (:obj:`torch.dtype`, `optional`):
+                Dtype of the packed probabilities (torch.float16 or torch.bfloat16).
+            packed (:obj:`bool`, `optional`):
+                Return a TopK, otherwise the legacy [batch_size, sequence_len, topk + topk] float tensor.
+
+        Returns:
+            encoded_probs (:obj:`Union[TopK, torch.Tensor]`, `required`):
+                Packed TopK, or [batch_size, sequence_len, topk + topk] probabilities followed by indices.
+    """
     logits = forward_response_tensor  # unnormalized logit scores: [batch_size, sequence_len, vocab_size]
-    probs = torch.softmax(logits, dim=-1).to(torch.float32)  # normalized probabilities: [batch_size, sequence_len, vocab_size]
+    topk = min(topk, logits.shape[-1])
+
+    # partial selection on the logits (same order as the probabilities), instead of sorting the whole vocabulary
+    topk_logits, topk_indices = torch.topk(logits, topk, dim=-1)  # [batch_size, sequence_len, topk]
+    # only the topk probabilities are computed, normalized over the full vocabulary
+    log_norm = torch.logsumexp(logits.float(), dim=-1, keepdim=True)  # [batch_size, sequence_len, 1]
+    topk_values = torch.exp(topk_logits.float() - log_norm)  # [batch_size, sequence_len, topk]
 
-    topk_indices = torch.argsort(probs, dim=-1, descending=True)[...,:topk]
-    # topk_values, topk_indices = torch.topk(probs, topk) # topk probs and indices: [batch_size, sequence_len, topk]
+    if not packed:
+        return torch.cat([topk_values, topk_indices.to(topk_values.dtype)], dim=-1)  # [batch_size, sequence_len, topk + topk]
 
-    topk_values = probs.gather( index=topk_indices, dim=-1)
-    encoded_probs = torch.cat([topk_values, topk_indices], dim=-1)  # [batch_size, sequence_len, topk + topk]
-    return encoded_probs  # [batch_size, sequence_len, topk + topk]
+    return TopK(probs=topk_values.to(dtype), indices=topk_indices.to(torch.int32), vocab_size=logits.shape[-1])
 
 
+def unpack_topk(forward_response_tensor: Union[TopK, torch.Tensor], topk: int = None,
+                vocab_size: int = None) -> TopK:
+    r"""
+    Returns the TopK of a packed or legacy [batch_size, sequence_len, topk + topk] encoding.
+        Args:
+            forward_response_tensor (:obj:`Union[TopK, torch.Tensor]`, `required`):
+                Top-k encoding.
+            topk (:obj:`int`, `optional`):
+                Number of probabilities in a legacy encoding, half of its last dimension by default.
+            vocab_size (:obj:`int`, `optional`):
+                Vocabulary size of a legacy encoding.
 
-def decode_topk(  forward_response_tensor: torch.Tensor, vocab_size:int=50400) -> torch.Tensor:
-    """ Returns full logits by decoding topk-encoding input. """
-    batch_size, sequence_len, _ = forward_response_tensor.shape
+        Returns:
+            topk (:obj:`TopK`, `required`):
+                Packed top-k encoding.
+    """
+    if isinstance(forward_response_tensor, TopK):
+        return forward_response_tensor
     encoded_probs = forward_response_tensor  # encoded probabilities: [batch_size, sequence_len, topk + topk]
-    # split the tensor along the last dimension
-    assert encoded_probs.shape[-1] % 2 == 0, "encoded_probs.shape[-1] must be even"
-    topk = encoded_probs.shape[-1] // 2  # topk: [batch_size, sequence_len, topk]
-    topk_values = encoded_probs[..., :topk]  # topk probs: [batch_size, sequence_len, topk]
-    topk_indices = encoded_probs[..., topk:].long()  # topk probs indices: [batch_size, sequence_len, topk]
-
-    topk_pmass = topk_values.sum(dim=-1)  # topk probability mass: [batch_size, sequence_len]
-    remainder_pmass = torch.clamp(1 - topk_pmass, 1e-40, 1)  # remainder probability mass: [batch_size, sequence_len]
-    
-    remainder_floor = remainder_pmass / (vocab_size - topk)  # divide remainder: [batch_size, sequence_len]
-
-    logits = torch.ones((batch_size, sequence_len, vocab_size), dtype=topk_values.dtype).to(topk_values.device)
-    logits *= torch.log(remainder_floor)[:, :, None]  # set probability floor: [batch_size, sequence_len, vocab_size]
-    topk_indices = torch.clamp(topk_indices, 0, vocab_size - 1)
-    logits.scatter_(-1, topk_indices, torch.log(topk_values + 1e-40))  # insert topk probs: [batch_size, sequence_len, vocab_size]
+    if topk == None:
+        assert encoded_probs.shape[-1] % 2 == 0, "encoded_probs.shape[-1] must be even"
+        topk = encoded_probs.shape[-1] // 2
+    return TopK(probs=encoded_probs[..., :topk],  # topk probs: [batch_size, sequence_len, topk]
+                indices=encoded_probs[..., topk:].round().int(),  # topk probs indices: [batch_size, sequence_len, topk]
+                vocab_size=vocab_size)
+
+
+def topk_floor_probs(topk: TopK) -> torch.Tensor:
+    r"""
+    The probability of every token outside the top-k, as the remainder mass divided evenly.
+        Args:
+            topk (:obj:`TopK`, `required`):
+                Packed top-k encoding.
+
+        Returns:
+            floor_probs (:obj:`torch.Tensor`, `required`):
+                [batch_size, sequence_len] Floor probabilities.
+    """
+    topk_pmass = topk.probs.float().sum(dim=-1)  # topk probability mass: [batch_size, sequence_len]
+    remainder_pmass = torch.clamp(1 - topk_pmass, EPSILON, 1)  # remainder probability mass: [batch_size, sequence_len]
+    return remainder_pmass / max(topk.vocab_size - topk.probs.shape[-1], 1)  # divide remainder: [batch_size, sequence_len]
+
+
+def decode_topk(forward_response_tensor: Union[TopK, torch.Tensor], topk: int = None,
+                vocab_size: int = 50400) -> torch.Tensor:
+    r"""
+    Returns full logits by decoding topk-encoding input. Prefer the sparse topk_* functions when
+    only the probabilities of some tokens are needed, as this materializes [batch_size, sequence_len, vocab_size].
+        Args:
+            forward_response_tensor (:obj:`Union[TopK, torch.Tensor]`, `required`):
+                Packed TopK or legacy [batch_size, sequence_len, topk + topk] encoding.
+            topk (:obj:`int`, `optional`):
+                Number of probabilities in a legacy encoding, half of its last dimension by default.
+            vocab_size (:obj:`int`, `optional`):
+                Vocabulary size of a legacy encoding (a TopK knows its own).
+
+        Returns:
+            logits (:obj:`torch.Tensor`, `required`):
+                [batch_size, sequence_len, vocab_size] Log probabilities.
+    """
+    encoded = unpack_topk(forward_response_tensor, topk=topk, vocab_size=vocab_size)
+    vocab_size = encoded.vocab_size or vocab_size
+    encoded = encoded._replace(vocab_size=vocab_size)
+    topk_values = encoded.probs.float()  # topk probs: [batch_size, sequence_len, topk]
+    topk_indices = torch.clamp(encoded.indices.long(), 0, vocab_size - 1)  # [batch_size, sequence_len, topk]
+    remainder_floor = topk_floor_probs(encoded)  # [batch_size, sequence_len]
+
+    logits = torch.log(remainder_floor)[..., None].expand(*remainder_floor.shape, vocab_size).clone()  # set probability floor
+    logits.scatter_(-1, topk_indices, torch.log(topk_values + EPSILON))  # insert topk probs: [batch_size, sequence_len, vocab_size]
 
     return logits  # [batch_size, sequence_len, vocab_size]
 
+
+def topk_target_probs(topk: TopK, target_ids: torch.Tensor) -> torch.Tensor:
+    r"""
+    The probability of each target token under a top-k encoding, without densifying it.
+        Args:
+            topk (:obj:`TopK`, `required`):
+                [batch_size, sequence_len, topk] Packed top-k encoding.
+            target_ids (:obj:`torch.Tensor`, `required`):
+                [batch_size, sequence_len] Target token of every position.
+
+        Returns:
+            target_probs (:obj:`torch.Tensor`, `required`):
+                [batch_size, sequence_len] Target probabilities (the floor probability if not in the top-k).
+    """
+    match = topk.indices == target_ids[..., None].to(topk.indices.device, topk.indices.dtype)  # [batch_size, sequence_len, topk]
+    target_probs = (topk.probs.float() * match).sum(dim=-1)  # [batch_size, sequence_len]
+    return torch.where(match.any(dim=-1), target_probs, topk_floor_probs(topk))
+
+
+def topk_cross_entropy(topk: Union[TopK, torch.Tensor], target_ids: torch.Tensor, ignore_index: int = -100,
+                       reduce: bool = True, reduction: str = 'mean', vocab_size: int = 50400) -> torch.Tensor:
+    r"""
+    Next token cross entropy of a top-k encoding against target tokens, computed on the sparse form.
+        Args:
+            topk (:obj:`Union[TopK, torch.Tensor]`, `required`):
+                [batch_size, sequence_len, topk] Packed (or legacy) top-k encoding.
+            target_ids (:obj:`torch.Tensor`, `required`):
+                [batch_size, sequence_len] Target token of every position (already shifted to the predicted position).
+            ignore_index (:obj:`int`, `optional`):
+                Target value of positions to leave out.
+            reduce (:obj:`bool`, `optional`):
+                Whether to reduce the cross entropy over the unmasked positions.
+            reduction (:obj:`str`, `optional`):
+                Reduction function to perform when reduce is True.
+            vocab_size (:obj:`int`, `optional`):
+                Vocabulary size of a legacy encoding.
+
+        Returns:
+            loss (:obj:`torch.Tensor`, `required`):
+                Cross entropy loss, either scalar if reduce or [batch_size, sequence_len].
+    """
+    topk = unpack_topk(topk, vocab_size=vocab_size)
+    target_probs = torch.clamp(topk_target_probs(topk, target_ids), 0, 1)
+    loss = - torch.log(target_probs + EPSILON)  # [batch_size, sequence_len]
+    mask = (target_ids != ignore_index).to(loss.device)
+    if not reduce:
+        return loss * mask
+    if not hasattr(loss, reduction):
+        raise RuntimeError(f'topk_cross_entropy(): Reduction function {reduction} not found.')
+    return getattr(loss[mask], reduction)()
+
+
+def topk_phrase_cross_entropy(target_phrases: Union[List[List[int]], torch.Tensor], topk: TopK,
+                              reduce: bool = True, reduction: str = 'mean',
+                              vocab_size_min: int = 50257) -> Tuple[torch.Tensor, torch.Tensor]:
+    r"""
+    phrase_cross_entropy for a packed top-k encoding of the last position, where every phrase is a single token,
+    so the phrase loss and the validation loss coincide.
+        Args:
+            target_phrases (:obj:`List[List[int]]`, `required`):
+                [batch_size, *] Target phrases in standard token sequence list.
+            topk (:obj:`TopK`, `required`):
+                [batch_size, topk] or [batch_size, sequence_len, topk] Packed top-k encoding.
+            reduce (:obj:`bool`, `optional`):
+                Whether to reduce the cross entropy over the batch dimension.
+            reduction (:obj:`str`, `optional`):
+                Reduction function to perform when reduce is True.
+            vocab_size_min (:obj:`int`, `optional`):
+                Minimum server vocab_size expected, used to prevent the floor_probs from being too large.
+        Returns:
+            loss_val (:obj:`torch.Tensor`, `required`):
+                Validation cross entropy loss, either scalar if reduce or [batch_size].
+            loss (:obj:`torch.Tensor`, `required`):
+                Phrase cross entropy loss, either scalar if reduce or [batch_size].
+    """
+    if topk.probs.dim() == 3:
+        topk = TopK(probs=topk.probs[:, -1], indices=topk.indices[:, -1], vocab_size=topk.vocab_size)
+    topk = topk._replace(vocab_size=max(topk.vocab_size or 0, vocab_size_min))
+    target_ids = torch.tensor([round(float(p[0])) for p in target_phrases])  # [batch_size] first target tokens
+    target_probs = torch.clamp(topk_target_probs(topk, target_ids), 0, 1)  # [batch_size]
+    loss = - torch.log(target_probs + EPSILON)  # [batch_size] calculate cross entropy loss
+
+    if reduce:
+        if not hasattr(loss, reduction):
+            raise RuntimeError(f'phase_cross_entropy(): Reduction function {reduction} not found.')
+        loss = getattr(loss, reduction)()
+    return loss, loss
+
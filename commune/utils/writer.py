@@ -0,0 +1,250 @@
+import os
+import time
+import threading
+import concurrent.futures
+from typing import *
+
+"""
+Atomic, group committed file writes.
+
+A write goes to a temporary file next to the target, which is renamed over the target, so a
+reader (or a process that crashed mid-write) sees the old file or the new one, never a torn one.
+
+Writes are queued and committed by one thread in batches:
+- writes to the same path that are still queued are coalesced, the last one wins
+- the temporary files of a batch are written first, fsynced together, then renamed, and every
+  directory of the batch is fsynced once, instead of one open/write/fsync/close per file
+- write(wait=True) returns once its batch is committed, flush() once everything queued before it is
+"""
+
+TMP_SUFFIX = '.tmp'
+
+
+def tmp_path(path:str) -> str:
+    directory, name = os.path.split(path)
+    return os.path.join(directory, f'.{name}.{os.getpid()}.{threading.get_ident()}{TMP_SUFFIX}')
+
+
+def fsync_directory(directory:str):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def atomic_write(path:str, data:Union[str, bytes], fsync:bool = True) -> int:
+    """
+    Writes data to path through a temporary file and a rename, without a writer thread.
+    """
+    if isinstance(data, str):
+        data = data.encode()
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    tmp = tmp_path(path)
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(data)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException as e:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise e
+    if fsync:
+        fsync_directory(directory)
+    return len(data)
+
+
+def clean_tmp(directory:str, max_age:float = 60) -> List[str]:
+    """
+    Removes the temporary files that writers which crashed left behind in directory.
+    """
+    removed = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name.startswith('.') and name.endswith(TMP_SUFFIX) and time.time() - os.path.getmtime(path) > max_age:
+            os.remove(path)
+            removed.append(path)
+    return removed
+
+
+class PendingWrite:
+    def __init__(self, path:str, data:bytes, seq:int):
+        self.path = path
+        self.data = data
+        self.seq = seq
+        # the seq of the first write, which flush waits for even after later writes replaced it
+        self.first_seq = seq
+        self.writes = 1
+        self.error = None
+        self.done = threading.Event()
+
+
+class GroupWriter:
+    """
+    Commits the queued writes in batches on a background thread.
+
+    window: seconds to wait after the first write of a batch for more writes to join it. With 0,
+            the writes that arrive while a batch is being committed make up the next one.
+    fsync: fsync the files and their directories, so a commit survives a power loss and not only a crash
+    fsync_threads: fsyncs issued at once, which lets the filesystem commit them in one journal flush
+    """
+    def __init__(self,
+                 window:float = 0.0,
+                 max_batch:int = 256,
+                 fsync:bool = True,
+                 fsync_threads:int = 8):
+        self.window = window
+        self.max_batch = max_batch
+        self.fsync = fsync
+        self.pending = {}
+        self.seq = 0
+        self.committed = 0
+        self.condition = threading.Condition()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=fsync_threads) if fsync and fsync_threads > 1 else None
+        self.stats = {'writes': 0, 'coalesced': 0, 'files': 0, 'batches': 0, 'errors': 0}
+        self.pid = None
+        self.start_lock = threading.Lock()
+
+    def start(self):
+        # a forked child gets the queue of its parent but not the thread, so it starts its own
+        if self.pid == os.getpid():
+            return
+        with self.start_lock:
+            if self.pid == os.getpid():
+                return
+            self.pending = {}
+            self.committed = self.seq
+            self.condition = threading.Condition()
+            if self.executor != None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.executor._max_workers)
+            self.thread = threading.Thread(target=self.run, daemon=True, name='group_writer')
+            self.thread.start()
+            self.pid = os.getpid()
+
+    def write(self, path:str, data:Union[str, bytes], wait:bool = True, timeout:float = None) -> dict:
+        """
+        Queues data to be written to path. With wait, returns once it is committed and raises its error.
+        """
+        if isinstance(data, str):
+            data = data.encode()
+        path = os.path.abspath(path)
+        self.start()
+        with self.condition:
+            self.seq += 1
+            self.stats['writes'] += 1
+            pending = self.pending.get(path)
+            if pending != None:
+                # the last write wins, and whoever waits on the earlier ones waits on it
+                pending.data = data
+                pending.seq = self.seq
+                pending.writes += 1
+                self.stats['coalesced'] += 1
+            else:
+                pending = self.pending[path] = PendingWrite(path, data, self.seq)
+            self.condition.notify_all()
+        if wait:
+            if not pending.done.wait(timeout):
+                raise TimeoutError(f'write to {path} was not committed in {timeout}s')
+            if pending.error != None:
+                raise pending.error
+        return {'success': True, 'msg': f'wrote {path}', 'size': len(data), 'committed': pending.done.is_set()}
+
+    def flush(self, timeout:float = None) -> dict:
+        """
+        A barrier: returns once every write queued before it is committed.
+        """
+        self.start()
+        with self.condition:
+            seq = self.seq
+            if not self.condition.wait_for(lambda: self.committed >= seq, timeout=timeout):
+                raise TimeoutError(f'writes up to {seq} were not committed in {timeout}s')
+        return {'success': True, 'msg': f'committed {seq} writes'}
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: len(self.pending) > 0)
+            if self.window > 0:
+                time.sleep(self.window)
+            with self.condition:
+                paths = list(self.pending)[:self.max_batch]
+                batch = [self.pending.pop(path) for path in paths]
+            self.commit(batch)
+            with self.condition:
+                # seqs are handed out in order and the queue is taken in order, up to the oldest still queued
+                oldest = min([p.first_seq for p in self.pending.values()] + [self.seq + 1])
+                self.committed = max(self.committed, oldest - 1)
+                self.stats['files'] += len(batch)
+                self.stats['batches'] += 1
+                self.condition.notify_all()
+            for pending in batch:
+                pending.done.set()
+
+    def commit(self, batch:List[PendingWrite]):
+        files = []
+        for pending in batch:
+            tmp = tmp_path(pending.path)
+            f = None
+            try:
+                os.makedirs(os.path.dirname(pending.path), exist_ok=True)
+                f = open(tmp, 'wb')
+                f.write(pending.data)
+                f.flush()
+                files.append((pending, tmp, f))
+            except Exception as e:
+                if f != None:
+                    f.close()
+                self.fail(pending, e, tmp)
+        if self.fsync:
+            self.map(self.fsync_file, files)
+        directories = set()
+        for pending, tmp, f in files:
+            f.close()
+            if pending.error != None:
+                self.fail(pending, pending.error, tmp)
+                continue
+            try:
+                os.replace(tmp, pending.path)
+                directories.add(os.path.dirname(pending.path))
+            except Exception as e:
+                self.fail(pending, e, tmp)
+        if self.fsync:
+            try:
+                self.map(fsync_directory, list(directories))
+            except Exception as e:
+                # the files are renamed, only their durability is in question
+                self.stats['errors'] += 1
+
+    def fsync_file(self, item:tuple):
+        pending, tmp, f = item
+        try:
+            os.fsync(f.fileno())
+        except Exception as e:
+            pending.error = e
+
+    def map(self, fn:Callable, items:list):
+        if self.executor == None or len(items) < 2:
+            return [fn(item) for item in items]
+        return list(self.executor.map(fn, items))
+
+    def fail(self, pending:PendingWrite, error:Exception, tmp:str):
+        pending.error = error
+        self.stats['errors'] += 1
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+writers = {}
+
+def writer(**kwargs) -> GroupWriter:
+    """
+    The GroupWriter of this process for these settings.
+    """
+    key = tuple(sorted(kwargs.items()))
+    if key not in writers:
+        writers[key] = GroupWriter(**kwargs)
+    return writers[key]
@@ -55,29 +55,25 @@ class Vali(c.Module):
         self.start_time = c.time()
         for i in range(self.config.workers):
             self.start_worker(i)
-        while True:
+        return c.schedule(self.run_step, interval=self.config.sleep_interval, delay=self.config.sleep_interval)
 
-            c.sleep(self.config.sleep_interval)
-            try:
-                self.sync()
-                run_info = self.run_info()
-                c.print(run_info)
-
-                r = {'success': False, 'msg': 'Vote Staleness is too low', 'vote_staleness': self.vote_staleness, 'vote_interval': self.config.vote_interval}
-                if not 'subspace' in self.config.network and 'bittensor' not in self.config.network:
-                    r = {'success': False, 'msg': 'Not a voting network', 'network': self.config.network}
-                else:
-                    if self.vote_staleness > self.config.vote_interval:
-                        r = self.vote()
-                run_info.update(r)
-
-                df = self.leaderboard()[:10]
-                c.print(df)
-                c.print(run_info)
-
-            except Exception as e:
-                c.print(c.detailed_error(e))
+    def run_step(self):
+        self.sync()
+        run_info = self.run_info()
+        c.print(run_info)
 
+        r = {'success': False, 'msg': 'Vote Staleness is too low', 'vote_staleness': self.vote_staleness, 'vote_interval': self.config.vote_interval}
+        if not 'subspace' in self.config.network and 'bittensor' not in self.config.network:
+            r = {'success': False, 'msg': 'Not a voting network', 'network': self.config.network}
+        else:
+            if self.vote_staleness > self.config.vote_interval:
+                r = self.vote()
+        run_info.update(r)
+
+        df = self.leaderboard()[:10]
+        c.print(df)
+        c.print(run_info)
+        return run_info
 
 
     
@@ -25,9 +25,20 @@ import json
 from loguru import logger
 import random
 import os
+import time
+import queue
+import hashlib
+import threading
+import http.server
+import urllib.parse
+import urllib.request
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from collections import OrderedDict
+import numpy as np
 import torch
 from torch.utils.data.dataloader import DataLoader
-from typing import Optional, Union, Dict, List, Any
+from typing import Optional, Union, Dict, List, Any, Callable, Awaitable
 import commune
 from commune import Module
 from commune.utils.dict import chunk
@@ -35,6 +46,25 @@ from commune.utils.dict import chunk
 logger = logger.opt(colors=True)
 
 
+class _LocalTextHandler(http.server.BaseHTTPRequestHandler):
+    '''
+    The cat endpoint of LocalTextApi. It is defined before BittensorDataset, since a module resolves
+    to the last class of its file.
+    '''
+    def do_POST(self):
+        api = self.server.api
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        time.sleep(api.latency)
+        body = api.text(query['arg'][0])
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
 class BittensorDataset(Module):
     """ Implementation for the dataset class, which handles dataloading from ipfs
     """
@@ -63,7 +93,10 @@ class BittensorDataset(Module):
             background: bool = True,
             min_hash_count : int = 850000,
             loop: Optional['asyncio.loop'] = None ,
-            nest_asyncio: bool = True
+            nest_asyncio: bool = True,
+            prefetch: bool = False,
+            cache_bytes: int = 2**30,
+            num_fetchers: int = 8,
             
             ):
 
@@ -108,6 +141,30 @@ class BittensorDataset(Module):
             # Build the text corpus by fetching the hashes of the textfiles (Current Heirarchy)
         
             self.download_hashes(background=self.background, min_hash_count=self.min_hash_count)
+
+        self.pipeline = None
+        if prefetch:
+            self.start_pipeline(cache_bytes=cache_bytes, num_fetchers=num_fetchers)
+      
+    def start_pipeline(self, cache_bytes:int = 2**30, num_fetchers:int = 8) -> 'SamplePipeline':
+        '''
+        Serves sample() from a SamplePipeline: the blocks are fetched in the background into a deduplicated
+        block cache, and batches are cut from the cached blocks and tokenized in another process.
+        '''
+        cache = BlockCache(self.resolve_path('block_cache'), max_bytes=cache_bytes)
+        self.pipeline = SamplePipeline(fetch=self.fetch_block,
+                                       cids=[fm['Hash'] for fm in self.all_text_file_metas],
+                                       cache=cache,
+                                       tokenizer=self.tokenizer,
+                                       batch_size=self.batch_size,
+                                       sequence_length=self.sequence_length,
+                                       block_bytes=self.min_block_size_bytes,
+                                       num_fetchers=num_fetchers,
+                                       pad_token_id=self.pad_token_idx)
+        return self.pipeline.start()
+
+    async def fetch_block(self, cid:str) -> bytes:
+        return await self.cat(cid=cid, offset=0, length=self.max_hash_size)
       
       
     def set_tokenizer(self, tokenizer:'bittensor.tokenizer'=None)-> 'bittensor.tokenizer':
@@ -362,6 +419,12 @@ class BittensorDataset(Module):
         batch_size = batch_size if batch_size else self.batch_size
         sequence_length = sequence_length if sequence_length else self.sequence_length
         no_tokenizer = no_tokenizer if no_tokenizer else self.no_tokenizer
+        if self.pipeline != None and not no_tokenizer and batch_size == self.pipeline.batch_size and sequence_length == self.pipeline.sequence_length:
+            input_ids = torch.from_numpy(self.pipeline.sample())
+            output = {'input_ids': input_ids}
+            if task == True or task in ['causallm']:
+                output['targets'] = input_ids.clone()
+            return output
         getitem_jobs = asyncio.gather(*[self.__async_getitem__(sequence_length=sequence_length, no_tokenizer=True) for i in range(batch_size)])
         sample_text = asyncio.run(getitem_jobs)
         output = {}
@@ -873,6 +936,9 @@ class BittensorDataset(Module):
         if len(self.fetch_text_tasks)> 0:
             for t in self.fetch_text_tasks:
                 t.cancel()
+        if getattr(self, 'pipeline', None) != None:
+            self.pipeline.stop()
+            self.pipeline = None
 
     
     @classmethod
@@ -951,9 +1017,384 @@ class BittensorDataset(Module):
     def test(cls, *args,**kwargs):
         self = cls( *args,**kwargs)
         cls.print(self.sample())
-        
 
-        
-        
+    @classmethod
+    def test_pipeline(cls, num_blocks:int = 64, batch_size:int = 8, sequence_length:int = 64):
+        api = LocalTextApi(latency=0.01, duplicate_every=4)
+        cache = BlockCache(cls.resolve_path('test_block_cache'), max_bytes=2**20)
+        cids = [f'cid-{i}' for i in range(num_blocks)]
+        pipeline = SamplePipeline(fetch=api.cat, cids=cids, cache=cache, batch_size=batch_size, sequence_length=sequence_length, block_bytes=1000).start()
+        batches = [pipeline.sample(timeout=10) for _ in range(20)]
+        assert all(b.shape == (batch_size, sequence_length) for b in batches)
+        assert (batches[0] > 0).all(), 'the windows are shorter than the sequence'
+        pipeline.fetch_thread.join()
+        # every 4th block has the text of the block before it, and is stored once
+        assert len(cache) == num_blocks - (num_blocks - 1) // 4 and cache.duplicates == (num_blocks - 1) // 4, (len(cache), cache.duplicates)
+        assert cache.size <= cache.max_bytes
+        pipeline.stop()
+        api.stop()
+        # a new cache on the same folder has the blocks, and samples without fetching
+        assert len(BlockCache(cache.path, max_bytes=2**20)) == len(cache)
+        cls.rm('test_block_cache')
+        return {'success': True, 'msg': 'pipeline test passed'}
+
+    @classmethod
+    def test_pipeline_eviction(cls, num_blocks:int = 400, max_bytes:int = 200000, batch_size:int = 8, sequence_length:int = 64):
+        '''
+        The blocks are larger than the cache, so blocks are evicted while the sampler reads them.
+        '''
+        cls.rm('test_block_cache_eviction')
+        api = LocalTextApi(latency=0.0, duplicate_every=0)
+        cache = BlockCache(cls.resolve_path('test_block_cache_eviction'), max_bytes=max_bytes)
+        cids = [f'cid-{i}' for i in range(num_blocks)]
+        pipeline = SamplePipeline(fetch=api.cat, cids=cids, cache=cache, batch_size=batch_size, sequence_length=sequence_length,
+                                  block_bytes=1000, min_blocks=2).start()
+        batches = 0
+        while pipeline.fetch_thread.is_alive():
+            pipeline.sample(timeout=10)
+            batches += 1
+        assert pipeline.sample_thread.is_alive() and pipeline.stats['sample_errors'] == 0, pipeline.stats
+        assert pipeline.sample(timeout=10).shape == (batch_size, sequence_length)
+        assert cache.size <= cache.max_bytes and len(cache) < num_blocks
+        stats = {**pipeline.stats, 'batches_while_fetching': batches}
+        pipeline.stop()
+        api.stop()
+        cls.rm('test_block_cache_eviction')
+        return {'success': True, 'msg': 'pipeline eviction test passed', 'stats': stats}
+
+    @classmethod
+    def test_pipeline_benchmark(cls, latencies:List[float] = [0.0, 0.05, 0.5], num_blocks:int = 256, num_batches:int = 200,
+                                batch_size:int = 32, sequence_length:int = 256) -> dict:
+        '''
+        The latency of sample() with the pipeline for every fetch latency of the stand-in api,
+        against fetching and tokenizing every sample in place like __async_getitem__.
+        '''
+        stats = {}
+        for latency in latencies:
+            api = LocalTextApi(latency=latency)
+            cls.rm('benchmark_block_cache')
+            cache = BlockCache(cls.resolve_path('benchmark_block_cache'))
+            cids = [f'cid-{i}' for i in range(num_blocks)]
+            pipeline = SamplePipeline(fetch=api.cat, cids=cids, cache=cache, batch_size=batch_size, sequence_length=sequence_length).start()
+            pipeline.sample(timeout=60) # the first batch waits for min_blocks
+            times = []
+            for _ in range(num_batches):
+                t0 = time.time()
+                pipeline.sample(timeout=60)
+                times.append(time.time() - t0)
+            pipeline.stop()
+            times.sort()
+            async def fetch_batch():
+                return await asyncio.gather(*[api.cat(f'cid-{j}') for j in range(batch_size)])
+            inline = []
+            for i in range(min(num_batches, 3)):
+                t0 = time.time()
+                asyncio.run(fetch_batch())
+                inline.append(time.time() - t0)
+            api.stop()
+            stats[latency] = {'pipeline_p50_ms': times[len(times) // 2] * 1000,
+                              'pipeline_p99_ms': times[int(len(times) * 0.99)] * 1000,
+                              'inline_fetch_ms': sum(inline) / len(inline) * 1000,
+                              'blocks_cached': len(cache)}
+        cls.rm('benchmark_block_cache')
+        return stats
+
+
+class BlockCache:
+    """
+    Text blocks on disk, stored once per content hash (blocks with the same text under different cids
+    are one file), with the least recently used blocks evicted past max_bytes.
+    """
+
+    def __init__(self, path:str, max_bytes:int = 2**30):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+        self.lock = threading.Lock()
+        self.blocks = OrderedDict() # content hash -> size, least recently used first
+        self.keys = [] # the content hashes, for sampling in O(1)
+        self.key_index = {}
+        self.cids = {} # cid -> content hash
+        self.size = 0
+        self.duplicates = 0
+        files = [f for f in os.scandir(path) if f.name.endswith('.txt')]
+        for f in sorted(files, key=lambda f: f.stat().st_mtime):
+            self.add_key(f.name[:-len('.txt')], f.stat().st_size)
+        if os.path.exists(f'{path}/cids.json'):
+            with open(f'{path}/cids.json') as f:
+                self.cids = {k: v for k, v in json.load(f).items() if v in self.blocks}
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def add_key(self, key:str, size:int):
+        self.blocks[key] = size
+        self.key_index[key] = len(self.keys)
+        self.keys.append(key)
+        self.size += size
+
+    def remove_key(self, key:str):
+        self.size -= self.blocks.pop(key)
+        # swap with the last key, so removing is O(1)
+        i = self.key_index.pop(key)
+        last = self.keys.pop()
+        if last != key:
+            self.keys[i] = last
+            self.key_index[last] = i
+
+    def block_path(self, key:str) -> str:
+        return f'{self.path}/{key}.txt'
+
+    def has(self, cid:str) -> bool:
+        return cid in self.cids
+
+    def put(self, cid:str, data:bytes) -> str:
+        key = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            self.cids[cid] = key
+            if key in self.blocks:
+                self.duplicates += 1
+                self.blocks.move_to_end(key)
+                return key
+        tmp_path = f'{self.block_path(key)}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, self.block_path(key))
+        with self.lock:
+            if key not in self.blocks:
+                self.add_key(key, len(data))
+            while self.size > self.max_bytes and len(self.blocks) > 1:
+                old_key = next(iter(self.blocks))
+                self.remove_key(old_key)
+                os.remove(self.block_path(old_key))
+        return key
+
+    def read(self, key:str) -> bytes:
+        with open(self.block_path(key), 'rb') as f:
+            data = f.read()
+        with self.lock:
+            if key in self.blocks:
+                self.blocks.move_to_end(key)
+        return data
+
+    def random_key(self, rng:random.Random) -> str:
+        with self.lock:
+            return self.keys[rng.randrange(len(self.keys))]
+
+    def save_index(self):
+        with self.lock:
+            cids = {k: v for k, v in self.cids.items() if v in self.blocks}
+        tmp_path = f'{self.path}/cids.json.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(cids, f)
+        os.replace(tmp_path, f'{self.path}/cids.json')
+
+
+class SamplePipeline:
+    """
+    Serves batches of token ids without waiting on the text api.
+
+    - fetchers (asyncio tasks in a thread) download the blocks that are not cached into the BlockCache
+    - a sampler thread cuts random windows of cached blocks into batches of text, as soon as min_blocks are cached
+    - a tokenizer process tokenizes each batch at once into a ring buffer of batches in shared memory
+    - sample copies the next ready batch out of the ring buffer
+
+    The queues between the stages are bounded, so the pipeline runs at most queue_batches + ring_slots batches ahead.
+    """
+
+    def __init__(self,
+                 fetch:Callable[[str], Awaitable[bytes]],
+                 cids:List[str],
+                 cache:BlockCache,
+                 tokenizer = None,
+                 batch_size:int = 32,
+                 sequence_length:int = 256,
+                 block_bytes:int = 10000,
+                 num_fetchers:int = 8,
+                 queue_batches:int = 4,
+                 ring_slots:int = 8,
+                 min_blocks:int = 8,
+                 pad_token_id:int = 0,
+                 seed:int = None):
+        self.fetch = fetch
+        self.cids = list(cids)
+        self.cache = cache
+        self.tokenizer = tokenizer
+        self.batch_size = batch_size
+        self.sequence_length = sequence_length
+        self.block_bytes = block_bytes
+        self.num_fetchers = num_fetchers
+        self.min_blocks = min_blocks
+        self.pad_token_id = pad_token_id
+        self.rng = random.Random(seed)
+        self.ring_slots = ring_slots
+        context = mp.get_context('fork')
+        self.text_queue = context.Queue(maxsize=queue_batches)
+        self.free_slots = context.Semaphore(ring_slots)
+        self.ready_slots = context.Semaphore(0)
+        self.memory = shared_memory.SharedMemory(create=True, size=ring_slots * batch_size * sequence_length * 8)
+        self.ring = np.ndarray((ring_slots, batch_size, sequence_length), dtype=np.int64, buffer=self.memory.buf)
+        self.read_count = 0
+        self.running = False
+        self.cached = threading.Event()
+        self.stats = {'fetched': 0, 'fetch_errors': 0, 'fetch_seconds': 0.0, 'batches': 0, 'evicted_reads': 0, 'sample_errors': 0}
+        self.context = context
+
+    def start(self) -> 'SamplePipeline':
+        self.running = True
+        # forked, so the process shares the ring buffer mapping
+        self.tokenizer_process = self.context.Process(target=tokenize_loop,
+                                                      args=(self.tokenizer, self.text_queue, self.ring,
+                                                            self.free_slots, self.ready_slots, self.pad_token_id),
+                                                      daemon=True)
+        self.tokenizer_process.start()
+        self.fetch_thread = threading.Thread(target=lambda: asyncio.run(self.fetch_loop()), daemon=True, name='block fetch')
+        self.fetch_thread.start()
+        self.sample_thread = threading.Thread(target=self.sample_loop, daemon=True, name='block sample')
+        self.sample_thread.start()
+        return self
+
+    async def fetch_loop(self):
+        todo = [cid for cid in self.cids if not self.cache.has(cid)]
+        self.rng.shuffle(todo)
+        if len(self.cache) >= min(self.min_blocks, len(self.cids)):
+            self.cached.set()
+        async def fetcher():
+            while self.running and len(todo) > 0:
+                cid = todo.pop()
+                t0 = time.time()
+                try:
+                    data = await self.fetch(cid)
+                except Exception as e:
+                    self.stats['fetch_errors'] += 1
+                    continue
+                self.stats['fetch_seconds'] += time.time() - t0
+                if data:
+                    self.cache.put(cid, data.encode() if isinstance(data, str) else data)
+                    self.stats['fetched'] += 1
+                if len(self.cache) >= min(self.min_blocks, len(self.cids)):
+                    self.cached.set()
+        await asyncio.gather(*[fetcher() for _ in range(self.num_fetchers)])
+        self.cache.save_index()
+        # nothing fetched (e.g. the api is down), the sampler still uses what is cached
+        if len(self.cache) > 0:
+            self.cached.set()
+
+    def sample_text(self) -> str:
+        while True:
+            try:
+                data = self.cache.read(self.cache.random_key(self.rng))
+                break
+            except FileNotFoundError:
+                # the block was evicted between picking and reading it, another one will do
+                self.stats['evicted_reads'] += 1
+        start = self.rng.randint(0, max(len(data) - self.block_bytes, 0))
+        return data[start:start + self.block_bytes].decode('utf-8', errors='ignore')
+
+    def sample_loop(self):
+        self.cached.wait()
+        while self.running:
+            try:
+                texts = [self.sample_text() for _ in range(self.batch_size)]
+            except Exception as e:
+                # the sampler keeps going, sample would otherwise wait for a batch that never comes
+                self.stats['sample_errors'] += 1
+                logger.error(f'could not sample a batch of blocks: {type(e).__name__}: {e}')
+                time.sleep(0.1)
+                continue
+            while self.running:
+                try:
+                    self.text_queue.put(texts, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+
+    def sample(self, timeout:float = 60) -> np.ndarray:
+        """
+        The next batch of token ids, [batch_size, sequence_length]. Raises TimeoutError after timeout seconds
+        without one (e.g. nothing could be fetched), None waits forever.
+        """
+        if not self.ready_slots.acquire(timeout=timeout):
+            raise TimeoutError(f'no batch ready after {timeout}s ({len(self.cache)} blocks cached)')
+        batch = self.ring[self.read_count % self.ring_slots].copy()
+        self.read_count += 1
+        self.free_slots.release()
+        self.stats['batches'] += 1
+        return batch
+
+    def stop(self):
+        self.running = False
+        self.cached.set()
+        self.tokenizer_process.terminate()
+        self.tokenizer_process.join()
+        self.sample_thread.join()
+        self.fetch_thread.join()
+        # the batches nobody reads anymore are dropped, instead of blocking the exit
+        self.text_queue.cancel_join_thread()
+        self.text_queue.close()
+        self.ring = None
+        self.memory.close()
+        self.memory.unlink()
+
+
+def tokenize_loop(tokenizer, text_queue, ring:np.ndarray, free_slots, ready_slots, pad_token_id:int = 0):
+    """
+    The tokenizer process: tokenizes every batch of text at once into the next free slot of the ring buffer.
+    """
+    slots, batch_size, sequence_length = ring.shape
+    write_count = 0
+    while True:
+        texts = text_queue.get()
+        if tokenizer == None:
+            # bytes as tokens
+            ids = np.full((batch_size, sequence_length), pad_token_id, dtype=np.int64)
+            for i, text in enumerate(texts):
+                row = np.frombuffer(text.encode()[:sequence_length], dtype=np.uint8)
+                ids[i, :len(row)] = row
+        else:
+            ids = tokenizer(texts, max_length=sequence_length, truncation=True, padding='max_length', return_tensors='np')['input_ids']
+        free_slots.acquire()
+        ring[write_count % slots] = ids
+        write_count += 1
+        ready_slots.release()
+
+
+class LocalTextApi:
+    """
+    A local stand-in for the ipfs api: POST {url}/cat?arg=<cid> returns the text of the cid after latency seconds.
+    Every duplicate_every-th cid has the text of the cid before it, to exercise the content deduplication.
+    """
+
+    def __init__(self, latency:float = 0.05, block_bytes:int = 20000, duplicate_every:int = 10, port:int = 0):
+        self.latency = latency
+        self.block_bytes = block_bytes
+        self.duplicate_every = duplicate_every
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', port), _LocalTextHandler)
+        self.server.api = self
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/api/v0'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def text(self, cid:str) -> bytes:
+        i = int(cid.split('-')[-1])
+        if self.duplicate_every and i % self.duplicate_every == 0 and i > 0:
+            i -= 1
+        rng = random.Random(i)
+        words = ['the', 'of', 'and', 'model', 'data', 'token', 'block', 'network', 'key', 'value']
+        text = ' '.join(rng.choice(words) for _ in range(self.block_bytes // 5))
+        return text.encode()
+
+    async def cat(self, cid:str) -> bytes:
+        def post():
+            request = urllib.request.Request(f'{self.url}/cat?arg={cid}', method='POST')
+            with urllib.request.urlopen(request) as response:
+                return response.read()
+        return await asyncio.get_running_loop().run_in_executor(None, post)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
 if __name__ == "__main__":
     BittensorDataset.run()
\ No newline at end of file
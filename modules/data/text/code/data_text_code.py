@@ -1,10 +1,11 @@
 import commune as c
 
 class DataTextCode(c.Module):
-    def __init__(self, **kwargs):
+    def __init__(self, corpus:bool = True, **kwargs):
         config = self.set_config(kwargs=kwargs)
         self.folder_path = self.resolve_path(config.folder_path)
         self.filepaths = sorted([f for f in self.walk(self.folder_path) if f.endswith('.py')])
+        self.corpus = c.module('data.text.corpus')(folder_path=self.folder_path, suffix='.py') if corpus else None
 
     def random_idx(self):
         return self.random_int(0, len(self.filepaths)-1)
@@ -15,6 +16,26 @@ class DataTextCode(c.Module):
                output_chars: int = 500,
                random_start_line: int = None,
                 real_prob:float=0.5):
+        if self.corpus != None:
+            return self.sample_batch(1, idx=idx, input_chars=input_chars, output_chars=output_chars, real_prob=real_prob)[0]
+        return self.sample_file(idx=idx, input_chars=input_chars, output_chars=output_chars, real_prob=real_prob)
+
+    def sample_batch(self, n:int = 32,
+                     idx=None,
+                     input_chars:int = 500,
+                     output_chars: int = 500,
+                     real_prob:float=0.5):
+        if self.corpus == None:
+            return [self.sample_file(idx=idx, input_chars=input_chars, output_chars=output_chars, real_prob=real_prob) for _ in range(n)]
+        # here real is 1 with probability 1 - real_prob
+        samples = self.corpus.sample_pairs(n, input_chars=input_chars, output_chars=output_chars, real_prob=1 - real_prob, idx=idx)
+        return [{k: s[k] for k in ['input_text', 'output_text', 'filepath', 'real']} for s in samples]
+
+    def sample_file(self, idx=None, 
+               input_chars:int = 500,
+               output_chars: int = 500,
+               random_start_line: int = None,
+                real_prob:float=0.5):
         
         while True:
             idx = self.random_idx() if idx == None else idx
@@ -44,7 +65,7 @@ class DataTextCode(c.Module):
 
         #  then we need to sample a different file
         if sample['real'] == 0 :
-            other_sample = self.sample( input_chars=input_chars, real_prob = 0, output_chars=output_chars)
+            other_sample = self.sample_file( input_chars=input_chars, real_prob = 0, output_chars=output_chars)
             sample['output_text'] = other_sample['output_text']
     
         return sample
@@ -0,0 +1,349 @@
+import os
+import json
+import mmap
+import random
+import hashlib
+from typing import *
+import numpy as np
+import commune as c
+
+
+class DataTextCorpus(c.Module):
+    """
+    A folder of text files packed into one memory-mapped shard.
+
+    build() concatenates the files (in sorted path order) into data.bin, either as raw utf-8 bytes
+    or, with a tokenizer, as uint16/uint32 token ids, and writes offsets.npy (where every document
+    starts, plus the end) and meta.json (the paths and a fingerprint of the folder). Documents keep
+    the index of their path, and unreadable files are kept as empty documents so that the indices
+    line up with the file list.
+
+    The units of positions and lengths are characters for raw text and tokens with a tokenizer.
+    For raw text, chars.npy holds the byte offset of every char_stride-th character, so a window is
+    decoded from the indexed character before it, at most char_stride characters early.
+
+    Sampling never touches the files: a window is an offset into the memmap, so drawing a batch of
+    windows is a few numpy operations however large the folder is.
+    """
+    version = 2
+    char_stride = 64
+
+    def __init__(self,
+                 folder_path:str = './',
+                 suffix:str = '.py',
+                 tokenizer:str = None,
+                 path:str = None,
+                 refresh:bool = False,
+                 seed:int = None):
+        self.set_config(kwargs=locals())
+        self.folder_path = os.path.abspath(os.path.expanduser(folder_path))
+        self.filepaths = self.list_files(self.folder_path, suffix)
+        self.path = self.resolve_path(path or self.corpus_name(self.folder_path, suffix, tokenizer))
+        self.rng = np.random.default_rng(seed)
+        self.random = random.Random(seed) # for single samples, where numpy calls cost more than they save
+        self.eligible_cache = {}
+        fingerprint = self.fingerprint(self.filepaths)
+        meta = self.load()
+        if refresh or meta.get('fingerprint') != fingerprint or meta.get('version') != self.version:
+            self.build(fingerprint=fingerprint)
+            self.load()
+
+    @staticmethod
+    def list_files(folder_path:str, suffix:str = '.py') -> List[str]:
+        return sorted([os.path.join(root, f) for root, _, files in os.walk(folder_path) for f in files if f.endswith(suffix)])
+
+    @staticmethod
+    def corpus_name(folder_path:str, suffix:str, tokenizer:str = None) -> str:
+        key = json.dumps([folder_path, suffix, tokenizer])
+        return 'corpus/' + hashlib.sha256(key.encode()).hexdigest()[:16]
+
+    @staticmethod
+    def fingerprint(filepaths:List[str]) -> str:
+        """
+        A hash of the paths, sizes and modification times, to rebuild when the folder changes.
+        """
+        h = hashlib.sha256()
+        for f in filepaths:
+            try:
+                stat = os.stat(f)
+                h.update(f'{f}:{stat.st_size}:{stat.st_mtime_ns}\n'.encode())
+            except OSError:
+                h.update(f'{f}:missing\n'.encode())
+        return h.hexdigest()
+
+    def build(self, fingerprint:str = None) -> dict:
+        """
+        Packs the files into the shard. The files are written next to the old ones and swapped in at the end.
+        """
+        t0 = c.time()
+        os.makedirs(self.path, exist_ok=True)
+        tokenizer = None
+        dtype = np.uint8
+        if self.config.tokenizer != None:
+            tokenizer = c.module('tokenizer')(tokenizer=self.config.tokenizer, batch=False)
+            dtype = np.uint16 if len(tokenizer.tokenizer) <= np.iinfo(np.uint16).max else np.uint32
+        offsets = np.zeros(len(self.filepaths) + 1, dtype=np.int64)
+        char_index = [] # the byte offset of every char_stride-th character of raw text
+        num_bytes = 0
+        tmp_data_path = os.path.join(self.path, 'data.bin.tmp')
+        with open(tmp_data_path, 'wb') as f:
+            chunk_size = 1024
+            for i in range(0, len(self.filepaths), chunk_size):
+                docs = []
+                for filepath in self.filepaths[i:i + chunk_size]:
+                    try:
+                        with open(filepath, 'rb') as doc:
+                            docs.append(doc.read())
+                    except OSError:
+                        docs.append(b'')
+                if tokenizer != None:
+                    texts = [d.decode('utf-8', errors='ignore') for d in docs]
+                    docs = [ids.astype(dtype).tobytes() for ids in tokenizer.encode_batch(texts, add_special_tokens=False)]
+                for j, doc in enumerate(docs):
+                    f.write(doc)
+                    if tokenizer != None:
+                        offsets[i + j + 1] = offsets[i + j] + len(doc) // np.dtype(dtype).itemsize
+                        continue
+                    # a character starts at every byte that is not a utf-8 continuation byte
+                    starts = np.flatnonzero((np.frombuffer(doc, dtype=np.uint8) & 0xC0) != 0x80)
+                    first = (-offsets[i + j]) % self.char_stride
+                    char_index.append(starts[first::self.char_stride] + num_bytes)
+                    offsets[i + j + 1] = offsets[i + j] + len(starts)
+                    num_bytes += len(doc)
+        np.save(os.path.join(self.path, 'offsets.npy.tmp.npy'), offsets)
+        np.save(os.path.join(self.path, 'chars.npy.tmp.npy'), np.concatenate(char_index + [np.zeros(0, dtype=np.int64)]).astype(np.int64))
+        meta = {'version': self.version,
+                'folder_path': self.folder_path,
+                'suffix': self.config.suffix,
+                'tokenizer': self.config.tokenizer,
+                'dtype': np.dtype(dtype).name,
+                'units': 'chars' if tokenizer == None else 'tokens',
+                'char_stride': self.char_stride,
+                'num_bytes': num_bytes,
+                'num_docs': len(self.filepaths),
+                'num_units': int(offsets[-1]),
+                'filepaths': self.filepaths,
+                'fingerprint': fingerprint or self.fingerprint(self.filepaths),
+                'build_seconds': c.time() - t0}
+        with open(os.path.join(self.path, 'meta.json.tmp'), 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_data_path, os.path.join(self.path, 'data.bin'))
+        os.replace(os.path.join(self.path, 'offsets.npy.tmp.npy'), os.path.join(self.path, 'offsets.npy'))
+        os.replace(os.path.join(self.path, 'chars.npy.tmp.npy'), os.path.join(self.path, 'chars.npy'))
+        # the meta goes last, so a crash in between leaves a stale fingerprint and a rebuild
+        os.replace(os.path.join(self.path, 'meta.json.tmp'), os.path.join(self.path, 'meta.json'))
+        return {k: v for k, v in meta.items() if k != 'filepaths'}
+
+    def load(self) -> dict:
+        meta_path = os.path.join(self.path, 'meta.json')
+        if not os.path.exists(meta_path):
+            return {}
+        with open(meta_path) as f:
+            self.meta = json.load(f)
+        if self.meta.get('version') != self.version:
+            return self.meta
+        self.offsets = np.load(os.path.join(self.path, 'offsets.npy'))
+        self.lengths = np.diff(self.offsets)
+        self.filepaths = self.meta['filepaths']
+        self.eligible_cache = {}
+        self.itemsize = np.dtype(self.meta['dtype']).itemsize
+        self.buffer = b''
+        if self.meta['num_units'] > 0:
+            with open(os.path.join(self.path, 'data.bin'), 'rb') as f:
+                self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.data = np.frombuffer(self.buffer, dtype=self.meta['dtype'])
+        self.char_index = np.load(os.path.join(self.path, 'chars.npy'))
+        return self.meta
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    def eligible(self, length:int) -> np.ndarray:
+        """
+        The documents with at least length units, computed once per length.
+        """
+        if length not in self.eligible_cache:
+            self.eligible_cache[length] = np.flatnonzero(self.lengths >= length)
+        return self.eligible_cache[length]
+
+    def text(self, position:int, length:int) -> str:
+        """
+        The text of length units at position (in units from the start of the shard), sliced from the mmap.
+        """
+        if self.meta['tokenizer'] == None:
+            # from the indexed character before position, skip + length characters fit in 4 bytes each,
+            # a character cut at the end of that slice comes after them and is dropped by errors='ignore'
+            if len(self.char_index) == 0:
+                return ''
+            index = min(position // self.meta['char_stride'], len(self.char_index) - 1)
+            skip = position - index * self.meta['char_stride']
+            start = int(self.char_index[index])
+            text = self.buffer[start:start + 4 * (skip + length)].decode('utf-8', errors='ignore')
+            return text[skip:skip + length]
+        if not hasattr(self, 'tokenizer'):
+            self.tokenizer = c.module('tokenizer')(tokenizer=self.meta['tokenizer'], batch=False).tokenizer
+        return self.tokenizer.decode(self.data[position:position + length].tolist())
+
+    def sample_positions(self, n:int, length:int, idx:Union[int, np.ndarray] = None, start:Union[int, np.ndarray] = None,
+                         exclude:np.ndarray = None) -> Dict[str, np.ndarray]:
+        """
+        Where n random windows of length units start: the document indices, the starts within the
+        documents and the positions in the shard. Windows only come from documents that are long enough.
+        idx and start pin the windows, and exclude draws every window from a different document than exclude[i].
+        """
+        if idx is None:
+            eligible = self.eligible(length)
+            assert len(eligible) > 0, f'no document has {length} units'
+            idx = eligible[self.rng.integers(0, len(eligible), size=n)]
+            if exclude is not None and len(eligible) > 1:
+                # redraw the collisions, once per round
+                same = idx == exclude
+                while same.any():
+                    idx[same] = eligible[self.rng.integers(0, len(eligible), size=int(same.sum()))]
+                    same = idx == exclude
+        elif np.ndim(idx) == 0:
+            idx = np.full(n, idx, dtype=np.int64)
+        if start is None:
+            start = (self.rng.random(n) * np.maximum(self.lengths[idx] - length + 1, 1)).astype(np.int64)
+        elif np.ndim(start) == 0:
+            start = np.full(n, start, dtype=np.int64)
+        return {'idx': idx, 'start': start, 'position': self.offsets[idx] + start}
+
+    def sample_position(self, length:int, idx:int = None, start:int = None, exclude:int = None) -> Tuple[int, int, int]:
+        """
+        The (document index, start, position) of one window, like sample_positions with n = 1.
+        """
+        if idx == None:
+            eligible = self.eligible(length)
+            assert len(eligible) > 0, f'no document has {length} units'
+            idx = int(eligible[self.random.randrange(len(eligible))])
+            while idx == exclude and len(eligible) > 1:
+                idx = int(eligible[self.random.randrange(len(eligible))])
+        if start == None:
+            start = int(self.random.random() * max(int(self.lengths[idx]) - length + 1, 1))
+        return idx, start, int(self.offsets[idx]) + start
+
+    def sample_windows(self, n:int, length:int, **kwargs) -> Dict[str, np.ndarray]:
+        """
+        Like sample_positions, with the windows themselves as an [n, length] array (a token batch).
+        """
+        assert self.meta['units'] == 'tokens', 'windows are token batches, build the corpus with a tokenizer'
+        sample = self.sample_positions(n, length, **kwargs)
+        sample['windows'] = self.data[sample['position'][:, None] + np.arange(length)]
+        return sample
+
+    def sample_pairs(self, n:int = 1, input_chars:int = 1000, output_chars:int = 500, real_prob:float = 0.5,
+                     idx:int = None, start_index:int = None) -> List[dict]:
+        """
+        n (input, output) pairs of consecutive windows. The output of a fake pair (real == 0) comes from
+        a window of another document. input_chars, output_chars and start_index count characters
+        (tokens for a tokenized corpus).
+        """
+        if n == 1:
+            idx, start, position = self.sample_position(input_chars + output_chars, idx=idx, start=start_index)
+            real = self.random.random() < real_prob
+            output_position = position + input_chars if real else self.sample_position(output_chars, exclude=idx)[2]
+            idx, start, positions, output_positions, real = [idx], [start], [position], [output_position], [real]
+        else:
+            sample = self.sample_positions(n, input_chars + output_chars, idx=idx, start=start_index)
+            real = self.rng.random(n) < real_prob
+            output_positions = sample['position'] + input_chars
+            if not real.all():
+                fake = self.sample_positions(n, output_chars, exclude=sample['idx'])['position']
+                output_positions = np.where(real, output_positions, fake)
+            idx, start, positions = sample['idx'].tolist(), sample['start'].tolist(), sample['position'].tolist()
+            output_positions, real = output_positions.tolist(), real.tolist()
+        return [{'input_text': self.text(positions[i], input_chars),
+                 'output_text': self.text(output_positions[i], output_chars),
+                 'filepath': self.filepaths[idx[i]],
+                 'idx': idx[i],
+                 'start_index': start[i],
+                 'input_chars': input_chars,
+                 'output_chars': output_chars,
+                 'real': int(real[i])} for i in range(n)]
+
+    @classmethod
+    def make_tree(cls, path:str, num_files:int = 100000, min_chars:int = 200, max_chars:int = 8000, seed:int = 0,
+                  words:List[str] = None) -> str:
+        """
+        A folder of random python-like files to benchmark on.
+        """
+        rng = np.random.default_rng(seed)
+        words = np.array(words or ['def', 'return', 'self', 'import', 'class', 'for', 'in', 'if', 'x', 'y', '=', '(', ')', ':', '\n', '    '])
+        for i in range(num_files):
+            dirpath = os.path.join(path, str(i % 100))
+            os.makedirs(dirpath, exist_ok=True)
+            text = ' '.join(words[rng.integers(0, len(words), size=int(rng.integers(min_chars, max_chars)) // 4)])
+            with open(os.path.join(dirpath, f'{i}.py'), 'w', encoding='utf-8') as f:
+                f.write(text)
+        return path
+
+    def test(self, n:int = 100):
+        path = self.resolve_path('test_tree')
+        self.make_tree(path, num_files=20, min_chars=100, max_chars=4000)
+        corpus = DataTextCorpus(folder_path=path, path='test_corpus', refresh=True, seed=0)
+        samples = corpus.sample_pairs(n, input_chars=100, output_chars=50, real_prob=0.5)
+        for s in samples:
+            text = c.get_text(s['filepath'])
+            assert text[s['start_index']:s['start_index'] + 100] == s['input_text'], 'the window does not match the file'
+            if s['real']:
+                assert text[s['start_index'] + 100:s['start_index'] + 150] == s['output_text']
+        assert 0 < sum(s['real'] for s in samples) < n
+        pinned = corpus.sample_pairs(1, input_chars=100, output_chars=50, real_prob=1, idx=samples[0]['idx'], start_index=samples[0]['start_index'])[0]
+        assert pinned['input_text'] == samples[0]['input_text']
+        # an unchanged folder is loaded, not rebuilt
+        meta = DataTextCorpus(folder_path=path, path='test_corpus').meta
+        assert meta['fingerprint'] == corpus.meta['fingerprint']
+        return {'success': True, 'msg': 'corpus test passed', 'num_docs': meta['num_docs']}
+
+    def test_unicode(self, n:int = 100):
+        """
+        Windows and start_index count characters when the files have multi-byte characters.
+        """
+        path = self.resolve_path('test_tree_unicode')
+        words = ['café', 'naïve', '日本語', 'ü', '🐍', 'x', '=', '\n', 'def']
+        self.make_tree(path, num_files=20, min_chars=100, max_chars=4000, words=words)
+        corpus = DataTextCorpus(folder_path=path, path='test_corpus_unicode', refresh=True, seed=0)
+        assert corpus.meta['num_bytes'] > int(corpus.offsets[-1]), 'the tree has no multi-byte characters'
+        for batch in [corpus.sample_pairs(n, input_chars=100, output_chars=50, real_prob=1),
+                      [corpus.sample_pairs(1, input_chars=100, output_chars=50, real_prob=1)[0] for _ in range(10)]]:
+            for s in batch:
+                text = c.get_text(s['filepath'])
+                assert len(s['input_text']) == 100 and len(s['output_text']) == 50
+                assert text[s['start_index']:s['start_index'] + 150] == s['input_text'] + s['output_text']
+        # any window of the shard, up to its end, is the same characters as the files
+        text = ''.join(c.get_text(f) for f in corpus.filepaths)
+        for position in list(range(0, len(text), 7)) + [len(text) - 1, len(text)]:
+            assert corpus.text(position, 20) == text[position:position + 20], position
+        return {'success': True, 'msg': 'corpus unicode test passed', 'chars': len(text), 'bytes': corpus.meta['num_bytes']}
+
+    @classmethod
+    def test_benchmark(cls, num_files:int = 100000, n:int = 1000, batch_size:int = 256):
+        """
+        Samples per second of the folder sampler reading files against the corpus, on a num_files tree.
+        """
+        path = cls.resolve_path(f'bench_tree_{num_files}')
+        if not os.path.exists(path):
+            cls.make_tree(path, num_files=num_files)
+        folder = c.module('data.text.folder')(folder_path=path, corpus=False)
+        t0 = c.time()
+        for _ in range(n):
+            folder.sample()
+        files_rate = n / (c.time() - t0)
+        t0 = c.time()
+        corpus = cls(folder_path=path)
+        build_seconds = c.time() - t0
+        t0 = c.time()
+        for _ in range(n):
+            corpus.sample_pairs(1)
+        corpus_rate = n / (c.time() - t0)
+        t0 = c.time()
+        for _ in range(n // batch_size + 1):
+            corpus.sample_pairs(batch_size)
+        batch_rate = (n // batch_size + 1) * batch_size / (c.time() - t0)
+        return {'success': True,
+                'num_files': num_files,
+                'load_or_build_seconds': build_seconds,
+                'files_samples_per_second': files_rate,
+                'corpus_samples_per_second': corpus_rate,
+                'corpus_batch_samples_per_second': batch_rate}
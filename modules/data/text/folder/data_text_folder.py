@@ -1,10 +1,12 @@
 import commune as c
 
 class DataFolder(c.Module):
-    def __init__(self, folder_path: str = './', suffix: str = '.py'):
+    def __init__(self, folder_path: str = './', suffix: str = '.py', corpus: bool = True):
         config = self.set_config(kwargs=locals())
         self.folder_path = self.resolve_path(config.folder_path)
-        self.filepaths = sorted([f for f in self.walk(self.folder_path) if f.endswith('.py')])
+        self.filepaths = sorted([f for f in self.walk(self.folder_path) if f.endswith(config.suffix)])
+        # the folder packed into one memory-mapped shard, so sampling does not read files
+        self.corpus = c.module('data.text.corpus')(folder_path=self.folder_path, suffix=config.suffix) if corpus else None
 
     def random_idx(self):
         return self.random_int(0, len(self.filepaths)-1)
@@ -14,6 +16,25 @@ class DataFolder(c.Module):
                output_chars: int = 500,
                start_index: int = None,
                 real_prob:float=0.5):
+        if self.corpus != None:
+            return self.corpus.sample_pairs(1, input_chars=input_chars, output_chars=output_chars,
+                                            real_prob=real_prob, idx=idx, start_index=start_index)[0]
+        return self.sample_file(idx=idx, input_chars=input_chars, output_chars=output_chars,
+                                start_index=start_index, real_prob=real_prob)
+
+    def sample_batch(self, n:int = 32,
+                     input_chars:int = 1000,
+                     output_chars: int = 500,
+                     real_prob:float=0.5):
+        if self.corpus != None:
+            return self.corpus.sample_pairs(n, input_chars=input_chars, output_chars=output_chars, real_prob=real_prob)
+        return [self.sample_file(input_chars=input_chars, output_chars=output_chars, real_prob=real_prob) for _ in range(n)]
+
+    def sample_file(self, idx=None, 
+               input_chars:int = 1000,
+               output_chars: int = 500,
+               start_index: int = None,
+                real_prob:float=0.5):
         
         if idx == None:
             while True:
@@ -53,16 +74,19 @@ class DataFolder(c.Module):
 
         #  then we need to sample a different file
         if sample['real'] == 0 :
-            other_sample = self.sample( input_chars=input_chars, real_prob = 1, output_chars=output_chars)
+            other_sample = self.sample_file( input_chars=input_chars, real_prob = 1, output_chars=output_chars)
             sample['output_text'] = other_sample['output_text']
     
         return sample
 
 
     def test(self, n=100):
-        sample = self.sample()
-        msg = {'samples_per_second': i / (c.time() - t)}
+        t = c.time()
+        for i in range(n):
+            sample = self.sample()
+        msg = {'samples_per_second': n / (c.time() - t)}
         c.print(msg)
+        return msg
 
     @classmethod
     def validate(cls, *objs):
@@ -7,6 +7,8 @@ import json
 import threading
 import queue
 import os
+from collections import OrderedDict
+import numpy as np
 import torch
 
 
@@ -20,6 +22,7 @@ class Pile(commune.Module):
 
         config = self.set_config(config)
         self.url = self.config.url
+        self.sequence_length = config.get('sequence_length', 256)
         self.set_shards(config.shards)
         self.set_tokenizer(config.tokenizer)
         self.start_text_generator()
@@ -59,11 +62,15 @@ class Pile(commune.Module):
     
     @classmethod
     def ls_shards(cls):
-        return [p for p in cls.glob('shards') if p.endswith('.jsonl')]
+        return [p for p in cls.glob('shards') if p.endswith('.jsonl') or p.endswith('.jsonl.zst')]
     
     @classmethod
-    def get_shard_path(cls, shard:int, split:str='train', ext='jsonl'):
+    def get_shard_path(cls, shard:int, split:str='train', ext=None):
         filename = f'{shard}' if shard >= 10 else f'0{shard}'
+        if ext == None:
+            # a decompressed shard if there is one, else the downloaded .jsonl.zst
+            path = cls.resolve_path(f'shards/{filename}.jsonl')
+            return path if os.path.exists(path) else cls.resolve_path(f'shards/{filename}.jsonl.zst')
         path= cls.resolve_path(f'shards/{filename}.{ext}')
         return path
 
@@ -98,47 +105,99 @@ class Pile(commune.Module):
             
     
 
-    def get_text(self, shard=1, split='train', path=None, start_pos=0):
-        path = self.get_shard_path(shard=shard, split=split) if path is None else path
-        with open(path, 'r') as f:
-            # Move the file pointer to the starting position
-            f.seek(start_pos)
-            cnt = 0
-            for line in f:
-                # print(line)
-                data = json.loads(line)
-
-                # # print(data['text'])
-                # self.print(data['text'])
-                self.queue.put(data['text'])
-                if self.stop_threads:
-                    break
-                
-
-    def start_text_generator(self, num_threads=1, shard=1, split='train', path=None):
-        self.queue = queue.Queue(1000)
-        path = self.get_shard_path(shard=shard, split=split)
-        file_size = os.stat(path).st_size
-        chunk_size = file_size // num_threads
-        start_pos = 0
-        threads = []
-        for i in range(num_threads):
-            # Start the thread with the current start position
-            t = threading.Thread(target=self.get_text, args=(shard, split, path, start_pos))
-            t.start()
-            threads.append(t)
-            # Update the start position for the next thread
-            start_pos += chunk_size
-            # If this is the last thread, read until the end of the file
-            if i == num_threads - 2:
-                chunk_size = file_size - start_pos
-                
-        self.threads = threads
-        # # Wait for all threads to finish
-        # for t in threads:
-        #     t.join()
-            
-    
+    """
+    ################ SHARDS ############################
+    """
+
+    # the shards and tokenizers of the worker processes (or threads), opened once per process
+    process_shards = {}
+    process_tokenizers = {}
+
+    @classmethod
+    def open_shard(cls, path:str, frame_size:int = 4 * 2**20) -> 'PileShard':
+        if path not in cls.process_shards:
+            cls.process_shards[path] = PileShard(path, frame_size=frame_size)
+        return cls.process_shards[path]
+
+    @classmethod
+    def encode_texts(cls, texts:List[str], tokenizer:str = None) -> List[np.ndarray]:
+        """
+        The token ids of the texts, or their utf-8 bytes when tokenizer is None.
+        """
+        if tokenizer == None:
+            return [np.frombuffer(t.encode('utf-8'), dtype=np.uint8).astype(np.int32) for t in texts]
+        if tokenizer not in cls.process_tokenizers:
+            from transformers import AutoTokenizer
+            cls.process_tokenizers[tokenizer] = AutoTokenizer.from_pretrained(tokenizer, use_fast=True)
+        input_ids = cls.process_tokenizers[tokenizer](texts, add_special_tokens=False)['input_ids']
+        return [np.asarray(ids, dtype=np.int32) for ids in input_ids]
+
+    @classmethod
+    def tokenize_range(cls, path:str, start:int, end:int,
+                       tokenizer:str = None,
+                       sequence_length:int = 256,
+                       eos_token_id:int = 0) -> np.ndarray:
+        """
+        Decodes and tokenizes the documents [start, end) of a shard, joins them with eos and cuts
+        them into [n, sequence_length] int32 rows (the tail that does not fill a row is dropped).
+        Runs in the worker processes or threads.
+        """
+        # blank lines (e.g. a trailing one) hold no document
+        texts = [json.loads(line)['text'] for line in cls.open_shard(path).lines(start, end) if len(line.strip()) > 0]
+        input_ids = cls.encode_texts(texts, tokenizer=tokenizer)
+        eos = np.array([eos_token_id], dtype=np.int32)
+        tokens = np.concatenate([x for ids in input_ids for x in (ids, eos)]) if len(input_ids) > 0 else eos[:0]
+        n = len(tokens) // sequence_length
+        return tokens[:n * sequence_length].reshape(n, sequence_length)
+
+    def get_text(self, idx:int = None, shard=1, split='train', path=None) -> str:
+        """
+        The text of document idx (a random one if None) of a shard, read through the shard index.
+        """
+        shard = self.open_shard(path or self.shard_path)
+        idx = np.random.randint(len(shard)) if idx == None else idx
+        return json.loads(shard.line(idx))['text']
+
+    def start_text_generator(self, num_workers:int = None, shard=1, split='train', path=None, mode:str = None):
+        """
+        Fills a bounded queue with pre-tokenized [n, sequence_length] blocks. The shard is split into
+        ranges of docs_per_task documents that are visited in a random order, and every range is
+        decoded and tokenized by one of num_workers processes (or threads).
+        """
+        from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+        config = self.config
+        num_workers = num_workers or config.get('num_workers', 1)
+        mode = mode or config.get('mode', 'process')
+        self.shard_path = path or self.get_shard_path(shard=shard, split=split)
+        shard = self.open_shard(self.shard_path)
+        self.queue = queue.Queue(config.get('queue_size', 64))
+        self.stop_threads = False
+        executor_class = ProcessPoolExecutor if mode == 'process' else ThreadPoolExecutor
+        self.executor = executor_class(max_workers=num_workers)
+        docs_per_task = config.get('docs_per_task', 256)
+        tokenizer = self.tokenizer.name_or_path
+        eos_token_id = self.tokenizer.eos_token_id or 0
+
+        def run():
+            while not self.stop_threads:
+                ranges = [(i, min(i + docs_per_task, len(shard))) for i in range(0, len(shard), docs_per_task)]
+                np.random.shuffle(ranges)
+                futures = []
+                for start, end in ranges:
+                    futures.append(self.executor.submit(self.tokenize_range, self.shard_path, start, end,
+                                                        tokenizer, self.sequence_length, eos_token_id))
+                    # keep a few tasks per worker in flight, and hand the results over in order
+                    while len(futures) > 2 * num_workers or (len(futures) > 0 and futures[0].done()):
+                        self.queue.put(futures.pop(0).result())
+                        if self.stop_threads:
+                            return
+                for future in futures:
+                    self.queue.put(future.result())
+
+        self.threads = [commune.thread(run)]
+        self.buffer = np.zeros((0, self.sequence_length), dtype=np.int32)
+        return {'success': True, 'msg': f'loading {self.shard_path} with {num_workers} {mode} workers', 'docs': len(shard)}
+
     def stop_threads(self):
         self.stop_threads=True
 
@@ -148,28 +207,115 @@ class Pile(commune.Module):
 
     def shutdown(self, wait=True):
         self.stop_threads = True
-        # if wait:
-        #     for t in self.threads:
-        #         try:
-        #             t.join()
-        #         except Exception:
-        #             pass
-    
+        if hasattr(self, 'executor'):
+            # unblock the loader if it waits on a full queue
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
     def sample_text(self):
-        return self.queue.get()
-    
+        return self.get_text()
+
+    def sample_tokens(self, batch_size:int = 32) -> np.ndarray:
+        """
+        batch_size pre-tokenized rows of sequence_length tokens from the loader.
+        """
+        while len(self.buffer) < batch_size:
+            self.buffer = np.concatenate([self.buffer, self.queue.get()])
+        rows, self.buffer = self.buffer[:batch_size], self.buffer[batch_size:]
+        return rows
+
     def sample(self, batch_size:int=32, sequence_length:int=256, idx_list:List[int] = None, tokenize:bool= True)->dict:
-        
-        sample_dict = {'text': [self.sample_text() for i in range(batch_size)]}
-            
-        if tokenize:
-            sample_dict = self.tokenize(text=sample_dict['text'], max_length=sequence_length)
+        if not tokenize:
+            return {'text': [self.get_text(idx) for idx in (idx_list or [None] * batch_size)]}
+        if idx_list != None or sequence_length != self.sequence_length:
+            sample_dict = {'text': [self.get_text(idx) for idx in (idx_list or [None] * batch_size)]}
+            return self.tokenize(text=sample_dict['text'], max_length=sequence_length)
+        input_ids = torch.from_numpy(self.sample_tokens(batch_size).astype(np.int64))
+        return dict(input_ids=input_ids.to(self.device),
+                    attention_mask=torch.ones_like(input_ids).to(self.device))
 
-        return sample_dict
-    
     forward = sample
-    
-    
+
+    @classmethod
+    def make_shard(cls, path:str, size_gb:float = 1.0, seed:int = 0) -> str:
+        """
+        Writes a Pile-like shard of about size_gb of random documents (zstd compressed if path ends in .zst).
+        """
+        rng = np.random.default_rng(seed)
+        words = [w.encode() for w in 'the of and to in a is that for it as was with be by on not he this are or'.split()]
+        vocab = np.array(words, dtype=object)
+        target = int(size_gb * 2**30)
+        tmp_path = path + '.tmp'
+        f = open(tmp_path, 'wb')
+        writer = f
+        if path.endswith('.zst'):
+            import zstandard
+            writer = zstandard.ZstdCompressor(level=3).stream_writer(f)
+        written = 0
+        while written < target:
+            lines = []
+            for n in rng.integers(50, 2000, size=1024):
+                text = b' '.join(vocab[rng.integers(0, len(vocab), size=n)]).decode()
+                lines.append(json.dumps({'text': text, 'meta': {'pile_set_name': 'synthetic'}}).encode() + b'\n')
+            chunk = b''.join(lines)
+            writer.write(chunk)
+            written += len(chunk)
+        writer.close() if writer is not f else None
+        f.close()
+        os.replace(tmp_path, path)
+        return path
+
+    @classmethod
+    def test_shard(cls, n:int = 1000):
+        path = cls.resolve_path('test_shard.jsonl')
+        texts = [f'document {i} ' + 'word ' * (i % 17) for i in range(n)]
+        with open(path, 'w') as f:
+            for t in texts:
+                f.write(json.dumps({'text': t}) + '\n')
+        shard = PileShard(path, refresh=True, frame_size=1024)
+        assert len(shard) == n
+        for i in np.random.randint(0, n, size=100):
+            assert json.loads(shard.line(i))['text'] == texts[i]
+        assert [json.loads(l)['text'] for l in shard.lines(10, 20)] == texts[10:20]
+        rows = cls.tokenize_range(path, 0, n, sequence_length=64)
+        assert rows.shape[1] == 64 and rows.dtype == np.int32
+        # blank lines are skipped
+        with open(path, 'a') as f:
+            f.write('\n' + json.dumps({'text': texts[0]}) + '\n\n')
+        shard = PileShard(path, refresh=True, frame_size=1024)
+        cls.process_shards[path] = shard
+        assert np.array_equal(cls.tokenize_range(path, n, len(shard), sequence_length=1)[:-1, 0], cls.encode_texts(texts[:1])[0])
+        return {'success': True, 'msg': 'shard index test passed', 'docs': len(shard)}
+
+    @classmethod
+    def test_throughput(cls, size_gb:float = 2.0, num_workers:List[int] = [1, 2, 4, 8], compressed:bool = True,
+                        tokenizer:str = None, docs_per_task:int = 256, max_docs:int = 200000):
+        """
+        Documents and tokens per second of the parallel decoder on a locally generated shard, per worker count.
+        """
+        from concurrent.futures import ProcessPoolExecutor
+        path = cls.resolve_path(f'bench_{size_gb}gb.jsonl' + ('.zst' if compressed else ''))
+        if not os.path.exists(path):
+            cls.make_shard(path, size_gb=size_gb)
+        t0 = commune.time()
+        shard = PileShard(path)
+        index_seconds = commune.time() - t0
+        num_docs = min(len(shard), max_docs)
+        ranges = [(i, min(i + docs_per_task, num_docs)) for i in range(0, num_docs, docs_per_task)]
+        results = {}
+        for n in num_workers:
+            with ProcessPoolExecutor(max_workers=n) as executor:
+                # open the shard in every worker before timing
+                list(executor.map(cls.tokenize_range, [path] * n, [0] * n, [1] * n))
+                t0 = commune.time()
+                futures = [executor.submit(cls.tokenize_range, path, start, end, tokenizer) for start, end in ranges]
+                tokens = sum(f.result().size for f in futures)
+                seconds = commune.time() - t0
+            results[n] = {'docs_per_second': num_docs / seconds, 'tokens_per_second': tokens / seconds}
+        return {'success': True, 'path': path, 'docs': len(shard), 'index_seconds': index_seconds, 'workers': results}
+
+
     def tokenize(self, text: str = 'Whadup',
                  padding=True, 
                  truncation=True, 
@@ -238,3 +384,131 @@ class Pile(commune.Module):
         self.shutdown()
 
         # self.shutdown()
+
+
+class PileShard:
+    """
+    Random access to the documents (lines) of a plain or zstd compressed JSONL shard.
+
+    The first open builds an index next to the shard (<path>.index.npz) in one pass. For a plain
+    file it holds the offset of every line, so a document is one pread. A .zst shard is a single
+    zstd frame that cannot be seeked into, so the indexing pass also rewrites it as independent
+    frames of about frame_size bytes (<path>.frames.zst) and indexes the frames and the lines in
+    them. A document then costs at most one frame decode, and recent frames are cached. Reads use
+    pread, so one shard can be shared by threads.
+    """
+
+    def __init__(self, path:str, frame_size:int = 4 * 2**20, cache_frames:int = 8, refresh:bool = False):
+        self.path = path
+        self.compressed = path.endswith('.zst')
+        self.frame_size = frame_size
+        self.index_path = path + '.index.npz'
+        self.frames_path = path + '.frames.zst'
+        self.cache = OrderedDict() # frame -> decompressed bytes
+        self.cache_frames = cache_frames
+        self.lock = threading.Lock()
+        if refresh or not os.path.exists(self.index_path) or os.path.getmtime(self.index_path) < os.path.getmtime(path):
+            self.build_index()
+        index = np.load(self.index_path)
+        self.line_offsets = index['line_offsets'] # [n + 1] offsets in the decompressed text
+        self.frame_offsets = index['frame_offsets'] # [f + 1] offsets of the frames in the frames file
+        self.frame_starts = index['frame_starts'] # [f + 1] decompressed offset where each frame starts
+        self.fd = os.open(self.frames_path if self.compressed else path, os.O_RDONLY)
+
+    def __len__(self) -> int:
+        return len(self.line_offsets) - 1
+
+    def __del__(self):
+        if hasattr(self, 'fd'):
+            os.close(self.fd)
+
+    @staticmethod
+    def newlines(chunk:bytes, offset:int = 0) -> np.ndarray:
+        """ The offsets (plus offset) right after every newline of chunk. """
+        return np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == 10) + offset + 1
+
+    def build_index(self, chunk_size:int = 16 * 2**20) -> dict:
+        line_offsets = [np.zeros(1, dtype=np.int64)]
+        frame_offsets, frame_starts = [0], [0]
+        total = 0
+        if not self.compressed:
+            with open(self.path, 'rb') as f:
+                while True:
+                    chunk = f.read(chunk_size)
+                    if len(chunk) == 0:
+                        break
+                    line_offsets.append(self.newlines(chunk, total))
+                    total += len(chunk)
+        else:
+            import zstandard
+            compressor = zstandard.ZstdCompressor(level=3)
+            tmp_frames_path = self.frames_path + '.tmp'
+            with open(self.path, 'rb') as src, open(tmp_frames_path, 'wb') as dst:
+                reader = zstandard.ZstdDecompressor().stream_reader(src, read_across_frames=True)
+                pending = b''
+                while True:
+                    chunk = reader.read(chunk_size)
+                    eof = len(chunk) == 0
+                    pending += chunk
+                    # cut frames at line ends where there is one (read() also joins lines that span frames)
+                    while len(pending) >= self.frame_size or (eof and len(pending) > 0):
+                        cut = pending.rfind(b'\n', 0, max(self.frame_size, 1)) + 1 if not eof else len(pending)
+                        if cut <= 0:
+                            cut = pending.find(b'\n') + 1 or len(pending)
+                        frame, pending = pending[:cut], pending[cut:]
+                        line_offsets.append(self.newlines(frame, total))
+                        total += len(frame)
+                        dst.write(compressor.compress(frame))
+                        frame_offsets.append(dst.tell())
+                        frame_starts.append(total)
+                    if eof:
+                        break
+            os.replace(tmp_frames_path, self.frames_path)
+        line_offsets = np.concatenate(line_offsets)
+        if line_offsets[-1] != total:
+            # the last line has no newline
+            line_offsets = np.append(line_offsets, total)
+        tmp_index_path = self.index_path + '.tmp.npz'
+        np.savez(tmp_index_path,
+                 line_offsets=line_offsets,
+                 frame_offsets=np.array(frame_offsets, dtype=np.int64),
+                 frame_starts=np.array(frame_starts, dtype=np.int64))
+        os.replace(tmp_index_path, self.index_path)
+        return {'success': True, 'docs': len(line_offsets) - 1, 'frames': len(frame_offsets) - 1, 'bytes': total}
+
+    def frame(self, f:int) -> bytes:
+        with self.lock:
+            if f in self.cache:
+                self.cache.move_to_end(f)
+                return self.cache[f]
+        import zstandard
+        start, end = int(self.frame_offsets[f]), int(self.frame_offsets[f + 1])
+        data = zstandard.ZstdDecompressor().decompress(os.pread(self.fd, end - start, start))
+        with self.lock:
+            self.cache[f] = data
+            while len(self.cache) > self.cache_frames:
+                self.cache.popitem(last=False)
+        return data
+
+    def read(self, start:int, end:int) -> bytes:
+        """ The decompressed bytes [start, end) of the shard. """
+        if not self.compressed:
+            return os.pread(self.fd, end - start, start)
+        first = int(np.searchsorted(self.frame_starts, start, side='right')) - 1
+        last = int(np.searchsorted(self.frame_starts, end, side='left'))
+        data = b''.join(self.frame(f) for f in range(first, last))
+        offset = int(self.frame_starts[first])
+        return data[start - offset:end - offset]
+
+    def line(self, idx:int) -> bytes:
+        return self.read(int(self.line_offsets[idx]), int(self.line_offsets[idx + 1]))
+
+    def lines(self, start:int = 0, end:int = None) -> List[bytes]:
+        """ The lines [start, end), from one contiguous read. """
+        end = len(self) if end == None else min(end, len(self))
+        if end <= start:
+            return []
+        offsets = self.line_offsets[start:end + 1]
+        data = self.read(int(offsets[0]), int(offsets[-1]))
+        offsets = (offsets - offsets[0]).tolist()
+        return [data[offsets[i]:offsets[i + 1]] for i in range(end - start)]
@@ -9,12 +9,10 @@ class Loop(c.Module):
     
 
     def loops(self, module2timeout= {'module': 10, 'subspace': 10}):
-        t1 = c.timestamp()
-        while  True:
-            t2 = c.timestamp()
-            for module, timeout in module2timeout.items():
-                if t2 - t1 > timeout:
-                    c.update(module=module)
+        scheduler = c.scheduler()
+        for module, timeout in module2timeout.items():
+            scheduler.schedule(c.update, interval=timeout, name=f'update::{module}', kwargs={'module': module}, delay=timeout)
+        return scheduler.wait()
 
     def app(self):
         import streamlit as st
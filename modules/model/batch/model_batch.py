@@ -0,0 +1,158 @@
+import json
+import queue
+import threading
+import concurrent.futures
+from concurrent.futures import Future
+from typing import *
+import commune as c
+
+
+class ModelBatch(c.Module):
+    """
+    Gathers concurrent requests to a model into dynamic batches.
+
+    Callers submit one item at a time and get a Future back. A single worker thread
+    groups pending requests by (fn, kwargs, length bucket), and runs a group as one
+    call to fn(items, **kwargs) once it is full or its oldest request has waited
+    max_latency seconds. The results are scattered back to the callers' futures.
+    A request that is cancelled before its batch starts is dropped from the batch.
+    """
+
+    def __init__(self,
+                 max_batch_size:int = 32,
+                 max_latency:float = 0.01,
+                 buckets:List[int] = [32, 64, 128, 256, 512]):
+        self.set_config(kwargs=locals())
+        self.queue = queue.Queue()
+        self.stats = {'requests': 0, 'batches': 0, 'cancelled': 0, 'failures': 0, 'items': 0}
+        self.running = True
+        self.worker = c.thread(self.run_loop)
+
+    def bucket(self, size:int = None) -> int:
+        """
+        The smallest bucket that fits size, so that a batch is padded to at most that length.
+        """
+        if size == None:
+            return 0
+        for bucket in self.config.buckets:
+            if size <= bucket:
+                return bucket
+        return self.config.buckets[-1]
+
+    def submit(self, fn:Callable, item:Any, kwargs:dict = None, size:int = None) -> Future:
+        """
+        Queues item for fn(items, **kwargs), which has to return one result per item.
+        size is the length of the item (e.g. the number of tokens) used to pick its bucket.
+        """
+        assert self.running, 'the batcher is stopped'
+        kwargs = kwargs or {}
+        future = Future()
+        group = (fn, json.dumps(kwargs, sort_keys=True, default=str), self.bucket(size))
+        self.queue.put({'group': group, 'fn': fn, 'kwargs': kwargs, 'item': item, 'future': future, 'time': c.time()})
+        self.stats['requests'] += 1
+        return future
+
+    def call(self, fn:Callable, item:Any, kwargs:dict = None, size:int = None, timeout:float = None) -> Any:
+        """
+        Submits the item and waits for its result. The request is cancelled if it times out
+        before its batch starts.
+        """
+        future = self.submit(fn=fn, item=item, kwargs=kwargs, size=size)
+        try:
+            return future.result(timeout=timeout)
+        except concurrent.futures.TimeoutError as e:
+            future.cancel()
+            raise e
+
+    def wait_time(self, group2requests:dict) -> float:
+        """
+        How long the worker can wait for new requests before the oldest pending one is due.
+        """
+        if len(group2requests) == 0:
+            return 0.1
+        oldest = min(requests[0]['time'] for requests in group2requests.values())
+        return max(self.config.max_latency - (c.time() - oldest), 0)
+
+    def run_loop(self):
+        group2requests = {}
+        while self.running:
+            timeout = self.wait_time(group2requests)
+            try:
+                request = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+                group2requests.setdefault(request['group'], []).append(request)
+            except queue.Empty:
+                pass
+            # everything that arrived while the last batch ran joins this round
+            while True:
+                try:
+                    request = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                group2requests.setdefault(request['group'], []).append(request)
+
+            now = c.time()
+            for group in list(group2requests.keys()):
+                requests = group2requests[group]
+                while len(requests) >= self.config.max_batch_size or \
+                        (len(requests) > 0 and now - requests[0]['time'] >= self.config.max_latency):
+                    batch = requests[:self.config.max_batch_size]
+                    del requests[:self.config.max_batch_size]
+                    self.run_batch(batch)
+                if len(requests) == 0:
+                    del group2requests[group]
+
+    def run_batch(self, batch:List[dict]):
+        # set_running_or_notify_cancel is False for requests that were cancelled while they waited
+        num_requests = len(batch)
+        batch = [r for r in batch if r['future'].set_running_or_notify_cancel()]
+        self.stats['cancelled'] += num_requests - len(batch)
+        if len(batch) == 0:
+            return
+        fn, kwargs = batch[0]['fn'], batch[0]['kwargs']
+        try:
+            results = fn([r['item'] for r in batch], **kwargs)
+            assert len(results) == len(batch), f'expected {len(batch)} results, got {len(results)}'
+        except Exception as e:
+            self.stats['failures'] += 1
+            for r in batch:
+                r['future'].set_exception(e)
+            return
+        self.stats['batches'] += 1
+        self.stats['items'] += len(batch)
+        for r, result in zip(batch, results):
+            r['future'].set_result(result)
+
+    def stop(self):
+        self.running = False
+        self.worker.join(timeout=1)
+        return {'success': True, 'msg': 'stopped the batcher', 'stats': self.stats}
+
+    def test_batch(self, n:int = 64, max_batch_size:int = 16):
+        from concurrent.futures import ThreadPoolExecutor
+        self = ModelBatch(max_batch_size=max_batch_size, max_latency=0.05)
+        batch_sizes = []
+        def double(items:list, offset:int = 0):
+            batch_sizes.append(len(items))
+            c.sleep(0.01)
+            return [x * 2 + offset for x in items]
+
+        with ThreadPoolExecutor(max_workers=n) as executor:
+            futures = [executor.submit(self.call, double, i, {'offset': i % 2}, i) for i in range(n)]
+            results = [f.result() for f in futures]
+        assert results == [i * 2 + i % 2 for i in range(n)], 'results were scattered to the wrong callers'
+        assert max(batch_sizes) <= max_batch_size
+        assert len(batch_sizes) < n, f'{n} requests ran in {len(batch_sizes)} batches'
+
+        # a request cancelled before its batch starts never reaches fn
+        slow = ModelBatch(max_batch_size=max_batch_size, max_latency=0.5)
+        seen = []
+        def identity(items:list):
+            seen.extend(items)
+            return items
+        futures = [slow.submit(identity, i) for i in range(4)]
+        assert futures[1].cancel()
+        assert [f.result() for i, f in enumerate(futures) if i != 1] == [0, 2, 3]
+        assert seen == [0, 2, 3], seen
+        stats = self.stop()['stats']
+        slow.stop()
+        return {'success': True, 'msg': f'{n} requests in {len(batch_sizes)} batches', 'stats': stats}
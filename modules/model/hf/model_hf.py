@@ -25,24 +25,44 @@ class ModelTransformer(Model):
                  max_new_tokens: int = 256,
                  load: bool = False,  # Assuming load is a boolean
                  quantize: str = None,
+                 batch: bool = False, # gather concurrent generate/forward calls into batches
+                 max_batch_size: int = 32,
+                 max_batch_latency: float = 0.01,
+                 batch_timeout: float = 60, # seconds a batched call waits before it is cancelled
                  test:bool = True): # OPTIONS = ['int4', 'int8', None]
 
         # Here you would initial
         config = self.set_config(kwargs=locals())
         self.init_model()
+        self.set_batcher(config)
         self.set_model(config)
 
+    def set_batcher(self, config) -> None:
+        self.batcher = None
+        if config.batch:
+            self.batcher = c.module('model.batch')(max_batch_size=config.max_batch_size,
+                                                    max_latency=config.max_batch_latency)
+        return self.batcher
+
     def forward(self,  
                 input_ids: Union[str, torch.Tensor], 
                 output_hidden_states: bool = False,
                 topk:int=None,
                 hidden_layer: int = -1, # -1 is the last hidden layer                     
+                timeout: float = None,
                 **kwargs):
 
         sample = {}
         is_string =  isinstance(input_ids, str) or \
                  bool(isinstance(input_ids, list) and isinstance(input_ids[0], str))
 
+        if self.batcher != None and isinstance(input_ids, str) and len(kwargs) == 0:
+            token_ids = self.tokenize(input_ids, padding=False)['input_ids'][0]
+            return self.batcher.call(self.forward_batch, token_ids, 
+                                     kwargs=dict(output_hidden_states=output_hidden_states, topk=topk, hidden_layer=hidden_layer),
+                                     size=len(token_ids),
+                                     timeout=timeout or self.config.batch_timeout)
+
         if is_string:
             sample = self.tokenize(input_ids)
         
@@ -60,13 +80,57 @@ class ModelTransformer(Model):
         if output_hidden_states:
             response['hidden_states'] = output['hidden_states'][hidden_layer].detach()
         if topk:
-            response['topk']=self.encode_topk(output['logits'].detach(), topk=topk).detach()
+            response['topk']=self.encode_topk(output['logits'].detach(), topk=topk)
         else:
             response['logits']= output['logits'].detach()
         
         return response
     
 
+    def pad_batch(self, token_ids: List[torch.Tensor], padding_side: str = 'right') -> dict:
+        """ Pads a list of 1d token id tensors into input_ids and attention_mask [batch_size, max_len]. """
+        max_len = max(len(t) for t in token_ids)
+        input_ids = torch.full((len(token_ids), max_len), self.tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(token_ids), max_len), dtype=torch.long)
+        for i, t in enumerate(token_ids):
+            idx = slice(max_len - len(t), max_len) if padding_side == 'left' else slice(0, len(t))
+            input_ids[i, idx] = t
+            attention_mask[i, idx] = 1
+        return dict(input_ids=input_ids.to(self.device), attention_mask=attention_mask.to(self.device))
+
+    def forward_batch(self, 
+                      token_ids: List[torch.Tensor], 
+                      output_hidden_states: bool = False,
+                      topk: int = None,
+                      hidden_layer: int = -1) -> List[dict]:
+        """ Runs a batch of requests from the batcher in one forward pass and splits the response per request. """
+        sample = self.pad_batch(token_ids, padding_side='right')
+        with torch.no_grad():
+            output = self.model(**sample, output_hidden_states=output_hidden_states)
+        logits = output['logits'].detach()
+        if topk:
+            topk_logits = self.encode_topk(logits, topk=topk)
+        responses = []
+        for i, t in enumerate(token_ids):
+            # keep the batch dimension, so every caller gets what an unbatched forward returns
+            response = {'logits': logits[i:i+1, :len(t)]}
+            if output_hidden_states:
+                response['hidden_states'] = output['hidden_states'][hidden_layer][i:i+1, :len(t)].detach()
+            if topk:
+                response['topk'] = topk_logits._replace(probs=topk_logits.probs[i:i+1, :len(t)],
+                                                        indices=topk_logits.indices[i:i+1, :len(t)])
+            responses.append(response)
+        return responses
+
+    def generate_batch(self, token_ids: List[torch.Tensor], max_new_tokens: int = 256, **kwargs) -> List[str]:
+        """ Generates for a batch of prompts (from the batcher or one call), left padded so that every row continues at the end. """
+        sample = self.pad_batch(token_ids, padding_side='left')
+        output_ids = self.model.generate(**sample, 
+                                         max_new_tokens=max_new_tokens, 
+                                         pad_token_id=self.tokenizer.pad_token_id,
+                                         **kwargs)
+        return self.detokenize(output_ids[:, sample['input_ids'].shape[1]:], skip_special_tokens=True)
+
     def logit2token(self, logits):
         '''
         ### Documentation
@@ -196,57 +260,6 @@ class ModelTransformer(Model):
                 
         return self.tokenizer
 
-    @staticmethod
-    def encode_topk( forward_response_tensor: torch.Tensor , topk:int=4096) -> torch.Tensor:
-        '''
-        ## Documentation
-        
-        ### Function: encode_topk
-        
-        #### Description:
-        The `encode_topk` function takes a tensor of unnormalized logit scores and returns the top-k tokens and their corresponding probabilities. The input tensor is expected to represent a batch of sequences, with each sequence containing a distribution over a vocabulary of possible tokens.
-        
-        #### Parameters:
-        - `forward_response_tensor` (torch.Tensor): A tensor containing unnormalized logit scores of shape `[batch_size, sequence_len, vocab_size]`.
-          
-        
-        '''
-        """ Returns topk tokens/probabilities given unnormalized logits as input. """
-
-        #import ipdb; ipdb.set_trace()
-
-        logits = forward_response_tensor  # unnormalized logit scores: [batch_size, sequence_len, vocab_size]
-        probs = torch.softmax(logits, dim=-1).to(torch.float32)  # normalized probabilities: [batch_size, sequence_len, vocab_size]
-
-        topk_indices = torch.argsort(logits, dim=-1, descending=True)[...,:topk]
-        # topk_values, topk_indices = torch.topk(probs, topk) # topk probs and indices: [batch_size, sequence_len, topk]
-
-        topk_values = probs.gather( index=topk_indices, dim=-1)
-        encoded_probs = torch.cat([topk_values, topk_indices], dim=-1)  # [batch_size, sequence_len, topk + topk]
-        return encoded_probs  # [batch_size, sequence_len, topk + topk]
-
-
-    @staticmethod
-    def decode_topk(  forward_response_tensor: torch.Tensor, topk=4096, vocab_size:int=50257) -> torch.Tensor:
-        """ Returns full logits by decoding topk-encoding input. """
-        batch_size, sequence_len, _ = forward_response_tensor.shape
-        
-        encoded_probs = forward_response_tensor  # encoded probabilities: [batch_size, sequence_len, topk + topk]
-        topk_values = encoded_probs[..., :topk]  # topk probs: [batch_size, sequence_len, topk]
-        topk_indices = encoded_probs[..., topk:].long()  # topk probs indices: [batch_size, sequence_len, topk]
-
-        topk_pmass = topk_values.sum(dim=-1)  # topk probability mass: [batch_size, sequence_len]
-        remainder_pmass = torch.clamp(1 - topk_pmass, 1e-40, 1)  # remainder probability mass: [batch_size, sequence_len]
-        remainder_floor = remainder_pmass / (vocab_size - topk)  # divide remainder: [batch_size, sequence_len]
-
-        logits = torch.ones((batch_size, sequence_len, vocab_size), dtype=topk_values.dtype).to(topk_values.device)
-        logits *= torch.log(remainder_floor)[:, :, None]  # set probability floor: [batch_size, sequence_len, vocab_size]
-
-        logits.scatter_(-1, topk_indices, torch.log(topk_values + 1e-40))  # insert topk probs: [batch_size, sequence_len, vocab_size]
-
-        return logits  # [batch_size, sequence_len, vocab_size]
-
-
     def tokenizer_name(self):
         '''
         ### Documentation
@@ -477,31 +490,114 @@ class ModelTransformer(Model):
     
 
 
+    def sample_token(self, logits: torch.Tensor, temperature: float = 1.0, top_k: int = 0, top_p: float = 1.0) -> torch.Tensor:
+        """ Samples the next token from the last position logits [batch_size, vocab_size]. """
+        if temperature == 0:
+            return torch.argmax(logits, dim=-1)
+        logits = logits / temperature
+        if top_k > 0:
+            kth_value = torch.topk(logits, min(top_k, logits.shape[-1]), dim=-1).values[..., -1, None]
+            logits = logits.masked_fill(logits < kth_value, float('-inf'))
+        probs = torch.softmax(logits.float(), dim=-1)
+        if top_p < 1.0:
+            sorted_probs, sorted_indices = torch.sort(probs, descending=True, dim=-1)
+            # drop the tokens after the cumulative mass passes top_p (always keep the first one)
+            sorted_probs[(sorted_probs.cumsum(dim=-1) - sorted_probs) > top_p] = 0
+            probs = torch.zeros_like(probs).scatter_(-1, sorted_indices, sorted_probs)
+        return torch.multinomial(probs, num_samples=1).squeeze(-1)
+
     def generate_stream(self, text: str, 
-                max_length: int = 20, 
-                max_new_tokens: int = None,
-                min_length: int = 0, 
-                min_new_tokens: int = None,
-                early_stopping: bool = True,
+                max_new_tokens: int = 256,
+                max_length: int = 512,
                 max_time: float = None,
-                chunk_size: int = 10,
-                **kwargs) -> List[str]:
-        if isinstance(text, str):
-            text = [text]
-
-         
-        input_ids = self.tokenize(text)['input_ids']
-        for i in range(max_new_tokens):
-            output_ids = self.model.generate(input_ids, 
-                                            max_length=max_length, 
-                                            max_new_tokens=chunk_size,
-                                            min_length=min_length, 
-                                            min_new_tokens=min_new_tokens,
-                                            early_stopping=early_stopping,
-                                            max_time=max_time, **kwargs)
-            output_text = self.decode(output_ids)
-            yield output_text
-            text = output_text
+                stop: Union[str, List[str]] = None,
+                temperature: float = 1.0,
+                top_k: int = 0,
+                top_p: float = 1.0,
+                do_sample: bool = None,
+                early_stopping: bool = None,
+                num_beams: int = 1,
+                **kwargs) -> Iterator[str]:
+        """
+        Streams the generated text as the tokens are sampled.
+
+        The prompt is encoded once and every step only feeds the last sampled token back in
+        with the past_key_values of the previous step, so each new token costs one forward
+        pass over one position. Text that could be the start of a stop sequence is held back
+        until it is clear, and nothing after a stop sequence is yielded.
+
+        do_sample=False decodes greedily. early_stopping only changes beam search, and a stream
+        has one beam, so it is accepted and has no effect. Other generate options raise a
+        ValueError instead of being ignored.
+        """
+        if len(kwargs) > 0:
+            raise ValueError(f'generate_stream does not support {sorted(kwargs)}')
+        if num_beams != 1:
+            raise ValueError(f'generate_stream samples one beam, not num_beams={num_beams}')
+        if do_sample == False:
+            temperature = 0
+        return self.stream_tokens(text, max_new_tokens=max_new_tokens, max_length=max_length, max_time=max_time,
+                                  stop=stop, temperature=temperature, top_k=top_k, top_p=top_p)
+
+    def stream_tokens(self, text: str,
+                      max_new_tokens: int = 256,
+                      max_length: int = 512,
+                      max_time: float = None,
+                      stop: Union[str, List[str]] = None,
+                      temperature: float = 1.0,
+                      top_k: int = 0,
+                      top_p: float = 1.0) -> Iterator[str]:
+        """
+        The generator behind generate_stream, which checks the options before the first token.
+        """
+        if isinstance(text, list):
+            assert len(text) == 1, 'generate_stream streams one text at a time'
+            text = text[0]
+        max_new_tokens = min(max_new_tokens, self.config.max_new_tokens)
+        stop = [stop] if isinstance(stop, str) else (stop or [])
+        eos_token_id = self.tokenizer.eos_token_id
+        input_ids = self.tokenize(text, max_length=max_length, padding=False)['input_ids']
+
+        start_time = c.time()
+        past_key_values = None
+        token_ids = []
+        emitted = ''
+        with torch.no_grad():
+            for i in range(max_new_tokens):
+                output = self.model(input_ids=input_ids, past_key_values=past_key_values, use_cache=True)
+                past_key_values = output.past_key_values
+                next_token = self.sample_token(output.logits[:, -1, :], temperature=temperature, top_k=top_k, top_p=top_p)
+                if next_token.item() == eos_token_id:
+                    break
+                token_ids.append(next_token.item())
+                input_ids = next_token.view(1, 1)
+
+                # decode all of the new tokens so merged spaces and multi byte characters come out right
+                output_text = self.tokenizer.decode(token_ids, skip_special_tokens=True)
+                stop_idx = min([output_text.find(s) for s in stop if s in output_text], default=-1)
+                if stop_idx >= 0:
+                    if stop_idx > len(emitted):
+                        yield output_text[len(emitted):stop_idx]
+                    return
+                # hold back an unfinished character or a possible start of a stop sequence
+                hold = 1 if output_text.endswith('\ufffd') else 0
+                for s in stop:
+                    for n in range(min(len(s), len(output_text)), hold, -1):
+                        if s.startswith(output_text[-n:]):
+                            hold = n
+                            break
+                ready_text = output_text[:len(output_text) - hold]
+                if len(ready_text) > len(emitted):
+                    yield ready_text[len(emitted):]
+                    emitted = ready_text
+
+                if max_time != None and c.time() - start_time > max_time:
+                    break
+
+        if len(token_ids) > 0:
+            output_text = self.tokenizer.decode(token_ids, skip_special_tokens=True)
+            if len(output_text) > len(emitted):
+                yield output_text[len(emitted):]
 
     hf = c.module('hf')()
     def generate(self, text: str, 
@@ -510,15 +606,19 @@ class ModelTransformer(Model):
                 early_stopping: bool = True,
                 stream:bool = False,
                 info : bool = False,
+                timeout: float = None,
                 **kwargs) -> List[str]:
+        """
+        Generates the continuation of text (without the prompt), batched with concurrent calls when
+        the batcher is on. timeout is how long a batched call waits before it is cancelled.
+        """
         if stream:
             return self.generate_stream(text, 
                                         max_new_tokens=max_new_tokens, 
+                                        max_length=max_length,
                                         early_stopping=early_stopping, **kwargs)
 
         is_string = isinstance(text, str)
-        if is_string:
-            text = [text]
 
         # resolve max_length
         if max_length > self.config.max_length:
@@ -528,23 +628,24 @@ class ModelTransformer(Model):
         if max_new_tokens > self.config.max_new_tokens:
             max_new_tokens = self.config.max_new_tokens
 
-        # get tokens
-        input_ids = self.tokenize(text, max_length=max_length)
+        if self.batcher != None and is_string:
+            token_ids = self.tokenize(text, padding=False, max_length=max_length)['input_ids'][0]
+            return self.batcher.call(self.generate_batch, token_ids, 
+                                     kwargs=dict(max_new_tokens=max_new_tokens, early_stopping=early_stopping, **kwargs),
+                                     size=len(token_ids),
+                                     timeout=timeout or self.config.batch_timeout)
 
-        # generate
-        output_ids = self.model.generate(**input_ids, 
-                                        max_new_tokens=max_new_tokens,
-                                        early_stopping=early_stopping,
-                                          **kwargs)
-        
-        # decode
-        output_text = self.detokenize(output_ids, skip_special_tokens=True)
+        if is_string:
+            text = [text]
 
-        # remove input text
-        for t, ot in zip(text, output_text):
-            output_text = ot.replace(t, '')
+        # the same left padded generation as a batch from the batcher, so that both give the same text
+        token_ids = [self.tokenize(t, padding=False, max_length=max_length)['input_ids'][0] for t in text]
+        output_text = self.generate_batch(token_ids,
+                                          max_new_tokens=max_new_tokens,
+                                          early_stopping=early_stopping,
+                                          **kwargs)
 
-        if is_string and isinstance(output_text, list):
+        if is_string:
             output_text = output_text[0]
 
         return output_text
@@ -610,6 +711,79 @@ class ModelTransformer(Model):
         print(sequences[0]["generated_text"])
 
 
+    @classmethod
+    def test_generate_stream(cls, model='sshleifer/tiny-gpt2', text='hey whadup fam?', max_new_tokens=64, trials=3):
+        """
+        Time to first token and tokens per second of generate_stream against a non streaming
+        model.generate over the same number of tokens, on a tiny cpu model.
+        """
+        self = cls(model=model, device_map='cpu', max_new_tokens=max_new_tokens, test=False)
+        stats = {'ttft': [], 'stream_tokens_per_second': [], 'generate_tokens_per_second': []}
+        for i in range(trials):
+            t0 = c.time()
+            ttft = None
+            chunks = []
+            for chunk in self.generate_stream(text, max_new_tokens=max_new_tokens, temperature=0):
+                ttft = ttft or c.time() - t0
+                chunks.append(chunk)
+            num_tokens = len(self.tokenizer.encode(''.join(chunks), add_special_tokens=False))
+            stats['ttft'].append(ttft)
+            stats['stream_tokens_per_second'].append(num_tokens / (c.time() - t0))
+
+            input_ids = self.tokenize(text, padding=False)['input_ids']
+            t0 = c.time()
+            output_ids = self.model.generate(input_ids, max_new_tokens=max_new_tokens, min_new_tokens=max_new_tokens, do_sample=False)
+            stats['generate_tokens_per_second'].append((output_ids.shape[1] - input_ids.shape[1]) / (c.time() - t0))
+
+        stats = {k: sum(v)/len(v) for k,v in stats.items()}
+        # the options of generate(stream=True) are applied, or refused when a stream cannot honor them
+        greedy = ''.join(self.generate(text, stream=True, max_new_tokens=8, do_sample=False, early_stopping=True))
+        assert greedy == ''.join(self.generate_stream(text, max_new_tokens=8, temperature=0))
+        for kwargs in [{'num_beams': 4}, {'repetition_penalty': 1.2}]:
+            try:
+                self.generate(text, stream=True, **kwargs)
+                raise AssertionError(f'generate_stream accepted {kwargs}')
+            except ValueError:
+                pass
+        assert stats['ttft'] < max_new_tokens / stats['generate_tokens_per_second'], 'the first token should arrive before a full generate'
+        return stats
+
+    @classmethod
+    def test_batch(cls, model='sshleifer/tiny-gpt2', text='hey whadup fam?', n=64, max_new_tokens=16):
+        """
+        Requests per second of n concurrent generate callers with and without the batcher, on a tiny cpu model.
+        """
+        import concurrent.futures
+        from concurrent.futures import ThreadPoolExecutor
+        self = cls(model=model, device_map='cpu', max_new_tokens=max_new_tokens, batch=True, max_batch_size=n, test=False)
+        prompts = [f'{text} {i}' for i in range(n)]
+        batcher = self.batcher
+        stats = {}
+        mode2outputs = {}
+        for mode in ['single', 'batch']:
+            self.batcher = batcher if mode == 'batch' else None
+            t0 = c.time()
+            with ThreadPoolExecutor(max_workers=n) as executor:
+                futures = [executor.submit(self.generate, p, max_new_tokens=max_new_tokens, do_sample=False) for p in prompts]
+                outputs = [f.result() for f in futures]
+            assert all(isinstance(o, str) for o in outputs), outputs
+            stats[f'{mode}_requests_per_second'] = n / (c.time() - t0)
+            mode2outputs[mode] = outputs
+        stats['speedup'] = stats['batch_requests_per_second'] / stats['single_requests_per_second']
+        # greedy decoding gives the same text whichever way the prompts were grouped
+        assert mode2outputs['batch'] == mode2outputs['single'], 'batched and single outputs differ'
+        self.batcher = None
+        assert self.generate(prompts, max_new_tokens=max_new_tokens, do_sample=False) == mode2outputs['single'], 'list outputs differ'
+        self.batcher = batcher
+        # a call that is not answered within its timeout is cancelled and raises
+        try:
+            self.generate(text, max_new_tokens=max_new_tokens, do_sample=False, timeout=1e-6)
+            raise AssertionError('the batched call did not time out')
+        except concurrent.futures.TimeoutError:
+            pass
+        stats['batcher'] = batcher.stop()['stats']
+        return stats
+
     @classmethod
     def shortcuts(cls):
         return c.load_yaml(cls.dirpath() + '/model_shortcuts.yaml')
@@ -520,19 +520,69 @@ class Model(nn.Module, c.Module):
     
 
     @staticmethod
-    def encode_topk( forward_response_tensor: 'torch.Tensor' , topk:int=4096) -> 'torch.Tensor':
-        """ Returns topk tokens/probabilities given unnormalized logits as input. """
-        #import ipdb; ipdb.set_trace()
-        logits = forward_response_tensor  # unnormalized logit scores: [batch_size, sequence_len, vocab_size]
-        probs = torch.softmax(logits, dim=-1).to(torch.float32)  # normalized probabilities: [batch_size, sequence_len, vocab_size]
-
-        topk_indices = torch.argsort(probs, dim=-1, descending=True)[...,:topk]
-        # topk_values, topk_indices = torch.topk(probs, topk) # topk probs and indices: [batch_size, sequence_len, topk]
-
-        topk_values = probs.gather( index=topk_indices, dim=-1)
-        encoded_probs = torch.cat([topk_values, topk_indices], dim=-1)  # [batch_size, sequence_len, topk + topk]
-        return encoded_probs  # [batch_size, sequence_len, topk + topk]
-    
+    def encode_topk( forward_response_tensor: 'torch.Tensor' , topk:int=4096, dtype:'torch.dtype'=torch.float16, packed:bool=True) -> 'TopK':
+        """ Returns topk tokens/probabilities given unnormalized logits as input, packed as int32 indices and fp16 probabilities. """
+        from commune.utils.tokenizer import encode_topk
+        return encode_topk(forward_response_tensor, topk=topk, dtype=dtype, packed=packed)
+
+    @staticmethod
+    def decode_topk( forward_response_tensor: Union['TopK', 'torch.Tensor'], topk:int=None, vocab_size:int=50257) -> 'torch.Tensor':
+        """ Returns full logits by decoding a packed (or legacy) topk encoding. """
+        from commune.utils.tokenizer import decode_topk
+        return decode_topk(forward_response_tensor, topk=topk, vocab_size=vocab_size)
+
+    @staticmethod
+    def topk_cross_entropy( forward_response_tensor: Union['TopK', 'torch.Tensor'], target_ids: 'torch.Tensor', **kwargs) -> 'torch.Tensor':
+        """ Next token cross entropy of a topk encoding, computed without decoding the full logits. """
+        from commune.utils.tokenizer import topk_cross_entropy
+        return topk_cross_entropy(forward_response_tensor, target_ids, **kwargs)
+
+    @classmethod
+    def test_topk(cls, vocab_sizes:List[int] = [50257, 100000, 150000], batch_size:int = 4, sequence_len:int = 64, topk:int = 4096, repeats:int = 3):
+        """
+        Encode time, memory and bytes on the wire of the packed topk encoding against the
+        legacy argsort + float concatenation, for vocabulary sizes of 50k-150k.
+        Both encodings are warmed up, then timed alternately and the fastest of repeats runs is kept.
+        """
+        serializer = c.module('serializer')()
+        def encode_legacy(logits):
+            probs = torch.softmax(logits, dim=-1)
+            legacy_indices = torch.argsort(probs, dim=-1, descending=True)[...,:topk]
+            return torch.cat([probs.gather(index=legacy_indices, dim=-1), legacy_indices], dim=-1)
+        encoders = {'legacy': encode_legacy, 'packed': lambda logits: cls.encode_topk(logits, topk=topk)}
+        stats = {}
+        for vocab_size in vocab_sizes:
+            logits = torch.randn(batch_size, sequence_len, vocab_size)
+            outputs = {name: encode(logits) for name, encode in encoders.items()} # warm up
+            seconds = {name: float('inf') for name in encoders}
+            for _ in range(repeats):
+                for name, encode in encoders.items():
+                    t0 = c.time()
+                    encode(logits)
+                    seconds[name] = min(seconds[name], c.time() - t0)
+            legacy, packed = outputs['legacy'], outputs['packed']
+            legacy_seconds, packed_seconds = seconds['legacy'], seconds['packed']
+            assert torch.allclose(packed.probs.float(), legacy[..., :topk], atol=1e-3), 'topk probabilities differ'
+
+            # the sparse loss matches the loss on the densified logits
+            target_ids = torch.randint(vocab_size, (batch_size, sequence_len))
+            dense_loss = torch.nn.functional.nll_loss(cls.decode_topk(packed).view(-1, vocab_size), target_ids.view(-1))
+            sparse_loss = cls.topk_cross_entropy(packed, target_ids)
+            assert torch.isclose(dense_loss, sparse_loss, rtol=1e-3), f'{dense_loss} != {sparse_loss}'
+
+            stats[vocab_size] = {'legacy_encode_seconds': legacy_seconds,
+                                 'packed_encode_seconds': packed_seconds,
+                                 'legacy_bytes': legacy.numel() * legacy.element_size(),
+                                 'packed_bytes': packed.nbytes,
+                                 'dense_logits_bytes': logits.numel() * 4,
+                                 'legacy_wire_bytes': len(serializer.serialize(legacy)),
+                                 'packed_wire_bytes': len(serializer.serialize(packed))}
+
+        small = cls.encode_topk(torch.randn(1, 2, 200000), topk=8)
+        roundtrip = serializer.deserialize(serializer.serialize({'topk': small}))['topk']
+        assert torch.equal(roundtrip.indices, small.indices) and roundtrip.indices.dtype == torch.int32
+        assert roundtrip.probs.dtype == torch.float16 and roundtrip.vocab_size == 200000
+        return stats
 
 
 
@@ -1,28 +1,240 @@
-
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import *
+import numpy as np
 import commune as c
 
 
 class Sentence(c.Module):
-    def __init__(self, 
+    """
+    An embedding service on top of a SentenceTransformer.
+
+    Every text is keyed by the hash of (model, encode kwargs, text). Embeddings live in an
+    in-memory LRU tier and an append-only float32 file on disk that is read through a memmap,
+    with a digest index next to it, so repeated texts are never encoded twice.
+    Concurrent calls that miss the cache are coalesced into large batches by model.batch
+    within max_batch_latency seconds. Vectors are returned as float32, float16 or int8
+    (with one scale per vector).
+    """
+    digest_size = 16
+
+    def __init__(self,
                 config=None,
                   **kwargs):
         config = self.set_config(config=config, kwargs=kwargs)
         self.set_model(model=config.model, device=config.device)
-    
+        self.metrics_lock = threading.Lock()
+        self.reset_metrics()
+        self.set_cache(config)
+        self.set_batcher(config)
+
     def set_model(self, model:str, device:str):
         from sentence_transformers import SentenceTransformer
         self.model = SentenceTransformer(model, device=device)
 
-    def forward(self, text, **kwargs):
+    def set_batcher(self, config) -> None:
+        self.batcher = None
+        if config.batch:
+            self.batcher = c.module('model.batch')(max_batch_size=config.max_batch_size,
+                                                    max_latency=config.max_batch_latency)
+        return self.batcher
+
+    def reset_metrics(self):
+        self.stats = {'requests': 0, 'texts': 0, 'memory_hits': 0, 'disk_hits': 0, 'encoded': 0, 'encode_seconds': 0}
+
+    def update_metrics(self, **increments):
+        with self.metrics_lock:
+            for k,v in increments.items():
+                self.stats[k] += v
+
+    def metrics(self) -> dict:
+        """
+        Embeddings per second of the model and the cache hit rate, since the start (or reset_metrics).
+        """
+        stats = dict(self.stats)
+        hits = stats['memory_hits'] + stats['disk_hits']
+        stats['hit_rate'] = hits / stats['texts'] if stats['texts'] > 0 else 0
+        stats['embeddings_per_second'] = stats['encoded'] / stats['encode_seconds'] if stats['encode_seconds'] > 0 else 0
+        stats['memory_items'] = len(self.memory)
+        stats['disk_items'] = len(self.digest2row)
+        if self.batcher != None:
+            stats['batcher'] = dict(self.batcher.stats)
+        return stats
+
+    """
+    ################ CACHE ############################
+    """
+
+    def set_cache(self, config) -> None:
+        self.cache_lock = threading.Lock()
+        self.memory = OrderedDict() # digest -> float32 vector
+        self.inflight = {} # digest -> future of a text that is being encoded
+        self.digest2row = {}
+        self.disk = None # memmap over the vectors file, remapped when it grows
+        self.dim = self.model.get_sentence_embedding_dimension()
+        self.vectors_path = self.index_path = None
+        if config.cache and config.cache_path != None:
+            name = config.model.replace('/', '_')
+            dirpath = self.resolve_path(config.cache_path)
+            os.makedirs(dirpath, exist_ok=True)
+            self.vectors_path = os.path.join(dirpath, f'{name}.{self.dim}.vectors')
+            self.index_path = os.path.join(dirpath, f'{name}.{self.dim}.index')
+            self.load_index()
+
+    def load_index(self):
+        self.digest2row = {}
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, 'rb') as f:
+            data = f.read()
+        # only index the rows whose vectors are fully written, and ignore a torn trailing digest
+        num_rows = min(len(data) // self.digest_size, os.path.getsize(self.vectors_path) // (self.dim * 4))
+        for row in range(num_rows):
+            self.digest2row[data[row * self.digest_size:(row + 1) * self.digest_size]] = row
+
+    def digest(self, text:str, kwargs:dict = None) -> bytes:
+        key = json.dumps([self.config.model, kwargs or {}, text], sort_keys=True, default=str)
+        return hashlib.sha256(key.encode()).digest()[:self.digest_size]
+
+    def remember(self, digest:bytes, vector:np.ndarray):
+        with self.cache_lock:
+            self.memory[digest] = vector
+            self.memory.move_to_end(digest)
+            while len(self.memory) > self.config.cache_size:
+                self.memory.popitem(last=False)
+
+    def disk_rows(self, rows:List[int]) -> np.ndarray:
+        if self.disk is None or max(rows) >= len(self.disk):
+            self.disk = np.memmap(self.vectors_path, dtype=np.float32, mode='r').reshape(-1, self.dim)
+        return np.array(self.disk[rows])
+
+    def lookup(self, digests:List[bytes]) -> Dict[bytes, np.ndarray]:
+        """
+        The cached vectors of the digests, from memory first and then from disk.
+        """
+        found = {}
+        with self.cache_lock:
+            for d in digests:
+                if d in self.memory:
+                    self.memory.move_to_end(d)
+                    found[d] = self.memory[d]
+        memory_hits = len(found)
+        disk_digests = [d for d in digests if d not in found and d in self.digest2row]
+        if len(disk_digests) > 0:
+            vectors = self.disk_rows([self.digest2row[d] for d in disk_digests])
+            for d, v in zip(disk_digests, vectors):
+                found[d] = v
+                self.remember(d, v)
+        self.update_metrics(memory_hits=memory_hits, disk_hits=len(disk_digests))
+        return found
+
+    def store(self, digests:List[bytes], vectors:np.ndarray):
+        for d, v in zip(digests, vectors):
+            self.remember(d, v)
+        if self.vectors_path == None:
+            return
+        with self.cache_lock:
+            new = [(d, v) for d, v in zip(digests, vectors) if d not in self.digest2row]
+            if len(new) == 0 or len(self.digest2row) + len(new) > self.config.max_disk_items:
+                return
+            row = len(self.digest2row)
+            # the vectors are written before their digests, so a crash never indexes a partial vector
+            with open(self.vectors_path, 'ab') as f:
+                f.write(np.stack([v for _, v in new]).astype(np.float32).tobytes())
+            with open(self.index_path, 'ab') as f:
+                f.write(b''.join([d for d, _ in new]))
+            for i, (d, _) in enumerate(new):
+                self.digest2row[d] = row + i
+
+    def clear_cache(self):
+        with self.cache_lock:
+            self.memory.clear()
+            self.digest2row = {}
+            self.disk = None
+            for path in [self.vectors_path, self.index_path]:
+                if path != None and os.path.exists(path):
+                    os.remove(path)
+        return {'success': True, 'msg': 'cleared the embedding cache'}
+
+    """
+    ################ ENCODING ############################
+    """
+
+    def encode_batch(self, texts:List[str], **kwargs) -> List[np.ndarray]:
+        """ Encodes one (coalesced) batch of texts. """
+        t0 = c.time()
+        embeddings = self.model.encode(texts, batch_size=len(texts), convert_to_numpy=True, **kwargs)
+        self.update_metrics(encoded=len(texts), encode_seconds=c.time() - t0)
+        return list(embeddings.astype(np.float32))
+
+    def encode_missing(self, missing:Dict[bytes, str], kwargs:dict) -> List[np.ndarray]:
+        if self.batcher == None:
+            return self.encode_batch(list(missing.values()), **kwargs)
+        # concurrent calls for a text that is already being encoded wait for the same future
+        futures = []
+        with self.cache_lock:
+            for d, t in missing.items():
+                if d not in self.inflight:
+                    future = self.batcher.submit(self.encode_batch, t, kwargs=kwargs)
+                    future.add_done_callback(lambda f, d=d: self.inflight.pop(d, None))
+                    self.inflight[d] = future
+                futures.append(self.inflight[d])
+        return [f.result() for f in futures]
+
+    @staticmethod
+    def quantize(embeddings:np.ndarray) -> dict:
+        """ Symmetric int8 quantization with one scale per vector. """
+        scale = np.abs(embeddings).max(axis=-1, keepdims=True) / 127
+        scale[scale == 0] = 1
+        return {'data': np.round(embeddings / scale).astype(np.int8), 'scale': scale.astype(np.float32)}
+
+    @staticmethod
+    def dequantize(quantized:dict) -> np.ndarray:
+        return quantized['data'].astype(np.float32) * quantized['scale']
+
+    def forward(self, text, dtype:str = 'float32', cache:bool = True, **kwargs):
+        """
+        Embeds a text or a list of texts. dtype is float32, float16 or int8, where int8 returns
+        {'data': int8 vectors, 'scale': float32 scale per vector} (see dequantize).
+        """
         initially_string = isinstance(text, str)
         if initially_string:
             text = [text]
         assert isinstance(text, list)
         assert isinstance(text[0], str)
-        embeddings = self.model.encode(text, **kwargs)
+        assert dtype in ['float32', 'float16', 'int8'], f'dtype {dtype} not supported'
+        self.update_metrics(requests=1, texts=len(text))
+
+        digests = [self.digest(t, kwargs) for t in text]
+        found = self.lookup(digests) if cache and self.config.cache else {}
+        # every distinct missing text is encoded once, even if it repeats within the request
+        missing = {}
+        for d, t in zip(digests, text):
+            if d not in found:
+                missing.setdefault(d, t)
+        if len(missing) > 0:
+            vectors = self.encode_missing(missing, kwargs)
+            if cache and self.config.cache:
+                self.store(list(missing.keys()), vectors)
+            found.update(zip(missing.keys(), vectors))
+
+        embeddings = np.stack([found[d] for d in digests])
+        if dtype == 'float16':
+            embeddings = embeddings.astype(np.float16)
+        elif dtype == 'int8':
+            embeddings = self.quantize(embeddings)
+            if initially_string:
+                embeddings = {k: v[0] for k,v in embeddings.items()}
+            return embeddings
         if initially_string:
             embeddings = embeddings[0]
         return embeddings
+
+    embed = forward
+
     def test(self):
         sentences = ["This is an example sentence", "Each sentence is converted"]
         embeddings = self.model.encode(sentences)
@@ -31,5 +243,33 @@ class Sentence(c.Module):
         embeddings = self.model.encode(sentences)
         c.print(embeddings.shape)
         return embeddings
-    
-    
+
+    @classmethod
+    def test_embed(cls, model:str = 'sentence-transformers/all-MiniLM-L6-v2', n:int = 256, unique:int = 32):
+        """
+        n concurrent single text calls over a few distinct texts: they are encoded in
+        coalesced batches, once per distinct text, and later calls hit the cache.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        self = cls(model=model, device='cpu', cache_path='test_embeddings', max_batch_latency=0.02)
+        self.clear_cache()
+        texts = [f'validator prompt number {i % unique}' for i in range(n)]
+        with ThreadPoolExecutor(max_workers=64) as executor:
+            embeddings = list(executor.map(self.forward, texts))
+        expected = self.model.encode(texts[:unique], convert_to_numpy=True)
+        assert np.allclose(np.stack(embeddings[:unique]), expected, atol=1e-4), 'batched embeddings differ'
+        assert self.stats['encoded'] < n, self.stats
+
+        # a fresh service reads the disk tier
+        cold = cls(model=model, device='cpu', cache_path='test_embeddings', batch=False)
+        assert np.allclose(cold.forward(texts[:unique]), expected, atol=1e-4)
+        assert cold.stats['disk_hits'] == unique and cold.stats['encoded'] == 0, cold.stats
+        half = cold.forward(texts[:unique], dtype='float16')
+        assert half.dtype == np.float16
+        quantized = cold.forward(texts[:unique], dtype='int8')
+        assert np.abs(cls.dequantize(quantized) - expected).max() < 1e-2
+
+        metrics = self.metrics()
+        self.batcher.stop()
+        self.clear_cache()
+        return {'success': True, 'msg': f'{n} calls encoded {metrics["encoded"]} texts', 'metrics': metrics}
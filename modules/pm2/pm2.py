@@ -1,11 +1,89 @@
 import os
+import threading
 from typing import *
 import commune as c
 import json
 
 class PM2(c.Module):
     dir = os.path.expanduser('~/.pm2')
-   
+
+    # local mirror of the pm2 process list (name -> state), refreshed from pm2 jlist at most every ttl seconds
+    registry = {}
+    registry_time = 0
+    ttl = 2
+    lock = threading.Lock()
+    # the number of names per pm2 invocation in bulk commands, to stay under the argument length limit
+    bulk_size = 256
+
+    @classmethod
+    def parse_jlist(cls, output:str) -> Dict[str, dict]:
+        """
+        Parses the json process list of pm2 jlist into {name: state}.
+        pm2 can print warnings (e.g. [PM2] ...) before the json, so only the line with the list is parsed.
+        Output without a list (e.g. only warnings) means there are no processes.
+        """
+        lines = [l for l in output.split('\n') if l.startswith('[') and l.rstrip().endswith(']') and not l.startswith('[PM2')]
+        if len(lines) == 0:
+            return {}
+        processes = json.loads(lines[-1])
+        registry = {}
+        for p in processes:
+            env = p.get('pm2_env', {})
+            monit = p.get('monit', {})
+            registry[p['name']] = {
+                'name': p['name'],
+                'pm_id': p.get('pm_id'),
+                'pid': p.get('pid'),
+                'status': env.get('status'),
+                'restarts': env.get('restart_time', 0),
+                'unstable_restarts': env.get('unstable_restarts', 0),
+                'uptime': env.get('pm_uptime'),
+                'memory': monit.get('memory'),
+                'cpu': monit.get('cpu'),
+            }
+        return registry
+
+    @classmethod
+    def processes(cls, search=None, update:bool = False, max_age:float = None) -> Dict[str, dict]:
+        """
+        The mirrored process states {name: {pid, status, restarts, memory, ...}}.
+        pm2 is only asked again when the mirror is older than max_age (ttl by default) or update is True.
+        """
+        max_age = cls.ttl if max_age == None else max_age
+        with cls.lock:
+            if update or c.time() - cls.registry_time > max_age:
+                cls.registry = cls.parse_jlist(c.cmd('pm2 jlist', verbose=False))
+                cls.registry_time = c.time()
+            registry = dict(cls.registry)
+        if search != None:
+            registry = {k:v for k,v in registry.items() if cls.search_match(k, search)}
+        return registry
+
+    @classmethod
+    def invalidate(cls, names:List[str] = None):
+        """
+        Marks the mirror as stale after we changed the processes, and drops the names that are gone.
+        """
+        with cls.lock:
+            for name in names or []:
+                cls.registry.pop(name, None)
+            cls.registry_time = 0
+
+    @staticmethod
+    def search_match(name:str, search:Union[str, List[str]]) -> bool:
+        search = [search] if isinstance(search, str) else search
+        return any([s in name for s in search])
+
+    @classmethod
+    def bulk(cls, action:str, names:List[str], verbose:bool = False) -> List[str]:
+        """
+        Runs a pm2 action (restart, stop, delete) on many processes with one pm2 invocation per bulk_size names.
+        """
+        outputs = []
+        for chunk in c.chunk(names, chunk_size=cls.bulk_size):
+            outputs.append(c.cmd(['pm2', action] + list(chunk), verbose=verbose))
+        return outputs
+
     @classmethod
     def restart(cls, name:str, verbose:bool = False, prefix_match:bool = True):
         list = cls.servers()
@@ -19,25 +97,21 @@ class PM2(c.Module):
 
         if len(rm_list) == 0:
             return []
+        c.print(f'Restarting {rm_list}', color='cyan')
+        cls.bulk('restart', rm_list)
         for n in rm_list:
-            c.print(f'Restarting {n}', color='cyan')
-            c.cmd(f"pm2 restart {n}", verbose=False)
             cls.rm_logs(n)  
+        cls.invalidate()
         return {'success':True, 'message':f'Restarted {name}'}
        
     @classmethod
     def restart_prefix(cls, name:str = None, verbose:bool=False):
-        list = cls.servers()
-            
-        restarted_modules = []
-        
-        for module in list:
-            if module.startswith(name) or name in ['all']:
-                if verbose:
-                    c.print(f'Restarting {module}', color='cyan')
-                c.cmd(f"pm2 restart {module}", verbose=verbose)
-                restarted_modules.append(module)
-        
+        restarted_modules = [m for m in cls.servers() if name in ['all'] or m.startswith(name)]
+        if verbose:
+            c.print(f'Restarting {restarted_modules}', color='cyan')
+        if len(restarted_modules) > 0:
+            cls.bulk('restart', restarted_modules, verbose=verbose)
+            cls.invalidate()
         return restarted_modules
        
 
@@ -48,6 +122,7 @@ class PM2(c.Module):
         cls.cmd(f"pm2 delete {name}", verbose=False)
         # remove the logs from the pm2 logs directory
         cls.rm_logs(name)
+        cls.invalidate([name])
         return {'success':True, 'message':f'Killed {name}'}
     
     @classmethod
@@ -105,6 +180,10 @@ class PM2(c.Module):
                     continue
             
             return text
+        elif mode == 'follow':
+            # a generator of the new out lines, streamed as events when served
+            path = f'{cls.dir}/logs/{module.replace("/", "-")}-out.log'.replace(':', '-').replace('_', '-')
+            return c.follow_text(path, tail=tail, **kwargs)
         elif mode == 'cmd':
             return cls.run_command(f"pm2 logs {module}", verbose=verbose)
         else:
@@ -116,43 +195,33 @@ class PM2(c.Module):
    
     @classmethod
     def kill_many(cls, search=None, verbose:bool = True, timeout=10):
-        futures = []
-        for name in cls.servers(search=search):
-            c.print(f'[bold cyan]Killing[/bold cyan] [bold yellow]{name}[/bold yellow]', color='green', verbose=verbose)
-            f = c.submit(cls.kill, kwargs=dict(name=name, verbose=verbose), return_future=True, timeout=timeout)
-            futures.append(f)
-        return c.wait(futures)
+        names = cls.servers(search=search)
+        if len(names) == 0:
+            return []
+        c.print(f'[bold cyan]Killing[/bold cyan] [bold yellow]{names}[/bold yellow]', color='green', verbose=verbose)
+        cls.bulk('delete', names)
+        for name in names:
+            cls.rm_logs(name)
+        cls.invalidate(names)
+        return [{'success':True, 'message':f'Killed {name}'} for name in names]
     
     @classmethod
     def kill_all(cls, verbose:bool = True, timeout=10):
         return cls.kill_many(search=None, verbose=verbose, timeout=timeout)
                 
     @classmethod
-    def servers(cls, search=None,  verbose:bool = False) -> List[str]:
-        output_string = c.cmd('pm2 status', verbose=False)
-        module_list = []
-        for line in output_string.split('\n'):
-            if '  default  ' in line:
-                server_name = line.split('default')[0].strip()
-                server_name = server_name.split(' ')[-1].strip()
-                if 'errored' in line:
-                    cls.kill(server_name, verbose=True)
-                    continue
+    def servers(cls, search=None,  verbose:bool = False, update:bool = False) -> List[str]:
+        processes = cls.processes(search=search, update=update)
+        errored = [name for name, p in processes.items() if p['status'] == 'errored']
+        if len(errored) > 0:
+            c.print(f'Killing errored processes {errored}', color='red', verbose=verbose)
+            cls.bulk('delete', errored)
+            cls.invalidate(errored)
+        return [name for name in processes if name not in errored]
 
-                module_list += [server_name]
-            
-        if search != None:
-            search_true = lambda x: any([s in x for s in search])
-            module_list = [m for m in module_list if search_true(m)]
-                
-        return module_list
-    
-
-    # commune.run_command('pm2 status').stdout.split('\n')[5].split('    │')[0].split('  │ ')[-1]commune.run_command('pm2 status').stdout.split('\n')[5].split('    │')[0].split('  │ ')[-1] 
-    
     @classmethod
-    def exists(cls, name:str) -> bool:
-        return bool(name in cls.servers())
+    def exists(cls, name:str, update:bool = False) -> bool:
+        return bool(name in cls.processes(update=update))
     
     @classmethod
     def start(cls, 
@@ -191,7 +260,30 @@ class PM2(c.Module):
         if current_dir:
             kwargs['cwd'] = c.dirpath(path)
 
-        return c.cmd(cmd, verbose=verbose, **kwargs)
+        stdout = c.cmd(cmd, verbose=verbose, **kwargs)
+        cls.invalidate()
+        return stdout
+
+    @classmethod
+    def start_many(cls, apps:List[dict], refresh:bool = True, verbose:bool = False) -> dict:
+        """
+        Starts many processes with a single pm2 invocation through an ecosystem file.
+        Each app is a pm2 app config, e.g. {'name': .., 'script': .., 'args': .., 'interpreter': .., 'cwd': .., 'env': ..}.
+        """
+        names = [app['name'] for app in apps]
+        if refresh:
+            existing = [n for n in names if cls.exists(n)]
+            if len(existing) > 0:
+                cls.bulk('delete', existing)
+                cls.invalidate(existing)
+        import tempfile
+        # pm2 only reads ecosystem files that end with .json
+        with tempfile.NamedTemporaryFile('w', suffix='.json', prefix='ecosystem-') as f:
+            json.dump({'apps': apps}, f)
+            f.flush()
+            stdout = c.cmd(['pm2', 'start', f.name], verbose=verbose)
+        cls.invalidate()
+        return {'success': True, 'message': f'Started {len(apps)} processes', 'names': names, 'stdout': stdout}
         
     @classmethod
     def launch(cls, 
@@ -231,7 +323,7 @@ class PM2(c.Module):
 
         name = cls.resolve_server_name(module=module, name=name, tag=tag, tag_seperator=tag_seperator) 
 
-        if refresh:
+        if refresh and cls.exists(name):
             cls.kill(name)
         
         module = c.module()
@@ -251,25 +343,81 @@ class PM2(c.Module):
                 env['CUDA_VISIBLE_DEVICES']=str(device)
             if isinstance(device, list):
                 env['CUDA_VISIBLE_DEVICES']=','.join(list(map(str, device)))
-        if refresh:
-            cls.kill(name)  
         
         cwd = cwd or module.dirpath()
         
         stdout = c.cmd(command, env=env, verbose=verbose, cwd=cwd)
+        cls.invalidate()
         return {'success':True, 'message':f'Launched {module}', 'command': command, 'stdout':stdout}
 
+    @classmethod
+    def launch_many(cls, 
+                    launches:List[dict],
+                    interpreter:str='python3', 
+                    autorestart: bool = True,
+                    meta_fn: str = 'module_fn',
+                    tag_seperator:str = '::',
+                    refresh:bool = True,
+                    verbose:bool = False):
+        """
+        Launches many modules with one pm2 invocation.
+        Each launch is a dict of launch kwargs: module, fn, name, tag, args, kwargs, device, cwd.
+        """
+        filepath = c.filepath()
+        apps = []
+        for launch in launches:
+            module = launch.get('module')
+            if hasattr(module, 'module_path'):
+                module = module.module_path()
+            kwargs = {
+                'module': module,
+                'fn': launch.get('fn', 'serve'),
+                'args': launch.get('args') or [],
+                'kwargs': launch.get('kwargs') or {},
+            }
+            name = cls.resolve_server_name(module=module, name=launch.get('name'), tag=launch.get('tag'), tag_seperator=tag_seperator)
+            app = {'name': name,
+                   'script': filepath,
+                   'interpreter': interpreter,
+                   'autorestart': autorestart,
+                   'cwd': launch.get('cwd') or c.module().dirpath(),
+                   'args': ['--fn', meta_fn, '--kwargs', json.dumps(kwargs).replace('"', "'")],
+                   'env': {}}
+            device = launch.get('device')
+            if isinstance(device, int):
+                app['env']['CUDA_VISIBLE_DEVICES'] = str(device)
+            if isinstance(device, list):
+                app['env']['CUDA_VISIBLE_DEVICES'] = ','.join(list(map(str, device)))
+            apps.append(app)
+        return cls.start_many(apps, refresh=refresh, verbose=verbose)
+
 
 
 
     @classmethod
-    def restart_many(cls, search:str = None, network = None, **kwargs):
-        t1 = c.time()
+    def restart_many(cls, search:str = None, network = None, verbose:bool = False, **kwargs):
         servers = cls.servers(search)
-        futures = [c.submit(c.restart, kwargs={"name": m, **kwargs}) for m in servers]
-        results = []
-        for f in c.as_completed(futures):
-            result = f.result()
-            c.print(result)
-            results.append(result)
-        return results
+        if len(servers) == 0:
+            return []
+        cls.bulk('restart', servers, verbose=verbose)
+        for name in servers:
+            cls.rm_logs(name)
+        cls.invalidate()
+        return [{'success':True, 'message':f'Restarted {name}'} for name in servers]
+
+    @classmethod
+    def test_registry(cls):
+        output = '[PM2] a warning before the list\n' + json.dumps([
+            {'name': 'module::a', 'pid': 10, 'pm_id': 0, 'monit': {'memory': 1024, 'cpu': 1.5},
+             'pm2_env': {'status': 'online', 'restart_time': 2, 'unstable_restarts': 0, 'pm_uptime': 1}},
+            {'name': 'module::b', 'pid': 0, 'pm_id': 1, 'monit': {'memory': 0, 'cpu': 0},
+             'pm2_env': {'status': 'errored', 'restart_time': 15, 'unstable_restarts': 15, 'pm_uptime': 2}},
+        ])
+        registry = cls.parse_jlist(output)
+        assert list(registry.keys()) == ['module::a', 'module::b']
+        assert registry['module::a']['pid'] == 10 and registry['module::a']['memory'] == 1024
+        assert registry['module::b']['status'] == 'errored' and registry['module::b']['restarts'] == 15
+        assert cls.search_match('module::a', 'module') and not cls.search_match('module::a', ['vali'])
+        assert cls.parse_jlist('[PM2] Spawning PM2 daemon with pm2_home=~/.pm2\n[PM2] PM2 Successfully daemonized\n') == {}
+        assert cls.parse_jlist('') == {}
+        return {'success': True, 'msg': 'pm2 registry test passed'}
@@ -1,172 +1,268 @@
 import commune as c
-import multiprocessing as mp
-import os
+import asyncio
+import random
+import threading
 from typing import *
-class Pool(c.Module):
 
-    def __init__(self, module, replicas = 3 , queue_size=1000, args=None, kwargs=None):
-        self.args = args or []
-        self.kwargs = kwargs or {}
-        self.queue = mp.Queue(queue_size=queue_size)
-        self.replicas = []
-        for i in range(replicas):
-            self.add_replica(module, args=self.args, kwargs=self.kwargs)
-        
-
-    def add_replica(self, module:str, args=None, kwargs=None):
-        if args == None:
-            args = self.args
-        if kwargs == None:
-            kwargs = self.kwargs
-        if isinstance(fn, str):
-            fn = c.get_fn(fn)
-        assert callable(fn), f'target must be callable, got {fn}'
-        t = mp.Process(target=fn, args=args, kwargs=kwargs)
-        fn_name = fn.__name__
-
-        t.__dict__['start_time'] = c.time()
-
-        t.daemon = True
-        t.start()
-        if tag == None:
-            tag = ''
+class Pool(c.Module):
+    """
+    A client for every replica of a module: the servers named module or module::tag in the namespace.
+
+    Each replica tracks its in-flight calls and an exponentially weighted moving average (ewma) of its
+    latency. A call goes to the better of two random replicas (p2c, by (in-flight + 1) * ewma),
+    to the replica with the fewest in-flight calls (least), or to a random one (random).
+    A replica that fails max_failures calls in a row (errors or timeouts, not error results) is
+    ejected for cooldown seconds, doubled every time it fails again after coming back, and the
+    call is retried on another replica. Pool.forward and Pool.async_forward are the ones of a client.
+    """
+    strategies = ['p2c', 'least', 'random']
+
+    def __init__(self,
+                 module:str = 'module',
+                 network:str = 'local',
+                 strategy:str = 'p2c',
+                 max_failures:int = 3,
+                 cooldown:float = 10,
+                 max_cooldown:float = 300,
+                 alpha:float = 0.3,
+                 retries:int = 1,
+                 refresh_interval:float = 30,
+                 clients:Dict[str, Any] = None,
+                 loop = None):
+        """
+        clients: the client of each replica by name, instead of the namespace (e.g. for tests)
+        """
+        assert strategy in self.strategies, f'strategy must be one of {self.strategies}'
+        self.set_config(kwargs={k:v for k,v in locals().items() if k not in ['clients', 'loop']})
+        self.module = module
+        self.network = network
+        self.strategy = strategy
+        self.loop = c.get_event_loop() if loop == None else loop
+        self.lock = threading.Lock()
+        self.replicas = {}
+        self.last_refresh = 0
+        self.fixed = clients != None
+        if clients != None:
+            for name, client in clients.items():
+                self.add_replica(name, client=client)
         else:
-            tag = str(tag)
-
-        if name == None:
-            name = fn_name
-        name = name + tag_seperator + tag
-        cnt = 0
-        while name in cls.process_map:
-            cnt += 1
-            name = fn_name + tag_seperator + tag + str(cnt)
-
-
-    def num_replicas(self):
+            self.refresh()
+
+    """
+    ################ REPLICAS ############################
+    """
+
+    def add_replica(self, name:str, address:str = None, client = None) -> dict:
+        with self.lock:
+            if name not in self.replicas:
+                self.replicas[name] = {'name': name,
+                                       'address': address,
+                                       'client': client,
+                                       'inflight': 0,
+                                       'ewma': None,
+                                       'calls': 0,
+                                       'failures': 0,
+                                       'consecutive_failures': 0,
+                                       'ejections': 0,
+                                       'ejected_until': 0}
+        return self.info(name)
+
+    def rm_replica(self, name:str) -> dict:
+        with self.lock:
+            replica = self.replicas.pop(name, None)
+        return {'success': replica != None, 'msg': f'removed {name}', 'n': self.num_replicas()}
+
+    def refresh(self) -> List[str]:
+        """
+        Adds the replicas that are new in the namespace and removes the ones that are gone.
+        """
+        self.last_refresh = c.time()
+        if self.fixed:
+            return list(self.replicas)
+        namespace = c.namespace(search=self.module, network=self.network)
+        namespace = {name: address for name, address in namespace.items() if name == self.module or name.startswith(self.module + '::')}
+        for name, address in namespace.items():
+            if name in self.replicas and self.replicas[name]['address'] != address:
+                self.rm_replica(name)
+            self.add_replica(name, address=address)
+        for name in list(self.replicas):
+            if name not in namespace:
+                self.rm_replica(name)
+        return list(self.replicas)
+
+    def num_replicas(self) -> int:
         return len(self.replicas)
 
-    def pop_replica(self):
-        replica = self.replicas.pop()
-        del replica
-        return {
-            'success':True,
-            'msg':'replica removed',
-            'n':self.num_replicas()
-        }
-
-    @classmethod
-    def getppid(cls):
-        return os.getppid()
-
-    @classmethod
-    def getpid(cls):
-        return os.getpid()
-
-    @classmethod
-    def get_age(cls, name):
-        return c.time() - cls.process_map[name].start_time
-
-    @classmethod
-    def oldest_process_name(cls):
-        oldest_name = None
-        oldest_age = 0
-        assert len(cls.process_map) > 0, 'no processes to join'
-        for name in cls.process_map.keys():
-
-            if cls.get_age(name) > oldest_age:
-                oldest_age = cls.get_age(name)
-                oldest_name = name
-
-        return oldest_name
-
-    @classmethod
-    def oldest_process(cls):
-        oldest_name = cls.oldest_process_name()
-        oldest_process = cls.process_map[oldest_name]
-        return oldest_process
+    def client(self, replica:dict):
+        if replica['client'] == None:
+            replica['client'] = c.connect(replica['address'], network=self.network, virtual=False, loop=self.loop)
+        return replica['client']
+
+    def info(self, name:str) -> dict:
+        return {k: v for k, v in self.replicas[name].items() if k != 'client'}
+
+    def stats(self) -> Dict[str, dict]:
+        with self.lock:
+            return {name: self.info(name) for name in self.replicas}
+
+    """
+    ################ ROUTING ############################
+    """
+
+    def score(self, replica:dict, default_latency:float) -> float:
+        ewma = replica['ewma'] if replica['ewma'] != None else default_latency
+        return (replica['inflight'] + 1) * ewma
+
+    def select(self, exclude:List[str] = None) -> dict:
+        """
+        Picks a replica that is not ejected (or the one that comes back first when all are), and counts the call as in flight.
+        """
+        if not self.fixed and c.time() - self.last_refresh > self.config.refresh_interval:
+            self.refresh()
+        with self.lock:
+            now = c.time()
+            replicas = [r for r in self.replicas.values() if r['name'] not in (exclude or [])]
+            assert len(replicas) > 0, f'no replicas of {self.module}'
+            available = [r for r in replicas if r['ejected_until'] <= now]
+            if len(available) == 0:
+                available = [min(replicas, key=lambda r: r['ejected_until'])]
+            latencies = [r['ewma'] for r in available if r['ewma'] != None]
+            # replicas without calls yet look as fast as the fastest, so they get tried
+            default_latency = min(latencies) if len(latencies) > 0 else 1.0
+            if self.strategy == 'p2c':
+                pair = random.sample(available, min(2, len(available)))
+                replica = min(pair, key=lambda r: self.score(r, default_latency))
+            elif self.strategy == 'least':
+                replica = min(available, key=lambda r: (r['inflight'], self.score(r, default_latency), random.random()))
+            else:
+                replica = random.choice(available)
+            replica['inflight'] += 1
+            return replica
+
+    def record(self, replica:dict, latency:float = None, error:str = None):
+        with self.lock:
+            replica['inflight'] -= 1
+            replica['calls'] += 1
+            if error == None:
+                alpha = self.config.alpha
+                replica['ewma'] = latency if replica['ewma'] == None else alpha * latency + (1 - alpha) * replica['ewma']
+                replica['consecutive_failures'] = 0
+                replica['ejections'] = 0
+                return
+            replica['failures'] += 1
+            replica['consecutive_failures'] += 1
+            replica['last_error'] = error
+            # a replica that comes back after an ejection is ejected again by its first failure
+            if replica['consecutive_failures'] >= self.config.max_failures or replica['ejections'] > 0:
+                cooldown = min(self.config.cooldown * 2 ** replica['ejections'], self.config.max_cooldown)
+                replica['ejections'] += 1
+                replica['ejected_until'] = c.time() + cooldown
+                c.print(f'ejected {replica["name"]} for {cooldown:.1f}s after {replica["consecutive_failures"]} failures: {error}', color='red')
+
+    async def async_forward(self,
+                            fn:str = 'info',
+                            args:list = None,
+                            kwargs:dict = None,
+                            timeout:int = 10,
+                            retries:int = None,
+                            **extra_kwargs):
+        retries = self.config.retries if retries == None else retries
+        tried = []
+        while True:
+            replica = self.select(exclude=tried)
+            tried.append(replica['name'])
+            t0 = c.time()
+            try:
+                result = await asyncio.wait_for(self.client(replica).async_forward(fn=fn, args=args, kwargs=kwargs, timeout=timeout, **extra_kwargs), timeout=timeout)
+            except Exception as e:
+                self.record(replica, error=f'{type(e).__name__}: {e}')
+                if len(tried) > retries or len(tried) >= self.num_replicas():
+                    raise e
+                continue
+            self.record(replica, latency=c.time() - t0)
+            return result
+
+    def forward(self, *args, return_future:bool = False, timeout:int = 10, **kwargs):
+        future = self.async_forward(*args, timeout=timeout, **kwargs)
+        if return_future:
+            return future
+        return self.loop.run_until_complete(future)
+
+    __call__ = forward
+
+    def virtual(self):
+        from commune.client.virtual import VirtualClient
+        return VirtualClient(module=self)
+
+    def __str__(self):
+        return f'Pool({self.module}, replicas={self.num_replicas()}, strategy={self.strategy})'
+
+    def __repr__(self):
+        return self.__str__()
+
+    """
+    ################ TESTS ############################
+    """
 
     @classmethod
-    def oldest_pid(cls):
-        return cls.oldest_process().pid
-
-    @classmethod
-    def n(cls):
-        return len(cls.process_map)
-
-
-    def join(cls):
-        processs = list(cls.process_map.keys())
-        for p_name in processs:
-            cls.stop(p_name)
-        return {'success':True, 'msg':'processes stopped', 'n':cls.n()}
-
-    stop_all = join
+    def test(cls):
+        clients = {f'test::{i}': LocalReplica(latency=0.001) for i in range(3)}
+        clients['test::3'] = LocalReplica(latency=0.001, fail=True)
+        self = cls('test', clients=clients, max_failures=2, cooldown=60, retries=3)
+        results = [self.forward('echo', args=[i]) for i in range(100)]
+        assert results == list(range(100)), results
+        stats = self.stats()
+        # the failing replica is ejected after 2 failures, and its calls were retried
+        assert stats['test::3']['failures'] == 2 and stats['test::3']['ejected_until'] > c.time(), stats['test::3']
+        assert all(s['inflight'] == 0 for s in stats.values())
+        assert self.virtual().echo(7) == 7
+        return {'success': True, 'msg': 'pool test passed', 'stats': stats}
 
     @classmethod
-    def stop(cls, name=None):
-        if name == None:
-            name = cls.oldest_process_name()
-        assert name in cls.process_map, f'process {name} not found'
-        p = cls.process_map.pop(name)
-        p.join()
-        assert p.is_alive() == False, f'process {name} is still alive'
-        return {'success':True, 'name':name, 'msg':'process removed', 'n':cls.n()}
-
-    @classmethod
-    def remove_oldest(cls):
-        name = cls.oldest_process_name()
-        return cls.remove(name)
-
-    @classmethod
-    def fleet(cls, fn:str, n=10,  tag:str=None,  args:list = None, kwargs:dict=None):
-        args = args or []
-        kwargs = kwargs or {}
-        processs = []
-        if tag == None:
-            tag = ''
-        for i in range(n):
-            t = cls.process(fn=fn, tag=tag+str(i), *args, **kwargs)
-        return cls.process_map
-
-
-    @classmethod
-    def processes(cls, *args, **kwargs):
-        return list(cls.process_map(*args, **kwargs).keys())
-
-    @classmethod
-    def fn(cls):
-        return 1
-    
-
-    @classmethod
-    def test(cls, n=10):
-
-
-        for i in range(n):
-            cls.start(fn=cls.fn, tag='test', start=True)
-            c.print('Started process', i+1, 'of', n, 'processes')
-            assert cls.n() == i+1, 'process not added'
-        
-        for i in range(n):
-            cls.stop()
-            c.print('Stopped process', i+1, 'of', n, 'processes')
-            assert cls.n() == n-i-1, 'process not removed'
-        assert cls.n() == 0, 'process not removed'  
-
-        return {'success':True, 'msg':'processes started and stopped'}      
-
-    @classmethod
-    def semaphore(cls, n:int = 100):
-        semaphore = mp.Semaphore(n)
-        return semaphore
-
-
-        
-
-    def __delete__(self):
-        self.join()
-        return {'success':True, 'msg':'processes stopped'}
-    
-
-    
-
+    def test_benchmark(cls,
+                       replicas:int = 4,
+                       latency:float = 0.005,
+                       slow_latency:float = 0.1,
+                       calls:int = 2000,
+                       concurrency:int = 16,
+                       strategies:List[str] = strategies) -> dict:
+        """
+        Calls replicas of which one is slow_latency slow, concurrency calls at a time, with every strategy.
+        """
+        stats = {}
+        for strategy in strategies:
+            clients = {f'bench::{i}': LocalReplica(latency=latency) for i in range(replicas - 1)}
+            clients[f'bench::{replicas - 1}'] = LocalReplica(latency=slow_latency)
+            self = cls('bench', clients=clients, strategy=strategy)
+            latencies = []
+            async def worker(n):
+                for i in range(n):
+                    t0 = c.time()
+                    await self.async_forward('echo', args=[i])
+                    latencies.append(c.time() - t0)
+            async def run():
+                await asyncio.gather(*[worker(calls // concurrency) for _ in range(concurrency)])
+            t0 = c.time()
+            self.loop.run_until_complete(run())
+            seconds = c.time() - t0
+            latencies.sort()
+            stats[strategy] = {'calls_per_second': len(latencies) / seconds,
+                               'p50_ms': latencies[len(latencies) // 2] * 1000,
+                               'p99_ms': latencies[int(len(latencies) * 0.99)] * 1000,
+                               'slow_replica_share': self.replicas[f'bench::{replicas - 1}']['calls'] / len(latencies)}
+        return stats
+
+
+class LocalReplica:
+    """
+    An in-process stand-in for the client of a replica, with a fixed latency, for tests and benchmarks.
+    """
+    def __init__(self, latency:float = 0.001, fail:bool = False):
+        self.latency = latency
+        self.fail = fail
+
+    async def async_forward(self, fn:str, args:list = None, kwargs:dict = None, timeout:int = 10, **extra_kwargs):
+        await asyncio.sleep(self.latency)
+        if self.fail:
+            raise ConnectionError('replica is down')
+        return (args or [None])[0]
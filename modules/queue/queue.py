@@ -1,74 +1,251 @@
-
+import os
+import time
+import heapq
+import pickle
+import socket
 import asyncio
+import itertools
+import threading
+from typing import *
 import commune as c
 
+
 class QueueServer(c.Module):
-    def __init__(self, max_size=1000, mode = 'asyncio', **kwargs):
+    """
+    Named work queues for local modules (validators, workers).
+
+    Every queue is a priority queue (lower priorities come out first, FIFO within a priority)
+    with delayed messages that only become visible after delay seconds. put and get take whole
+    batches, and get blocks up to timeout seconds until a message is ready.
+
+    In one process the queues are called directly. serve() exposes them to other processes on a
+    unix socket with an asyncio server: every request is one length prefixed pickle frame, and a
+    blocked get waits on the event loop without holding a thread. QueueServer.client(path)
+    returns a QueueClient with the same put/get interface.
+    """
+
+    def __init__(self, max_size:int = 1000, path:str = None, serve:bool = False, **kwargs):
         self.queues = {}
         self.max_size = max_size
-        self.mode = mode
+        self.path = path
+        self.server_loop = None
+        self.handlers = set()
+        if serve:
+            self.serve(path=path)
 
     def queue_exists(self, key:str):
         return bool(key in self.queues)
-        
-    def add_queue(self, key:str, 
-                  refresh:bool=False, 
-                  max_size:int=None, 
-                  mode:str=None, **kwargs):
-        if mode == None:
-            mode = self.mode
-        if max_size == None:
-            max_size = self.max_size
-        
+
+    def add_queue(self, key:str,
+                  refresh:bool=False,
+                  max_size:int=None, **kwargs) -> 'MessageQueue':
+        if key in self.queues and not refresh:
+            return self.queues[key]
         max_size = self.max_size if max_size is None else max_size
+        self.queues[key] = MessageQueue(max_size=max_size)
+        return self.queues[key]
+
+    def rm_queue(self, key:str):
+        self.queues.pop(key, None)
+        return {'success': True, 'msg': f'removed queue {key}'}
 
-        if mode == 'asyncio':
-            self.queues[key] = asyncio.Queue(max_size,**kwargs)
-        else:
-            raise NotImplemented
-            
+    def queue(self, key:str) -> 'MessageQueue':
+        if key not in self.queues:
+            self.add_queue(key)
         return self.queues[key]
 
+    def put(self, key:str, value:Any, priority:int = 0, delay:float = 0, timeout:float = None) -> bool:
+        """
+        Puts one message, waiting up to timeout seconds (forever if None) while the queue is full.
+        """
+        return self.put_batch(key, [value], priority=priority, delay=delay, timeout=timeout) == 1
+
+    def put_batch(self, key:str, values:list, priority:int = 0, delay:float = 0, timeout:float = None) -> int:
+        """
+        Puts the messages in order, and returns how many fit before the timeout.
+        """
+        return self.queue(key).put(values, priority=priority, delay=delay, timeout=timeout)
 
-    def get(self, key:str, sync=False, **kwargs):
-        q = self.queues[key]
-        job = q.get(**kwargs)
-        return c.gather(job)
-    
-    def put(self, key, value, sync=False, **kwargs):
-        q = self.queues[key]
-        job = q.put(value, **kwargs)
-        if future:
-            return job
-        return  c.gather(job)
-
-
-    def get_batch(self, key, batch_size=10, sync=False, **kwargs):
-        q = self.queues[key]
-        batch_size = min(batch_size, q.qsize())
-        jobs = [self.get(key, sync=False) for i in range(batch_size)]
-        job = asyncio.gather(*jobs)
-        if sync:
-            return self.async_run(job)
-        return job
+    def get(self, key:str, timeout:float = None, default:Any = None) -> Any:
+        """
+        The next ready message, waiting up to timeout seconds (forever if None), or default.
+        """
+        items = self.get_batch(key, batch_size=1, timeout=timeout)
+        return items[0] if len(items) > 0 else default
+
+    def get_batch(self, key:str, batch_size:int = 10, timeout:float = 0) -> list:
+        """
+        Up to batch_size ready messages, waiting up to timeout seconds for the first one.
+        """
+        return self.queue(key).get(batch_size, timeout=timeout)
 
     def size(self, key):
-        # The size of the queue
-        return self.queues[key].qsize()
+        # The size of the queue, including the delayed messages
+        return self.queue(key).qsize()
 
     def empty(self, key):
         # Whether the queue is empty.
-        return self.queues[key].empty()
+        return self.size(key) == 0
 
     def full(self, key):
         # Whether the queue is full.
-        return self.queues[key].full()
+        return self.queue(key).free() <= 0
 
     def size_map(self):
         return {k: self.size(k) for k in self.queues}
 
+    """
+    ################ TRANSPORT ############################
+    """
+
+    @classmethod
+    def resolve_socket_path(cls, path:str = None) -> str:
+        return cls.resolve_path(path or 'queue.sock')
+
+    def serve(self, path:str = None, timeout:float = 10) -> dict:
+        """
+        Serves the queues on a unix socket from an event loop in a background thread.
+        The socket takes pickle frames, so it is bound in a private directory and only moved
+        to path once it is readable by its owner alone.
+        """
+        import tempfile
+        if self.server_loop != None:
+            return {'success': True, 'msg': f'already serving on {self.path}', 'path': self.path}
+        self.path = self.resolve_socket_path(path)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        started = threading.Event()
+        errors = []
+        def run():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            try:
+                private_dir = tempfile.mkdtemp(dir=os.path.dirname(self.path))
+                private_path = os.path.join(private_dir, 'queue.sock')
+                try:
+                    self.server = loop.run_until_complete(asyncio.start_unix_server(self.handle, path=private_path))
+                    os.chmod(private_path, 0o600)
+                    os.replace(private_path, self.path)
+                finally:
+                    if os.path.exists(private_path):
+                        os.remove(private_path)
+                    os.rmdir(private_dir)
+            except Exception as e:
+                errors.append(e)
+                loop.close()
+                started.set()
+                return
+            self.server_loop = loop
+            started.set()
+            loop.run_forever()
+            loop.close()
+        self.server_thread = threading.Thread(target=run, daemon=True, name='queue_server')
+        self.server_thread.start()
+        if not started.wait(timeout):
+            raise TimeoutError(f'the queue server did not start on {self.path} in {timeout}s')
+        if len(errors) > 0:
+            raise errors[0]
+        return {'success': True, 'msg': f'serving queues on {self.path}', 'path': self.path}
+
+    def stop(self) -> dict:
+        if self.server_loop == None:
+            return {'success': False, 'msg': 'not serving'}
+        async def close():
+            self.server.close()
+            for task in list(self.handlers):
+                task.cancel()
+            await asyncio.gather(*self.handlers, return_exceptions=True)
+            self.server_loop.stop()
+        asyncio.run_coroutine_threadsafe(close(), self.server_loop)
+        self.server_thread.join(timeout=1)
+        self.server_loop = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        return {'success': True, 'msg': f'stopped serving on {self.path}'}
+
+    async def handle(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self.handlers.add(task)
+        try:
+            while True:
+                size = int.from_bytes(await reader.readexactly(4), 'little')
+                request = pickle.loads(await reader.readexactly(size))
+                try:
+                    response = {'result': await self.async_call(request['fn'], **request['kwargs'])}
+                except Exception as e:
+                    response = {'error': f'{type(e).__name__}: {e}'}
+                data = pickle.dumps(response, protocol=pickle.HIGHEST_PROTOCOL)
+                writer.write(len(data).to_bytes(4, 'little') + data)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self.handlers.discard(task)
+            writer.close()
+
+    async def async_call(self, fn:str, key:str = None, timeout:float = None, **kwargs) -> Any:
+        """
+        Runs a request on the event loop. A put or get that has to wait is woken up by the
+        queue (or by its next delayed message) instead of blocking a thread.
+        """
+        if fn not in ['put', 'put_batch', 'get', 'get_batch']:
+            assert fn in ['size', 'empty', 'full', 'size_map', 'queue_exists', 'add_queue', 'rm_queue'], f'fn {fn} not allowed'
+            if fn == 'add_queue':
+                self.add_queue(key, **kwargs)
+                return True
+            return getattr(self, fn)(**({'key': key, **kwargs} if key != None else kwargs))
+
+        q = self.queue(key)
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        listener = lambda: loop.call_soon_threadsafe(event.set)
+        deadline = None if timeout == None else time.time() + timeout
+        if fn in ['put', 'put_batch']:
+            values = [kwargs.pop('value')] if fn == 'put' else kwargs.pop('values')
+        num_put = 0
+        q.listeners.add(listener)
+        try:
+            while True:
+                event.clear()
+                if fn in ['put', 'put_batch']:
+                    num_put += q.put(values[num_put:], timeout=0, **kwargs)
+                    if num_put == len(values):
+                        break
+                    wait = None
+                else:
+                    items, wait = q.get_nowait(kwargs.get('batch_size', 1))
+                    if len(items) > 0:
+                        break
+                remaining = None if deadline == None else deadline - time.time()
+                if remaining != None and remaining <= 0:
+                    break
+                waits = [w for w in [remaining, wait] if w != None]
+                try:
+                    await asyncio.wait_for(event.wait(), timeout=min(waits) if len(waits) > 0 else None)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            q.listeners.discard(listener)
+
+        if fn == 'put':
+            return num_put == 1
+        elif fn == 'put_batch':
+            return num_put
+        elif fn == 'get':
+            return items[0] if len(items) > 0 else kwargs.get('default')
+        return items
+
+    @classmethod
+    def client(cls, path:str = None) -> 'QueueClient':
+        return QueueClient(path=path)
+
+    """
+    ################ TESTS ############################
+    """
 
     def test(self):
+        self = QueueServer()
         for i in range(100):
             self.add_queue(i)
             for j in range(100):
@@ -81,4 +258,214 @@ class QueueServer(c.Module):
                 assert self.size(i) == size - j -1, f'{self.size(i)} != {size - j -1}'
 
         return  {'success': True, 'message': 'QueueServer test passed'}
-            
\ No newline at end of file
+
+    def test_priority_delay(self, path:str = None):
+        self = QueueServer(max_size=0)
+        self.serve(path=path or self.resolve_socket_path('test_queue.sock'))
+        assert os.stat(self.path).st_mode & 0o777 == 0o600, 'the socket is readable by others'
+        client = self.client(self.path)
+        for q in [self, client]:
+            q.put_batch('jobs', ['low_1', 'low_2'], priority=1)
+            q.put('jobs', 'high', priority=0)
+            q.put('jobs', 'later', priority=-1, delay=0.2)
+            assert q.get_batch('jobs', batch_size=10) == ['high', 'low_1', 'low_2'], 'wrong priority order'
+            assert q.get('jobs', timeout=0) == None, 'a delayed message came out early'
+            t0 = c.time()
+            assert q.get('jobs', timeout=1) == 'later'
+            assert 0.1 < c.time() - t0 < 0.5, 'the delayed message was not released on time'
+            assert q.get('jobs', timeout=0.05, default='none') == 'none'
+        # a blocked get over the socket wakes up on a put
+        c.thread(lambda: (c.sleep(0.1), self.put('wake', 'up')))
+        assert client.get('wake', timeout=1) == 'up'
+        client.close()
+        self.stop()
+        # a socket that cannot be bound raises instead of hanging serve
+        long_dir = os.path.join(os.path.dirname(self.path), 'd' * 110)
+        try:
+            QueueServer().serve(path=os.path.join(long_dir, 'test_queue.sock'))
+            raise AssertionError('serving on a path that is too long did not raise')
+        except OSError:
+            pass
+        os.rmdir(long_dir)
+        return {'success': True, 'msg': 'priority and delay test passed'}
+
+    @classmethod
+    def produce(cls, path:str, key:str, n:int, batch_size:int):
+        client = cls.client(path)
+        for i in range(0, n, batch_size):
+            client.put_batch(key, list(range(i, min(i + batch_size, n))))
+        client.close()
+
+    def test_benchmark(self, n:int = 200000, batch_size:int = 1000, path:str = None):
+        """
+        Messages per second in one process and between two processes over the socket.
+        """
+        import multiprocessing
+        self = QueueServer(max_size=n)
+        results = {}
+        t0 = c.time()
+        for i in range(0, n, batch_size):
+            self.put_batch('bench', list(range(i, i + batch_size)))
+        received = 0
+        while received < n:
+            received += len(self.get_batch('bench', batch_size=batch_size))
+        results['local_messages_per_second'] = n / (c.time() - t0)
+
+        self.serve(path=path or self.resolve_socket_path('bench_queue.sock'))
+        consumer = self.client(self.path)
+        t0 = c.time()
+        producer = multiprocessing.get_context('fork').Process(target=self.produce, args=(self.path, 'bench', n, batch_size))
+        producer.start()
+        received = []
+        while len(received) < n:
+            received += consumer.get_batch('bench', batch_size=batch_size, timeout=5)
+        producer.join()
+        results['socket_messages_per_second'] = n / (c.time() - t0)
+        assert received == list(range(n)), 'messages were lost or reordered'
+        consumer.close()
+        self.stop()
+        return {'success': True, 'n': n, 'batch_size': batch_size, **results}
+
+
+class QueueClient:
+    """
+    Talks to a QueueServer socket from another process, with the same put/get methods.
+    """
+
+    def __init__(self, path:str = None):
+        self.path = QueueServer.resolve_socket_path(path)
+        self.lock = threading.Lock()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+    def call(self, fn:str, **kwargs) -> Any:
+        data = pickle.dumps({'fn': fn, 'kwargs': kwargs}, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self.sock.sendall(len(data).to_bytes(4, 'little') + data)
+            size = int.from_bytes(self.recv(4), 'little')
+            response = pickle.loads(self.recv(size))
+        if 'error' in response:
+            raise Exception(response['error'])
+        return response['result']
+
+    def recv(self, size:int) -> bytes:
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        while size > 0:
+            n = self.sock.recv_into(view[-size:], size)
+            if n == 0:
+                raise ConnectionError(f'queue server at {self.path} closed the connection')
+            size -= n
+        return bytes(buffer)
+
+    def put(self, key:str, value:Any, priority:int = 0, delay:float = 0, timeout:float = None) -> bool:
+        return self.call('put', key=key, value=value, priority=priority, delay=delay, timeout=timeout)
+
+    def put_batch(self, key:str, values:list, priority:int = 0, delay:float = 0, timeout:float = None) -> int:
+        return self.call('put_batch', key=key, values=values, priority=priority, delay=delay, timeout=timeout)
+
+    def get(self, key:str, timeout:float = None, default:Any = None) -> Any:
+        return self.call('get', key=key, timeout=timeout, default=default)
+
+    def get_batch(self, key:str, batch_size:int = 10, timeout:float = 0) -> list:
+        return self.call('get_batch', key=key, batch_size=batch_size, timeout=timeout)
+
+    def add_queue(self, key:str, refresh:bool = False, max_size:int = None):
+        return self.call('add_queue', key=key, refresh=refresh, max_size=max_size)
+
+    def size(self, key:str) -> int:
+        return self.call('size', key=key)
+
+    def size_map(self) -> dict:
+        return self.call('size_map')
+
+    def close(self):
+        self.sock.close()
+
+
+class MessageQueue:
+    """
+    A thread safe priority queue with delayed messages. Ready messages sit in a heap of
+    (priority, seq, value) and delayed ones in a heap of (ready time, seq, priority, value)
+    until they are due. max_size <= 0 means unbounded.
+    """
+
+    def __init__(self, max_size:int = 1000):
+        self.max_size = max_size
+        self.ready = []
+        self.delayed = []
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+        # called after every change, e.g. to wake up waiters on an event loop
+        self.listeners = set()
+
+    def qsize(self) -> int:
+        return len(self.ready) + len(self.delayed)
+
+    def free(self) -> int:
+        return self.max_size - self.qsize() if self.max_size > 0 else float('inf')
+
+    def notify(self):
+        self.cond.notify_all()
+        for listener in list(self.listeners):
+            listener()
+
+    def release(self) -> Optional[float]:
+        """
+        Moves the due delayed messages to the ready heap, and returns the seconds until the next one.
+        """
+        now = time.time()
+        while len(self.delayed) > 0 and self.delayed[0][0] <= now:
+            _, seq, priority, value = heapq.heappop(self.delayed)
+            heapq.heappush(self.ready, (priority, seq, value))
+        return self.delayed[0][0] - now if len(self.delayed) > 0 else None
+
+    def put_nowait(self, values:list, priority:int = 0, delay:float = 0) -> int:
+        with self.cond:
+            n = int(min(len(values), self.free()))
+            if n == 0:
+                return 0
+            seq = self.seq
+            if delay > 0:
+                ready_time = time.time() + delay
+                for value in values[:n]:
+                    heapq.heappush(self.delayed, (ready_time, next(seq), priority, value))
+            else:
+                for value in values[:n]:
+                    heapq.heappush(self.ready, (priority, next(seq), value))
+            self.notify()
+            return n
+
+    def get_nowait(self, batch_size:int = 1) -> Tuple[list, Optional[float]]:
+        """
+        Up to batch_size ready messages, and the seconds until the next delayed message.
+        """
+        with self.cond:
+            wait = self.release()
+            n = min(batch_size, len(self.ready))
+            items = [heapq.heappop(self.ready)[-1] for _ in range(n)]
+            if n > 0:
+                self.notify()
+            return items, wait
+
+    def put(self, values:list, priority:int = 0, delay:float = 0, timeout:float = None) -> int:
+        deadline = None if timeout == None else time.time() + timeout
+        num_put = 0
+        with self.cond:
+            while True:
+                num_put += self.put_nowait(values[num_put:], priority=priority, delay=delay)
+                remaining = None if deadline == None else deadline - time.time()
+                if num_put == len(values) or (remaining != None and remaining <= 0):
+                    return num_put
+                self.cond.wait(remaining)
+
+    def get(self, batch_size:int = 1, timeout:float = None) -> list:
+        deadline = None if timeout == None else time.time() + timeout
+        with self.cond:
+            while True:
+                items, wait = self.get_nowait(batch_size)
+                remaining = None if deadline == None else deadline - time.time()
+                if len(items) > 0 or (remaining != None and remaining <= 0):
+                    return items
+                waits = [w for w in [remaining, wait] if w != None]
+                self.cond.wait(min(waits) if len(waits) > 0 else None)
@@ -1,112 +1,331 @@
+import os
+import json
+import threading
 import commune as c
+import numpy as np
 import torch
+from typing import *
 
 class VectorStore(c.Module):
-    def __init__(self, 
+    """
+    A vector index over a preallocated matrix that grows by doubling.
+
+    Rows [0, size) hold the vectors, a delete moves the last row into the hole so the matrix stays dense.
+    Search is an exact top-k (one matrix multiply + argpartition), or an inverted file (IVF) search
+    once train_index has clustered the vectors into nlist lists, which only scores the rows of the
+    nprobe lists closest to the query. With a path, the matrix is a memory-mapped file and save()
+    persists the keys and the IVF next to it.
+    """
+    def __init__(self,
                     config = None,
                     **kwargs
                  ):
-        self.set_config(config=config, kwargs=kwargs)
+        config = self.set_config(config=config, kwargs=kwargs)
+        self.lock = threading.RLock()
+        self.model = None
+        self.dim = config.dim
         self.k2index = {}
-        self.index2k = {}
-        self.vectors = []
+        self.index2k = []
+        self.size = 0
+        self.vectors = None
+        self.centroids = None # [nlist, dim] once the IVF is trained
+        self.assignments = None # [capacity] list of every row
+        self.lists = None # (rows grouped by list, list offsets), see inverted_lists
         self.example_vector = None
-        config = self.set_config(config)
-        self.set_model(config.model)
-        
-        
+        self.dirpath = self.resolve_path(config.path) if config.path != None else None
+        if self.dirpath != None and os.path.exists(os.path.join(self.dirpath, 'meta.json')):
+            self.load()
 
     def set_model(self, model='model'):
         self.model = c.connect(model)
-        
-        
-        
+
     def encode(self, text:str, **kwargs):
-        return self.model.encode(text, **kwargs)
-    
+        return self.resolve_model().encode(text, **kwargs)
 
-    def resolve_vector(self, v:torch.Tensor):
-        
-        if isinstance(v, list):
-            v = torch.tensor(v)
-        elif isinstance(v, np.ndarray):
-            v = torch.from_numpy(v)
-            
-        assert isinstance(v, torch.Tensor), f'Expected a torch.Tensor, got {type(v)}'
-        if self.example_vector == None:
-            self.example_vector = v
-        assert self.example_vector.shape == v.shape, f'Expected a vector of shape {self.example_vector.shape}, got {v.shape}'
-        
-        return v
-    
-    @classmethod
     def resolve_model(self, model=None):
         if model == None:
+            if self.model == None:
+                self.set_model(self.config.model)
             model = self.model
         elif isinstance(model, str):
             model = c.connect(model)
-            
         return model
-        
 
-    def embed(self, text:str, model=None, **kwargs):
+    def embed(self, text:Union[str, List[str]], model=None, **kwargs):
+        # send the whole list in one call, the embedding server batches and caches it
         model = self.resolve_model(model)
-        vectors = self.model.embed(text, **kwargs)
-    
-    def add_vector(self, k, v , verbose=True):
-    
+        return model.embed(text, **kwargs)
 
-        v = self.resolve_vector(v)
-        stacked_vectors = []
-        if len(self.vectors) == 0:
-            stacked_vectors = [v]
+    def add_texts(self, texts:Dict[str, str], model=None, **kwargs) -> dict:
+        """ Embeds {key: text} in one call and adds the vectors. """
+        keys = list(texts.keys())
+        vectors = self.embed([texts[k] for k in keys], model=model, **kwargs)
+        return self.add_vectors(keys, vectors)
+
+    """
+    ################ MATRIX ############################
+    """
+
+    def resolve_vectors(self, v:Union[list, np.ndarray, torch.Tensor]) -> np.ndarray:
+        if isinstance(v, torch.Tensor):
+            v = v.detach().cpu().numpy()
+        v = np.asarray(v, dtype=np.float32)
+        if v.ndim == 1:
+            v = v[None, :]
+        if self.dim == None:
+            self.dim = v.shape[1]
+        assert v.shape[1] == self.dim, f'Expected vectors of dimension {self.dim}, got {v.shape[1]}'
+        if self.config.metric == 'cosine':
+            v = v / np.maximum(np.linalg.norm(v, axis=1, keepdims=True), 1e-12)
+        return v
+
+    def resolve_vector(self, v:torch.Tensor):
+        v = self.resolve_vectors(v)[0]
+        if self.example_vector is None:
+            self.example_vector = v
+        return v
+
+    @property
+    def capacity(self) -> int:
+        return 0 if self.vectors is None else self.vectors.shape[0]
+
+    @property
+    def vectors_path(self) -> str:
+        return os.path.join(self.dirpath, 'vectors.f32')
+
+    def allocate(self, capacity:int):
+        """
+        Grows the matrix to capacity rows, in memory or by extending the memory-mapped file.
+        """
+        if self.dirpath != None:
+            os.makedirs(self.dirpath, exist_ok=True)
+            if self.vectors is not None:
+                self.vectors.flush()
+            with open(self.vectors_path, 'ab') as f:
+                f.truncate(capacity * self.dim * 4)
+            self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r+', shape=(capacity, self.dim))
         else:
-            stacked_vectors = [self.vectors, v]
-        
-        self.vectors = torch.stack(stacked_vectors)
-        idx = len(self.vectors) - 1
+            vectors = np.empty((capacity, self.dim), dtype=np.float32)
+            if self.size > 0:
+                vectors[:self.size] = self.vectors[:self.size]
+            self.vectors = vectors
+        assignments = np.full(capacity, -1, dtype=np.int32)
+        if self.assignments is not None:
+            assignments[:self.size] = self.assignments[:self.size]
+        self.assignments = assignments
+
+    def reserve(self, n:int):
+        if self.size + n > self.capacity:
+            # doubling keeps inserts amortized O(1)
+            self.allocate(max(self.size + n, 2 * self.capacity, self.config.capacity))
+
+    def add_vectors(self, keys:List[str], vectors:Union[list, np.ndarray, torch.Tensor]) -> dict:
+        """
+        Inserts (or overwrites) a batch of vectors.
+        """
+        vectors = self.resolve_vectors(vectors)
+        assert len(keys) == len(vectors), f'{len(keys)} keys for {len(vectors)} vectors'
+        with self.lock:
+            # the last vector of a key that repeats within the batch wins
+            key2row = {k: i for i, k in enumerate(keys)}
+            existing = [k for k in key2row if k in self.k2index]
+            if len(existing) > 0:
+                rows = np.array([self.k2index[k] for k in existing])
+                self.vectors[rows] = vectors[[key2row[k] for k in existing]]
+                self.assign(rows)
+            new = [k for k in key2row if k not in self.k2index]
+            self.reserve(len(new))
+            start = self.size
+            self.vectors[start:start + len(new)] = vectors[[key2row[k] for k in new]]
+            for i, k in enumerate(new):
+                self.k2index[k] = start + i
+            self.index2k.extend(new)
+            self.size += len(new)
+            self.assign(np.arange(start, self.size))
+        return {'added': len(new), 'updated': len(existing), 'size': self.size}
+
+    def add_vector(self, k, v , verbose=False):
+        v = self.resolve_vector(v)
+        response = self.add_vectors([k], v[None, :])
         if verbose:
-            c.print(f'Adding vector {k} at index {idx}, {self.vectors}')
-        self.k2index[k] = idx
-        self.index2k[idx] = k
-        
+            c.print(f'Adding vector {k} at index {self.k2index[k]}')
+        return response
+
+    def rm_vectors(self, keys:List[str]) -> dict:
+        """
+        Removes a batch of keys, filling every hole with the current last row.
+        """
+        removed = 0
+        with self.lock:
+            self.lists = None
+            for k in keys:
+                if k not in self.k2index:
+                    continue
+                idx = self.k2index.pop(k)
+                last_idx = self.size - 1
+                if idx != last_idx:
+                    last_k = self.index2k[last_idx]
+                    self.vectors[idx] = self.vectors[last_idx]
+                    self.assignments[idx] = self.assignments[last_idx]
+                    self.k2index[last_k] = idx
+                    self.index2k[idx] = last_k
+                self.index2k.pop()
+                self.size -= 1
+                removed += 1
+        return {'removed': removed, 'size': self.size}
+
     def rm_vector(self, k):
-        last_idx = len(self.vectors) - 1
-        print(f'last_idx: {last_idx}')
-        # swap the vector to be removed with the last vector
-        idx = self.k2index[k]
-        last_k = self.index2k[last_idx]
-        last_v = self.vectors[last_idx]
-        self.vectors[idx] = last_v
-        self.k2index[last_k] = idx
-        self.index2k[idx] = last_k
-        # remove the last vector
-        del self.index2k[last_idx]
-        del self.k2index[last_k]
-        
-        self.vectors = self.vectors[:-1]
-
-
-
-
-    def search(self, query, top_k=10, chunks=1):
-        assert len(self.vectors) > 0, 'No vectors stored in the vector store'
-        c.print(f'query: {query}', 'vector shape:', self.vectors.shape)
-        query_vector = torch.tensor(query) 
-        if len(query_vector.shape) == 1:
-            query_vector = query_vector.unsqueeze(0)
-        # Convert the query into a tensor (assuming it's a vector representation)
-        print(query_vector.shape, self.vectors.shape)
-        similarities = torch.einsum('ij,kj->i', query_vector, self.vectors)  # Compute the similarity scores between the query and stored vectors
-        indices = similarities.argsort(descending=True)[:top_k]  # Sort the similarity scores and retrieve the indices of the top-k results
-        results = {}  # Create an empty dictionary to store the results
-        indices = indices.tolist()  # Convert the indices tensor to a list
-        for idx in indices:
-            key = self.index2k[idx]  # Retrieve the key corresponding to the index
-            score = similarities[idx].item()  # Retrieve the similarity score for the corresponding index
-            results[key] = score  # Store the key-score pair in the results dictionary
-        return results  # Return the dictionary of results
+        return self.rm_vectors([k])
+
+    def __len__(self):
+        return self.size
+
+    """
+    ################ SEARCH ############################
+    """
+
+    @staticmethod
+    def topk_rows(scores:np.ndarray, top_k:int) -> np.ndarray:
+        """ The columns of the top_k scores of every row, best first, without sorting the whole row. """
+        top_k = min(top_k, scores.shape[1])
+        idx = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+        order = np.argsort(-np.take_along_axis(scores, idx, axis=1), axis=1)
+        return np.take_along_axis(idx, order, axis=1)
+
+    def search_exact(self, queries:np.ndarray, top_k:int = 10, chunk_size:int = 64) -> Tuple[np.ndarray, np.ndarray]:
+        matrix = self.vectors[:self.size]
+        rows, scores = [], []
+        for i in range(0, len(queries), chunk_size):
+            chunk_scores = queries[i:i + chunk_size] @ matrix.T # [chunk, size]
+            idx = self.topk_rows(chunk_scores, top_k)
+            rows.append(idx)
+            scores.append(np.take_along_axis(chunk_scores, idx, axis=1))
+        return np.concatenate(rows), np.concatenate(scores)
+
+    def search_ivf(self, queries:np.ndarray, top_k:int = 10, nprobe:int = None) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+        nprobe = min(nprobe or self.config.nprobe, len(self.centroids))
+        probes = self.topk_rows(queries @ self.centroids.T, nprobe) # [num_queries, nprobe]
+        order, offsets = self.inverted_lists()
+        rows, scores = [], []
+        for query, query_probes in zip(queries, probes):
+            candidates = np.concatenate([order[offsets[l]:offsets[l + 1]] for l in query_probes])
+            if len(candidates) == 0:
+                rows.append(np.zeros(0, dtype=np.int64))
+                scores.append(np.zeros(0, dtype=np.float32))
+                continue
+            candidate_scores = (self.vectors[candidates] @ query)[None, :]
+            idx = self.topk_rows(candidate_scores, top_k)[0]
+            rows.append(candidates[idx])
+            scores.append(candidate_scores[0, idx])
+        return rows, scores
+
+    def search_batch(self, queries, top_k:int = 10, nprobe:int = None, exact:bool = None) -> List[Dict[str, float]]:
+        """
+        The top_k {key: score} of every query, with the IVF if it is trained (unless exact).
+        """
+        assert self.size > 0, 'No vectors stored in the vector store'
+        queries = self.resolve_vectors(queries)
+        with self.lock:
+            exact = self.centroids is None if exact == None else exact
+            if exact:
+                rows, scores = self.search_exact(queries, top_k=top_k)
+            else:
+                rows, scores = self.search_ivf(queries, top_k=top_k, nprobe=nprobe)
+            return [{self.index2k[r]: float(s) for r, s in zip(query_rows, query_scores)}
+                    for query_rows, query_scores in zip(rows, scores)]
+
+    def search(self, query, top_k=10, chunks=1, **kwargs):
+        if isinstance(query, str):
+            query = self.embed(query)
+        return self.search_batch([query] if np.ndim(query) == 1 else query, top_k=top_k, **kwargs)[0]
+
+    """
+    ################ IVF ############################
+    """
+
+    def inverted_lists(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The rows grouped by list (order) and where every list starts (offsets), rebuilt after the rows changed.
+        """
+        if self.lists is None:
+            order = np.argsort(self.assignments[:self.size], kind='stable')
+            offsets = np.searchsorted(self.assignments[:self.size][order], np.arange(len(self.centroids) + 1))
+            self.lists = (order, offsets)
+        return self.lists
+
+    def assign(self, rows:np.ndarray, chunk_size:int = 65536):
+        self.lists = None
+        if self.centroids is None or len(rows) == 0:
+            return
+        for i in range(0, len(rows), chunk_size):
+            chunk = rows[i:i + chunk_size]
+            self.assignments[chunk] = np.argmax(self.vectors[chunk] @ self.centroids.T, axis=1)
 
+    def train_index(self, nlist:int = None, iterations:int = 10, sample_per_list:int = 64, seed:int = 0) -> dict:
+        """
+        Clusters a sample of the vectors into nlist lists (k-means on the search metric) and assigns every row.
+        """
+        nlist = nlist or self.config.nlist or max(int(4 * np.sqrt(self.size)), 1)
+        assert self.size >= nlist, f'need at least {nlist} vectors to train {nlist} lists'
+        rng = np.random.default_rng(seed)
+        with self.lock:
+            sample_size = min(sample_per_list * nlist, self.size)
+            sample = np.array(self.vectors[np.sort(rng.choice(self.size, sample_size, replace=False))])
+            centroids = sample[rng.choice(len(sample), nlist, replace=False)]
+            for _ in range(iterations):
+                labels = np.argmax(sample @ centroids.T, axis=1)
+                counts = np.bincount(labels, minlength=nlist)
+                # sum every cluster with one reduceat over the sample sorted by label, empty lists keep their centroid
+                order = np.argsort(labels, kind='stable')
+                nonempty = counts > 0
+                starts = (np.cumsum(counts) - counts)[nonempty]
+                centroids[nonempty] = np.add.reduceat(sample[order], starts, axis=0) / counts[nonempty, None]
+                if self.config.metric == 'cosine':
+                    centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+            self.centroids = centroids.astype(np.float32)
+            self.assign(np.arange(self.size))
+        return {'nlist': nlist, 'size': self.size}
+
+    """
+    ################ PERSISTENCE ############################
+    """
+
+    def save(self) -> dict:
+        assert self.dirpath != None, 'the vector store has no path'
+        with self.lock:
+            if self.vectors is not None:
+                self.vectors.flush()
+            if self.centroids is not None:
+                np.save(os.path.join(self.dirpath, 'centroids.npy'), self.centroids)
+                np.save(os.path.join(self.dirpath, 'assignments.npy'), self.assignments[:self.size])
+            c.put_json(os.path.join(self.dirpath, 'keys.json'), self.index2k)
+            # meta is written last, so a store is only loaded from a complete save
+            c.put_json(os.path.join(self.dirpath, 'meta.json'), {'dim': self.dim, 'size': self.size, 'capacity': self.capacity,
+                                                                'metric': self.config.metric, 'ivf': self.centroids is not None})
+        return {'success': True, 'msg': f'saved {self.size} vectors to {self.dirpath}'}
+
+    def load(self) -> dict:
+        meta = c.get_json(os.path.join(self.dirpath, 'meta.json'))
+        self.dim, self.size = meta['dim'], meta['size']
+        self.index2k = c.get_json(os.path.join(self.dirpath, 'keys.json'))[:self.size]
+        self.k2index = {k: i for i, k in enumerate(self.index2k)}
+        self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r+', shape=(meta['capacity'], self.dim))
+        self.assignments = np.full(meta['capacity'], -1, dtype=np.int32)
+        if meta['ivf']:
+            self.centroids = np.load(os.path.join(self.dirpath, 'centroids.npy'))
+            self.assignments[:self.size] = np.load(os.path.join(self.dirpath, 'assignments.npy'))
+        return {'success': True, 'msg': f'loaded {self.size} vectors from {self.dirpath}'}
+
+    def clear(self):
+        with self.lock:
+            self.k2index, self.index2k, self.size = {}, [], 0
+            self.vectors = self.centroids = self.assignments = self.lists = None
+            if self.dirpath != None:
+                for name in ['vectors.f32', 'keys.json', 'meta.json', 'centroids.npy', 'assignments.npy']:
+                    path = os.path.join(self.dirpath, name)
+                    if os.path.exists(path):
+                        os.remove(path)
+        return {'success': True, 'msg': 'cleared the vector store'}
 
     @classmethod
     def test(cls):
@@ -114,8 +333,59 @@ class VectorStore(c.Module):
         self.add_vector('test', [1,2,3])
         assert self.search([1,2,3]) == {'test': 14.0}
         self.rm_vector('test')
-        assert len(self.vectors) == 0
+        assert len(self) == 0
         print('test passed')
-        
-        
-        
+
+    @classmethod
+    def test_index(cls, n:int = 10000, dim:int = 32):
+        self = cls(path='test_vector_store', capacity=16)
+        self.clear()
+        rng = np.random.default_rng(0)
+        vectors = rng.standard_normal((n, dim)).astype(np.float32)
+        keys = [f'k{i}' for i in range(n)]
+        for i in range(0, n, 1000):
+            self.add_vectors(keys[i:i + 1000], vectors[i:i + 1000])
+        self.rm_vectors(keys[:n // 2:2])
+        alive = np.arange(1, n // 2, 2).tolist() + np.arange(n // 2, n).tolist()
+        query = rng.standard_normal(dim).astype(np.float32)
+        expected = sorted(alive, key=lambda i: -float(vectors[i] @ query))[:10]
+        result = self.search(query, top_k=10)
+        assert list(result.keys()) == [f'k{i}' for i in expected], 'exact search mismatch'
+
+        self.train_index(nlist=16)
+        assert set(self.search(query, top_k=10, nprobe=16)) == set(result), 'probing every list is exact'
+        self.save()
+        loaded = cls(path='test_vector_store')
+        assert len(loaded) == len(alive) and loaded.search(query, top_k=10, nprobe=16) == self.search(query, top_k=10, nprobe=16)
+        self.clear()
+        return {'success': True, 'msg': 'vector index test passed'}
+
+    @classmethod
+    def test_benchmark(cls, n:int = 1_000_000, dim:int = 64, num_queries:int = 100, top_k:int = 10,
+                       nlist:int = 1024, nprobe:int = 16, num_clusters:int = 4096):
+        """
+        Insert throughput, exact vs IVF latency, and recall@top_k of the IVF, on clustered random vectors.
+        """
+        rng = np.random.default_rng(0)
+        self = cls(capacity=1024)
+        centers = rng.standard_normal((num_clusters, dim)).astype(np.float32)
+        t0 = c.time()
+        for i in range(0, n, 100_000):
+            m = min(100_000, n - i)
+            vectors = centers[rng.integers(num_clusters, size=m)] + 0.3 * rng.standard_normal((m, dim)).astype(np.float32)
+            self.add_vectors(list(range(i, i + m)), vectors)
+        stats = {'inserts_per_second': n / (c.time() - t0)}
+        queries = centers[rng.integers(num_clusters, size=num_queries)] + 0.3 * rng.standard_normal((num_queries, dim)).astype(np.float32)
+
+        t0 = c.time()
+        exact = self.search_batch(queries, top_k=top_k, exact=True)
+        stats['exact_ms_per_query'] = 1000 * (c.time() - t0) / num_queries
+        t0 = c.time()
+        self.train_index(nlist=nlist)
+        stats['train_seconds'] = c.time() - t0
+        t0 = c.time()
+        approx = self.search_batch(queries, top_k=top_k, nprobe=nprobe)
+        stats['ivf_ms_per_query'] = 1000 * (c.time() - t0) / num_queries
+        stats['recall'] = float(np.mean([len(set(e) & set(a)) / top_k for e, a in zip(exact, approx)]))
+        stats['speedup'] = stats['exact_ms_per_query'] / stats['ivf_ms_per_query']
+        return stats
@@ -1,24 +1,146 @@
 
-import commune
+import json
+import threading
+import itertools
+import numpy as np
+import commune as c
 import torch
-from typing import Dict, Any, List, Tuple
+from typing import Dict, Any, List, Tuple, Union
 import streamlit as st
-commune.new_event_loop()
+c.new_event_loop()
 from commune.utils.tokenizer import get_translation_map, translate_logits_to_probs_std, \
     translate_special_token_text, pad_offsets, topk_token_phrases, compact_topk_token_phrases, \
         encode_topk, decode_topk, prep_tokenizer, check_tokenizer_equivalence
 
 class Tokenizer(c.Module):
-    def __init__(self, tokenizer = 'llama', **kwargs):
+    """
+    A tokenization service.
+
+    Every call tokenizes its missing texts inline in one call of the (fast) tokenizer, and frequent
+    strings are memoized in a bounded cache keyed by (tokenizer, text, options) whose hits take no lock.
+    Token ids are kept as compact int32 arrays, which is also what encode returns through the
+    serializer. Batches of at least process_threshold texts are split over num_workers processes.
+    """
+    def __init__(self, tokenizer = 'llama',
+                 cache_size:int = 65536,
+                 num_workers:int = 0,
+                 process_threshold:int = 4096,
+                 **kwargs):
+        self.cache_size = cache_size
+        self.num_workers = num_workers
+        self.process_threshold = process_threshold
+        self.cache = {} # (tokenizer, text, *options) -> int32 ids
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'texts': 0, 'hits': 0, 'tokenized': 0, 'tokenize_seconds': 0}
+        # requests served fully from the cache, counted without the lock
+        self.hit_requests = itertools.count()
+        self.hit_texts = itertools.count()
         self.set_tokenizer(tokenizer=tokenizer, **kwargs)
-            
+        self.pool = None
+
     def set_tokenizer(self, tokenizer='gpt2', **kwargs):
         from transformers import AutoTokenizer, AutoModel
         from commune.utils.tokenizer import prep_tokenizer
         tokenizer = self.shortcuts.get(tokenizer, tokenizer)
         self.tokenizer = AutoTokenizer.from_pretrained(tokenizer, **kwargs)
+        self.tokenizer_path = tokenizer
+        self.tokenizer_kwargs = kwargs
         return {'success': True, 'msg': f'set tokenizer to {tokenizer}'}
 
+    """
+    ################ ENCODING ############################
+    """
+
+    # the tokenizers of the worker processes, loaded once per process
+    process_tokenizers = {}
+
+    @classmethod
+    def tokenize_chunk(cls, tokenizer_path:str, tokenizer_kwargs:dict, texts:List[str], options:dict) -> List[np.ndarray]:
+        from transformers import AutoTokenizer
+        key = (tokenizer_path, json.dumps(tokenizer_kwargs, sort_keys=True, default=str))
+        if key not in cls.process_tokenizers:
+            cls.process_tokenizers[key] = AutoTokenizer.from_pretrained(tokenizer_path, **tokenizer_kwargs)
+        input_ids = cls.process_tokenizers[key](texts, padding=False, **options)['input_ids']
+        return [np.asarray(ids, dtype=np.int32) for ids in input_ids]
+
+    def encode_batch(self, texts:List[str], **options) -> List[np.ndarray]:
+        """ Tokenizes the texts in a single tokenizer call, or over the process pool. """
+        t0 = c.time()
+        if self.num_workers > 0 and len(texts) >= self.process_threshold:
+            if self.pool == None:
+                from concurrent.futures import ProcessPoolExecutor
+                self.pool = ProcessPoolExecutor(max_workers=self.num_workers)
+            chunk_size = -(-len(texts) // self.num_workers)
+            futures = [self.pool.submit(self.tokenize_chunk, self.tokenizer_path, self.tokenizer_kwargs, texts[i:i + chunk_size], options)
+                       for i in range(0, len(texts), chunk_size)]
+            input_ids = [ids for f in futures for ids in f.result()]
+        else:
+            input_ids = self.tokenizer(texts, padding=False, **options)['input_ids']
+            input_ids = [np.asarray(ids, dtype=np.int32) for ids in input_ids]
+        with self.lock:
+            self.stats['tokenized'] += len(texts)
+            self.stats['tokenize_seconds'] += c.time() - t0
+        return input_ids
+
+    def encode(self, text:Union[str, List[str]],
+               truncation:bool = True,
+               max_length:int = 64,
+               add_special_tokens:bool = False,
+               cache:bool = True) -> Union[np.ndarray, List[np.ndarray]]:
+        """
+        The int32 token ids of every text, unpadded.
+        """
+        is_string = isinstance(text, str)
+        texts = [text] if is_string else list(text)
+        keys = [(self.tokenizer_path, t, truncation, max_length, add_special_tokens) for t in texts]
+
+        found = {}
+        if cache:
+            # hits are plain dict reads, which need no lock
+            for k in keys:
+                ids = self.cache.get(k)
+                if ids is not None:
+                    found[k] = ids
+        # every distinct missing text is tokenized once
+        missing = list(dict.fromkeys([k for k in keys if k not in found]))
+        if len(missing) == 0:
+            next(self.hit_requests)
+            for _ in keys:
+                next(self.hit_texts)
+        else:
+            input_ids = self.encode_batch([k[1] for k in missing], truncation=truncation,
+                                          max_length=max_length, add_special_tokens=add_special_tokens)
+            for ids in input_ids:
+                ids.flags.writeable = False # shared through the cache
+            found.update(zip(missing, input_ids))
+            with self.lock:
+                self.stats['requests'] += 1
+                self.stats['texts'] += len(texts)
+                self.stats['hits'] += len(texts) - len(missing)
+                if cache:
+                    for k in missing:
+                        self.cache[k] = found[k]
+                    # evicts in insertion order, hits do not reorder the cache so they can skip the lock
+                    while len(self.cache) > self.cache_size:
+                        del self.cache[next(iter(self.cache))]
+        input_ids = [found[k] for k in keys]
+        return input_ids[0] if is_string else input_ids
+
+    def pad(self, input_ids:List[np.ndarray], padding:Union[bool, str] = True, max_length:int = None) -> Dict[str, np.ndarray]:
+        """ Pads int32 ids into input_ids and attention_mask [batch_size, max_len] on the tokenizer's padding side. """
+        max_len = max([len(ids) for ids in input_ids] + [0])
+        if padding == 'max_length' and max_length != None:
+            max_len = max(max_len, max_length)
+        pad_token_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id != None else 0
+        ids = np.full((len(input_ids), max_len), pad_token_id, dtype=np.int32)
+        attention_mask = np.zeros((len(input_ids), max_len), dtype=np.int32)
+        left = self.tokenizer.padding_side == 'left'
+        for i, row in enumerate(input_ids):
+            idx = slice(max_len - len(row), max_len) if left else slice(0, len(row))
+            ids[i, idx] = row
+            attention_mask[i, idx] = 1
+        return {'input_ids': ids, 'attention_mask': attention_mask}
+
     def tokenize(self, text: str = 'Whadup',
                  padding=True, 
                  truncation=True, 
@@ -26,28 +148,49 @@ class Tokenizer(c.Module):
                  return_tensors='pt',
                  add_special_tokens=False,
                  **kwargs) -> torch.Tensor:
-        """ Returns tokenized text as torch tensor. """
-        
-        sample = self.tokenizer(text, 
-                                             padding=padding, 
-                                             truncation=truncation, 
-                                             max_length=max_length, 
-                                             return_tensors=return_tensors,
-                                             add_special_tokens=add_special_tokens, 
-                                             **kwargs)  # assume tokenizer.padding_side = 'left'
-        
+        """ Returns tokenized text as torch tensor (or int32 numpy arrays with return_tensors='np'). """
+        if len(kwargs) > 0:
+            # options the service does not memoize go straight to the tokenizer
+            return self.tokenizer(text, padding=padding, truncation=truncation, max_length=max_length,
+                                  return_tensors=return_tensors, add_special_tokens=add_special_tokens, **kwargs)
+        texts = [text] if isinstance(text, str) else text
+        input_ids = self.encode(texts, truncation=truncation, max_length=max_length, add_special_tokens=add_special_tokens)
+        if padding in [False, 'do_not_pad']:
+            if return_tensors == None:
+                return {'input_ids': input_ids}
+            # like the tokenizer, tensors without padding only exist when every text has the same length
+            if len(set(len(ids) for ids in input_ids)) > 1:
+                raise ValueError(f'padding=False with return_tensors={return_tensors} needs texts of the same length, got {sorted(set(len(ids) for ids in input_ids))} tokens (use padding=True or return_tensors=None)')
+        sample = self.pad(input_ids, padding=padding, max_length=max_length)
+        if return_tensors == 'pt':
+            sample = {k: torch.from_numpy(v).long() for k,v in sample.items()}
         return sample
 
-
-
     def detokenize(self, input_ids: torch.Tensor, **kwargs) -> torch.Tensor:
         """ Returns tokenized text as torch tensor. """
-        
+        if isinstance(input_ids, np.ndarray) and input_ids.ndim == 1:
+            input_ids = [input_ids]
+        input_ids = [ids.tolist() if hasattr(ids, 'tolist') else ids for ids in input_ids]
         text = self.tokenizer.batch_decode(input_ids,**kwargs)  # assume tokenizer.padding_side = 'left'
 
         return text
-    
-    
+
+    def metrics(self) -> dict:
+        stats = dict(self.stats)
+        hit_requests, hit_texts = self.hit_requests.__reduce__()[1][0], self.hit_texts.__reduce__()[1][0]
+        stats['requests'] += hit_requests
+        stats['texts'] += hit_texts
+        stats['hits'] += hit_texts
+        stats['hit_rate'] = stats['hits'] / stats['texts'] if stats['texts'] > 0 else 0
+        stats['texts_per_second'] = stats['tokenized'] / stats['tokenize_seconds'] if stats['tokenize_seconds'] > 0 else 0
+        stats['cache_items'] = len(self.cache)
+        return stats
+
+    def stop(self):
+        if self.pool != None:
+            self.pool.shutdown()
+        return {'success': True, 'msg': 'stopped the tokenizer', 'metrics': self.metrics()}
+
     @classmethod
     def test(cls,**kwargs):
         text = 'Whadup'
@@ -55,7 +198,42 @@ class Tokenizer(c.Module):
         print(self.tokenize(text))
         print(self.detokenize(self.tokenize(text)['input_ids']))
 
+    @classmethod
+    def test_throughput(cls, tokenizer:str = 'gpt2', n:int = 4096, num_threads:int = 64, unique:int = 1024):
+        """
+        Texts per second of num_threads concurrent single text callers through the plain tokenizer,
+        encode without the cache, and encode with the cache.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        texts = [f'validator prompt {i % unique}: what is the capital of country {i % unique}?' for i in range(n)]
+        self = cls(tokenizer=tokenizer)
+        expected = [list(ids) for ids in self.tokenizer(texts[:unique], add_special_tokens=False, truncation=True, max_length=64)['input_ids']]
+        stats = {}
+        modes = {'plain': lambda t: self.tokenizer(t, add_special_tokens=False, truncation=True, max_length=64)['input_ids'],
+                 'uncached': lambda t: self.encode(t, cache=False),
+                 'cached': lambda t: self.encode(t)}
+        for mode, fn in modes.items():
+            t0 = c.time()
+            with ThreadPoolExecutor(max_workers=num_threads) as executor:
+                results = list(executor.map(fn, texts))
+            stats[f'{mode}_texts_per_second'] = n / (c.time() - t0)
+            assert [list(ids) for ids in results[:unique]] == expected, f'{mode} tokens differ'
+        stats['metrics'] = self.stop()['metrics']
+        return stats
 
+    @classmethod
+    def test_padding(cls, tokenizer:str = 'gpt2'):
+        self = cls(tokenizer=tokenizer)
+        texts = ['a b', 'a longer text than the first one']
+        assert [len(ids) for ids in self.tokenize(texts, padding=False, return_tensors=None)['input_ids']] == [len(ids) for ids in self.encode(texts)]
+        assert self.tokenize(texts[:1] * 2, padding=False, return_tensors='np')['input_ids'].shape == (2, len(self.encode(texts[0])))
+        try:
+            self.tokenize(texts, padding=False, return_tensors='pt')
+            raise AssertionError('ragged texts without padding did not raise')
+        except ValueError:
+            pass
+        assert self.tokenize(texts, padding=True, return_tensors='np')['input_ids'].shape[1] == max(len(ids) for ids in self.encode(texts))
+        return {'success': True, 'msg': 'padding test passed'}
 
     shortcuts =  {
         # 0-1B models
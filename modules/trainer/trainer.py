@@ -1,184 +1,428 @@
-
-from ray import tune
+import os
+import json
+import math
+import time
+import random
+import resource
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 from typing import *
-import torch
-from copy import deepcopy
+import numpy as np
 import commune as c
 
 
+class Trainer(c.Module):
+    """
+    Hyperparameter search over a local process pool, with asynchronous successive halving (ASHA).
 
+    Every trial starts with min_budget steps. A trial is promoted to the next rung (eta times the budget,
+    up to max_budget) when it is in the top 1/eta of the trials that finished its rung, and a free worker
+    otherwise starts a new trial, so the workers never wait for a rung to fill up.
+    A trial continues from its checkpoint when it is promoted, the data is written once and memory mapped
+    by every worker, and the search state is saved after every result, so fit resumes where it stopped.
+    A worker that dies (a crash or the oom killer) breaks the pool, which is recreated: the trials that
+    were running rerun alone, so the one that kills its worker again fails by itself.
 
-class Trainer(c.Module):
-    def __init__(self, 
-                 model: str = 'model:gptj:train', 
-                 metrics_server: str = 'metrics_server' ,
-                 tuner: Dict = dict(
-                     metric = 'loss',
-                     mode = 'min',
-                     mgax_concurrent_trials = 1,
-                     resources_per_trial = {"cpu": 2, "gpu": 0},
-                     num_samples= 1000
-                 ),
-                 **kwargs):
-        
-        
-        config = self.set_config(locals())
-        self.set_model(config.model)
-        self.set_metrics_server(self.config.metrics_server)
-        self.set_tuner(**self.config.tuner)
-
-    def set_config(self, config) -> None:
-        config.pop('self',None)
-        kwargs = config.pop('kwargs', {})
-        config.update(kwargs)
-        self.config = c.dict2munch(config)
-        return config
-        
-        # self.model = self.connect(self.model_name)
-
-
-        
-    def set_model(self, 
-                          model:str,
-                          refresh:bool = True,
-                          timeout:int = 1000,
-                          check_step:int= 2):
-        # if not self.server_exists(metrics_server):
-        wait_time = 0
-        while not self.server_exists(model) and wait_time <= timeout:
-            self.sleep(check_step)
-            wait_time += check_step
-            
-        if wait_time >= timeout:
-            raise Exception('Your peer is not visible')
-        
-        self.model = model
-       
-    def hyper2params(self, params: Dict) -> Dict:
-        return self.flat2deep(params)
-
-    def get_hyperopt_tag(self, config:dict):
-        
-        tag = f'{self.model}::{self.tag}__'
-        for k, v in config.items():
-            tag += f'{k}_{v}__'
-                
-        return tag
- 
-                
-    def objective(self, 
-                  hyperparams:dict = None, 
-                  train_kwargs = {'num_batches': 100},
-                  timeout:int=1000) -> Dict:
-
-        if hyperparams is None:
-            hyperparams = {}
-            
-        params = self.hyper2params(deepcopy(hyperparams))
-        params['stats'] = {}
-        train_kwargs.update(dict(
-            tag=self.tag,
-            params = params,
-            save = False,
-            load = False,
-        ))
-        
-        model = commune.connect(self.model)
-
-        output = model.train_model(**train_kwargs, timeout=timeout)
-        
-        metric_server = c.connect(self.metrics_server)
-        best_metric = metric_server.best_metric()
-        
-        is_best = False
-        if self.config.tuner.mode == 'min':
-            is_best =  bool(output['loss'] <  best_metric)
-        elif self.config.tuner.mode == 'max':
-            is_best =  bool(output['loss'] >  best_metric)
-            
-        hyperopt_tag = self.get_hyperopt_tag(hyperparams)
-
-
-        if is_best:
-            model.save(tag=self.tag)
-            
-        return output
-    @classmethod
-    def default_search_space(cls):
-        search_space = {
-            'optimizer.lr': tune.loguniform(1e-6, 1e-4),
-            "finetune.num_layers": tune.choice([1,2,3,4,5,6,7]),
-            # 'load': tune.choice([True, False]),
-        }
-        
-        return search_space
-    
-    def set_tuner(self, 
-                 resources_per_trial:dict = {"cpu": 2, "gpu": 0},
-                 max_concurrent_trials:int = 4,
-                 num_samples: int = 10,
+    objective(params, budget, checkpoint, data) trains the model in params from the step in checkpoint
+    (if it exists) to budget steps, saves it to checkpoint, and returns the metric (or a dict with it).
+    """
+
+    default_search_space = {
+        'lr': {'loguniform': [1e-3, 1.0]},
+        'hidden': {'choice': [8, 16, 32, 64]},
+        'weight_decay': {'loguniform': [1e-6, 1e-2]},
+        'batch_size': {'choice': [32, 64, 128]},
+    }
+
+    def __init__(self,
+                 objective:Callable = None,
                  search_space:Dict = None,
-                 metric: str = 'loss',
-                 mode : str = 'min'):
-        
-        
-        # 2. Define a search space.
-        
-        self.metric = metric
-        self.mode = mode
-
-        self.search_space = search_space if search_space else self.default_search_space()
-        
-        
-            
-        self.resources_per_trial = resources_per_trial
-        self.objective_with_resources = tune.with_resources(self.objective, self.resources_per_trial)
-
-        self.tune_config = tune.TuneConfig(num_samples=num_samples,
-                                           max_concurrent_trials=max_concurrent_trials)
-        
-        # 3. Start a Tune run and print the best result.
-        self.tuner = tune.Tuner(self.objective_with_resources, 
-                                param_space=self.search_space, 
-                                tune_config=self.tune_config)
-        
-        return {'success': True, 'message': 'Tuner set'}
-    def fit(self, **kwargs):
-
-        results = self.tuner.fit()
-        print(results.get_best_result(metric=self.metric, mode=self.mode).config)
+                 data:Callable = None,
+                 data_kwargs:dict = None,
+                 metric:str = 'loss',
+                 mode:str = 'min',
+                 num_samples:int = 64,
+                 min_budget:int = 1,
+                 max_budget:int = 27,
+                 eta:int = 3,
+                 max_workers:int = None,
+                 cpus_per_trial:int = 1,
+                 memory_per_trial:int = None,
+                 path:str = 'search',
+                 seed:int = 0):
+        """
+        data: a function that returns a dict of numpy arrays, written once for all the trials
+        cpus_per_trial: the threads of a trial (and max_workers defaults to the cpus // cpus_per_trial)
+        memory_per_trial: the bytes a worker can allocate beyond what it starts with, a trial that needs more fails
+        """
+        assert mode in ['min', 'max'], f'mode must be min or max, not {mode}'
+        self.set_config(kwargs={k: v for k, v in locals().items() if k not in ['objective', 'data']})
+        self.objective = objective or mlp_objective
+        self.data = data or make_classification_data
+        self.search_space = search_space or self.default_search_space
+        self.max_workers = max_workers or max(os.cpu_count() // cpus_per_trial, 1)
+        self.path = self.resolve_path(path)
+        self.state_path = f'{self.path}/state.json'
+        self.data_path = f'{self.path}/data'
+        self.budgets = self.rung_budgets(min_budget, max_budget, eta)
+
+    @staticmethod
+    def rung_budgets(min_budget:int, max_budget:int, eta:int) -> List[int]:
+        num_rungs = int(math.floor(math.log(max_budget / min_budget, eta) + 1e-9)) + 1
+        budgets = [min(int(min_budget * eta ** k), max_budget) for k in range(num_rungs)]
+        # the last rung trains for max_budget, even when it is not min_budget times a power of eta
+        if budgets[-1] < max_budget:
+            budgets.append(max_budget)
+        return budgets
+
+    def sample_params(self, trial_id:str = '0') -> dict:
+        # seeded by the trial, so a resumed search samples the trials it did not start yet
+        rng = random.Random(f'{self.config.seed}:{trial_id}')
+        params = {}
+        for k, space in self.search_space.items():
+            if not isinstance(space, dict):
+                params[k] = space
+                continue
+            kind, values = list(space.items())[0]
+            if kind == 'choice':
+                params[k] = rng.choice(values)
+            elif kind == 'uniform':
+                params[k] = rng.uniform(*values)
+            elif kind == 'loguniform':
+                params[k] = math.exp(rng.uniform(math.log(values[0]), math.log(values[1])))
+            elif kind == 'randint':
+                params[k] = rng.randint(*values)
+            else:
+                raise ValueError(f'unknown search space {kind} for {k}')
+        return params
+
+    """
+    ################ STATE ############################
+    """
+
+    def new_state(self) -> dict:
+        return {'trials': {}, 'num_started': 0, 'budgets': self.budgets, 'seconds': 0}
+
+    def load_state(self) -> dict:
+        if not os.path.exists(self.state_path):
+            return self.new_state()
+        with open(self.state_path) as f:
+            state = json.load(f)
+        for trial in state['trials'].values():
+            # the rungs that were running when the search stopped run again, from the last checkpoint
+            if trial['status'] == 'running':
+                trial['status'] = 'pending'
+        return state
+
+    def save_state(self, state:dict):
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+    def write_data(self) -> str:
+        """
+        Writes the data once, the workers memory map it.
+        """
+        if not os.path.exists(f'{self.data_path}/.done'):
+            os.makedirs(self.data_path, exist_ok=True)
+            for k, v in self.data(**(self.config.data_kwargs or {})).items():
+                np.save(f'{self.data_path}/{k}.npy', v)
+            open(f'{self.data_path}/.done', 'w').close()
+        return self.data_path
+
+    def rm_search(self) -> dict:
+        return self.rm(self.path)
+
+    """
+    ################ SCHEDULING ############################
+    """
+
+    def sort_key(self, metric:float) -> float:
+        if metric == None or math.isnan(metric):
+            return float('inf')
+        return metric if self.config.mode == 'min' else -metric
+
+    def next_job(self, state:dict) -> Optional[Tuple[str, int]]:
+        """
+        The next (trial, rung) to run: a pending rung, a promotion from the highest rung that has one, or a new trial.
+        """
+        trials = state['trials']
+        for trial_id, trial in trials.items():
+            if trial['status'] == 'pending':
+                return trial_id, trial['rung']
+        eta = self.config.eta
+        for rung in reversed(range(len(self.budgets) - 1)):
+            finished = [t for t in trials.values() if str(rung) in t['results']]
+            top = sorted(finished, key=lambda t: self.sort_key(t['results'][str(rung)]))[:len(finished) // eta]
+            for trial in top:
+                if trial['status'] == 'paused' and trial['rung'] == rung:
+                    return trial['id'], rung + 1
+        if state['num_started'] < self.config.num_samples:
+            trial_id = str(state['num_started'])
+            state['num_started'] += 1
+            trials[trial_id] = {'id': trial_id, 'params': self.sample_params(trial_id), 'rung': 0, 'results': {}, 'status': 'new'}
+            return trial_id, 0
+        return None
+
+    def fit(self, resume:bool = True, max_seconds:float = None) -> dict:
+        """
+        Runs the search until every trial stopped, was promoted to max_budget, or max_seconds passed.
+        """
+        state = self.load_state() if resume else self.new_state()
+        if not resume:
+            self.rm(f'{self.path}/trials')
+        os.makedirs(f'{self.path}/trials', exist_ok=True)
+        data_path = self.write_data()
+        t0 = c.time()
+        seconds = state['seconds']
+        executor = self.process_pool()
+        running = {}
+        try:
+            while True:
+                while len(running) < self.max_workers and (max_seconds == None or c.time() - t0 < max_seconds):
+                    if any(state['trials'][trial_id].get('crashes') for trial_id, _ in running.values()):
+                        break
+                    job = self.next_job(state)
+                    if job == None:
+                        break
+                    trial_id, rung = job
+                    trial = state['trials'][trial_id]
+                    if trial.get('crashes') and len(running) > 0:
+                        # it was running when the pool broke, so it runs alone to tell whether it broke it
+                        break
+                    trial['status'] = 'running'
+                    trial['rung'] = rung
+                    future = executor.submit(run_trial, self.objective, trial['params'], self.budgets[rung],
+                                             f'{self.path}/trials/{trial_id}.npz', data_path, self.config.metric)
+                    running[future] = job
+                if len(running) == 0:
+                    break
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                broken = False
+                for future in done:
+                    trial_id, rung = running.pop(future)
+                    trial = state['trials'][trial_id]
+                    try:
+                        result = future.result()
+                        trial['results'][str(rung)] = result['metric']
+                        trial['seconds'] = trial.get('seconds', 0) + result['seconds']
+                        trial['status'] = 'done' if rung == len(self.budgets) - 1 else 'paused'
+                    except BrokenProcessPool:
+                        broken = True
+                        running[future] = (trial_id, rung)
+                    except Exception as e:
+                        trial['status'] = 'failed'
+                        trial['error'] = f'{type(e).__name__}: {e}'
+                        c.print(f'trial {trial_id} failed at rung {rung}: {trial["error"]}', color='red')
+                if broken:
+                    # a worker died and took the pool with it, every running trial is lost
+                    for trial_id, rung in running.values():
+                        trial = state['trials'][trial_id]
+                        if len(running) == 1:
+                            trial['status'] = 'failed'
+                            trial['error'] = 'BrokenProcessPool: the worker died running the trial'
+                            c.print(f'trial {trial_id} failed at rung {rung}: {trial["error"]}', color='red')
+                        else:
+                            trial['status'] = 'pending'
+                            trial['crashes'] = trial.get('crashes', 0) + 1
+                    running = {}
+                    executor.shutdown(wait=True)
+                    executor = self.process_pool()
+                state['seconds'] = seconds + c.time() - t0
+                self.save_state(state)
+        finally:
+            executor.shutdown(wait=True)
+        return self.results(state)
+
+    def process_pool(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=self.max_workers,
+                                   mp_context=mp.get_context('fork'),
+                                   initializer=init_worker,
+                                   initargs=(self.config.cpus_per_trial, self.config.memory_per_trial))
+
+    def results(self, state:dict = None) -> dict:
+        state = state or self.load_state()
+        trials = list(state['trials'].values())
+        def best_metric(trial):
+            # the metric at the highest rung the trial reached
+            rungs = sorted(trial['results'], key=int)
+            return (-int(rungs[-1]), self.sort_key(trial['results'][rungs[-1]])) if len(rungs) > 0 else (1, float('inf'))
+        best = min(trials, key=best_metric) if len(trials) > 0 else None
+        return {'best_params': best['params'] if best else None,
+                'best_metric': best['results'][max(best['results'], key=int)] if best and best['results'] else None,
+                'trials': len(trials),
+                'completed': len([t for t in trials if t['status'] == 'done']),
+                'failed': len([t for t in trials if t['status'] == 'failed']),
+                'steps': sum(self.budgets[int(r)] - (self.budgets[int(r) - 1] if int(r) > 0 else 0) for t in trials for r in t['results']),
+                'seconds': state['seconds'],
+                'trials_per_hour': len(trials) / max(state['seconds'], 1e-9) * 3600}
+
+    def fit_sequential(self, num_samples:int = None) -> dict:
+        """
+        Every trial with the full budget one after the other, as a baseline for fit.
+        """
+        data_path = self.write_data()
+        os.makedirs(f'{self.path}/sequential', exist_ok=True)
+        t0 = c.time()
+        results = []
+        for i in range(num_samples or self.config.num_samples):
+            params = self.sample_params(str(i))
+            result = run_trial(self.objective, params, self.budgets[-1], f'{self.path}/sequential/{i}.npz', data_path, self.config.metric)
+            results.append((result['metric'], params))
+        seconds = c.time() - t0
+        metric, params = min(results, key=lambda r: self.sort_key(r[0]))
+        return {'best_params': params, 'best_metric': metric, 'trials': len(results), 'seconds': seconds,
+                'trials_per_hour': len(results) / seconds * 3600}
+
+    """
+    ################ TESTS ############################
+    """
+
+    @classmethod
+    def test(cls, path:str = 'test_search'):
+        self = cls(path=path, num_samples=12, max_budget=9, max_workers=2)
+        self.rm_search()
+        results = self.fit(max_seconds=0.1)
+        assert results['trials'] < 12, results
+        # the search resumes from its state
+        results = cls(path=path, num_samples=12, max_budget=9, max_workers=2).fit()
+        assert results['trials'] == 12 and results['failed'] == 0 and results['completed'] >= 1, results
+        # the stopped trials used a fraction of the 12 * 9 steps of full budget trials
+        assert results['steps'] < 12 * 9 / 2, results
+        assert results['best_metric'] < 1.0, results
+        self.rm_search()
+        assert cls.rung_budgets(1, 27, 3) == [1, 3, 9, 27]
+        assert cls.rung_budgets(2, 9, 3) == [2, 6, 9]
+        return {'success': True, 'msg': 'trainer test passed', 'results': results}
+
+    @classmethod
+    def test_crash(cls, path:str = 'test_search_crash'):
+        """
+        A trial that kills its worker fails alone, and the search goes on in a new pool.
+        """
+        search_space = {**cls.default_search_space, 'crash': {'choice': [False, False, False, True]}}
+        self = cls(path=path, objective=crash_objective, search_space=search_space, num_samples=8, max_budget=3, max_workers=2,
+                   memory_per_trial=2**30)
+        self.rm_search()
+        results = self.fit(resume=False)
+        state = self.load_state()
+        crashed = [t for t in state['trials'].values() if t['params']['crash']]
+        assert len(crashed) > 0, 'no trial crashed, change the seed'
+        assert all(t['status'] == 'failed' for t in crashed), crashed
+        assert results['failed'] == len(crashed) and results['trials'] == 8, results
+        self.rm_search()
+        return {'success': True, 'msg': 'trainer crash test passed', 'results': results}
 
     @classmethod
-    def test(cls):
-        trainer = cls()
-        print(trainer.fit())
-        
-        # print(self.model)
-        # print(self.model_name)
-        
-        
-if __name__ == "__main__":
-    Trainer.test()
-    # dataset = commune.connect('dataset::bittensor')
-    
-    # print(dataset.module_name)
-    # for i in range(10):
-    #     print('Alo')
-    #     AdapterModel.train(num_batches=1, dataset=dataset)
-    #     adapter = dict(
-    #                 module='commune.model.adapter.block.AdapterBlock', 
-    #                 params = {'in_dim': 10, 'hidden_dim': 64,  'num_layers': 8},
-    #                 key2attr = {'in_dim': 'hidden_dim', 'out_dim': 'vocab_size'},
-    #                 device = None
-    #                 )
-    # AdapterModel.run()
-    # EnsembleModel.run_neuron()
-    # AdapterModel.serve(wait_for_termination=False)
-    # AdapterModel.run()
-    # print('FUCK')
-    # TransformerModel('gptj', tag='demo', load=True).save_pretrained()
-    
-    # TransformerModel.run()
-    # TransformerModel.experiment()
+    def test_benchmark(cls, path:str = 'test_search_benchmark', num_samples:int = 27, max_budget:int = 27, max_workers:int = None) -> dict:
+        """
+        Trials per hour of the search against every trial with the full budget, one after the other.
+        """
+        self = cls(path=path, num_samples=num_samples, max_budget=max_budget, max_workers=max_workers)
+        self.rm_search()
+        search = self.fit(resume=False)
+        sequential = cls(path=path, num_samples=num_samples, max_budget=max_budget).fit_sequential()
+        self.rm_search()
+        return {'search': search, 'sequential': sequential, 'speedup': search['trials_per_hour'] / sequential['trials_per_hour']}
+
+
+"""
+################ WORKERS ############################
+"""
+
+data_cache = {}
+
+def init_worker(threads:int = 1, memory:int = None):
+    for k in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']:
+        os.environ[k] = str(threads)
+    if memory != None:
+        # a forked worker starts with the address space of the parent, the trial gets memory on top of it,
+        # and a trial that allocates more raises MemoryError and fails alone
+        limit = address_space() + memory
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+
+def address_space() -> int:
+    """
+    The bytes of virtual memory of this process, what RLIMIT_AS limits.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[0]) * resource.getpagesize()
+    except OSError:
+        # without /proc the limit is on the whole address space
+        return 0
+
+def load_data(data_path:str) -> Dict[str, np.ndarray]:
+    if data_path not in data_cache:
+        data_cache[data_path] = {f[:-len('.npy')]: np.load(f'{data_path}/{f}', mmap_mode='r') for f in os.listdir(data_path) if f.endswith('.npy')}
+    return data_cache[data_path]
+
+def run_trial(objective:Callable, params:dict, budget:int, checkpoint:str, data_path:str, metric:str = 'loss') -> dict:
+    t0 = time.time()
+    result = objective(params=params, budget=budget, checkpoint=checkpoint, data=load_data(data_path))
+    if not isinstance(result, dict):
+        result = {metric: result}
+    return {'metric': float(result[metric]), 'seconds': time.time() - t0}
+
+def crash_objective(params:dict, budget:int, checkpoint:str, data:dict) -> dict:
+    """
+    mlp_objective, except that the worker dies when params['crash'] is set, like a trial killed by the oom killer.
+    """
+    if params.get('crash'):
+        os._exit(1)
+    return mlp_objective(params=params, budget=budget, checkpoint=checkpoint, data=data)
 
+def make_classification_data(n:int = 20000, dim:int = 32, classes:int = 4, seed:int = 0) -> Dict[str, np.ndarray]:
+    """
+    Points labelled by a random two layer network, split into train and validation.
+    """
+    rng = np.random.default_rng(seed)
+    x = rng.standard_normal((n, dim)).astype(np.float32)
+    w1 = rng.standard_normal((dim, 64)).astype(np.float32)
+    w2 = rng.standard_normal((64, classes)).astype(np.float32)
+    y = np.argmax(np.tanh(x @ w1) @ w2, axis=1)
+    split = int(n * 0.8)
+    return {'x_train': x[:split], 'y_train': y[:split], 'x_val': x[split:], 'y_val': y[split:]}
 
+def mlp_objective(params:dict, budget:int, checkpoint:str, data:dict, steps_per_budget:int = 50) -> dict:
+    """
+    A one hidden layer classifier trained with sgd for budget * steps_per_budget steps, returns the validation loss.
+    """
+    x, y = data['x_train'], data['y_train']
+    dim, classes = x.shape[1], int(y.max()) + 1
+    rng = np.random.default_rng(0)
+    if os.path.exists(checkpoint):
+        state = dict(np.load(checkpoint))
+    else:
+        state = {'w1': (rng.standard_normal((dim, params['hidden'])) / np.sqrt(dim)).astype(np.float32),
+                 'w2': (rng.standard_normal((params['hidden'], classes)) / np.sqrt(params['hidden'])).astype(np.float32),
+                 'step': np.array(0)}
+    w1, w2 = state['w1'], state['w2']
+    lr, wd, batch_size = params['lr'], params['weight_decay'], params['batch_size']
+    def forward(xb):
+        h = np.maximum(xb @ w1, 0)
+        logits = h @ w2
+        logits -= logits.max(axis=1, keepdims=True)
+        p = np.exp(logits)
+        return h, p / p.sum(axis=1, keepdims=True)
+    for step in range(int(state['step']), budget * steps_per_budget):
+        idx = np.random.default_rng(step).integers(0, len(x), batch_size)
+        xb, yb = np.asarray(x[idx]), np.asarray(y[idx])
+        h, p = forward(xb)
+        p[np.arange(batch_size), yb] -= 1
+        grad_w2 = h.T @ p / batch_size + wd * w2
+        grad_h = (p @ w2.T) * (h > 0)
+        grad_w1 = xb.T @ grad_h / batch_size + wd * w1
+        w1 -= lr * grad_w1
+        w2 -= lr * grad_w2
+    np.savez(checkpoint, w1=w1, w2=w2, step=np.array(budget * steps_per_budget))
+    _, p = forward(np.asarray(data['x_val']))
+    loss = -np.mean(np.log(p[np.arange(len(p)), np.asarray(data['y_val'])] + 1e-9))
+    return {'loss': float(loss)}